@@ -0,0 +1,119 @@
+"""服务冷启动与/models接口基准测试
+
+运行方式：python benchmarks/bench_cold_start.py [--runs 5] [--requests 200] [--top 15] [--output result.json]
+
+- import：全新解释器中导入应用（main）的耗时
+- ready：启动服务进程到/models首次返回200的耗时（新副本可接收请求前的时间）
+- models_200 / models_304：/models完整响应与携带If-None-Match的条件请求延迟
+--top大于0时额外列出导入耗时最多的模块（python -X importtime，累计耗时）。
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from common import summarize, write_result
+from load_test import BENCHMARK_DIR, SERVER_DIR, free_port, start_process
+
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+
+def measure_import(runs: int) -> list:
+    """在全新解释器中导入应用，返回每次耗时（毫秒）；工作目录为临时目录，日志和数据不写入项目目录"""
+    samples = []
+    env = dict(os.environ, PYTHONPATH=SERVER_DIR)
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as cwd:
+            output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=cwd, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+        samples.append(float(output.strip().splitlines()[-1]) * 1000)
+    return samples
+
+def import_profile(top: int) -> list:
+    """python -X importtime的结果中累计耗时最多的模块"""
+    env = dict(os.environ, PYTHONPATH=SERVER_DIR)
+    with tempfile.TemporaryDirectory() as cwd:
+        stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=cwd, env=env,
+                                capture_output=True, text=True, check=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        # 跳过表头行
+        if not self_us.isdigit():
+            continue
+        modules.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    return sorted(modules, key=lambda module: module["cumulative_ms"], reverse=True)[:top]
+
+async def measure_ready(runs: int, requests: int) -> tuple:
+    """启动服务直到/models返回200的耗时，以及最后一次启动后/models的完整响应与条件请求延迟（毫秒）"""
+    ready = []
+    full, conditional = [], []
+    for run in range(runs):
+        port = free_port()
+        url = f"http://127.0.0.1:{port}/models"
+        with tempfile.TemporaryDirectory() as data_dir:
+            start = time.perf_counter()
+            server = start_process([
+                os.path.join(BENCHMARK_DIR, "load_test.py"), "--serve", "--port", str(port),
+                "--upstream", "http://127.0.0.1:9/v1/images/generations", "--data-dir", data_dir
+            ], os.path.join(data_dir, "server.log"))
+            try:
+                async with httpx.AsyncClient() as client:
+                    while True:
+                        if server.poll() is not None:
+                            with open(server.log_path, encoding="utf-8", errors="replace") as f:
+                                raise RuntimeError(f"服务启动失败: {f.read()}")
+                        try:
+                            response = await client.get(url)
+                            if response.status_code == 200:
+                                break
+                        except httpx.TransportError:
+                            pass
+                        await asyncio.sleep(0.01)
+                    ready.append((time.perf_counter() - start) * 1000)
+                    
+                    if run == runs - 1:
+                        etag = response.headers.get("ETag")
+                        for samples, headers in ((full, {}), (conditional, {"If-None-Match": etag or ""})):
+                            for _ in range(requests):
+                                request_start = time.perf_counter()
+                                await client.get(url, headers=headers)
+                                samples.append((time.perf_counter() - request_start) * 1000)
+            finally:
+                server.terminate()
+                try:
+                    server.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+    return ready, full, conditional
+
+def main():
+    parser = argparse.ArgumentParser(description="服务冷启动与/models接口基准测试")
+    parser.add_argument("--runs", type=int, default=5, help="导入与启动的测量次数")
+    parser.add_argument("--requests", type=int, default=200, help="/models延迟测量的请求数")
+    parser.add_argument("--top", type=int, default=0, help="列出导入耗时最多的模块数")
+    parser.add_argument("--output", help="结果同时写入的文件")
+    args = parser.parse_args()
+    
+    results = [{"phase": "import", **summarize(measure_import(args.runs))}]
+    ready, full, conditional = asyncio.run(measure_ready(args.runs, args.requests))
+    results.append({"phase": "ready", **summarize(ready)})
+    results.append({"phase": "models_200", **summarize(full)})
+    results.append({"phase": "models_304", **summarize(conditional)})
+    for result in results:
+        print(f"{result['phase']}: p50 {result['p50']:.2f}ms", file=sys.stderr)
+    
+    params = {"runs": args.runs, "requests": args.requests}
+    if args.top:
+        params["slowest_imports"] = import_profile(args.top)
+    write_result("cold_start", params, results, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""ImageUtils微基准测试：在多个图片尺寸下测量每个函数的单次调用耗时
+
+运行方式：python benchmarks/bench_image_utils.py [--sizes 256x256,1024x1024,2048x2048] [--repeat 5] [--output result.json]
+每个函数自动选择每轮调用次数（单轮不少于--min-time秒），结果为各轮单次耗时（毫秒）的汇总。
+"""
+import argparse
+import asyncio
+import inspect
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from common import make_test_image, parse_size, summarize, write_result
+from PIL import Image
+from utils.executor_utils import ImageExecutor
+from utils.image_utils import ImageUtils
+
+def build_cases(jpeg_bytes: bytes, path: str):
+    """各ImageUtils函数的测试用例：函数名 -> 无参调用"""
+    image = Image.open(BytesIO(jpeg_bytes))
+    image.load()
+    base64_str = ImageUtils.pil_image_to_base64(image, "JPEG")
+    executor = ImageExecutor(thread_workers=2, process_workers=0)
+    loop = asyncio.new_event_loop()
+    
+    def run_async():
+        # 执行器调度开销：在线程池中执行仅解析文件头的操作
+        ImageUtils.executor = executor
+        try:
+            return loop.run_until_complete(ImageUtils.run_async(ImageUtils.probe_image, jpeg_bytes))
+        finally:
+            ImageUtils.executor = None
+    
+    cases = {
+        "run_async": run_async,
+        "bytes_to_pil_image": lambda: ImageUtils.bytes_to_pil_image(jpeg_bytes).load(),
+        "pil_image_to_bytes": lambda: ImageUtils.pil_image_to_bytes(image),
+        "pil_image_to_base64": lambda: ImageUtils.pil_image_to_base64(image),
+        "bytes_to_base64": lambda: ImageUtils.bytes_to_base64(jpeg_bytes),
+        "open_buffer": lambda: ImageUtils.open_buffer(jpeg_bytes),
+        "probe_image": lambda: ImageUtils.probe_image(jpeg_bytes),
+        "probe_image_file": lambda: ImageUtils.probe_image_file(path),
+        "render_variant": lambda: ImageUtils.render_variant(jpeg_bytes, 256, "WEBP", 70),
+        "get_image_size": lambda: ImageUtils.get_image_size(image),
+        "get_image_info": lambda: ImageUtils.get_image_info(image, base64_str, 0),
+        "build_image_info": lambda: ImageUtils.build_image_info(image.width, image.height, "JPEG", base64_str, 0),
+        "get_base64_image_info": lambda: ImageUtils.get_base64_image_info(base64_str, 0),
+        "base64_to_pil_image": lambda: ImageUtils.base64_to_pil_image(base64_str).load()
+    }
+    
+    def close():
+        loop.close()
+        executor.shutdown()
+    return cases, close
+
+def measure(func, repeat: int, min_time: float) -> dict:
+    """自动确定每轮调用次数，返回单次耗时（毫秒）汇总"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) * 1000 / number)
+    return {"calls_per_round": number, **summarize(samples)}
+
+def main():
+    parser = argparse.ArgumentParser(description="ImageUtils微基准测试")
+    parser.add_argument("--sizes", default="256x256,1024x1024,2048x2048", help="逗号分隔的图片尺寸")
+    parser.add_argument("--repeat", type=int, default=5, help="每个函数的测量轮数")
+    parser.add_argument("--min-time", type=float, default=0.05, help="单轮最短时间（秒）")
+    parser.add_argument("--functions", help="只测量指定函数（逗号分隔）")
+    parser.add_argument("--output", help="结果同时写入的文件")
+    args = parser.parse_args()
+    selected = set(args.functions.split(",")) if args.functions else None
+    
+    results = []
+    covered = set()
+    for size in args.sizes.split(","):
+        jpeg_bytes = make_test_image(*parse_size(size))
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+            f.write(jpeg_bytes)
+        cases, close = build_cases(jpeg_bytes, f.name)
+        try:
+            for name, func in cases.items():
+                if selected and name not in selected:
+                    continue
+                covered.add(name)
+                results.append({"function": name, "size": size, "input_bytes": len(jpeg_bytes),
+                                **measure(func, args.repeat, args.min_time)})
+                print(f"{name} {size}: p50 {results[-1]['p50']:.3f}ms", file=sys.stderr)
+        finally:
+            close()
+            os.remove(f.name)
+    
+    # 新增的ImageUtils函数没有用例时在结果中列出，避免遗漏
+    functions = {name for name, _ in inspect.getmembers(ImageUtils, inspect.isfunction) if not name.startswith("_")}
+    write_result("image_utils", {"sizes": args.sizes, "repeat": args.repeat, "min_time": args.min_time,
+                                 "uncovered": sorted(functions - covered) if not selected else []}, results, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""上传图片处理链路基准测试：对比改造前（解码+两次PNG重编码）与直通链路的CPU时间和峰值RSS
+
+运行方式：python benchmarks/bench_upload_pipeline.py [--size 2400x1800] [--requests 5]
+每种链路在独立子进程中运行，以便分别统计峰值RSS。
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from config import Config
+from models.image_input import InputImage
+from services.image_generator import ImageGenerator
+from utils.image_utils import ImageUtils
+
+def make_test_jpeg(width: int, height: int) -> bytes:
+    """生成带噪声的JPEG测试图片（接近真实照片的压缩率）"""
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=95)
+    return buffered.getvalue()
+
+def legacy_pipeline(image_bytes: bytes) -> int:
+    """改造前的链路：Image.open解码、日志预览PNG重编码、上游请求PNG重编码"""
+    image = Image.open(BytesIO(image_bytes))
+    base64_str = ImageUtils.bytes_to_base64(image_bytes)
+    ImageUtils.get_image_info(image, base64_str, 0, Config.IMAGE_BASE64_PREVIEW_LENGTH)
+    payload_image = f"data:image/png;base64,{ImageUtils.pil_image_to_base64(image)}"
+    return len(payload_image)
+
+def passthrough_pipeline(image_bytes: bytes) -> int:
+    """直通链路：仅解析文件头，原始字节base64编码一次，日志与上游请求共用"""
+    image = InputImage.from_bytes(image_bytes)
+    image.get_image_info(0, Config.IMAGE_BASE64_PREVIEW_LENGTH)
+    payload = ImageGenerator(cache=None).build_payload(model=Config.DEFAULT_MODEL, prompt="benchmark", images=[image])
+    return len(payload["image"])
+
+PIPELINES = {
+    "legacy": legacy_pipeline,
+    "passthrough": passthrough_pipeline
+}
+
+def run_pipeline(name: str, width: int, height: int, requests: int) -> dict:
+    """在当前进程中运行指定链路并统计结果"""
+    image_bytes = make_test_jpeg(width, height)
+    pipeline = PIPELINES[name]
+    baseline_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    payload_bytes = 0
+    for _ in range(requests):
+        payload_bytes = pipeline(image_bytes)
+    cpu_seconds = time.process_time() - cpu_start
+    wall_seconds = time.perf_counter() - wall_start
+
+    return {
+        "pipeline": name,
+        "input_bytes": len(image_bytes),
+        "payload_image_bytes": payload_bytes,
+        "requests": requests,
+        "cpu_ms_per_request": cpu_seconds * 1000 / requests,
+        "wall_ms_per_request": wall_seconds * 1000 / requests,
+        "baseline_rss_mb": baseline_rss_kb / 1024,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="上传图片处理链路基准测试")
+    parser.add_argument("--size", default="2400x1800", help="测试图片尺寸，如 2400x1800")
+    parser.add_argument("--requests", type=int, default=5, help="每种链路的请求次数")
+    parser.add_argument("--pipeline", choices=list(PIPELINES), help="仅在当前进程运行指定链路（内部使用）")
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.size.split("x"))
+
+    if args.pipeline:
+        print(json.dumps(run_pipeline(args.pipeline, width, height, args.requests)))
+        return
+
+    results = []
+    for name in PIPELINES:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--pipeline", name,
+             "--size", args.size, "--requests", str(args.requests)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output))
+    print(json.dumps({"benchmark": "upload_pipeline", "size": args.size, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""基准测试公共工具：测试图片生成、分位数统计、进程资源读取和结果输出
+
+各基准测试的结果统一为JSON，包含运行环境信息（提交、Python版本、CPU数），可用compare_results.py对比两次运行。
+"""
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Sequence
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+def make_test_image(width: int, height: int, format: str = "JPEG") -> bytes:
+    """生成带噪声的测试图片（接近真实照片的压缩率）"""
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    buffered = BytesIO()
+    image.save(buffered, format=format, **({"quality": 95} if format == "JPEG" else {}))
+    return buffered.getvalue()
+
+def parse_size(value: str) -> tuple:
+    """解析WxH形式的尺寸"""
+    width, height = (int(v) for v in value.lower().split("x"))
+    return width, height
+
+def percentile(values: Sequence[float], p: float) -> Optional[float]:
+    """最近秩法分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def summarize(values: Sequence[float]) -> Dict[str, Optional[float]]:
+    """耗时样本的汇总（单位与输入一致）"""
+    if not values:
+        return {"count": 0, "mean": None, "min": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "min": min(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values)
+    }
+
+def read_process_stats(pid: int) -> Dict[str, Optional[float]]:
+    """读取进程累计CPU时间（秒）和峰值RSS（MB），仅支持Linux的/proc"""
+    stats = {"cpu_seconds": None, "peak_rss_mb": None, "rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # 进程名可能含空格，从最后一个右括号之后开始解析
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        stats["cpu_seconds"] = (int(fields[11]) + int(fields[12])) / ticks
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    stats["peak_rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith("VmRSS:"):
+                    stats["rss_mb"] = int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return stats
+
+def get_environment() -> Dict[str, Any]:
+    """运行环境信息，便于判断两次结果是否可比"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+def write_result(benchmark: str, params: Dict[str, Any], results: List[Dict[str, Any]],
+                 output: Optional[str] = None) -> Dict[str, Any]:
+    """输出基准测试结果JSON（标准输出，可同时写入文件）"""
+    document = {"benchmark": benchmark, "environment": get_environment(), "params": params, "results": results}
+    text = json.dumps(document, ensure_ascii=False, indent=2)
+    print(text)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    return document
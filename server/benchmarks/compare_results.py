@@ -0,0 +1,63 @@
+"""对比两次基准测试结果，列出各指标的变化，超过阈值的退化以非零状态码退出
+
+运行方式：python benchmarks/compare_results.py baseline.json current.json [--threshold 0.1]
+"""
+import argparse
+import json
+import sys
+
+# 各基准测试的结果标识字段与对比指标：(指标路径, 是否越大越好)
+METRICS = {
+    "image_utils": (("function", "size"), [("p50", False), ("p95", False)]),
+    "upload_pipeline": (("pipeline",), [("cpu_ms_per_request", False), ("peak_rss_mb", False)]),
+    "cold_start": (("phase",), [("p50", False), ("p95", False)]),
+    "load_test": ((), [("throughput_rps", True), ("latency_ms.p50", False), ("latency_ms.p95", False),
+                       ("latency_ms.p99", False), ("server_cpu_ms_per_request", False), ("server_peak_rss_mb", False)])
+}
+
+def get_value(result: dict, path: str):
+    for key in path.split("."):
+        result = result.get(key) if isinstance(result, dict) else None
+    return result
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """返回每个指标的对比行：(标识, 指标, 基线值, 当前值, 变化比例, 是否退化)"""
+    if baseline["benchmark"] != current["benchmark"]:
+        raise ValueError(f"基准测试类型不一致: {baseline['benchmark']} / {current['benchmark']}")
+    keys, metrics = METRICS[baseline["benchmark"]]
+    baseline_results = {tuple(result.get(key) for key in keys): result for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        identity = tuple(result.get(key) for key in keys)
+        previous = baseline_results.get(identity)
+        if previous is None:
+            continue
+        for path, higher_is_better in metrics:
+            old, new = get_value(previous, path), get_value(result, path)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = (-change if higher_is_better else change) > threshold
+            rows.append(("/".join(str(value) for value in identity) or "-", path, old, new, change, regressed))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="对比两次基准测试结果")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.1, help="视为退化的变化比例")
+    args = parser.parse_args()
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    
+    rows = compare(baseline, current, args.threshold)
+    for identity, path, old, new, change, regressed in rows:
+        print(f"{'❌' if regressed else '✅'} {identity:<40} {path:<28} {old:>12.3f} -> {new:>12.3f} ({change:+.1%})")
+    regressions = sum(row[-1] for row in rows)
+    print(f"\n{len(rows)}项指标，{regressions}项退化超过{args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""本地模拟的SiliconFlow图片生成接口（/v1/images/generations），用于负载测试
+
+运行方式：python benchmarks/fake_upstream.py [--port 9100] [--latency lognormal:1.5:0.4]
+    [--rate-limit 0.05] [--error-rate 0.01] [--output base64|url] [--image-size 1024x1024]
+
+延迟分布：fixed:秒、uniform:最小:最大、lognormal:中位数:sigma。
+按--rate-limit的概率返回429（带Retry-After），按--error-rate的概率返回500；
+url模式返回/files/{name}链接，由本服务提供下载。
+"""
+import argparse
+import asyncio
+import base64
+import os
+import random
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from common import make_test_image, parse_size
+
+class LatencyDistribution:
+    """上游推理延迟分布"""
+    
+    def __init__(self, spec: str):
+        kind, *args = spec.split(":")
+        self.kind = kind
+        self.args = [float(arg) for arg in args]
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"不支持的延迟分布: {spec}")
+    
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.args[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.args[0], self.args[1])
+        median, sigma = self.args
+        return rng.lognormvariate(0, sigma) * median
+
+class FakeSiliconFlow:
+    """模拟上游：按配置的延迟、限流和错误概率响应生成请求，并统计请求数"""
+    
+    def __init__(self, latency: str = "fixed:0.5", rate_limit: float = 0.0, error_rate: float = 0.0,
+                 output: str = "base64", image_size: str = "1024x1024", retry_after: float = 1.0,
+                 seed: int = 0):
+        self.latency = LatencyDistribution(latency)
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.output = output
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.image = make_test_image(*parse_size(image_size), format="PNG")
+        self.image_base64 = base64.b64encode(self.image).decode("ascii")
+        self.stats = {"requests": 0, "succeeded": 0, "rate_limited": 0, "errors": 0, "downloads": 0}
+    
+    async def generate(self, request: Request) -> Response:
+        payload = await request.json()
+        self.stats["requests"] += 1
+        roll = self.rng.random()
+        if roll < self.rate_limit:
+            self.stats["rate_limited"] += 1
+            return JSONResponse({"message": "rate limited"}, status_code=429,
+                                headers={"Retry-After": str(self.retry_after)})
+        if roll < self.rate_limit + self.error_rate:
+            self.stats["errors"] += 1
+            return JSONResponse({"message": "internal error"}, status_code=500)
+        
+        latency = self.latency.sample(self.rng)
+        await asyncio.sleep(latency)
+        count = int(payload.get("batch_size") or 1)
+        if self.output == "url":
+            base_url = str(request.base_url).rstrip("/")
+            images = [{"url": f"{base_url}/files/{self.stats['requests']}-{i}.png"} for i in range(count)]
+        else:
+            images = [self.image_base64] * count
+        self.stats["succeeded"] += 1
+        return JSONResponse({
+            "images": images,
+            "timings": {"inference": latency},
+            "seed": payload.get("seed") or self.rng.randint(0, 9999999999)
+        })
+    
+    async def download(self, name: str) -> Response:
+        self.stats["downloads"] += 1
+        return Response(self.image, media_type="image/png")
+    
+    def create_app(self) -> FastAPI:
+        app = FastAPI(title="Fake SiliconFlow")
+        app.add_api_route("/v1/images/generations", self.generate, methods=["POST"])
+        app.add_api_route("/files/{name}", self.download, methods=["GET"])
+        app.add_api_route("/stats", lambda: dict(self.stats), methods=["GET"])
+        return app
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的SiliconFlow图片生成接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default="fixed:0.5", help="延迟分布：fixed:秒、uniform:最小:最大、lognormal:中位数:sigma")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="返回429的概率")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429响应的Retry-After（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回500的概率")
+    parser.add_argument("--output", choices=["base64", "url"], default="base64", help="结果图片形式")
+    parser.add_argument("--image-size", default="1024x1024", help="结果图片尺寸")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子（可复现的延迟与错误序列）")
+    args = parser.parse_args()
+    
+    upstream = FakeSiliconFlow(args.latency, args.rate_limit, args.error_rate, args.output,
+                               args.image_size, args.retry_after, args.seed)
+    uvicorn.run(upstream.create_app(), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""端到端负载测试：启动模拟上游和服务，按固定并发压测/generate-images
+
+运行方式：python benchmarks/load_test.py [--concurrency 16] [--requests 200] [--latency lognormal:0.5:0.3]
+    [--output-mode base64|url] [--response-mode json|url|multipart] [--image-size 1024x768] [--output result.json]
+    [--bulk-concurrency 32 --scheduler-concurrency 8]
+
+报告吞吐量、延迟分位数、状态码分布，以及服务进程的CPU时间和峰值RSS（读取/proc，仅Linux）。
+--bulk-concurrency大于0时，测量期间另有该数量的批量类别（X-Traffic-Class: bulk）客户端持续发送请求，
+结果中的延迟仅统计交互请求，批量请求单独统计（用于验证公平调度下交互请求的延迟分位数）。
+服务在独立子进程中运行（--serve为内部使用的启动方式），配置在导入应用前改为指向模拟上游并使用临时目录。
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from common import make_test_image, parse_size, read_process_stats, summarize, write_result
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCHMARK_DIR)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def serve(port: int, upstream: str, data_dir: str, rate_limit: bool, scheduler_concurrency: int = 0) -> None:
+    """在当前进程中启动服务（修改配置后再导入应用）"""
+    os.chdir(SERVER_DIR)
+    from config import Config
+    Config.API_KEY = "benchmark"
+    Config.API_BASE_URL = upstream
+    Config.UPSTREAM_BACKENDS = []
+    Config.RATE_LIMIT_ENABLED = rate_limit
+    if scheduler_concurrency:
+        Config.SCHEDULER_MAX_CONCURRENT = scheduler_concurrency
+    Config.LOG_PATH = os.path.join(data_dir, "logs", "image_generation.log")
+    Config.JOB_DB_PATH = os.path.join(data_dir, "jobs.db")
+    Config.BATCH_DB_PATH = os.path.join(data_dir, "batches.db")
+    Config.BLOB_STORE_DIR = os.path.join(data_dir, "blobs")
+    import uvicorn
+    from main import app
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+def start_process(args: list, log_path: str) -> subprocess.Popen:
+    """启动子进程，输出写入日志文件（避免管道写满阻塞子进程）"""
+    process = subprocess.Popen([sys.executable, *args], cwd=SERVER_DIR, stdout=subprocess.DEVNULL,
+                               stderr=open(log_path, "wb"))
+    process.log_path = log_path
+    return process
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                with open(process.log_path, encoding="utf-8", errors="replace") as f:
+                    raise RuntimeError(f"进程启动失败: {f.read()}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"等待 {url} 就绪超时")
+
+async def run_load(base_url: str, image: bytes, args: argparse.Namespace) -> dict:
+    """按固定并发发送请求，每个请求使用不同提示词（避免被合并），返回延迟样本和状态码分布"""
+    latencies = []
+    statuses = {}
+    bulk_latencies = []
+    counter = iter(range(args.requests + args.warmup))
+    connections = args.concurrency + args.bulk_concurrency
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        async def post(prompt: str, headers: dict) -> str:
+            data = {"model": args.model, "prompt": prompt, "response_mode": args.response_mode}
+            files = [("files", ("input.jpg", image, "image/jpeg"))]
+            try:
+                response = await client.post("/generate-images", data=data, files=files, headers=headers)
+                await response.aread()
+                return str(response.status_code)
+            except httpx.HTTPError as e:
+                return type(e).__name__
+        
+        async def send(i: int) -> None:
+            prompt = "benchmark" if args.same_prompt else f"benchmark {i}"
+            start = time.perf_counter()
+            status = await post(prompt, {"X-Client-Id": "interactive"})
+            if i >= args.warmup:
+                latencies.append((time.perf_counter() - start) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+        
+        async def worker() -> None:
+            for i in counter:
+                await send(i)
+        
+        async def bulk_worker(worker_id: int) -> None:
+            # 批量客户端在测量期间持续发送请求
+            for i in itertools.count():
+                start = time.perf_counter()
+                await post(f"bulk {worker_id} {i}", {"X-Client-Id": "bulk", "X-Traffic-Class": "bulk"})
+                bulk_latencies.append((time.perf_counter() - start) * 1000)
+        
+        # 预热请求（建立连接、首次导入）不计入结果
+        for i in range(args.warmup):
+            next(counter)
+            await send(i)
+        bulk_tasks = [asyncio.ensure_future(bulk_worker(i)) for i in range(args.bulk_concurrency)]
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+        for task in bulk_tasks:
+            task.cancel()
+        await asyncio.gather(*bulk_tasks, return_exceptions=True)
+    return {"latencies": latencies, "statuses": statuses, "elapsed": elapsed, "bulk_latencies": bulk_latencies}
+
+async def run(args: argparse.Namespace) -> None:
+    upstream_port, server_port = free_port(), free_port()
+    upstream_url = f"http://127.0.0.1:{upstream_port}"
+    server_url = f"http://127.0.0.1:{server_port}"
+    image = make_test_image(*parse_size(args.image_size))
+    
+    with tempfile.TemporaryDirectory() as data_dir:
+        upstream = start_process([
+            os.path.join(BENCHMARK_DIR, "fake_upstream.py"), "--port", str(upstream_port),
+            "--latency", args.latency, "--rate-limit", str(args.upstream_rate_limit),
+            "--error-rate", str(args.upstream_error_rate), "--output", args.output_mode,
+            "--image-size", args.result_size
+        ], os.path.join(data_dir, "upstream.log"))
+        server = start_process([
+            os.path.abspath(__file__), "--serve", "--port", str(server_port),
+            "--upstream", f"{upstream_url}/v1/images/generations", "--data-dir", data_dir,
+            "--scheduler-concurrency", str(args.scheduler_concurrency),
+            *(["--rate-limit"] if args.rate_limit else [])
+        ], os.path.join(data_dir, "server.log"))
+        try:
+            await wait_ready(f"{upstream_url}/stats", upstream)
+            await wait_ready(f"{server_url}/health", server)
+            before = read_process_stats(server.pid)
+            load = await run_load(server_url, image, args)
+            after = read_process_stats(server.pid)
+            async with httpx.AsyncClient() as client:
+                upstream_stats = (await client.get(f"{upstream_url}/stats")).json()
+                scheduler_stats = (await client.get(f"{server_url}/health")).json().get("scheduler")
+        finally:
+            for process in (server, upstream):
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+    
+    cpu_seconds = None
+    if before["cpu_seconds"] is not None and after["cpu_seconds"] is not None:
+        cpu_seconds = after["cpu_seconds"] - before["cpu_seconds"]
+    completed = len(load["latencies"])
+    result = {
+        "requests": completed,
+        "elapsed_seconds": load["elapsed"],
+        "throughput_rps": completed / load["elapsed"] if load["elapsed"] else None,
+        "latency_ms": summarize(load["latencies"]),
+        "statuses": load["statuses"],
+        "server_cpu_seconds": cpu_seconds,
+        "server_cpu_ms_per_request": cpu_seconds * 1000 / completed if cpu_seconds is not None and completed else None,
+        "server_peak_rss_mb": after["peak_rss_mb"],
+        "upstream": upstream_stats
+    }
+    if args.bulk_concurrency:
+        result["bulk_requests"] = len(load["bulk_latencies"])
+        result["bulk_latency_ms"] = summarize(load["bulk_latencies"]) if load["bulk_latencies"] else None
+        result["scheduler"] = scheduler_stats
+    params = {key: value for key, value in vars(args).items() if key not in ("serve", "port", "upstream", "data_dir", "output")}
+    write_result("load_test", params, [result], args.output)
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端负载测试")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--requests", type=int, default=200, help="计入结果的请求数")
+    parser.add_argument("--warmup", type=int, default=5, help="预热请求数")
+    parser.add_argument("--timeout", type=float, default=300.0, help="单个请求超时（秒）")
+    parser.add_argument("--model", default="Qwen/Qwen-Image-Edit-2509")
+    parser.add_argument("--image-size", default="1024x768", help="上传图片尺寸")
+    parser.add_argument("--result-size", default="1024x1024", help="模拟上游返回的图片尺寸")
+    parser.add_argument("--response-mode", choices=["json", "url", "multipart"], default="json")
+    parser.add_argument("--same-prompt", action="store_true", help="所有请求使用相同提示词（测试请求合并）")
+    parser.add_argument("--latency", default="lognormal:0.5:0.3", help="模拟上游延迟分布")
+    parser.add_argument("--upstream-rate-limit", type=float, default=0.0, help="模拟上游返回429的概率")
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0, help="模拟上游返回500的概率")
+    parser.add_argument("--output-mode", choices=["base64", "url"], default="base64", help="模拟上游的结果形式")
+    parser.add_argument("--rate-limit", action="store_true", help="保留服务端的上游速率控制（默认关闭以测量服务本身）")
+    parser.add_argument("--bulk-concurrency", type=int, default=0, help="测量期间同时运行的批量类别客户端数")
+    parser.add_argument("--scheduler-concurrency", type=int, default=0, help="服务端公平调度的上游并发名额（0为默认配置）")
+    parser.add_argument("--output", help="结果同时写入的文件")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--upstream", help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.serve:
+        serve(args.port, args.upstream, args.data_dir, args.rate_limit, args.scheduler_concurrency)
+    else:
+        asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
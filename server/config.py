@@ -20,6 +20,191 @@ class Config:
         "Qwen-Image": ["1328x1328", "1664x928", "928x1664", "1472x1140", "1140x1472", "1584x1056", "1056x1584"]
     }
     
+    # 模型能力配置（启动时构建为不可变的模型注册表，/models、参数校验和上游请求体共用）
+    # type：模型类型；size_family：可用尺寸与预处理策略分组；custom_size：是否支持image_size参数；
+    # image_slots：参考图片依次对应的请求字段；params：传给上游的模型参数（取值范围见MODEL_PARAM_RANGES）
+    # AVAILABLE_MODELS中未在此配置的模型按名称前缀推断（Kwai-Kolors/为Kolor分组，其余为Qwen-Image分组）
+    MODEL_SPECS = {
+        "Qwen/Qwen-Image-Edit-2509": {"type": "image_edit", "size_family": "Qwen-Image", "custom_size": False,
+                                      "image_slots": ["image", "image2", "image3"], "params": ["cfg"]},
+        "Qwen/Qwen-Image-Edit": {"type": "image_edit", "size_family": "Qwen-Image", "custom_size": False,
+                                 "image_slots": ["image"], "params": ["cfg"]},
+        "Kwai-Kolors/Kolors": {"type": "image_generation", "size_family": "Kolor", "custom_size": True,
+                               "image_slots": ["image"], "params": ["batch_size", "num_inference_steps", "guidance_scale"]}
+    }
+    MODEL_PARAM_RANGES = {  # 生成参数的默认值与取值范围
+        "batch_size": {"default": 1, "min": 1, "max": 4},
+        "seed": {"default": None, "min": 0, "max": 9999999999},
+        "num_inference_steps": {"default": 20, "min": 1, "max": 100},
+        "guidance_scale": {"default": 7.5, "min": 0.0, "max": 20.0},
+        "cfg": {"default": 4.0, "min": 0.1, "max": 20.0}
+    }
+    
+    # 上游HTTP连接池配置
+    HTTP_POOL_SIZE = 64  # 连接池最大连接数（决定单个worker可同时进行的上游请求数）
+    HTTP_MAX_KEEPALIVE = 32  # 最大保活连接数
+    HTTP_KEEPALIVE_EXPIRY = 60.0  # 保活连接空闲过期时间（秒）
+    HTTP2_ENABLED = True  # 启用HTTP/2（需安装h2，未安装时自动回退HTTP/1.1）
+    HTTP_CONNECT_TIMEOUT = 10.0  # 建立连接超时（秒）
+    HTTP_READ_TIMEOUT = 180.0  # 读取响应超时（秒），需覆盖上游推理时间
+    HTTP_WRITE_TIMEOUT = 30.0  # 发送请求超时（秒）
+    HTTP_POOL_TIMEOUT = 30.0  # 等待连接池空闲连接超时（秒）
+    
+    # 生成结果缓存配置（仅对固定种子的请求生效）
+    RESULT_CACHE_ENABLED = True
+    RESULT_CACHE_MEMORY_MAX_BYTES = 256 * 1024 * 1024  # 内存层字节上限
+    RESULT_CACHE_DISK_DIR = None  # 磁盘层目录，None表示不启用，如 os.path.join(os.getcwd(), "cache", "results")
+    RESULT_CACHE_DISK_TTL_SECONDS = 3600  # 缓存过期时间（秒，内存层与磁盘层共用），上游返回URL时不应超过URL有效期
+    
+    # 并发相同请求合并配置
+    SINGLE_FLIGHT_ENABLED = True
+    SINGLE_FLIGHT_SEEDED_ONLY = False  # 为True时仅合并固定种子的请求（未固定种子的重复请求各自生成）
+    
+    # 上传图片预处理配置
+    IMAGE_PREPROCESS_ENABLED = True
+    IMAGE_PREPROCESS_IN_PROCESS = True  # 在进程池中执行（进程池未启用时回退到线程池）
+    IMAGE_PREPROCESS_POLICIES = {
+        # max_edge为None时取该分组可用尺寸中的最大边长；format可选auto/JPEG/WEBP/PNG（auto：有透明通道用PNG，否则JPEG）
+        "Kolor": {"max_edge": None, "format": "auto", "quality": 90, "strip_metadata": True},
+        "Qwen-Image": {"max_edge": None, "format": "auto", "quality": 92, "strip_metadata": True}
+    }
+    
+    # 图片处理执行器配置
+    EXECUTOR_THREAD_WORKERS = 8  # 线程池大小（编解码、base64等释放GIL的操作）
+    EXECUTOR_PROCESS_WORKERS = 2  # 进程池大小（缩放等重型变换），0表示不启用进程池
+    EXECUTOR_MAX_QUEUE = 64  # 每个池的排队任务上限，超出时请求在事件循环上等待
+    LOOP_LAG_INTERVAL_SECONDS = 0.5  # 事件循环延迟采样间隔（秒）
+    
+    # 异步任务配置
+    JOB_WORKERS = 4  # 任务工作协程数
+    JOB_QUEUE_MAX_SIZE = 200  # 排队任务上限，超出时拒绝提交
+    JOB_STORE_BACKEND = "sqlite"  # 任务存储后端：sqlite/memory
+    JOB_DB_PATH = os.path.join(os.getcwd(), "data", "jobs.db")
+    JOB_RESULT_TTL_SECONDS = 24 * 3600  # 已结束任务的保留时间（秒）
+    JOB_PURGE_INTERVAL_SECONDS = 600  # 过期任务清理间隔（秒）
+    
+    # 上游速率控制配置（令牌桶按每分钟图片数计，收到429后按AIMD调整）
+    RATE_LIMIT_ENABLED = True
+    RATE_LIMIT_KEY_RPM = 60  # 每个API密钥每分钟上限
+    RATE_LIMIT_MODEL_RPM = {  # 每个API密钥下各模型每分钟上限，default用于未列出的模型
+        "default": 60
+    }
+    RATE_LIMIT_BURST = 4  # 令牌桶容量（允许的突发量）
+    RATE_LIMIT_MAX_IN_FLIGHT = 32  # 同时进行的上游请求上限
+    RATE_LIMIT_MIN_RPM = 1  # 自适应降速的下限
+    RATE_LIMIT_AIMD_INCREASE = 1  # 每次成功后增加的每分钟速率
+    RATE_LIMIT_AIMD_DECREASE = 0.5  # 每次429后速率乘以该系数
+    RATE_LIMIT_MAX_RETRIES = 3  # 收到429后重新排队的次数
+    RATE_LIMIT_MAX_WAIT_SECONDS = 120  # 排队等待上限（秒），超出时返回429
+    
+    # 上游调用公平调度配置（按流量类别和客户端排队，加权差额轮询分配上游并发名额）
+    SCHEDULER_ENABLED = True
+    SCHEDULER_MAX_CONCURRENT = RATE_LIMIT_MAX_IN_FLIGHT  # 同时调度到上游的请求数
+    SCHEDULER_CLASSES = {  # 流量类别 -> 权重，排队时按权重分配上游名额，空闲名额可被任意类别使用
+        "interactive": 8,
+        "bulk": 1
+    }
+    SCHEDULER_DEFAULT_CLASS = "interactive"  # 未指定类别的调用（同步接口）
+    SCHEDULER_BULK_CLASS = "bulk"  # 异步任务和批量编辑的类别
+    SCHEDULER_CLIENTS = {}  # 客户端标识 -> {"weight": 类别内权重, "class": 固定类别}，如 {"id:nightly-script": {"class": "bulk"}}
+    SCHEDULER_TOKEN_HEADERS = ("Authorization", "X-API-Key")  # 按令牌区分客户端（标识为令牌摘要，不保存原值）
+    SCHEDULER_CLIENT_HEADER = "X-Client-Id"  # 无令牌时按该请求头区分客户端，都没有时按客户端IP
+    SCHEDULER_CLASS_HEADER = "X-Traffic-Class"  # 客户端可通过该请求头降低（不能提高）自己的类别
+    SCHEDULER_QUANTUM = 1  # 每轮每单位权重的额度（按图片数计）
+    SCHEDULER_MAX_QUEUED_PER_CLIENT = 200  # 单个客户端排队请求上限，超出时返回429
+    SCHEDULER_WAIT_SAMPLES = 1024  # 每个类别保留的最近排队时间样本数（用于/health中的分位数）
+    
+    # 上游后端池配置（多个密钥/端点负载均衡），为空时使用上方的API_KEY和API_BASE_URL
+    UPSTREAM_BACKENDS = []  # 如 [{"name": "sf-1", "base_url": API_BASE_URL, "api_key": "...", "weight": 1}]
+    UPSTREAM_ROUTING = "least_outstanding"  # 路由策略：least_outstanding（最少在途请求）或 ewma（延迟加权）
+    UPSTREAM_EWMA_ALPHA = 0.3  # 延迟指数加权平均系数
+    UPSTREAM_BREAKER_FAILURES = 5  # 连续失败达到该次数时熔断后端
+    UPSTREAM_BREAKER_COOLDOWN_SECONDS = 30  # 熔断后经过该时间放行一个探测请求（秒）
+    
+    # 上游调用韧性配置（截止时间、重试、对冲请求）
+    REQUEST_DEADLINE_SECONDS = 240  # 默认请求截止时间（秒），客户端可通过请求头缩短
+    REQUEST_DEADLINE_HEADER = "X-Request-Timeout"  # 客户端指定截止时间（秒）的请求头
+    UPSTREAM_RETRY_MAX_ATTEMPTS = 3  # 固定种子请求遇到传输错误或5xx时的最大尝试次数
+    UPSTREAM_RETRY_BASE_DELAY = 0.5  # 指数退避的初始等待（秒）
+    UPSTREAM_RETRY_MAX_DELAY = 8.0  # 指数退避的最大等待（秒）
+    UPSTREAM_HEDGING_ENABLED = False  # 固定种子请求超过p95延迟未返回时发送对冲请求（会增加上游调用量）
+    UPSTREAM_HEDGING_PERCENTILE = 95  # 触发对冲请求的延迟百分位
+    UPSTREAM_HEDGING_MIN_SAMPLES = 20  # 延迟样本少于该数量时不发送对冲请求
+    UPSTREAM_LATENCY_WINDOW = 200  # 延迟百分位统计的滑动窗口大小
+    
+    # 结果图片本地存储配置（url响应模式使用）
+    BLOB_STORE_DIR = os.path.join(os.getcwd(), "data", "blobs")
+    BLOB_TTL_SECONDS = 3600  # 图片链接有效期（秒）
+    
+    # 图片衍生版本配置（/images/{blob_id}/variants与/uploads/{handle}/variants，首次请求时生成并缓存）
+    VARIANT_SIZES = (128, 256, 512, 1024)  # 允许的最长边（像素），限制可生成的版本数量
+    VARIANT_QUALITY_LEVELS = {"low": 50, "medium": 70, "high": 85}  # JPEG/WEBP/AVIF质量等级
+    VARIANT_DEFAULT_QUALITY = "medium"
+    VARIANT_FORMATS = ("webp", "avif", "jpeg", "png")  # 允许的输出格式（AVIF需Pillow支持）
+    VARIANT_AUTO_FORMATS = ("avif", "webp")  # format=auto时按Accept请求头依次协商，均不接受时保持原图格式
+    VARIANT_IN_PROCESS = True  # 在进程池中生成（进程池未启用时回退到线程池）
+    VARIANT_CACHE_DIR = os.path.join(os.getcwd(), "data", "variants")
+    VARIANT_CACHE_TTL_SECONDS = 7 * 24 * 3600  # 衍生版本未使用时的保留时间（秒）
+    VARIANT_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 衍生版本磁盘缓存上限（字节），超出时淘汰最久未使用的版本
+    
+    # 结果图片获取配置（上游返回URL时下载到本地图片存储）
+    MATERIALIZE_CHUNK_SIZE = 256 * 1024  # 流式下载的分块大小（字节）
+    MATERIALIZE_PROBE_BYTES = 256 * 1024  # 用于解析图片尺寸的文件头字节数
+    MATERIALIZE_MAX_BYTES = 50 * 1024 * 1024  # 单张结果图片大小上限（字节）
+    
+    # 多候选生成配置（/generate-images的num_variants：输入只预处理和编码一次，按派生种子并发调用上游）
+    NUM_VARIANTS_MAX = 4  # 单个请求的候选数上限
+    
+    # 局部编辑配置（/generate-images的roi或mask参数：只把编辑区域及其周边送上游，结果羽化合成回原图）
+    ROI_PADDING_RATIO = 0.25  # 编辑区域四周保留的上下文边距（相对区域最长边），同时是羽化过渡宽度
+    ROI_MIN_PADDING = 32  # 边距下限（像素）
+    ROI_MIN_CROP_EDGE = 512  # 裁剪区域的最短边下限（像素），区域过小时向四周扩展，保留足够的上下文
+    ROI_OUTPUT_QUALITY = 95  # 原图为JPEG/WEBP时合成结果的编码质量
+    ROI_IN_PROCESS = True  # 裁剪与合成在进程池中执行（进程池未启用时回退到线程池）
+    
+    # 分块编辑配置（tiled=true：大图按模型可用尺寸切分为重叠分块并发编辑，再融合接缝拼接为完整分辨率）
+    TILE_OVERLAP = 128  # 相邻分块的最小重叠（像素），接缝在重叠区域内渐变融合
+    TILE_CONCURRENCY = 4  # 单个请求同时编辑的分块数（上游调用另受公平调度限制）
+    TILE_MAX_TILES = 64  # 单张图片的分块数上限，超出时返回400
+    TILE_MAX_PIXELS = 40_000_000  # 分块编辑输入图片的像素数上限（解码时整张图片在内存中），超出时返回400
+    TILE_BAND_ROWS = 256  # 解码和拼接时每次处理的行数，决定拼接时的内存占用
+    TILE_OUTPUT_QUALITY = 95  # 原图为JPEG/WEBP时拼接结果的编码质量
+    TILE_IN_PROCESS = True  # 解码、分块编码和拼接在进程池中执行（进程池未启用时回退到线程池）
+    TILE_WORK_DIR = None  # 分块中间文件目录，None时使用系统临时目录
+    
+    # 批量编辑配置
+    BATCH_CONCURRENCY = 8  # 单个批量任务同时执行的条目数
+    BATCH_MAX_ITEMS = 10000  # 单个批量任务的条目上限
+    BATCH_MAX_ARCHIVE_BYTES = 512 * 1024 * 1024  # 压缩包解压后的总大小上限（字节，按成员声明的大小在读取前检查），超出返回413
+    BATCH_MAX_REQUEST_BYTES = 512 * 1024 * 1024  # /batch请求体（上传图片与压缩包合计）大小上限（字节），超出返回413
+    BATCH_DB_PATH = os.path.join(os.getcwd(), "data", "batches.db")
+    BATCH_RESULT_TTL_SECONDS = 7 * 24 * 3600  # 批量任务最后更新后的保留时间（秒），期间可继续执行
+    BATCH_PURGE_INTERVAL_SECONDS = 3600  # 过期批量任务清理间隔（秒）
+    
+    # 上传图片读取配置（先校验文件头再读取完整内容，大文件写入临时文件并内存映射）
+    UPLOAD_MAX_FILE_BYTES = 20 * 1024 * 1024  # 单个上传文件大小上限（字节），超出返回413
+    UPLOAD_MAX_REQUEST_BYTES = 60 * 1024 * 1024  # 单个请求上传文件总大小上限（字节），超出返回413
+    UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024  # 请求体上限中为表单字段和multipart分隔符预留的字节数
+    UPLOAD_LIMITED_PATHS = ("/generate-images", "/jobs", "/uploads")  # 按上述上限限制请求体大小的接口
+    UPLOAD_PATH_MAX_BYTES = {"/batch": BATCH_MAX_REQUEST_BYTES}  # 单独设置请求体大小上限的接口
+    UPLOAD_MAX_PIXELS = 50_000_000  # 单张图片像素数上限（按文件头声明的尺寸检查，防止解压炸弹）
+    UPLOAD_ALLOWED_FORMATS = ("PNG", "JPEG", "WEBP", "GIF", "BMP")  # 按文件头魔数识别的允许格式
+    UPLOAD_SNIFF_BYTES = 64 * 1024  # 用于识别格式和解析尺寸的文件头字节数
+    UPLOAD_CHUNK_SIZE = 256 * 1024  # 分块读取大小（字节）
+    UPLOAD_SPOOL_THRESHOLD = 1024 * 1024  # 超过该大小的文件写入临时文件并内存映射，不复制到内存（字节）
+    UPLOAD_SPOOL_DIR = None  # 临时文件目录，None时使用系统临时目录
+    
+    # 参考图片存储配置（/uploads，上传一次后通过句柄重复使用）
+    UPLOAD_STORE_DIR = os.path.join(os.getcwd(), "data", "uploads")
+    UPLOAD_STORE_TTL_SECONDS = 24 * 3600  # 句柄未使用时的有效期（秒），每次使用后重新计时
+    UPLOAD_STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 磁盘占用上限（字节），超出时淘汰最久未使用的图片
+    UPLOAD_STORE_MEMORY_MAX_BYTES = 256 * 1024 * 1024  # 预处理并编码后的参考图片内存缓存上限（字节）
+    
+    # 指标配置（/metrics）
+    METRICS_ENABLED = True  # 是否记录各阶段耗时与载荷大小
+    METRICS_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # 耗时直方图分桶（秒）
+    METRICS_SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 载荷大小直方图分桶（1KB-256MB）
+    
     # 其他配置
     MAX_IMAGES = 3  # 最大支持上传图片数量
     
@@ -28,10 +213,33 @@ class Config:
     PORT = 8000
     DEBUG = True
     
+    # 按需性能剖析配置（/debug/profiles），PROFILE_TOKEN为None时关闭且没有任何额外开销
+    PROFILE_TOKEN = None  # 管理令牌，调用/debug/profiles或剖析单个请求时通过X-Debug-Token请求头提供
+    PROFILE_TOKEN_HEADER = "X-Debug-Token"
+    PROFILE_REQUEST_HEADER = "X-Debug-Profile"  # 值为cpu或memory（同时记录内存分配），携带管理令牌时剖析该次请求
+    PROFILE_PATHS = ("/generate-images",)  # 可剖析的接口
+    PROFILE_MAX_ARMED = 100  # 一次最多预约剖析的请求数
+    PROFILE_MAX_RESULTS = 50  # 内存中保留的剖析结果数
+    PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005  # CPU采样间隔（秒）
+    PROFILE_MAX_DEPTH = 128  # 调用栈最大深度
+    PROFILE_TRACEMALLOC_FRAMES = 16  # tracemalloc记录的调用栈帧数
+    PROFILE_MEMORY_SITES = ("*/utils/image_utils.py", "*/utils/logger_utils.py")  # 内存分配按这些文件中的调用位置归类
+    PROFILE_TOP = 30  # 剖析结果中列出的调用栈和分配位置数
+    
     # 日志配置
     LOG_PATH = os.path.join(os.getcwd(), "logs", "image_generation.log")
     LOG_LEVEL = "INFO"
     LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    LOG_QUEUE_SIZE = 10000  # 日志队列上限（条）
+    LOG_QUEUE_FULL_POLICY = "drop"  # 队列满时的策略：drop（丢弃并计数）或block（短暂阻塞等待）
+    LOG_QUEUE_BLOCK_SECONDS = 0.05  # block策略及ERROR级别日志的最长等待时间
+    LOG_BATCH_SIZE = 256  # 每次合并写入的最大记录数
+    LOG_FLUSH_INTERVAL_SECONDS = 0.5  # 写入线程空闲时的轮询间隔
+    LOG_ROTATE_BYTES = 100 * 1024 * 1024  # 日志文件达到该大小时轮转，0表示不按大小轮转
+    LOG_ROTATE_INTERVAL_SECONDS = 24 * 3600  # 日志文件按时间轮转的周期，0表示不按时间轮转
+    LOG_BACKUP_COUNT = 14  # 保留的轮转备份数
+    LOG_COMPRESS = True  # 轮转后的备份是否gzip压缩
+    LOG_INDEX_PATH = os.path.join(os.getcwd(), "logs", "image_generation.index.db")  # 日志分析索引（python -m utils.log_analytics）
     
     # 图片日志配置
     IMAGE_BASE64_PREVIEW_LENGTH = 100  # 图片base64预览长度
@@ -1,29 +1,111 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from typing import List, Optional
-from fastapi.responses import JSONResponse
-from PIL import Image
-import io
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Depends, Request
+from typing import List, Optional, Dict, Any, Tuple
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response, PlainTextResponse
+from pydantic import ValidationError
+from contextlib import asynccontextmanager
+import asyncio
 import time
 
 from config import Config
 from models.image_request import ImageGenerationRequest
-from models.image_response import ImageGenerationResponse, GeneratedImage
+from models.image_input import InputImage
+from models.image_response import ImageGenerationResponse
+from models.job_response import JobSubmitResponse, JobStatusResponse
+from models.model_registry import ModelRegistry
+from models.roi_edit import RoiEdit
+from models.upload_response import UploadedImage, UploadResponse
+from services.backend_pool import BackendUnavailableError
+from services.batch_manager import BatchManager
+from services.batch_store import BatchStore
+from services.blob_store import BlobStore
+from services.fair_scheduler import SchedulerQueueFullError, TrafficClient
+from services.generation_pipeline import GenerationPipeline
 from services.image_generator import ImageGenerator
+from services.image_preprocessor import ImagePreprocessor
+from services.job_manager import JobManager, JobQueueFullError
+from services.job_store import create_job_store
+from services.rate_governor import UpstreamRateLimitError
+from services.reference_store import ReferenceNotFoundError, ReferenceStore
+from services.request_profiler import ProfilingDisabledError, ProfilingMiddleware, RequestProfiler
+from services.resilience import Deadline, DeadlineExceededError
+from services.upload_reader import RequestSizeLimiter, UploadReader, UploadRejectedError
+from services.variant_renderer import VariantRenderer
+from utils.executor_utils import ImageExecutor, LoopLagMonitor
 from utils.image_utils import ImageUtils
 from utils.logger_utils import LoggerUtils
+from utils.metrics_utils import MetricsUtils
+from utils.response_utils import ResponseUtils
+from utils.roi_utils import RoiUtils
+
+# 模型注册表（启动时构建一次，/models响应体预先计算）
+model_registry = ModelRegistry.get_default()
+
+# 初始化图片生成器
+image_generator = ImageGenerator()
+
+# 初始化上传图片预处理器
+image_preprocessor = ImagePreprocessor()
+
+# 上传图片读取（大小限制、文件头校验、大文件内存映射）
+upload_reader = UploadReader()
+
+# /batch上传图片读取（请求总大小使用批量任务的上限）
+batch_upload_reader = UploadReader(max_request_bytes=Config.BATCH_MAX_REQUEST_BYTES)
+
+# 参考图片存储（/uploads句柄）
+reference_store = ReferenceStore(image_preprocessor)
+
+# 图片处理执行器与事件循环延迟监控
+ImageUtils.executor = ImageExecutor()
+loop_lag_monitor = LoopLagMonitor()
+
+# 初始化日志记录器
+logger = LoggerUtils.get_default_logger()
+
+# 结果图片本地存储（url响应模式）
+blob_store = BlobStore()
+
+# 图片衍生版本（缩略图、格式转换）
+variant_renderer = VariantRenderer()
+
+# 按需请求剖析（/debug/profiles，未配置PROFILE_TOKEN时关闭）
+request_profiler = RequestProfiler()
+
+# 图片生成流程（同步接口与异步任务共用）
+generation_pipeline = GenerationPipeline(image_generator, image_preprocessor, logger, blob_store)
+
+# 异步任务管理器
+job_manager = JobManager(create_job_store(), generation_pipeline)
+
+# 批量编辑管理器
+batch_manager = BatchManager(BatchStore(), generation_pipeline)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动事件循环监控和任务工作协程，退出时关闭上游连接池和图片处理执行器，并写完排队中的日志"""
+    loop_lag_monitor.start()
+    await job_manager.start()
+    yield
+    await job_manager.stop()
+    batch_manager.store.close()
+    await loop_lag_monitor.stop()
+    await image_generator.aclose()
+    ImageUtils.executor.shutdown()
+    await asyncio.to_thread(LoggerUtils.flush_logger, logger)
 
 # 创建FastAPI应用
 app = FastAPI(
     title="SiliconFlow Image Generation API",
     description="基于SiliconFlow API的图片生成服务",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-# 初始化图片生成器
-image_generator = ImageGenerator()
+# 上传接口的请求体大小限制（在解析表单前拒绝超大请求）
+app.add_middleware(RequestSizeLimiter)
 
-# 初始化日志记录器
-logger = LoggerUtils.get_default_logger()
+# 按需请求剖析（最外层，覆盖读取上传和发送响应）
+app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
 
 @app.get("/health", summary="健康检查")
 async def health_check():
@@ -31,44 +113,37 @@ async def health_check():
     return {
         "status": "healthy",
         "service": "SiliconFlow Image Generation API",
-        "available_models": Config.AVAILABLE_MODELS
+        "available_models": list(model_registry.names),
+        "upstream_connections": image_generator.get_connection_stats(),
+        "upstream_backends": image_generator.backend_pool.get_stats(),
+        "result_cache": image_generator.cache.get_stats() if image_generator.cache else None,
+        "single_flight": image_generator.single_flight.get_stats() if image_generator.single_flight else None,
+        "executor": ImageUtils.executor.get_stats(),
+        "event_loop_lag": loop_lag_monitor.get_stats(),
+        "jobs": job_manager.get_stats(),
+        "batches": batch_manager.get_stats(),
+        "rate_governor": image_generator.rate_governor.get_stats() if image_generator.rate_governor else None,
+        "scheduler": image_generator.scheduler.get_stats() if image_generator.scheduler else None,
+        "resilience": image_generator.resilience.get_stats(),
+        "blob_store": blob_store.get_stats(),
+        "uploads": upload_reader.get_stats(),
+        "reference_store": reference_store.get_stats(),
+        "variants": variant_renderer.get_stats(),
+        "materializer": generation_pipeline.materializer.get_stats(),
+        "profiler": request_profiler.get_stats(),
+        "logging": LoggerUtils.get_logger_stats(logger)
     }
 
 @app.get("/models", summary="获取可用模型列表")
-async def get_models():
-    """获取可用模型列表接口，返回所有支持的模型信息，包括模型名称和默认参数"""
-    models_info = []
-    
-    for model in Config.AVAILABLE_MODELS:
-        # 根据模型类型确定支持的图片尺寸
-        if model.startswith("Kwai-Kolors/"):
-            available_sizes = Config.AVAILABLE_IMAGE_SIZES.get("Kolor", [])
-            model_type = "image_generation"
-        elif model in ["Qwen/Qwen-Image-Edit-2509", "Qwen/Qwen-Image-Edit"]:
-            available_sizes = []  # 编辑模型不支持自定义尺寸
-            model_type = "image_edit"
-        else:
-            available_sizes = Config.AVAILABLE_IMAGE_SIZES.get("Qwen-Image", [])
-            model_type = "image_generation"
-        
-        models_info.append({
-            "model_name": model,
-            "model_type": model_type,
-            "available_sizes": available_sizes,
-            "is_default": model == Config.DEFAULT_MODEL
-        })
-    
-    return {
-        "models": models_info,
-        "total": len(models_info)
-    }
+async def get_models(request: Request):
+    """获取可用模型列表接口，返回所有支持的模型信息，包括模型名称、可用尺寸、参考图片数和参数取值范围；
+    响应体在启动时预先计算，支持ETag/If-None-Match条件请求"""
+    headers = {"ETag": model_registry.models_etag, "Cache-Control": "no-cache"}
+    if ResponseUtils.etag_matches(request.headers.get("If-None-Match"), model_registry.models_etag):
+        return Response(status_code=304, headers=headers)
+    return Response(model_registry.models_body, media_type="application/json", headers=headers)
 
-@app.post("/generate-images", response_model=ImageGenerationResponse, summary="生成图片")
-async def generate_images(
-    # 文件上传参数
-    files: List[UploadFile] = File(..., description="上传的图片文件列表"),
-    
-    # 文本参数
+async def generation_params(
     model: str = Form(Config.DEFAULT_MODEL, description="模型名称"),
     prompt: str = Form(..., description="提示词"),
     negative_prompt: str = Form("", description="负面提示词"),
@@ -78,11 +153,143 @@ async def generate_images(
     num_inference_steps: int = Form(20, description="推理步数"),
     guidance_scale: float = Form(7.5, description="引导比例"),
     cfg: float = Form(4.0, description="CFG值")
+) -> Dict[str, Any]:
+    """解析图片生成表单参数（/generate-images与/jobs共用）"""
+    # 验证模型参数
+    try:
+        model_registry.validate(model)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {
+        "model": model,
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "image_size": image_size,
+        "batch_size": batch_size,
+        "seed": seed,
+        "num_inference_steps": num_inference_steps,
+        "guidance_scale": guidance_scale,
+        "cfg": cfg
+    }
+
+def traffic_client(request: Request, default_class: str) -> Optional[TrafficClient]:
+    """上游公平调度使用的客户端身份（令牌、X-Client-Id或IP）和流量类别"""
+    if image_generator.scheduler is None:
+        return None
+    host = request.client.host if request.client else None
+    return image_generator.scheduler.identify(request.headers, host, default_class)
+
+async def read_upload_images(files: List[UploadFile], reader: UploadReader = upload_reader) -> List[InputImage]:
+    """读取上传的图片（先按大小和文件头校验，仅解析文件头获取尺寸和格式，大文件不复制到内存）"""
+    try:
+        return await reader.read_all(files)
+    except UploadRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+async def read_input_images(files: Optional[List[UploadFile]], handles: Optional[List[str]],
+                            model: str) -> List[InputImage]:
+    """获取输入图片：参考图片句柄在前（已按模型预处理和编码），上传文件在后"""
+    if not files and not handles:
+        raise HTTPException(status_code=400, detail="必须上传图片文件或提供参考图片句柄")
+    images = []
+    if handles:
+        try:
+            images.extend(await reference_store.resolve(handles, model))
+        except ReferenceNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+    if files:
+        images.extend(await read_upload_images(files))
+    return images
+
+async def use_original_first(images: List[InputImage], handles: Optional[List[str]]) -> List[InputImage]:
+    """第一张为参考图片时替换为磁盘上未经预处理的原图（局部编辑和分块编辑需要完整分辨率）"""
+    if not handles:
+        return images
+    try:
+        return [await reference_store.get_original(handles[0])] + images[1:]
+    except ReferenceNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+async def prepare_roi(images: List[InputImage], handles: Optional[List[str]], roi: Optional[str],
+                      mask: Optional[UploadFile]) -> Tuple[List[InputImage], RoiEdit]:
+    """局部编辑：裁剪第一张图片的编辑区域（第一张为参考图片时使用磁盘上未经预处理的原图），区域无效时返回400"""
+    images = await use_original_first(images, handles)
+    mask_image = (await read_upload_images([mask]))[0] if mask is not None else None
+    try:
+        box = RoiUtils.parse_box(roi) if roi is not None else None
+        return await generation_pipeline.prepare_roi(images, box, mask_image)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def prepare_tiled(images: List[InputImage], handles: Optional[List[str]], model: str) -> List[InputImage]:
+    """分块编辑：使用第一张图片的完整分辨率原图，按文件头尺寸预先检查分块数，超出上限时返回400"""
+    images = await use_original_first(images, handles)
+    try:
+        GenerationPipeline.plan_tiles(images[0].width, images[0].height, model)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return images
+
+@app.post("/uploads", response_model=UploadResponse, summary="上传参考图片")
+async def upload_references(
+    files: List[UploadFile] = File(..., description="上传的参考图片文件列表"),
+    model: Optional[str] = Form(None, description="预先按该模型预处理和编码（可选）")
+):
+    """
+    上传参考图片并返回句柄，之后可在/generate-images和/jobs的handles参数中代替上传文件重复使用
+    
+    - 图片按内容寻址保存，相同图片返回相同句柄
+    - 句柄在有效期内未使用时过期，每次使用后重新计时；超出存储容量时淘汰最久未使用的图片
+    - 指定model时立即完成该模型的预处理和编码，首次生成无需等待
+    """
+    if model is not None and model not in model_registry:
+        raise HTTPException(status_code=400, detail=f"模型必须是以下之一: {', '.join(model_registry.names)}")
+    
+    uploads = []
+    for image in await read_upload_images(files):
+        handle = await reference_store.put(image, model)
+        uploads.append(UploadedImage(
+            handle=handle,
+            filename=image.filename,
+            width=image.width,
+            height=image.height,
+            format=image.format,
+            mime_type=image.mime_type,
+            bytes=len(image.data),
+            expires_in=Config.UPLOAD_STORE_TTL_SECONDS
+        ))
+    return UploadResponse(uploads=uploads)
+
+@app.post("/generate-images", response_model=ImageGenerationResponse, summary="生成图片")
+async def generate_images(
+    request: Request,
+    
+    # 文件上传参数（与参考图片句柄至少提供一个）
+    files: Optional[List[UploadFile]] = File(None, description="上传的图片文件列表"),
+    handles: Optional[List[str]] = Form(None, description="/uploads返回的参考图片句柄，排在上传文件之前"),
+    
+    # 文本参数（model, prompt, negative_prompt, image_size, batch_size, seed, num_inference_steps, guidance_scale, cfg）
+    params: Dict[str, Any] = Depends(generation_params),
+    
+    # 响应模式
+    response_mode: str = Form(ResponseUtils.MODE_JSON, description="响应模式：json、multipart或url"),
+    
+    # 多候选参数：按派生种子并发生成多个候选
+    num_variants: int = Form(1, description="候选数量"),
+    
+    # 局部编辑参数（可选）
+    roi: Optional[str] = Form(None, description="局部编辑区域“x,y,宽,高”（像素，按第一张图片计）"),
+    mask: Optional[UploadFile] = File(None, description="局部编辑遮罩图片（白色为编辑区域）"),
+    
+    # 分块编辑参数：大图按完整分辨率分块编辑后拼接
+    tiled: bool = Form(False, description="分块编辑第一张图片")
 ):
     """
     生成图片API
     
-    - **files**: 上传的图片文件列表，支持PNG、JPG、JPEG格式
+    - **files**: 上传的图片文件列表，支持PNG、JPEG、WEBP、GIF、BMP格式（按文件内容识别）
+    - **handles**: /uploads返回的参考图片句柄（可重复），与files至少提供一个，句柄不存在或已过期时返回404
     - **model**: 模型名称，可选值：Qwen/Qwen-Image-Edit-2509, Qwen/Qwen-Image-Edit, Kwai-Kolors/Kolors
     - **prompt**: 提示词
     - **negative_prompt**: 负面提示词
@@ -92,139 +299,118 @@ async def generate_images(
     - **num_inference_steps**: 推理步数，1-100
     - **guidance_scale**: 引导比例，0.0-20.0（仅Kolor模型）
     - **cfg**: CFG值，0.1-20.0（仅Qwen模型）
+    - **response_mode**: 响应模式，json（默认，base64嵌入JSON）、multipart（multipart/mixed流式返回原始图片）或url（返回/images/{id}短期链接）
+    - **num_variants**: 候选数量，1-4，大于1时输入只编码一次，按种子seed、seed+1……并发生成（未指定seed时随机选取），
+      json/url模式在variants中返回各候选的种子和耗时，multipart模式按完成顺序流式返回各候选
+    - **roi**: 局部编辑区域“x,y,宽,高”，只把该区域及其周边送上游编辑，结果羽化合成回完整分辨率的第一张图片
+    - **mask**: 局部编辑遮罩（白色为编辑区域，尺寸不同时拉伸到原图尺寸），可与roi同时使用（取交集）
+    - **tiled**: 分块编辑，第一张图片按完整分辨率切分为重叠分块（模型可用尺寸），以相同种子并发编辑后融合接缝拼接，
+      返回与原图尺寸相同的一张图片；不能与roi、mask或num_variants同时使用
+    
+    可通过请求头X-Request-Timeout（秒）缩短请求截止时间，超时返回504；
+    上游调用按客户端（Authorization/X-API-Key令牌、X-Client-Id或IP）公平调度，可通过X-Traffic-Class: bulk降低优先级
     """
-    # 记录API调用开始时间
+    # 记录API调用开始时间，并确定请求截止时间
     start_time = time.time()
+    deadline = Deadline.from_header(request.headers.get(Config.REQUEST_DEADLINE_HEADER))
+    
+    # 验证响应模式
+    if response_mode not in ResponseUtils.RESPONSE_MODES:
+        raise HTTPException(status_code=400, detail=f"响应模式必须是以下之一: {', '.join(ResponseUtils.RESPONSE_MODES)}")
+    if not 1 <= num_variants <= Config.NUM_VARIANTS_MAX:
+        raise HTTPException(status_code=400, detail=f"候选数量必须在1-{Config.NUM_VARIANTS_MAX}之间")
+    if tiled and (roi is not None or mask is not None or num_variants > 1):
+        raise HTTPException(status_code=400, detail="分块编辑不能与roi、mask或num_variants同时使用")
     
-    # 初始化日志数据
-    input_images_log = []
-    output_images_log = []
-    status = "success"
-    error_message = None
+    # 获取参考图片并读取上传的图片
+    images = await read_input_images(files, handles, params["model"])
+    client = traffic_client(request, Config.SCHEDULER_DEFAULT_CLASS)
+    roi_edit = None
+    if roi is not None or mask is not None:
+        images, roi_edit = await prepare_roi(images, handles, roi, mask)
+    if tiled:
+        images = await prepare_tiled(images, handles, params["model"])
     
+    MetricsUtils.in_flight.inc(kind="requests")
     try:
-        # 验证模型参数
-        if model not in Config.AVAILABLE_MODELS:
-            raise HTTPException(status_code=400, detail=f"模型必须是以下之一: {', '.join(Config.AVAILABLE_MODELS)}")
-        
-        # 读取上传的图片
-        images = []
-        for i, file in enumerate(files):
-            if not file.content_type.startswith("image/"):
-                raise HTTPException(status_code=400, detail=f"文件 {file.filename} 不是有效的图片格式")
-            
-            # 读取文件内容
-            image_bytes = await file.read()
-            image = Image.open(io.BytesIO(image_bytes))
-            images.append(image)
-            
-            # 转换为base64
-            base64_str = ImageUtils.bytes_to_base64(image_bytes)
-            
-            # 记录输入图片信息
-            image_info = ImageUtils.get_image_info(image, base64_str, i, Config.IMAGE_BASE64_PREVIEW_LENGTH)
-            input_images_log.append(image_info)
-        
-        # 调用图片生成服务
-        result = image_generator.generate_images(
-            model=model,
-            prompt=prompt,
-            images=images,
-            negative_prompt=negative_prompt,
-            image_size=image_size,
-            batch_size=batch_size,
-            seed=seed,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            cfg=cfg
+        # 执行生成流程（预处理、调用上游、构建响应，并记录调用日志）
+        if tiled:
+            if response_mode == ResponseUtils.MODE_MULTIPART:
+                result, outputs = await generation_pipeline.generate_tiled(images, params, start_time=start_time,
+                                                                           deadline=deadline, client=client)
+                boundary = ResponseUtils.new_boundary()
+                return StreamingResponse(
+                    ResponseUtils.iter_multipart(GenerationPipeline.build_metadata(result, outputs), outputs, boundary),
+                    media_type=f"multipart/mixed; boundary={boundary}"
+                )
+            return await generation_pipeline.run_tiled(images, params, start_time=start_time, deadline=deadline,
+                                                        response_mode=response_mode, client=client)
+        if num_variants > 1:
+            if response_mode == ResponseUtils.MODE_MULTIPART:
+                # 各候选完成时立即输出其元数据和图片
+                outcomes = await generation_pipeline.generate_variants(images, params, num_variants, start_time=start_time,
+                                                                       deadline=deadline, client=client, roi=roi_edit)
+                boundary = ResponseUtils.new_boundary()
+                metadata = {"success": True, "message": "图片生成中，各候选按完成顺序返回", "num_variants": num_variants}
+                return StreamingResponse(
+                    ResponseUtils.iter_multipart_groups(metadata, GenerationPipeline.iter_variant_groups(outcomes), boundary),
+                    media_type=f"multipart/mixed; boundary={boundary}"
+                )
+            return await generation_pipeline.run_variants(images, params, num_variants, start_time=start_time, deadline=deadline,
+                                                          response_mode=response_mode, client=client, roi=roi_edit)
+        if response_mode == ResponseUtils.MODE_MULTIPART:
+            result, outputs = await generation_pipeline.generate(images, params, start_time=start_time, deadline=deadline,
+                                                                 client=client, roi=roi_edit)
+            boundary = ResponseUtils.new_boundary()
+            return StreamingResponse(
+                ResponseUtils.iter_multipart(GenerationPipeline.build_metadata(result, outputs), outputs, boundary),
+                media_type=f"multipart/mixed; boundary={boundary}"
+            )
+        return await generation_pipeline.run(images, params, start_time=start_time, deadline=deadline,
+                                             response_mode=response_mode, client=client, roi=roi_edit)
+    except DeadlineExceededError as e:
+        return JSONResponse(
+            status_code=504,
+            content=ImageGenerationResponse(
+                success=False,
+                message=f"图片生成失败: {str(e)}",
+                images=[]
+            ).dict()
+        )
+    except UpstreamRateLimitError as e:
+        # 上游持续限流时返回429而非500，便于客户端退避重试
+        headers = {"Retry-After": str(int(e.retry_after) + 1)} if e.retry_after is not None else None
+        return JSONResponse(
+            status_code=429,
+            content=ImageGenerationResponse(
+                success=False,
+                message=f"图片生成失败: {str(e)}",
+                images=[]
+            ).dict(),
+            headers=headers
         )
-        
-        # 构建响应
-        generated_images = []
-        for i, image_data in enumerate(result["images"]):
-            # 提取base64编码（如果包含前缀则去除）
-            base64_str = image_data
-            if base64_str.startswith("data:image/"):
-                base64_str = base64_str.split(",")[1]
-            
-            # 将base64转换为PIL Image对象（用于获取图片信息）
-            pil_image = ImageUtils.base64_to_pil_image(base64_str)
-            
-            # 记录输出图片信息
-            image_info = ImageUtils.get_image_info(pil_image, base64_str, i, Config.IMAGE_BASE64_PREVIEW_LENGTH)
-            output_images_log.append(image_info)
-            
-            generated_images.append(GeneratedImage(
-                base64=base64_str,
-                index=i
-            ))
-        
-        # 记录API调用结束时间
-        end_time = time.time()
-        total_time = end_time - start_time
-        
-        # 记录日志
-        LoggerUtils.log_api_call(
-            logger=logger,
-            api_key=Config.API_KEY,
-            model=model,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            input_images=input_images_log,
-            output_images=output_images_log,
-            status=status,
-            seed=result.get("seed"),
-            image_size=image_size,
-            batch_size=batch_size,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            cfg=cfg,
-            total_time_seconds=total_time,
-            timing=result.get("timings")
+    except SchedulerQueueFullError as e:
+        return JSONResponse(
+            status_code=429,
+            content=ImageGenerationResponse(
+                success=False,
+                message=f"图片生成失败: {str(e)}",
+                images=[]
+            ).dict()
         )
-        
-        return ImageGenerationResponse(
-            success=True,
-            message="图片生成成功",
-            images=generated_images,
-            seed=result.get("seed"),
-            timing=result.get("timings")
+    except BackendUnavailableError as e:
+        # 所有后端熔断属于过载，返回503并提示熔断冷却结束的时间
+        headers = {"Retry-After": str(int(e.retry_after) + 1)} if e.retry_after is not None else None
+        return JSONResponse(
+            status_code=503,
+            content=ImageGenerationResponse(
+                success=False,
+                message=f"图片生成失败: {str(e)}",
+                images=[]
+            ).dict(),
+            headers=headers
         )
-        
-    except HTTPException as e:
-        # 记录错误信息
-        status = "failed"
-        error_message = str(e.detail)
-        raise
     except Exception as e:
-        # 记录错误信息
-        status = "failed"
-        error_message = str(e)
-        
-        # 记录API调用结束时间
-        end_time = time.time()
-        total_time = end_time - start_time
-        
-        # 记录日志
-        LoggerUtils.log_api_call(
-            logger=logger,
-            api_key=Config.API_KEY,
-            model=model,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            input_images=input_images_log,
-            output_images=output_images_log,
-            status=status,
-            error_message=error_message,
-            seed=seed,
-            image_size=image_size,
-            batch_size=batch_size,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            cfg=cfg,
-            total_time_seconds=total_time
-        )
-        
         return JSONResponse(
             status_code=500,
             content=ImageGenerationResponse(
@@ -233,3 +419,246 @@ async def generate_images(
                 images=[]
             ).dict()
         )
+    finally:
+        MetricsUtils.in_flight.dec(kind="requests")
+
+@app.get("/metrics", summary="Prometheus指标")
+async def get_metrics():
+    """各处理阶段耗时直方图、进行中的请求数、上游状态码计数和载荷大小直方图（Prometheus文本格式）"""
+    return PlainTextResponse(MetricsUtils.render(), media_type=MetricsUtils.CONTENT_TYPE)
+
+def require_debug_token(request: Request) -> None:
+    """校验剖析接口的管理令牌：剖析未启用时返回404，令牌错误时返回403"""
+    try:
+        if not request_profiler.check_token(request.headers.get(Config.PROFILE_TOKEN_HEADER)):
+            raise HTTPException(status_code=403, detail="管理令牌无效")
+    except ProfilingDisabledError:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+@app.post("/debug/profiles", summary="预约剖析接下来的请求", dependencies=[Depends(require_debug_token)])
+async def arm_profiles(count: int = 1, memory: bool = False):
+    """剖析接下来count个可剖析接口（PROFILE_PATHS）的请求，memory为true时同时记录内存分配（tracemalloc，开销较大）"""
+    armed = request_profiler.arm(count, memory)
+    return {"armed": armed, "memory": memory, "paths": list(request_profiler.paths)}
+
+@app.get("/debug/profiles", summary="剖析结果列表", dependencies=[Depends(require_debug_token)])
+async def list_profiles():
+    """已完成的剖析（最近的在前）和当前预约状态"""
+    return {"profiles": request_profiler.list_profiles(), **request_profiler.get_stats()}
+
+def get_profile_or_404(profile_id: str):
+    profile = request_profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"剖析结果 {profile_id} 不存在")
+    return profile
+
+@app.get("/debug/profiles/{profile_id}", summary="剖析详情", dependencies=[Depends(require_debug_token)])
+async def get_profile(profile_id: str, top: int = Config.PROFILE_TOP):
+    """采样最多的调用栈与函数，以及按ImageUtils/LoggerUtils调用位置汇总的内存分配"""
+    return get_profile_or_404(profile_id).to_dict(top)
+
+@app.get("/debug/profiles/{profile_id}/collapsed", summary="折叠调用栈", dependencies=[Depends(require_debug_token)])
+async def get_profile_collapsed(profile_id: str):
+    """折叠调用栈文本，可用flamegraph.pl生成火焰图或导入speedscope"""
+    return PlainTextResponse(get_profile_or_404(profile_id).collapsed())
+
+@app.get("/images/{blob_id}", summary="获取生成图片")
+async def get_image(blob_id: str, request: Request):
+    """获取url模式保存的生成图片，支持Range分段下载和ETag条件请求，过期后返回404"""
+    path = blob_store.get_path(blob_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="图片不存在或已过期")
+    
+    etag = BlobStore.get_etag(blob_id)
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={Config.BLOB_TTL_SECONDS}, immutable"}
+    if ResponseUtils.etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers)
+
+async def serve_variant(store: BlobStore, source_id: str, request: Request, size: Optional[int],
+                        format: str, quality: Optional[str]) -> Response:
+    """返回原图的衍生版本，支持ETag条件请求；format为auto时按Accept协商并返回Vary: Accept"""
+    source_path = store.get_path(source_id)
+    if source_path is None:
+        raise HTTPException(status_code=404, detail="图片不存在或已过期")
+    try:
+        variant = VariantRenderer.resolve(source_id, size, format, quality, request.headers.get("Accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    headers = {"ETag": variant.etag, "Cache-Control": f"private, max-age={int(store.ttl_seconds)}, immutable"}
+    if format == "auto":
+        headers["Vary"] = "Accept"
+    if ResponseUtils.etag_matches(request.headers.get("If-None-Match"), variant.etag):
+        return Response(status_code=304, headers=headers)
+    
+    content = await variant_renderer.render(variant, source_path)
+    if isinstance(content, str):
+        return FileResponse(content, media_type=variant.mime_type, headers=headers)
+    return Response(content, media_type=variant.mime_type, headers=headers)
+
+@app.get("/images/{blob_id}/variants", summary="获取生成图片的衍生版本")
+async def get_image_variant(
+    blob_id: str,
+    request: Request,
+    size: Optional[int] = None,
+    format: str = "auto",
+    quality: Optional[str] = None
+):
+    """
+    获取url模式保存的生成图片的缩略图或格式转换版本，首次请求时生成并缓存
+    
+    - **size**: 最长边（像素），可选值见VARIANT_SIZES，不指定时保持原尺寸
+    - **format**: auto（默认，按Accept协商AVIF/WebP，均不接受时保持原图格式）、webp、avif、jpeg或png
+    - **quality**: 质量等级low、medium或high（png忽略）
+    """
+    return await serve_variant(blob_store, blob_id, request, size, format, quality)
+
+@app.get("/uploads/{handle}/variants", summary="获取参考图片的衍生版本")
+async def get_upload_variant(
+    handle: str,
+    request: Request,
+    size: Optional[int] = None,
+    format: str = "auto",
+    quality: Optional[str] = None
+):
+    """获取/uploads保存的参考图片的缩略图或格式转换版本，参数与/images/{blob_id}/variants相同"""
+    return await serve_variant(reference_store.blob_store, handle, request, size, format, quality)
+
+@app.post("/jobs", response_model=JobSubmitResponse, status_code=202, summary="提交异步生成任务")
+async def submit_job(
+    request: Request,
+    files: Optional[List[UploadFile]] = File(None, description="上传的图片文件列表"),
+    handles: Optional[List[str]] = Form(None, description="/uploads返回的参考图片句柄，排在上传文件之前"),
+    params: Dict[str, Any] = Depends(generation_params),
+    tiled: bool = Form(False, description="分块编辑第一张图片")
+):
+    """提交异步图片生成任务，参数与/generate-images相同（tiled为true时分块编辑，适合耗时较长的大图），返回任务ID"""
+    try:
+        ImageGenerationRequest(**params)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    images = await read_input_images(files, handles, params["model"])
+    if tiled:
+        images = await prepare_tiled(images, handles, params["model"])
+        params = dict(params, tiled=True)
+    try:
+        job_id = await job_manager.submit(images, params, traffic_client(request, Config.SCHEDULER_BULK_CLASS))
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    
+    return JobSubmitResponse(job_id=job_id, status=JobManager.QUEUED)
+
+async def get_job_or_404(job_id: str) -> Dict[str, Any]:
+    """查询任务，不存在时返回404"""
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"任务 {job_id} 不存在")
+    return job
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse, summary="查询任务状态")
+async def get_job(job_id: str):
+    """查询任务状态和进度"""
+    job = await get_job_or_404(job_id)
+    return JobStatusResponse(
+        job_id=job["job_id"],
+        status=job["status"],
+        stage=job["stage"],
+        progress=job["progress"],
+        error=job.get("error"),
+        created_at=job["created_at"],
+        updated_at=job["updated_at"]
+    )
+
+@app.get("/jobs/{job_id}/result", response_model=ImageGenerationResponse, summary="获取任务结果")
+async def get_job_result(job_id: str):
+    """获取任务生成结果，任务未完成时返回409"""
+    job = await get_job_or_404(job_id)
+    if job["status"] == JobManager.FAILED:
+        return JSONResponse(
+            status_code=500,
+            content=ImageGenerationResponse(
+                success=False,
+                message=f"图片生成失败: {job['error']}",
+                images=[]
+            ).dict()
+        )
+    if job["status"] != JobManager.SUCCEEDED:
+        raise HTTPException(status_code=409, detail=f"任务尚未完成，当前状态: {job['status']}")
+    return job["result"]
+
+@app.post("/batch", summary="提交批量编辑任务")
+async def create_batch(
+    request: Request,
+    files: List[UploadFile] = File(default=[], description="上传的图片文件列表"),
+    archive: Optional[UploadFile] = File(None, description="包含图片（及可选manifest.json）的zip或tar压缩包"),
+    manifest: Optional[str] = Form(None, description="JSON清单：条目数组或{\"defaults\": {...}, \"items\": [...]}"),
+    model: str = Form(Config.DEFAULT_MODEL, description="默认模型名称"),
+    prompt: Optional[str] = Form(None, description="默认提示词（未提供清单时应用于每张图片）"),
+    response_mode: str = Form(ResponseUtils.MODE_URL, description="条目结果的响应模式：url或json")
+):
+    """
+    批量编辑API：按清单或对每张图片执行生成，以NDJSON逐条返回结果
+    
+    - 同一提示词作用于多张图片：上传图片或压缩包并提供prompt
+    - 多个提示词作用于同一张图片：清单条目使用prompts数组
+    
+    输出首行为批量信息（含batch_id），之后每完成一个条目输出一行，末行为汇总。
+    连接中断后可通过/batch/{batch_id}/resume继续执行未完成的条目
+    """
+    if response_mode not in (ResponseUtils.MODE_URL, ResponseUtils.MODE_JSON):
+        raise HTTPException(status_code=400, detail="批量任务的响应模式必须是url或json")
+    
+    uploads = await read_upload_images(files, batch_upload_reader)
+    # 图片按文件名（压缩包内为成员路径）被清单引用，上传文件和压缩包成员之间不能重名
+    images = {}
+    try:
+        BatchManager.add_images(images, ((image.filename, image.data) for image in uploads))
+        if archive is not None:
+            # 从表单解析时的临时文件流式读取，成员按大小和数量上限逐个检查
+            archive_images, archive_manifest = await asyncio.to_thread(
+                BatchManager.read_archive, archive.file, archive.filename, batch_upload_reader
+            )
+            BatchManager.add_images(images, archive_images.items())
+            manifest = manifest or archive_manifest
+    except UploadRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        items = BatchManager.parse_manifest(manifest, list(images), {"model": model, "prompt": prompt})
+        batch_id = await batch_manager.create(items, images, response_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    client = traffic_client(request, Config.SCHEDULER_BULK_CLASS)
+    return StreamingResponse(ResponseUtils.iter_ndjson(batch_manager.run(batch_id, client=client)),
+                             media_type="application/x-ndjson")
+
+@app.post("/batch/{batch_id}/resume", summary="继续执行批量编辑任务")
+async def resume_batch(batch_id: str, request: Request, replay: bool = False):
+    """继续执行未成功的条目（包括失败的条目），replay为true时先输出已成功条目的结果"""
+    if await batch_manager.get(batch_id) is None:
+        raise HTTPException(status_code=404, detail=f"批量任务 {batch_id} 不存在")
+    if batch_manager.is_running(batch_id):
+        raise HTTPException(status_code=409, detail=f"批量任务 {batch_id} 正在执行")
+    client = traffic_client(request, Config.SCHEDULER_BULK_CLASS)
+    return StreamingResponse(ResponseUtils.iter_ndjson(batch_manager.run(batch_id, replay=replay, client=client)),
+                             media_type="application/x-ndjson")
+
+@app.get("/batch/{batch_id}", summary="查询批量编辑任务进度")
+async def get_batch(batch_id: str):
+    """查询批量任务各状态的条目数"""
+    batch = await batch_manager.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"批量任务 {batch_id} 不存在")
+    return {
+        "batch_id": batch["batch_id"],
+        "total": batch["total"],
+        "running": batch["running"],
+        **batch["counts"],
+        "created_at": batch["created_at"],
+        "updated_at": batch["updated_at"]
+    }
@@ -0,0 +1,79 @@
+import base64
+import hashlib
+import mmap
+from dataclasses import dataclass, field
+from typing import Dict, Any, Optional, Union, TYPE_CHECKING
+from utils.image_utils import ImageUtils
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+@dataclass
+class InputImage:
+    """上传图片：保留原始字节（大文件为只读内存映射），元数据仅从文件头读取，base64只编码一次"""
+    data: Union[bytes, mmap.mmap]
+    width: int
+    height: int
+    format: str
+    mime_type: str
+    filename: Optional[str] = None
+    preprocess: Optional[Dict[str, Any]] = None  # 预处理统计（原始字节数、节省字节数等）
+    prepared_for: Optional[str] = None  # 已按该尺寸分组的策略预处理（参考图片存储），无需再次处理
+    path: Optional[str] = None  # 内存映射对应的文件，传入进程池时只传路径，由子进程重新映射
+    _base64: Optional[str] = field(default=None, repr=False)
+    _digest: Optional[str] = field(default=None, repr=False)
+    _data_url: Optional[str] = field(default=None, repr=False)
+    
+    def __getstate__(self) -> Dict[str, Any]:
+        """传入进程池时内存映射只传文件路径，没有文件时转换为bytes（mmap不能序列化）"""
+        state = dict(self.__dict__)
+        if not isinstance(state["data"], bytes):
+            state["data"] = None if self.path is not None else bytes(state["data"])
+        return state
+    
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """子进程中按文件路径重新建立只读内存映射"""
+        if state["data"] is None:
+            state["data"] = ImageUtils.map_file(state["path"])
+        self.__dict__.update(state)
+    
+    @classmethod
+    def from_bytes(cls, data: bytes, filename: Optional[str] = None) -> "InputImage":
+        """从原始字节创建（惰性打开，仅解析文件头）"""
+        width, height, format, mime_type = ImageUtils.probe_image(data)
+        return cls(data=data, width=width, height=height, format=format, mime_type=mime_type, filename=filename)
+    
+    @classmethod
+    def from_pil(cls, image: "Image.Image", format: str = "PNG") -> "InputImage":
+        """从PIL Image对象创建（需要编码一次）"""
+        data = ImageUtils.pil_image_to_bytes(image, format)
+        return cls.from_bytes(data)
+    
+    @property
+    def base64(self) -> str:
+        """原始字节的base64编码（首次访问时计算）"""
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode("ascii")
+        return self._base64
+    
+    @property
+    def digest(self) -> str:
+        """原始字节的sha256摘要"""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+    
+    def to_data_url(self) -> str:
+        """上游请求使用的data URL，MIME类型与原始格式一致（首次调用时拼接）"""
+        if self._data_url is None:
+            self._data_url = f"data:{self.mime_type};base64,{self.base64}"
+        return self._data_url
+    
+    def get_image_info(self, index: int, max_base64_len: int = 100) -> Dict[str, Any]:
+        """构建日志用的图片信息（不解码像素）"""
+        extra = {"bytes": len(self.data)}
+        if self.preprocess:
+            extra["preprocess"] = self.preprocess
+        return ImageUtils.build_image_info(
+            self.width, self.height, self.format, self.base64, index, max_base64_len, **extra
+        )
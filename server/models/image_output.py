@@ -0,0 +1,43 @@
+import base64
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+from models.image_input import InputImage
+from utils.image_utils import ImageUtils
+
+@dataclass
+class OutputImage(InputImage):
+    """生成结果图片：保留解码后的字节，上游返回的base64直接复用，不重新编码；
+    上游返回URL时图片先流式保存到本地存储，data在需要时才读入内存"""
+    blob_id: Optional[str] = None  # 保存到本地图片存储后的ID
+    size: int = 0  # 图片字节数
+    source_url: Optional[str] = None  # 上游返回的图片URL
+    
+    @classmethod
+    def from_base64(cls, base64_str: str) -> "OutputImage":
+        """解码上游返回的base64（可带data URL前缀），仅解析文件头"""
+        if base64_str.startswith("data:image/"):
+            base64_str = base64_str.split(",")[1]
+        data = base64.b64decode(base64_str)
+        width, height, format, mime_type = ImageUtils.probe_image(data)
+        return cls(data=data, width=width, height=height, format=format, mime_type=mime_type,
+                   size=len(data), _base64=base64_str)
+    
+    @property
+    def extension(self) -> str:
+        """文件扩展名"""
+        return "jpg" if self.format == "JPEG" else (self.format or "png").lower()
+    
+    def get_image_info(self, index: int, max_base64_len: int = 100) -> Dict[str, Any]:
+        """构建日志用的图片信息，base64预览只编码开头部分，未读入内存时不含预览"""
+        if self._base64 is not None:
+            preview = self._base64
+        elif self.data is not None:
+            preview = base64.b64encode(self.data[:max_base64_len]).decode("ascii")
+        else:
+            preview = ""
+        extra = {"bytes": self.size}
+        if self.source_url:
+            extra["source_url"] = self.source_url
+        return ImageUtils.build_image_info(
+            self.width, self.height, self.format, preview, index, max_base64_len, **extra
+        )
@@ -1,22 +1,31 @@
 from pydantic import BaseModel, Field, validator
 from typing import Optional
 from config import Config
+from models.model_registry import ModelRegistry
+
+# 参数取值范围与模型注册表共用同一配置
+RANGES = Config.MODEL_PARAM_RANGES
 
 class ImageGenerationRequest(BaseModel):
     model: str = Field(default=Config.DEFAULT_MODEL, description="模型名称")
     prompt: str = Field(..., description="提示词")
     negative_prompt: str = Field(default="", description="负面提示词")
     image_size: Optional[str] = Field(default=None, description="图片尺寸")
-    batch_size: Optional[int] = Field(default=1, ge=1, le=4, description="批量大小")
-    seed: Optional[int] = Field(default=None, ge=0, le=9999999999, description="种子")
-    num_inference_steps: Optional[int] = Field(default=20, ge=1, le=100, description="推理步数")
-    guidance_scale: Optional[float] = Field(default=7.5, ge=0.0, le=20.0, description="引导比例")
-    cfg: Optional[float] = Field(default=4.0, ge=0.1, le=20.0, description="CFG值")
+    batch_size: Optional[int] = Field(default=RANGES["batch_size"]["default"], ge=RANGES["batch_size"]["min"],
+                                      le=RANGES["batch_size"]["max"], description="批量大小")
+    seed: Optional[int] = Field(default=RANGES["seed"]["default"], ge=RANGES["seed"]["min"],
+                                le=RANGES["seed"]["max"], description="种子")
+    num_inference_steps: Optional[int] = Field(default=RANGES["num_inference_steps"]["default"],
+                                               ge=RANGES["num_inference_steps"]["min"],
+                                               le=RANGES["num_inference_steps"]["max"], description="推理步数")
+    guidance_scale: Optional[float] = Field(default=RANGES["guidance_scale"]["default"], ge=RANGES["guidance_scale"]["min"],
+                                            le=RANGES["guidance_scale"]["max"], description="引导比例")
+    cfg: Optional[float] = Field(default=RANGES["cfg"]["default"], ge=RANGES["cfg"]["min"],
+                                 le=RANGES["cfg"]["max"], description="CFG值")
     
     @validator('model')
     def validate_model(cls, v):
-        if v not in Config.AVAILABLE_MODELS:
-            raise ValueError(f"模型必须是以下之一: {', '.join(Config.AVAILABLE_MODELS)}")
+        ModelRegistry.get_default().validate(v)
         return v
     
     @validator('image_size')
@@ -24,12 +33,12 @@ class ImageGenerationRequest(BaseModel):
         if v is None:
             return v
         
+        # 模型校验失败时values中没有model
         model = values.get('model')
-        if model.startswith("Kwai-Kolors/"):
-            if v not in Config.AVAILABLE_IMAGE_SIZES["Kolor"]:
-                raise ValueError(f"对于Kolor模型，图片尺寸必须是以下之一: {', '.join(Config.AVAILABLE_IMAGE_SIZES['Kolor'])}")
-        elif model.startswith("Qwen/") and model not in ["Qwen/Qwen-Image-Edit-2509", "Qwen/Qwen-Image-Edit"]:
-            if v not in Config.AVAILABLE_IMAGE_SIZES["Qwen-Image"]:
-                raise ValueError(f"对于Qwen-Image模型，图片尺寸必须是以下之一: {', '.join(Config.AVAILABLE_IMAGE_SIZES['Qwen-Image'])}")
+        if model is None:
+            return v
+        spec = ModelRegistry.get_default().get(model)
+        if spec.custom_size and v not in spec.available_sizes:
+            raise ValueError(f"对于{spec.size_family}模型，图片尺寸必须是以下之一: {', '.join(spec.available_sizes)}")
         
-        return v
\ No newline at end of file
+        return v
@@ -2,12 +2,24 @@ from pydantic import BaseModel, Field
 from typing import List, Optional
 
 class GeneratedImage(BaseModel):
-    base64: str = Field(..., description="生成图片的base64编码")
+    base64: Optional[str] = Field(default=None, description="生成图片的base64编码（json模式）")
+    url: Optional[str] = Field(default=None, description="生成图片的短期链接（url模式）")
+    mime_type: Optional[str] = Field(default=None, description="图片MIME类型")
     index: int = Field(..., description="图片索引")
 
+class GeneratedVariant(BaseModel):
+    variant_index: int = Field(..., description="候选索引")
+    seed: int = Field(..., description="该候选的生成种子")
+    success: bool = Field(..., description="该候选是否生成成功")
+    message: str = Field(..., description="该候选的响应消息")
+    image_indexes: List[int] = Field(default_factory=list, description="该候选的图片在images中的索引")
+    timing: Optional[dict] = Field(default=None, description="该候选的上游生成时间信息")
+    elapsed_seconds: float = Field(..., description="该候选从调用上游到获取结果的耗时（秒）")
+
 class ImageGenerationResponse(BaseModel):
     success: bool = Field(..., description="生成是否成功")
     message: str = Field(..., description="响应消息")
     images: List[GeneratedImage] = Field(default_factory=list, description="生成的图片列表")
     seed: Optional[int] = Field(default=None, description="生成种子")
     timing: Optional[dict] = Field(default=None, description="生成时间信息")
+    variants: Optional[List[GeneratedVariant]] = Field(default=None, description="各候选的种子、耗时和图片索引（num_variants大于1时）")
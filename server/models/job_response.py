@@ -0,0 +1,15 @@
+from pydantic import BaseModel, Field
+from typing import Optional
+
+class JobSubmitResponse(BaseModel):
+    job_id: str = Field(..., description="任务ID")
+    status: str = Field(..., description="任务状态")
+
+class JobStatusResponse(BaseModel):
+    job_id: str = Field(..., description="任务ID")
+    status: str = Field(..., description="任务状态：queued/running/succeeded/failed")
+    stage: Optional[str] = Field(default=None, description="当前执行阶段")
+    progress: int = Field(default=0, description="进度百分比，0-100")
+    error: Optional[str] = Field(default=None, description="失败原因")
+    created_at: float = Field(..., description="创建时间（Unix时间戳）")
+    updated_at: float = Field(..., description="最近更新时间（Unix时间戳）")
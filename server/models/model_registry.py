@@ -0,0 +1,105 @@
+import hashlib
+import json
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+from config import Config
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """单个模型的能力：类型、尺寸分组与可用尺寸、参考图片字段和上游参数"""
+    name: str
+    model_type: str
+    size_family: str
+    custom_size: bool
+    available_sizes: Tuple[str, ...]
+    default_size: Optional[str]
+    image_slots: Tuple[str, ...]
+    params: Tuple[str, ...]
+    is_default: bool = False
+    
+    @property
+    def max_images(self) -> int:
+        """最多可使用的参考图片数"""
+        return len(self.image_slots)
+    
+    def to_dict(self, param_ranges: Mapping[str, Mapping[str, Any]]) -> Dict[str, Any]:
+        """/models响应中的模型信息"""
+        return {
+            "model_name": self.name,
+            "model_type": self.model_type,
+            "available_sizes": list(self.available_sizes),
+            "default_size": self.default_size,
+            "size_family": self.size_family,
+            "max_images": self.max_images,
+            "image_slots": list(self.image_slots),
+            "parameters": {name: dict(param_ranges[name]) for name in ("seed",) + self.params if name in param_ranges},
+            "is_default": self.is_default
+        }
+
+class ModelRegistry:
+    """不可变的模型注册表：启动时由配置构建一次，/models响应体和ETag预先计算"""
+    
+    _default: Optional["ModelRegistry"] = None
+    
+    def __init__(self, models: Iterable[str] = None, specs: Mapping[str, Mapping[str, Any]] = None,
+                 param_ranges: Mapping[str, Mapping[str, Any]] = None, default_model: str = None):
+        models = list(Config.AVAILABLE_MODELS if models is None else models)
+        specs = Config.MODEL_SPECS if specs is None else specs
+        self.default_model = Config.DEFAULT_MODEL if default_model is None else default_model
+        self.param_ranges = MappingProxyType({
+            name: MappingProxyType(dict(value))
+            for name, value in (Config.MODEL_PARAM_RANGES if param_ranges is None else param_ranges).items()
+        })
+        self._specs = MappingProxyType({
+            name: ModelRegistry.build_spec(name, specs.get(name), name == self.default_model) for name in models
+        })
+        self.names = tuple(models)
+        
+        body = {"models": [spec.to_dict(self.param_ranges) for spec in self._specs.values()], "total": len(self._specs)}
+        self.models_body = json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.models_etag = f'"{hashlib.sha256(self.models_body).hexdigest()[:32]}"'
+    
+    @classmethod
+    def get_default(cls) -> "ModelRegistry":
+        """按当前配置构建的注册表（首次调用时构建）"""
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+    
+    @staticmethod
+    def build_spec(name: str, spec: Optional[Mapping[str, Any]] = None, is_default: bool = False) -> ModelSpec:
+        """由配置构建模型能力，未配置的模型按名称前缀推断"""
+        if spec is None:
+            if name.startswith("Kwai-Kolors/"):
+                spec = Config.MODEL_SPECS["Kwai-Kolors/Kolors"]
+            else:
+                spec = {"type": "image_generation", "size_family": "Qwen-Image", "custom_size": True,
+                        "image_slots": ["image"], "params": ["cfg"]}
+        custom_size = bool(spec.get("custom_size", True))
+        return ModelSpec(
+            name=name,
+            model_type=spec.get("type", "image_generation"),
+            size_family=spec["size_family"],
+            custom_size=custom_size,
+            available_sizes=tuple(Config.AVAILABLE_IMAGE_SIZES.get(spec["size_family"], [])) if custom_size else (),
+            default_size=spec.get("default_size", Config.DEFAULT_IMAGE_SIZE) if custom_size else None,
+            image_slots=tuple(spec.get("image_slots", ["image"])),
+            params=tuple(spec.get("params", [])),
+            is_default=is_default
+        )
+    
+    def __contains__(self, model: str) -> bool:
+        return model in self._specs
+    
+    def get(self, model: str) -> ModelSpec:
+        """获取模型能力，未注册的模型按名称前缀推断"""
+        spec = self._specs.get(model)
+        return spec if spec is not None else ModelRegistry.build_spec(model)
+    
+    def validate(self, model: str) -> ModelSpec:
+        """获取已注册模型的能力，未注册时抛出ValueError"""
+        spec = self._specs.get(model)
+        if spec is None:
+            raise ValueError(f"模型必须是以下之一: {', '.join(self.names)}")
+        return spec
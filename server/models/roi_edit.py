@@ -0,0 +1,31 @@
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+from models.image_input import InputImage
+from utils.roi_utils import Box
+
+@dataclass(frozen=True)
+class RoiEdit:
+    """局部编辑：完整分辨率的原图、编辑区域与送往上游的裁剪区域（坐标按应用EXIF方向后的原图），生成后按此合成回原图"""
+    original: InputImage
+    edit_box: Box
+    crop_box: Box
+    padding: int  # 裁剪区域的上下文边距，同时是羽化过渡宽度（像素）
+    size: Tuple[int, int]  # 原图尺寸（应用EXIF方向后）
+    mask: Optional[bytes] = None  # 遮罩图片（白色为编辑区域）
+    
+    @property
+    def area_ratio(self) -> float:
+        """裁剪区域占原图面积的比例"""
+        width = self.crop_box[2] - self.crop_box[0]
+        height = self.crop_box[3] - self.crop_box[1]
+        return width * height / (self.size[0] * self.size[1])
+    
+    def to_log(self) -> Dict[str, Any]:
+        """调用日志中的局部编辑信息"""
+        return {
+            "edit_box": list(self.edit_box),
+            "crop_box": list(self.crop_box),
+            "padding": self.padding,
+            "mask": self.mask is not None,
+            "area_ratio": round(self.area_ratio, 4)
+        }
@@ -0,0 +1,15 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+class UploadedImage(BaseModel):
+    handle: str = Field(..., description="参考图片句柄，可在/generate-images和/jobs的handles参数中代替上传文件")
+    filename: Optional[str] = Field(default=None, description="上传时的文件名")
+    width: int = Field(..., description="图片宽度")
+    height: int = Field(..., description="图片高度")
+    format: str = Field(..., description="图片格式")
+    mime_type: str = Field(..., description="图片MIME类型")
+    bytes: int = Field(..., description="图片字节数")
+    expires_in: float = Field(..., description="未使用时的有效期（秒），每次使用后重新计时")
+
+class UploadResponse(BaseModel):
+    uploads: List[UploadedImage] = Field(default_factory=list, description="已保存的参考图片")
@@ -0,0 +1,164 @@
+import random
+import time
+from typing import Any, Dict, Iterable, List, Optional
+from config import Config
+from utils.logger_utils import LoggerUtils
+
+class BackendUnavailableError(Exception):
+    """所有上游后端均已熔断，retry_after为最早结束冷却的秒数"""
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Backend:
+    """上游后端（端点 + 密钥 + 权重），记录在途请求数、延迟和熔断状态"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, base_url: str, api_key: str, weight: float = 1.0):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.weight = weight
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        self.state = Backend.CLOSED
+        self.opened_at = 0.0
+        self.consecutive_failures = 0
+        self.outstanding = 0
+        self.ewma_ms: Optional[float] = None
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0, "ejections": 0}
+    
+    def is_available(self, now: float, cooldown: float) -> bool:
+        """熔断冷却结束后进入半开状态，只放行一个探测请求"""
+        if self.state == Backend.OPEN and now - self.opened_at >= cooldown:
+            self.state = Backend.HALF_OPEN
+        if self.state == Backend.HALF_OPEN:
+            return self.outstanding == 0
+        return self.state == Backend.CLOSED
+    
+    def cooldown_remaining(self, now: float, cooldown: float) -> float:
+        """距离熔断冷却结束的秒数，半开状态（探测请求进行中）为0"""
+        if self.state == Backend.OPEN:
+            return max(0.0, self.opened_at + cooldown - now)
+        return 0.0
+    
+    def score(self, strategy: str) -> float:
+        """路由得分，越小越优先"""
+        load = (self.outstanding + 1) / self.weight
+        if strategy == BackendPool.EWMA:
+            # 尚无延迟样本的后端视为最快，以便尽快获得样本
+            return load * (self.ewma_ms or 0.0)
+        return load
+
+class BackendPool:
+    """多密钥/多端点负载均衡：按最少在途请求或延迟EWMA选择后端，连续失败时熔断"""
+    
+    LEAST_OUTSTANDING = "least_outstanding"
+    EWMA = "ewma"
+    
+    def __init__(self, backends: List[Backend], strategy: str = Config.UPSTREAM_ROUTING,
+                 failure_threshold: int = Config.UPSTREAM_BREAKER_FAILURES,
+                 cooldown_seconds: float = Config.UPSTREAM_BREAKER_COOLDOWN_SECONDS,
+                 ewma_alpha: float = Config.UPSTREAM_EWMA_ALPHA):
+        if not backends:
+            raise ValueError("至少需要一个上游后端")
+        if strategy not in (BackendPool.LEAST_OUTSTANDING, BackendPool.EWMA):
+            raise ValueError(f"不支持的路由策略: {strategy}")
+        self.backends = backends
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.ewma_alpha = ewma_alpha
+    
+    @staticmethod
+    def from_config() -> "BackendPool":
+        """根据配置创建后端池，未配置UPSTREAM_BACKENDS时使用API_KEY和API_BASE_URL"""
+        entries = Config.UPSTREAM_BACKENDS or [
+            {"name": "default", "base_url": Config.API_BASE_URL, "api_key": Config.API_KEY}
+        ]
+        backends = [
+            Backend(
+                name=entry.get("name", f"backend-{i}"),
+                base_url=entry.get("base_url", Config.API_BASE_URL),
+                api_key=entry["api_key"],
+                weight=entry.get("weight", 1.0)
+            )
+            for i, entry in enumerate(entries)
+        ]
+        return BackendPool(backends)
+    
+    def choose(self, exclude: Iterable[Backend] = ()) -> Backend:
+        """选择得分最低的可用后端，得分相同时按权重随机；排除的后端仅在没有其他选择时使用"""
+        now = time.monotonic()
+        available = [backend for backend in self.backends if backend.is_available(now, self.cooldown_seconds)]
+        if not available:
+            retry_after = min(backend.cooldown_remaining(now, self.cooldown_seconds) for backend in self.backends)
+            raise BackendUnavailableError("所有上游后端均已熔断，请稍后重试", retry_after=retry_after)
+        excluded = set(id(backend) for backend in exclude)
+        candidates = [backend for backend in available if id(backend) not in excluded] or available
+        
+        # 冷却结束的后端优先接收探测请求，以便尽快恢复或再次熔断
+        for backend in candidates:
+            if backend.state == Backend.HALF_OPEN:
+                return backend
+        
+        best = min(backend.score(self.strategy) for backend in candidates)
+        ties = [backend for backend in candidates if backend.score(self.strategy) == best]
+        return random.choices(ties, weights=[backend.weight for backend in ties])[0]
+    
+    def begin(self, backend: Backend) -> float:
+        """记录请求开始，返回开始时间"""
+        backend.outstanding += 1
+        backend.stats["requests"] += 1
+        return time.monotonic()
+    
+    def end(self, backend: Backend, start: float, success: Optional[bool], rate_limited: bool = False) -> None:
+        """记录请求结束；success为None表示请求被取消，429只计入限流，均不影响熔断"""
+        backend.outstanding -= 1
+        latency_ms = (time.monotonic() - start) * 1000
+        
+        if success is None:
+            return
+        if rate_limited:
+            backend.stats["rate_limited"] += 1
+            return
+        
+        if success:
+            if backend.ewma_ms is None:
+                backend.ewma_ms = latency_ms
+            else:
+                backend.ewma_ms = self.ewma_alpha * latency_ms + (1 - self.ewma_alpha) * backend.ewma_ms
+            backend.consecutive_failures = 0
+            backend.state = Backend.CLOSED
+            return
+        
+        backend.stats["errors"] += 1
+        backend.consecutive_failures += 1
+        # 半开状态下探测失败或连续失败达到阈值时熔断
+        if backend.state == Backend.HALF_OPEN or backend.consecutive_failures >= self.failure_threshold:
+            if backend.state != Backend.OPEN:
+                backend.stats["ejections"] += 1
+            backend.state = Backend.OPEN
+            backend.opened_at = time.monotonic()
+    
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """获取各后端的状态、延迟和错误统计"""
+        return [
+            {
+                "name": backend.name,
+                "base_url": backend.base_url,
+                "api_key": LoggerUtils.mask_api_key(backend.api_key, Config.API_KEY_VISIBLE_CHARS),
+                "weight": backend.weight,
+                "state": backend.state,
+                "outstanding": backend.outstanding,
+                "ewma_ms": round(backend.ewma_ms, 2) if backend.ewma_ms is not None else None,
+                **backend.stats
+            }
+            for backend in self.backends
+        ]
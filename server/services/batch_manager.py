@@ -0,0 +1,264 @@
+import asyncio
+import io
+import json
+import os
+import tarfile
+import time
+import uuid
+import zipfile
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple
+from pydantic import ValidationError
+from config import Config
+from models.image_input import InputImage
+from models.image_request import ImageGenerationRequest
+from services.batch_store import BatchStore
+from services.fair_scheduler import TrafficClient
+from services.generation_pipeline import GenerationPipeline
+from services.upload_reader import UploadReader, UploadRejectedError
+from utils.image_utils import ImageUtils
+
+class BatchRunningError(Exception):
+    """批量任务正在执行"""
+
+class BatchManager:
+    """批量编辑：解析清单或压缩包，按有限并发执行各条目，逐条返回结果并持久化以便中断后继续"""
+    
+    # 压缩包中识别为图片的扩展名
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+    # 压缩包中的清单文件名
+    MANIFEST_NAME = "manifest.json"
+    # 未提供调度身份时条目使用的客户端
+    BULK_CLIENT = TrafficClient(client_id="batches", traffic_class=Config.SCHEDULER_BULK_CLASS)
+    
+    def __init__(self, store: BatchStore, pipeline: GenerationPipeline,
+                 concurrency: int = Config.BATCH_CONCURRENCY):
+        self.store = store
+        self.pipeline = pipeline
+        self.concurrency = concurrency
+        self._running = set()
+        self._last_purge = time.time()
+        self.stats = {"batches": 0, "items_succeeded": 0, "items_failed": 0, "running": 0}
+    
+    @staticmethod
+    def read_archive(file: BinaryIO, filename: str, reader: UploadReader,
+                     max_members: int = Config.BATCH_MAX_ITEMS,
+                     max_bytes: int = Config.BATCH_MAX_ARCHIVE_BYTES) -> Tuple[Dict[str, bytes], Optional[str]]:
+        """从文件流式读取zip或tar压缩包（不整体读入内存），返回(图片名 -> 字节, 清单JSON)，忽略目录和非图片文件；
+        压缩包无效时抛出ValueError，成员数、单个成员或解压总量超出上限、图片无效时抛出UploadRejectedError"""
+        file.seek(0)
+        if zipfile.is_zipfile(file):
+            file.seek(0)
+            try:
+                with zipfile.ZipFile(file) as archive:
+                    members = ((info.filename, info.file_size, lambda info=info: archive.open(info))
+                               for info in archive.infolist() if not info.is_dir())
+                    return BatchManager._collect_members(members, reader, max_members, max_bytes)
+            except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError, EOFError):
+                raise ValueError(f"压缩包 {filename} 不是有效的zip或tar文件")
+        file.seek(0)
+        try:
+            # 按顺序遍历成员，gz/bz2/xz压缩的tar也不会一次解压全部内容
+            with tarfile.open(fileobj=file) as archive:
+                members = ((member.name, member.size, lambda member=member: archive.extractfile(member))
+                           for member in archive if member.isfile())
+                return BatchManager._collect_members(members, reader, max_members, max_bytes)
+        except (tarfile.TarError, EOFError, OSError):
+            raise ValueError(f"压缩包 {filename} 不是有效的zip或tar文件")
+    
+    @staticmethod
+    def _collect_members(members: Iterable[Tuple[str, int, Callable[[], BinaryIO]]], reader: UploadReader,
+                         max_members: int, max_bytes: int) -> Tuple[Dict[str, bytes], Optional[str]]:
+        """读取成员前按声明的大小检查单个文件上限和解压总量上限（防止压缩炸弹），读取后校验图片文件头和像素数"""
+        images = {}
+        manifest = None
+        count = 0
+        total = 0
+        for name, size, open_member in members:
+            count += 1
+            if count > max_members + 1:  # 另有一个清单文件
+                raise UploadRejectedError(f"压缩包成员数超过上限{max_members}", status_code=413)
+            basename = os.path.basename(name)
+            is_manifest = basename == BatchManager.MANIFEST_NAME
+            if basename.startswith(".") or not (is_manifest or basename.lower().endswith(BatchManager.IMAGE_EXTENSIONS)):
+                continue
+            if size > reader.max_file_bytes:
+                raise UploadRejectedError(f"压缩包成员 {name} 超过单个文件上限{reader.max_file_bytes}字节", status_code=413)
+            total += size
+            if total > max_bytes:
+                raise UploadRejectedError(f"压缩包解压后超过上限{max_bytes}字节", status_code=413)
+            with open_member() as member:
+                data = member.read(size)
+            if is_manifest:
+                if manifest is not None:
+                    raise ValueError("压缩包中有多个清单文件")
+                try:
+                    manifest = data.decode("utf-8")
+                except UnicodeDecodeError:
+                    raise ValueError("清单不是有效的UTF-8文本")
+            else:
+                reader.check_data(name, data)
+                BatchManager.add_images(images, [(name, data)])
+        return images, manifest
+    
+    @staticmethod
+    def add_images(images: Dict[str, Any], named: Iterable[Tuple[str, Any]]) -> None:
+        """按名称加入图片；名称重复时抛出ValueError（否则清单条目会引用被覆盖的图片）"""
+        for name, data in named:
+            if name in images:
+                raise ValueError(f"图片名称重复: {name}")
+            images[name] = data
+    
+    @staticmethod
+    def parse_manifest(manifest: Optional[str], image_names: List[str],
+                       defaults: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """解析清单为条目列表（params为校验后的完整参数，images为图片名列表）
+        
+        清单可以是条目数组，或{"defaults": {...}, "items": [...]}；条目的prompts数组会展开为多个条目。
+        没有清单时每张图片生成一个条目，使用默认参数。参数无效时抛出ValueError
+        """
+        if manifest:
+            try:
+                document = json.loads(manifest)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"清单不是有效的JSON: {str(e)}")
+            if isinstance(document, dict):
+                defaults = {**defaults, **document.get("defaults", {})}
+                entries = document.get("items", [])
+            else:
+                entries = document
+        else:
+            entries = [{"images": [name]} for name in image_names]
+        
+        items = []
+        for i, entry in enumerate(entries):
+            names = entry.get("images", [])
+            if isinstance(names, str):
+                names = [names]
+            for name in names:
+                if name not in image_names:
+                    raise ValueError(f"条目 {i} 引用的图片 {name} 不存在")
+            if len(names) > Config.MAX_IMAGES:
+                raise ValueError(f"条目 {i} 最多支持{Config.MAX_IMAGES}张图片")
+            
+            params = {**defaults, **{key: value for key, value in entry.items() if key not in ("images", "prompts")}}
+            for prompt in entry.get("prompts") or [params.get("prompt")]:
+                try:
+                    request = ImageGenerationRequest(**{**params, "prompt": prompt})
+                except ValidationError as e:
+                    raise ValueError(f"条目 {i} 参数无效: {str(e)}")
+                items.append({"params": request.model_dump(), "images": names})
+        
+        if not items:
+            raise ValueError("批量任务没有任何条目")
+        if len(items) > Config.BATCH_MAX_ITEMS:
+            raise ValueError(f"批量任务最多支持{Config.BATCH_MAX_ITEMS}个条目")
+        return items
+    
+    async def create(self, items: List[Dict[str, Any]], images: Dict[str, bytes], response_mode: str) -> str:
+        """校验图片并保存批量任务，返回批量ID；图片无效时抛出ValueError"""
+        for name, data in images.items():
+            try:
+                await ImageUtils.run_async(ImageUtils.probe_image, data)
+            except (OSError, SyntaxError):
+                raise ValueError(f"文件 {name} 不是有效的图片格式")
+        
+        # 周期性清理过期的批量任务
+        if time.time() - self._last_purge > Config.BATCH_PURGE_INTERVAL_SECONDS:
+            self._last_purge = time.time()
+            await asyncio.to_thread(self.store.delete_before, time.time() - Config.BATCH_RESULT_TTL_SECONDS)
+        
+        batch_id = uuid.uuid4().hex
+        # 只保存被条目引用的图片
+        used = {name for item in items for name in item["images"]}
+        await asyncio.to_thread(
+            self.store.create, batch_id, items, {name: data for name, data in images.items() if name in used},
+            {"response_mode": response_mode}
+        )
+        self.stats["batches"] += 1
+        return batch_id
+    
+    async def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """查询批量任务进度"""
+        batch = await asyncio.to_thread(self.store.get, batch_id)
+        if batch is not None:
+            batch["running"] = batch_id in self._running
+        return batch
+    
+    def is_running(self, batch_id: str) -> bool:
+        return batch_id in self._running
+    
+    async def run(self, batch_id: str, replay: bool = False,
+                  client: Optional[TrafficClient] = None) -> AsyncIterator[Dict[str, Any]]:
+        """执行未成功的条目，按完成顺序逐条产出结果；replay为True时先产出已成功条目的结果。
+        客户端断开时取消未完成的条目，之后可再次调用继续执行；client为条目调用上游时公平调度使用的客户端身份"""
+        if batch_id in self._running:
+            raise BatchRunningError(f"批量任务 {batch_id} 正在执行")
+        self._running.add(batch_id)
+        self.stats["running"] += 1
+        try:
+            batch = await asyncio.to_thread(self.store.get, batch_id)
+            items = await asyncio.to_thread(self.store.list_items, batch_id)
+            pending = [item for item in items if item["status"] != BatchStore.SUCCEEDED]
+            yield {"type": "batch", "batch_id": batch_id, "total": batch["total"], "pending": len(pending)}
+            
+            if replay:
+                for item in items:
+                    if item["status"] == BatchStore.SUCCEEDED:
+                        yield BatchManager._item_line(batch_id, item)
+            
+            semaphore = asyncio.Semaphore(self.concurrency)
+            mode = batch["options"]["response_mode"]
+            client = client or BatchManager.BULK_CLIENT
+            tasks = [asyncio.ensure_future(self._run_item(batch_id, item, mode, semaphore, client)) for item in pending]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    yield await next_done
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            
+            batch = await asyncio.to_thread(self.store.get, batch_id)
+            yield {"type": "summary", "batch_id": batch_id, "total": batch["total"], **batch["counts"]}
+        finally:
+            self._running.discard(batch_id)
+            self.stats["running"] -= 1
+    
+    async def _run_item(self, batch_id: str, item: Dict[str, Any], response_mode: str,
+                        semaphore: asyncio.Semaphore, client: Optional[TrafficClient] = None) -> Dict[str, Any]:
+        """执行单个条目并保存结果"""
+        async with semaphore:
+            try:
+                stored_images = await asyncio.to_thread(self.store.load_images, batch_id, item["image_names"])
+                images = [InputImage.from_bytes(data, filename=name) for data, name in stored_images]
+                response = await self.pipeline.run(images, item["params"], response_mode=response_mode, client=client)
+                item.update(status=BatchStore.SUCCEEDED, result=response.model_dump(), error=None)
+                self.stats["items_succeeded"] += 1
+            except Exception as e:
+                item.update(status=BatchStore.FAILED, result=None, error=str(e))
+                self.stats["items_failed"] += 1
+            await asyncio.to_thread(
+                self.store.update_item, batch_id, item["position"], item["status"], item["result"], item["error"]
+            )
+        return BatchManager._item_line(batch_id, item)
+    
+    @staticmethod
+    def _item_line(batch_id: str, item: Dict[str, Any]) -> Dict[str, Any]:
+        """单个条目的NDJSON输出行"""
+        line = {
+            "type": "item",
+            "batch_id": batch_id,
+            "index": item["position"],
+            "images": item["image_names"],
+            "prompt": item["params"]["prompt"],
+            "status": item["status"]
+        }
+        if item["status"] == BatchStore.SUCCEEDED:
+            line["result"] = item["result"]
+        else:
+            line["error"] = item["error"]
+        return line
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取批量任务统计"""
+        return dict(self.stats)
@@ -0,0 +1,139 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+from config import Config
+
+class BatchStore:
+    """批量任务持久化（SQLite）：保存条目参数、输入图片和每个条目的结果，中断后可按批量ID继续执行"""
+    
+    PENDING = "pending"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    
+    def __init__(self, db_path: str = Config.BATCH_DB_PATH):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS batches (
+                    batch_id TEXT PRIMARY KEY,
+                    total INTEGER NOT NULL,
+                    options TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS batch_items (
+                    batch_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    params TEXT NOT NULL,
+                    image_names TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (batch_id, position)
+                )
+            """)
+            # 同一批量中的图片只保存一份（多个提示词作用于同一张图片时共享）
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS batch_images (
+                    batch_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (batch_id, name)
+                )
+            """)
+    
+    def create(self, batch_id: str, items: List[Dict[str, Any]], images: Dict[str, bytes],
+               options: Dict[str, Any]) -> None:
+        """保存批量任务；items中每项包含params和images（图片名列表）"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO batches (batch_id, total, options, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (batch_id, len(items), json.dumps(options), now, now)
+            )
+            self._conn.executemany(
+                "INSERT INTO batch_items (batch_id, position, params, image_names, status, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(batch_id, i, json.dumps(item["params"], ensure_ascii=False), json.dumps(item["images"], ensure_ascii=False),
+                  BatchStore.PENDING, now) for i, item in enumerate(items)]
+            )
+            self._conn.executemany(
+                "INSERT INTO batch_images (batch_id, name, data) VALUES (?, ?, ?)",
+                [(batch_id, name, data) for name, data in images.items()]
+            )
+    
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """查询批量任务及各状态的条目数"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+            if row is None:
+                return None
+            counts = self._conn.execute(
+                "SELECT status, COUNT(*) AS count FROM batch_items WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall()
+        batch = dict(row)
+        batch["options"] = json.loads(batch["options"])
+        batch["counts"] = {status: 0 for status in (BatchStore.PENDING, BatchStore.SUCCEEDED, BatchStore.FAILED)}
+        batch["counts"].update({count["status"]: count["count"] for count in counts})
+        return batch
+    
+    def list_items(self, batch_id: str) -> List[Dict[str, Any]]:
+        """按顺序列出批量任务的所有条目"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM batch_items WHERE batch_id = ? ORDER BY position", (batch_id,)
+            ).fetchall()
+        items = []
+        for row in rows:
+            item = dict(row)
+            item["params"] = json.loads(item["params"])
+            item["image_names"] = json.loads(item["image_names"])
+            item["result"] = json.loads(item["result"]) if item["result"] is not None else None
+            items.append(item)
+        return items
+    
+    def load_images(self, batch_id: str, names: List[str]) -> List[Tuple[bytes, str]]:
+        """按给定顺序读取图片：(原始字节, 图片名)"""
+        if not names:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT name, data FROM batch_images WHERE batch_id = ? AND name IN ({', '.join('?' * len(names))})",
+                (batch_id, *names)
+            ).fetchall()
+        data = {row["name"]: bytes(row["data"]) for row in rows}
+        return [(data[name], name) for name in names]
+    
+    def update_item(self, batch_id: str, position: int, status: str,
+                    result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        """保存条目结果"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE batch_items SET status = ?, result = ?, error = ?, updated_at = ? WHERE batch_id = ? AND position = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, now, batch_id, position)
+            )
+            self._conn.execute("UPDATE batches SET updated_at = ? WHERE batch_id = ?", (now, batch_id))
+    
+    def delete_before(self, timestamp: float) -> int:
+        """删除早于指定时间最后更新的批量任务，返回删除数量"""
+        with self._lock, self._conn:
+            condition = "batch_id IN (SELECT batch_id FROM batches WHERE updated_at < ?)"
+            self._conn.execute(f"DELETE FROM batch_images WHERE {condition}", (timestamp,))
+            self._conn.execute(f"DELETE FROM batch_items WHERE {condition}", (timestamp,))
+            return self._conn.execute("DELETE FROM batches WHERE updated_at < ?", (timestamp,)).rowcount
+    
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,167 @@
+import hashlib
+import os
+import re
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from config import Config
+
+class BlobStore:
+    """本地图片存储：按内容sha256寻址，文件修改时间作为过期依据，供/images/{blob_id}短期访问；
+    设置max_bytes时超出容量按修改时间淘汰最早的图片（touch刷新修改时间，即LRU）"""
+    
+    # blob_id格式：sha256十六进制 + 扩展名
+    BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{2,5}$")
+    
+    def __init__(self, directory: str = Config.BLOB_STORE_DIR, ttl_seconds: float = Config.BLOB_TTL_SECONDS,
+                 max_bytes: Optional[int] = None):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._last_purge = time.time()
+        self.stats = {"stores": 0, "dedup_hits": 0, "bytes_stored": 0, "evictions": 0}
+        os.makedirs(self.directory, exist_ok=True)
+        # 当前占用字节数（仅设置容量上限时统计，启动时扫描一次已有图片）
+        self._total_bytes = sum(size for _, size, _ in self._scan()) if max_bytes else 0
+    
+    def _path(self, blob_id: str) -> str:
+        return os.path.join(self.directory, blob_id[:2], blob_id)
+    
+    def put(self, data: bytes, extension: str) -> str:
+        """保存图片并返回blob_id；内容相同的图片只保存一份，仅刷新过期时间"""
+        tmp_path = self.create_temp_path()
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        return self.commit(tmp_path, hashlib.sha256(data).hexdigest(), extension, len(data))
+    
+    def put_file(self, path: str, extension: str, chunk_size: int = 1024 * 1024) -> str:
+        """按块复制并计算摘要保存图片文件（不整体读入内存），返回blob_id"""
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = self.create_temp_path()
+        try:
+            with open(path, "rb") as source, open(tmp_path, "wb") as f:
+                for chunk in iter(lambda: source.read(chunk_size), b""):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self.commit(tmp_path, digest.hexdigest(), extension, size)
+    
+    def create_temp_path(self) -> str:
+        """流式写入用的临时文件路径，写完后调用commit"""
+        tmp_dir = os.path.join(self.directory, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        return os.path.join(tmp_dir, f"{uuid.uuid4().hex}.tmp")
+    
+    def commit(self, tmp_path: str, digest: str, extension: str, size: int) -> str:
+        """将写完的临时文件按内容摘要移动到存储位置，返回blob_id"""
+        blob_id = f"{digest}.{extension}"
+        path = self._path(blob_id)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            os.utime(path)
+            self.stats["dedup_hits"] += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            self.stats["stores"] += 1
+            self.stats["bytes_stored"] += size
+            if self.max_bytes:
+                self._total_bytes += size
+                if self._total_bytes > self.max_bytes:
+                    self.evict(self.max_bytes)
+        
+        # 周期性清理过期图片
+        if time.time() - self._last_purge > self.ttl_seconds:
+            self._last_purge = time.time()
+            self.purge_expired()
+        return blob_id
+    
+    def read(self, blob_id: str) -> bytes:
+        """读取图片字节"""
+        with open(self._path(blob_id), "rb") as f:
+            return f.read()
+    
+    def get_path(self, blob_id: str) -> Optional[str]:
+        """获取未过期图片的文件路径，ID无效、不存在或已过期时返回None"""
+        if not BlobStore.BLOB_ID_PATTERN.match(blob_id):
+            return None
+        path = self._path(blob_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+        except FileNotFoundError:
+            return None
+        return path
+    
+    def touch(self, blob_id: str) -> bool:
+        """刷新图片的修改时间（延长有效期并标记为最近使用），图片不存在时返回False"""
+        try:
+            os.utime(self._path(blob_id))
+            return True
+        except FileNotFoundError:
+            return False
+    
+    @staticmethod
+    def get_etag(blob_id: str) -> str:
+        """内容摘要即为强ETag"""
+        return f'"{blob_id.split(".")[0]}"'
+    
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        """列出所有图片的(修改时间, 大小, 路径)，不含写入中的临时文件"""
+        entries = []
+        tmp_dir = os.path.join(self.directory, "tmp")
+        for root, _, files in os.walk(self.directory):
+            if root == tmp_dir:
+                continue
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+    
+    def _remove(self, path: str, size: int) -> bool:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        if self.max_bytes:
+            self._total_bytes -= size
+        return True
+    
+    def purge_expired(self) -> int:
+        """删除所有过期图片，返回删除数量"""
+        removed = 0
+        now = time.time()
+        for mtime, size, path in self._scan():
+            if now - mtime > self.ttl_seconds and self._remove(path, size):
+                removed += 1
+        self.stats["evictions"] += removed
+        return removed
+    
+    def evict(self, target_bytes: int) -> int:
+        """按修改时间从早到晚删除图片，直到占用不超过target_bytes，返回删除数量"""
+        entries = self._scan()
+        self._total_bytes = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if self._total_bytes <= target_bytes:
+                break
+            if self._remove(path, size):
+                removed += 1
+        self.stats["evictions"] += removed
+        return removed
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取存储统计"""
+        stats = dict(self.stats)
+        if self.max_bytes:
+            stats["total_bytes"] = self._total_bytes
+            stats["max_bytes"] = self.max_bytes
+        return stats
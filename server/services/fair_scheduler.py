@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Hashable, Mapping, Optional, Tuple
+from config import Config
+from services.resilience import DeadlineExceededError, LatencyTracker
+from utils.metrics_utils import MetricsUtils
+
+class SchedulerQueueFullError(Exception):
+    """客户端排队的请求数超过上限"""
+
+@dataclass(frozen=True)
+class TrafficClient:
+    """调度身份：客户端标识和流量类别"""
+    client_id: str
+    traffic_class: str
+
+class _FIFO(deque):
+    """叶子队列，元素为(请求, 成本)"""
+    
+    def pop_next(self) -> Tuple[Any, float]:
+        return self.popleft()
+
+class _Waiter:
+    __slots__ = ("client", "future")
+    
+    def __init__(self, client: TrafficClient, future: asyncio.Future):
+        self.client = client
+        self.future = future
+
+class _Flow:
+    __slots__ = ("queue", "weight", "deficit", "visited")
+    
+    def __init__(self, queue: Any, weight: float):
+        self.queue = queue
+        self.weight = weight
+        self.deficit = 0.0
+        self.visited = False
+
+class DeficitRoundRobin:
+    """加权差额轮询：轮到的流获得quantum×权重的额度，额度为正时出队并按成本扣减（可透支，透支部分从之后的额度中扣回）；
+    流为空时移出轮询并清零额度。流的队列也可以是另一个DeficitRoundRobin，实现分层调度"""
+    
+    def __init__(self, quantum: float = 1.0):
+        self.quantum = quantum
+        # 只包含非空的流，队首为当前轮到的流
+        self._flows: "OrderedDict[Hashable, _Flow]" = OrderedDict()
+    
+    def __len__(self) -> int:
+        return sum(len(flow.queue) for flow in self._flows.values())
+    
+    def add_flow(self, key: Hashable, queue: Any, weight: float = 1.0) -> Any:
+        """加入流（已存在时只更新权重），返回该流的队列"""
+        flow = self._flows.get(key)
+        if flow is None:
+            flow = self._flows[key] = _Flow(queue, weight)
+        flow.weight = weight
+        return flow.queue
+    
+    def get_queue(self, key: Hashable) -> Any:
+        flow = self._flows.get(key)
+        return flow.queue if flow is not None else None
+    
+    def push(self, key: Hashable, item: Any, cost: float = 1.0, weight: float = 1.0) -> None:
+        """请求加入指定流的队尾"""
+        queue = self.get_queue(key)
+        if queue is None:
+            queue = self.add_flow(key, _FIFO(), weight)
+        queue.append((item, cost))
+    
+    def pop_next(self) -> Tuple[Any, float]:
+        """按轮询顺序取出下一个请求及其成本，队列为空时抛出IndexError"""
+        while self._flows:
+            key, flow = next(iter(self._flows.items()))
+            if not flow.visited:
+                flow.deficit += self.quantum * flow.weight
+                flow.visited = True
+            if flow.deficit > 0:
+                item, cost = flow.queue.pop_next()
+                flow.deficit -= cost
+                if not flow.queue:
+                    del self._flows[key]
+                return item, cost
+            flow.visited = False
+            self._flows.move_to_end(key)
+        raise IndexError("队列为空")
+    
+    def remove(self, key: Hashable, item: Any) -> bool:
+        """从叶子流中移除请求（如排队超时），流变为空时移出轮询"""
+        queue = self.get_queue(key)
+        if queue is None:
+            return False
+        for entry in queue:
+            if entry[0] is item:
+                queue.remove(entry)
+                self.prune(key)
+                return True
+        return False
+    
+    def prune(self, key: Hashable) -> None:
+        """流的队列为空时移出轮询"""
+        flow = self._flows.get(key)
+        if flow is not None and not flow.queue:
+            del self._flows[key]
+
+class FairScheduler:
+    """上游调用的加权公平调度：请求按流量类别和客户端分别排队，两级加权差额轮询（先类别、再类别内的客户端）
+    把空闲的上游并发名额分配给排队的请求，成本按图片数计。名额不按类别预留，低权重类别可使用其余类别未用的容量"""
+    
+    def __init__(self, max_concurrent: int = Config.SCHEDULER_MAX_CONCURRENT,
+                 classes: Optional[Mapping[str, float]] = None,
+                 clients: Optional[Mapping[str, Mapping[str, Any]]] = None,
+                 default_class: str = Config.SCHEDULER_DEFAULT_CLASS,
+                 quantum: float = Config.SCHEDULER_QUANTUM,
+                 max_queued_per_client: int = Config.SCHEDULER_MAX_QUEUED_PER_CLIENT):
+        self.max_concurrent = max_concurrent
+        self.classes = dict(Config.SCHEDULER_CLASSES if classes is None else classes)
+        self.clients = dict(Config.SCHEDULER_CLIENTS if clients is None else clients)
+        self.default_class = default_class if default_class in self.classes else next(iter(self.classes))
+        self.quantum = quantum
+        self.max_queued_per_client = max_queued_per_client
+        self._queue = DeficitRoundRobin(quantum)
+        self._in_flight = 0
+        # 客户端标识 -> 排队中的请求数
+        self._queued: Dict[str, int] = {}
+        self.stats = {"dispatched": 0, "queued_total": 0, "rejected": 0, "timeouts": 0}
+        self._class_stats = {
+            name: {"queued": 0, "in_flight": 0, "dispatched": 0, "wait_seconds": 0.0} for name in self.classes
+        }
+        self._waits = {name: LatencyTracker(Config.SCHEDULER_WAIT_SAMPLES) for name in self.classes}
+    
+    def identify(self, headers: Mapping[str, str], host: Optional[str] = None,
+                 default_class: Optional[str] = None) -> TrafficClient:
+        """按请求头确定调度身份：令牌摘要 > X-Client-Id > 客户端IP；配置中固定了类别的客户端使用该类别，
+        否则使用接口的默认类别；请求头只能把类别降为权重更低的类别"""
+        client_id = None
+        for name in Config.SCHEDULER_TOKEN_HEADERS:
+            value = headers.get(name)
+            if value:
+                client_id = f"token:{hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]}"
+                break
+        if client_id is None:
+            value = headers.get(Config.SCHEDULER_CLIENT_HEADER)
+            client_id = f"id:{value[:64]}" if value else f"ip:{host or 'unknown'}"
+        
+        traffic_class = self.clients.get(client_id, {}).get("class") or default_class
+        if traffic_class not in self.classes:
+            traffic_class = self.default_class
+        requested = headers.get(Config.SCHEDULER_CLASS_HEADER)
+        if requested in self.classes and self.classes[requested] < self.classes[traffic_class]:
+            traffic_class = requested
+        return TrafficClient(client_id=client_id, traffic_class=traffic_class)
+    
+    def resolve(self, client: Optional[TrafficClient]) -> TrafficClient:
+        """实际使用的调度身份：未提供时为内部客户端，未知类别按默认类别"""
+        if client is None:
+            return TrafficClient(client_id="internal", traffic_class=self.default_class)
+        if client.traffic_class not in self.classes:
+            return TrafficClient(client_id=client.client_id, traffic_class=self.default_class)
+        return client
+    
+    @asynccontextmanager
+    async def slot(self, client: Optional[TrafficClient] = None, cost: float = 1.0,
+                   timeout: Optional[float] = None) -> AsyncIterator[None]:
+        """排队获取一个上游并发名额；超过timeout仍未获得时抛出DeadlineExceededError，
+        客户端排队数超过上限时抛出SchedulerQueueFullError"""
+        client = self.resolve(client)
+        traffic_class = client.traffic_class
+        start = time.monotonic()
+        
+        if self._in_flight < self.max_concurrent and not len(self._queue):
+            self._in_flight += 1
+        else:
+            if self._queued.get(client.client_id, 0) >= self.max_queued_per_client:
+                self.stats["rejected"] += 1
+                raise SchedulerQueueFullError(f"客户端排队请求数超过上限{self.max_queued_per_client}，请稍后重试")
+            await self._wait(client, cost, timeout)
+        
+        waited = time.monotonic() - start
+        self._waits[traffic_class].record(waited)
+        MetricsUtils.observe_queue_wait(traffic_class, waited)
+        self.stats["dispatched"] += 1
+        class_stats = self._class_stats[traffic_class]
+        class_stats["dispatched"] += 1
+        class_stats["wait_seconds"] += waited
+        class_stats["in_flight"] += 1
+        try:
+            yield
+        finally:
+            class_stats["in_flight"] -= 1
+            self._in_flight -= 1
+            self._dispatch()
+    
+    async def _wait(self, client: TrafficClient, cost: float, timeout: Optional[float]) -> None:
+        """加入客户端队列并等待被调度（调度时名额已计入在途数）"""
+        waiter = _Waiter(client, asyncio.get_running_loop().create_future())
+        clients = self._queue.get_queue(client.traffic_class)
+        if clients is None:
+            clients = DeficitRoundRobin(self.quantum)
+        self._queue.add_flow(client.traffic_class, clients, self.classes[client.traffic_class])
+        clients.push(client.client_id, waiter, cost, self.clients.get(client.client_id, {}).get("weight", 1))
+        self._queued[client.client_id] = self._queued.get(client.client_id, 0) + 1
+        self._class_stats[client.traffic_class]["queued"] += 1
+        self.stats["queued_total"] += 1
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 已被调度但调用方同时被取消：归还名额
+                self._in_flight -= 1
+                self._dispatch()
+            elif clients.remove(client.client_id, waiter):
+                self._queue.prune(client.traffic_class)
+                self._dequeued(client)
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["timeouts"] += 1
+                raise DeadlineExceededError("等待上游调度超过截止时间")
+            raise
+    
+    def _dequeued(self, client: TrafficClient) -> None:
+        remaining = self._queued.get(client.client_id, 0) - 1
+        if remaining > 0:
+            self._queued[client.client_id] = remaining
+        else:
+            self._queued.pop(client.client_id, None)
+        self._class_stats[client.traffic_class]["queued"] -= 1
+    
+    def _dispatch(self) -> None:
+        """把空闲名额依次分配给轮询选出的请求"""
+        while self._in_flight < self.max_concurrent and len(self._queue):
+            waiter, _ = self._queue.pop_next()
+            self._dequeued(waiter.client)
+            # 等待已取消（超时或调用方断开）的请求跳过
+            if waiter.future.done():
+                continue
+            self._in_flight += 1
+            waiter.future.set_result(None)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取调度统计：在途与排队数，以及各类别的排队时间分位数"""
+        stats = dict(self.stats)
+        stats["max_concurrent"] = self.max_concurrent
+        stats["in_flight"] = self._in_flight
+        stats["queued"] = len(self._queue)
+        stats["queued_clients"] = len(self._queued)
+        classes = {}
+        for name, class_stats in self._class_stats.items():
+            p50 = self._waits[name].percentile(50, min_samples=1)
+            p95 = self._waits[name].percentile(95, min_samples=1)
+            classes[name] = dict(
+                class_stats, weight=self.classes[name], wait_seconds=round(class_stats["wait_seconds"], 3),
+                wait_p50=round(p50, 4) if p50 is not None else None,
+                wait_p95=round(p95, 4) if p95 is not None else None
+            )
+        stats["classes"] = classes
+        return stats
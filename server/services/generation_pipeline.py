@@ -0,0 +1,552 @@
+import asyncio
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional, Callable, Awaitable, AsyncIterator, Tuple, Union
+from config import Config
+from models.image_input import InputImage
+from models.image_output import OutputImage
+from models.image_response import ImageGenerationResponse, GeneratedImage, GeneratedVariant
+from models.model_registry import ModelRegistry
+from models.roi_edit import RoiEdit
+from services.blob_store import BlobStore
+from services.fair_scheduler import TrafficClient
+from services.image_generator import ImageGenerator
+from services.image_preprocessor import ImagePreprocessor
+from services.resilience import Deadline
+from services.result_materializer import ResultMaterializer
+from utils.image_utils import ImageUtils
+from utils.logger_utils import LoggerUtils
+from utils.metrics_utils import MetricsUtils
+from utils.response_utils import ResponseUtils
+from utils.roi_utils import Box, RoiUtils
+from utils.tile_utils import TileGrid, TileUtils
+
+# 进度回调：(阶段, 进度百分比)
+ProgressCallback = Callable[[str, int], Awaitable[None]]
+
+@dataclass
+class VariantOutcome:
+    """多候选生成中一个候选的结果：成功时为上游结果和结果图片，失败时为异常"""
+    index: int
+    seed: int
+    elapsed_seconds: float
+    result: Dict[str, Any] = field(default_factory=dict)
+    outputs: List[OutputImage] = field(default_factory=list)
+    error: Optional[Exception] = None
+
+class GenerationPipeline:
+    """图片生成流程：预处理 → 调用上游 → 解码/保存结果 → 记录日志 → 构建响应（同步接口与异步任务共用）"""
+    
+    def __init__(self, image_generator: ImageGenerator, image_preprocessor: ImagePreprocessor,
+                 logger: logging.Logger, blob_store: Optional[BlobStore] = None):
+        self.image_generator = image_generator
+        self.image_preprocessor = image_preprocessor
+        self.logger = logger
+        self.blob_store = blob_store
+        # URL结果通过上游客户端的共享连接池下载
+        self.materializer = ResultMaterializer(blob_store, lambda: image_generator.client)
+    
+    async def run(self, images: List[InputImage], params: Dict[str, Any],
+                  start_time: Optional[float] = None,
+                  progress: Optional[ProgressCallback] = None,
+                  deadline: Optional[Deadline] = None,
+                  response_mode: str = ResponseUtils.MODE_JSON,
+                  client: Optional[TrafficClient] = None,
+                  roi: Optional[RoiEdit] = None) -> ImageGenerationResponse:
+        """执行一次图片生成并按响应模式（json/url）构建响应，失败时抛出原异常"""
+        result, outputs = await self.generate(
+            images, params, start_time=start_time, progress=progress, deadline=deadline,
+            store=response_mode == ResponseUtils.MODE_URL, client=client, roi=roi
+        )
+        return GenerationPipeline.build_response(result, outputs, response_mode)
+    
+    async def generate(self, images: List[InputImage], params: Dict[str, Any],
+                       start_time: Optional[float] = None,
+                       progress: Optional[ProgressCallback] = None,
+                       deadline: Optional[Deadline] = None,
+                       store: bool = False,
+                       client: Optional[TrafficClient] = None,
+                       roi: Optional[RoiEdit] = None) -> Tuple[Dict[str, Any], List[OutputImage]]:
+        """执行一次图片生成，返回上游结果和结果图片（store为True时保存到本地图片存储且URL结果不读入内存），
+        成功或失败都会记录调用日志，失败时抛出原异常；client为上游公平调度使用的客户端身份，
+        roi为prepare_roi返回的局部编辑信息（images中的第一张已替换为裁剪区域），结果合成回完整分辨率的原图"""
+        # 记录API调用开始时间
+        start_time = start_time or time.time()
+        if roi is not None:
+            params = GenerationPipeline.roi_params(params, roi)
+        
+        # 初始化日志数据
+        input_images_log = []
+        output_images_log = []
+        preprocess_bytes_saved = None
+        result = {}
+        
+        async def report(stage: str, percent: int) -> None:
+            if progress is not None:
+                await progress(stage, percent)
+        
+        try:
+            with MetricsUtils.in_flight.track(kind="pipeline"):
+                # 按模型策略预处理图片（缩放、方向校正、去除元数据）
+                await report("preprocessing", 10)
+                images, preprocess_bytes_saved = await self._prepare_inputs(images, params["model"], input_images_log, roi)
+                
+                # 调用图片生成服务
+                await report("generating", 30)
+                result = await self.image_generator.generate_images(images=images, deadline=deadline, client=client, **params)
+                
+                # 获取结果图片：base64直接解码，URL并发下载到本地存储（仅解析文件头）
+                await report("materializing", 90)
+                outputs = await self._materialize(result, store, deadline, roi, output_images_log)
+        except Exception as e:
+            self._log(params, input_images_log, output_images_log, start_time, "failed",
+                      error_message=str(e), preprocess_bytes_saved=preprocess_bytes_saved)
+            raise
+        
+        self._log(params, input_images_log, output_images_log, start_time, "success",
+                  result=result, preprocess_bytes_saved=preprocess_bytes_saved)
+        return result, outputs
+    
+    async def generate_variants(self, images: List[InputImage], params: Dict[str, Any], num_variants: int,
+                                start_time: Optional[float] = None,
+                                deadline: Optional[Deadline] = None,
+                                store: bool = False,
+                                client: Optional[TrafficClient] = None,
+                                roi: Optional[RoiEdit] = None) -> AsyncIterator[VariantOutcome]:
+        """多候选生成：输入图片只预处理和编码一次，按派生种子并发调用上游（各自经公平调度排队），
+        返回按完成顺序产出各候选结果的异步迭代器（开始迭代时才调用上游）；预处理失败时直接抛出异常，单个候选失败时该候选带错误信息。
+        每个候选各自记录调用日志，迭代中止时取消并等待未完成的候选"""
+        start_time = start_time or time.time()
+        if roi is not None:
+            params = GenerationPipeline.roi_params(params, roi)
+        input_images_log = []
+        preprocess_bytes_saved = None
+        seeds = GenerationPipeline.derive_seeds(params.get("seed"), num_variants)
+        try:
+            with MetricsUtils.in_flight.track(kind="pipeline"):
+                images, preprocess_bytes_saved = await self._prepare_inputs(images, params["model"], input_images_log, roi)
+                # 各候选共用同一个请求体（data URL只拼接一次），仅种子不同
+                payload = self.image_generator.build_payload(images=images, **params)
+        except Exception as e:
+            self._log(dict(params, seed=seeds[0]), input_images_log, [], start_time, "failed",
+                      error_message=str(e), preprocess_bytes_saved=preprocess_bytes_saved)
+            raise
+        
+        async def run_one(index: int, seed: int) -> VariantOutcome:
+            variant_start = time.perf_counter()
+            variant_params = dict(params, seed=seed)
+            output_images_log = []
+            try:
+                with MetricsUtils.in_flight.track(kind="pipeline"):
+                    result = await self.image_generator.generate_from_payload(dict(payload, seed=seed), deadline, client)
+                    outputs = await self._materialize(result, store, deadline, roi, output_images_log)
+            except Exception as e:
+                self._log(variant_params, input_images_log, output_images_log, start_time, "failed",
+                          error_message=str(e), preprocess_bytes_saved=preprocess_bytes_saved)
+                return VariantOutcome(index=index, seed=seed, elapsed_seconds=time.perf_counter() - variant_start, error=e)
+            self._log(variant_params, input_images_log, output_images_log, start_time, "success",
+                      result=result, preprocess_bytes_saved=preprocess_bytes_saved)
+            return VariantOutcome(index=index, seed=seed, elapsed_seconds=time.perf_counter() - variant_start,
+                                  result=result, outputs=outputs)
+        
+        async def iterate() -> AsyncIterator[VariantOutcome]:
+            # 开始迭代时才发起上游调用：迭代器未被使用就丢弃时不会留下无人等待的任务
+            tasks = [asyncio.ensure_future(run_one(index, seed)) for index, seed in enumerate(seeds)]
+            try:
+                for future in asyncio.as_completed(tasks):
+                    yield await future
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        
+        return iterate()
+    
+    async def run_variants(self, images: List[InputImage], params: Dict[str, Any], num_variants: int,
+                           start_time: Optional[float] = None,
+                           deadline: Optional[Deadline] = None,
+                           response_mode: str = ResponseUtils.MODE_JSON,
+                           client: Optional[TrafficClient] = None,
+                           roi: Optional[RoiEdit] = None) -> ImageGenerationResponse:
+        """多候选生成并构建合并响应（图片按候选顺序排列，variants中为各候选的种子、耗时和图片序号）；
+        所有候选都失败时抛出第一个候选的异常"""
+        outcomes = await self.generate_variants(
+            images, params, num_variants, start_time=start_time, deadline=deadline,
+            store=response_mode == ResponseUtils.MODE_URL, client=client, roi=roi
+        )
+        collected = sorted([outcome async for outcome in outcomes], key=lambda outcome: outcome.index)
+        if all(outcome.error is not None for outcome in collected):
+            raise collected[0].error
+        return GenerationPipeline.build_variants_response(collected, response_mode)
+    
+    @staticmethod
+    async def iter_variant_groups(outcomes: AsyncIterator[VariantOutcome]) -> AsyncIterator[Tuple[Dict[str, Any], List[OutputImage]]]:
+        """把候选结果转换为multipart分组（候选元数据和图片），中止时取消未完成的候选"""
+        try:
+            async for outcome in outcomes:
+                yield GenerationPipeline.build_variant_metadata(outcome), outcome.outputs
+        finally:
+            await outcomes.aclose()
+    
+    @staticmethod
+    def derive_seeds(seed: Optional[int], count: int) -> List[int]:
+        """各候选的种子：第一个为请求的种子（未指定时随机生成），其余依次加1（超出取值范围时回绕），
+        固定种子的相同请求得到相同的候选"""
+        limits = Config.MODEL_PARAM_RANGES["seed"]
+        if seed is None:
+            seed = random.randint(limits["min"], limits["max"])
+        span = limits["max"] - limits["min"] + 1
+        return [limits["min"] + (seed - limits["min"] + i) % span for i in range(count)]
+    
+    async def _prepare_inputs(self, images: List[InputImage], model: str, input_images_log: List[Dict[str, Any]],
+                              roi: Optional[RoiEdit] = None) -> Tuple[List[InputImage], Optional[int]]:
+        """预处理输入图片并记录其日志信息，返回处理后的图片和预处理节省的字节数"""
+        with MetricsUtils.timer(MetricsUtils.STAGE_PREPROCESS):
+            images = await self.image_preprocessor.process(images, model)
+        
+        # 记录输入图片信息（base64与上游请求共用同一次编码，在执行器中完成）
+        for i, image in enumerate(images):
+            image_info = await ImageUtils.run_async(image.get_image_info, i, Config.IMAGE_BASE64_PREVIEW_LENGTH,
+                                                    stage=MetricsUtils.STAGE_ENCODE)
+            input_images_log.append(image_info)
+        if roi is not None:
+            input_images_log[0]["roi"] = roi.to_log()
+        return images, ImagePreprocessor.get_bytes_saved(images)
+    
+    async def _materialize(self, result: Dict[str, Any], store: bool, deadline: Optional[Deadline],
+                           roi: Optional[RoiEdit], output_images_log: List[Dict[str, Any]]) -> List[OutputImage]:
+        """获取上游结果图片（局部编辑时合成回原图）并记录其日志信息"""
+        with MetricsUtils.timer(MetricsUtils.STAGE_MATERIALIZE):
+            if roi is None:
+                outputs = await self.materializer.materialize(result["images"], store=store, load=not store, deadline=deadline)
+            else:
+                # 局部编辑的结果需要读入内存合成，合成后的完整图片再按需保存
+                outputs = await self.materializer.materialize(result["images"], load=True, deadline=deadline)
+        if roi is not None:
+            outputs = list(await asyncio.gather(*[self._composite(roi, image, store) for image in outputs]))
+        for i, image in enumerate(outputs):
+            MetricsUtils.observe_bytes("result", image.size)
+            output_images_log.append(image.get_image_info(i, Config.IMAGE_BASE64_PREVIEW_LENGTH))
+        return outputs
+    
+    async def prepare_roi(self, images: List[InputImage], box: Optional[Box] = None,
+                          mask: Optional[InputImage] = None) -> Tuple[List[InputImage], RoiEdit]:
+        """局部编辑：把第一张图片裁剪为编辑区域（box或mask覆盖范围）及其周边的上下文，返回替换后的输入图片和合成所需的信息；
+        区域无效时抛出ValueError"""
+        original = images[0]
+        mask_data = bytes(mask.data) if mask is not None else None
+        data, edit_box, crop_box, padding, size = await ImageUtils.run_async(
+            RoiUtils.crop, GenerationPipeline._payload(original), box, mask_data,
+            heavy=Config.ROI_IN_PROCESS, stage=MetricsUtils.STAGE_ROI
+        )
+        roi = RoiEdit(original=original, edit_box=edit_box, crop_box=crop_box, padding=padding, size=size, mask=mask_data)
+        cropped = InputImage.from_bytes(data, filename=original.filename)
+        return [cropped] + list(images[1:]), roi
+    
+    @staticmethod
+    def roi_params(params: Dict[str, Any], roi: RoiEdit) -> Dict[str, Any]:
+        """局部编辑的生成参数：支持image_size的模型改用宽高比与裁剪区域最接近的可用尺寸（合成时再缩放回裁剪尺寸）"""
+        if not ModelRegistry.get_default().get(params["model"]).custom_size:
+            return params
+        width, height = roi.crop_box[2] - roi.crop_box[0], roi.crop_box[3] - roi.crop_box[1]
+        size = TileUtils.nearest_size(width, height, GenerationPipeline.tile_sizes(params["model"]))
+        return dict(params, image_size=f"{size[0]}x{size[1]}")
+    
+    async def _composite(self, roi: RoiEdit, image: OutputImage, store: bool) -> OutputImage:
+        """把裁剪区域的编辑结果合成回原图，store为True时保存合成结果"""
+        data = await ImageUtils.run_async(
+            RoiUtils.composite, GenerationPipeline._payload(roi.original), image.data, roi.edit_box, roi.crop_box,
+            roi.padding, roi.mask, heavy=Config.ROI_IN_PROCESS, stage=MetricsUtils.STAGE_ROI
+        )
+        width, height, format, mime_type = ImageUtils.probe_image(data)
+        composite = OutputImage(data=data, width=width, height=height, format=format, mime_type=mime_type,
+                                size=len(data), source_url=image.source_url)
+        if store:
+            composite.blob_id = await asyncio.to_thread(self.blob_store.put, data, composite.extension)
+        return composite
+    
+    async def generate_tiled(self, images: List[InputImage], params: Dict[str, Any],
+                             start_time: Optional[float] = None,
+                             progress: Optional[ProgressCallback] = None,
+                             deadline: Optional[Deadline] = None,
+                             store: bool = False,
+                             client: Optional[TrafficClient] = None) -> Tuple[Dict[str, Any], List[OutputImage]]:
+        """分块编辑：第一张图片按完整分辨率切分为重叠分块（尺寸取自模型可用尺寸），以相同的种子和提示词并发编辑
+        （每个请求最多TILE_CONCURRENCY个分块同时进行），结果在重叠区域渐变融合后拼接为完整分辨率的图片；
+        其余图片作为参考图片随每个分块发送。原图和分块结果以内存映射文件暂存在磁盘，拼接和编码按行带进行。
+        像素数或分块数超出上限时抛出ValueError，任一分块失败时取消其余分块并抛出原异常"""
+        start_time = start_time or time.time()
+        input_images_log = []
+        output_images_log = []
+        preprocess_bytes_saved = None
+        seed = GenerationPipeline.derive_seeds(params.get("seed"), 1)[0]
+        tile_params = dict(params, seed=seed, batch_size=1)
+        result = {}
+        
+        async def report(stage: str, percent: int) -> None:
+            if progress is not None:
+                await progress(stage, percent)
+        
+        work_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="tiles-", dir=Config.TILE_WORK_DIR)
+        try:
+            with MetricsUtils.in_flight.track(kind="pipeline"):
+                # 原图解码为磁盘上的RGB数组，之后每个分块单独读取；内存映射的原图直接使用其文件
+                await report("preprocessing", 5)
+                source = images[0]
+                # 解码前按文件头尺寸检查像素数和分块数
+                GenerationPipeline.plan_tiles(source.width, source.height, params["model"])
+                source_path = source.path
+                raw_path = os.path.join(work_dir, "raw.npy")
+                if source_path is None:
+                    source_path = os.path.join(work_dir, "source")
+                    await asyncio.to_thread(GenerationPipeline._write_file, source_path, source.data)
+                width, height, format, icc_profile = await ImageUtils.run_async(
+                    TileUtils.unpack, source_path, raw_path, heavy=Config.TILE_IN_PROCESS, stage=MetricsUtils.STAGE_TILE
+                )
+                grid = GenerationPipeline.plan_tiles(width, height, params["model"])
+                input_images_log.append(ImageUtils.build_image_info(
+                    width, height, source.format, "", 0, bytes=len(source.data),
+                    tiles={"count": grid.count, "tile_size": f"{grid.tile_width}x{grid.tile_height}"}
+                ))
+                
+                # 参考图片只预处理和编码一次，所有分块共用
+                references_log = []
+                references, preprocess_bytes_saved = await self._prepare_inputs(list(images[1:]), params["model"], references_log)
+                for info in references_log:
+                    info["index"] += 1
+                input_images_log.extend(references_log)
+                
+                spec = ModelRegistry.get_default().get(params["model"])
+                if spec.custom_size:
+                    size = TileUtils.nearest_size(grid.tile_width, grid.tile_height, GenerationPipeline.tile_sizes(params["model"]))
+                    tile_params["image_size"] = f"{size[0]}x{size[1]}"
+                policy = ImagePreprocessor.get_policy(params["model"])
+                tile_format = policy.get("format", "auto")
+                tile_format = "JPEG" if tile_format == "auto" else tile_format
+                tile_paths = [os.path.join(work_dir, f"tile_{i}.npy") for i in range(grid.count)]
+                semaphore = asyncio.Semaphore(Config.TILE_CONCURRENCY)
+                tile_timings = []
+                
+                async def edit_tile(index: int, box: Box) -> None:
+                    async with semaphore:
+                        data = await ImageUtils.run_async(
+                            TileUtils.read_tile, raw_path, box, tile_format, policy.get("quality", 90),
+                            heavy=Config.TILE_IN_PROCESS, stage=MetricsUtils.STAGE_TILE
+                        )
+                        tile = InputImage.from_bytes(data, filename=f"tile_{index}")
+                        tile_result = await self.image_generator.generate_images(
+                            images=[tile] + references, deadline=deadline, client=client, **tile_params
+                        )
+                        with MetricsUtils.timer(MetricsUtils.STAGE_MATERIALIZE):
+                            outputs = await self.materializer.materialize(tile_result["images"][:1], load=True, deadline=deadline)
+                        await ImageUtils.run_async(
+                            TileUtils.store_tile, outputs[0].data, tile_paths[index], (grid.tile_width, grid.tile_height),
+                            heavy=Config.TILE_IN_PROCESS, stage=MetricsUtils.STAGE_TILE
+                        )
+                    tile_timings.append(tile_result.get("timings") or {})
+                    await report("generating", 10 + 80 * len(tile_timings) // grid.count)
+                
+                await report("generating", 10)
+                tasks = [asyncio.ensure_future(edit_tile(index, box)) for index, box in enumerate(grid.boxes)]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    # 等待被取消的分块结束，之后才删除其使用的中间文件
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                
+                # 按行带融合拼接并编码到文件，url模式从文件保存到图片存储，结果不读入内存
+                await report("materializing", 90)
+                output_path = os.path.join(work_dir, "output")
+                await ImageUtils.run_async(
+                    TileUtils.assemble, grid, tile_paths, output_path, format, icc_profile,
+                    heavy=Config.TILE_IN_PROCESS, stage=MetricsUtils.STAGE_TILE
+                )
+                width, height, output_format, mime_type = await asyncio.to_thread(ImageUtils.probe_image_file, output_path)
+                output = OutputImage(data=None, width=width, height=height, format=output_format, mime_type=mime_type,
+                                     size=os.path.getsize(output_path))
+                if store:
+                    output.blob_id = await asyncio.to_thread(self.blob_store.put_file, output_path, output.extension)
+                else:
+                    output.data = await asyncio.to_thread(GenerationPipeline._read_file, output_path)
+                MetricsUtils.observe_bytes("result", output.size)
+                output_images_log.append(output.get_image_info(0, Config.IMAGE_BASE64_PREVIEW_LENGTH))
+                result = {
+                    "seed": seed,
+                    "timings": {"tiles": grid.count,
+                                "inference": sum(timing.get("inference", 0) for timing in tile_timings)}
+                }
+        except Exception as e:
+            self._log(tile_params, input_images_log, output_images_log, start_time, "failed",
+                      error_message=str(e), preprocess_bytes_saved=preprocess_bytes_saved)
+            raise
+        finally:
+            await asyncio.to_thread(shutil.rmtree, work_dir, True)
+        
+        self._log(tile_params, input_images_log, output_images_log, start_time, "success",
+                  result=result, preprocess_bytes_saved=preprocess_bytes_saved)
+        return result, [output]
+    
+    async def run_tiled(self, images: List[InputImage], params: Dict[str, Any],
+                        start_time: Optional[float] = None,
+                        progress: Optional[ProgressCallback] = None,
+                        deadline: Optional[Deadline] = None,
+                        response_mode: str = ResponseUtils.MODE_JSON,
+                        client: Optional[TrafficClient] = None) -> ImageGenerationResponse:
+        """分块编辑并按响应模式（json/url）构建响应，失败时抛出原异常"""
+        result, outputs = await self.generate_tiled(
+            images, params, start_time=start_time, progress=progress, deadline=deadline,
+            store=response_mode == ResponseUtils.MODE_URL, client=client
+        )
+        return GenerationPipeline.build_response(result, outputs, response_mode)
+    
+    @staticmethod
+    def plan_tiles(width: int, height: int, model: str) -> TileGrid:
+        """按模型可用尺寸规划分块网格，像素数超出TILE_MAX_PIXELS或分块数超出TILE_MAX_TILES时抛出ValueError"""
+        if width * height > Config.TILE_MAX_PIXELS:
+            raise ValueError(f"图片尺寸{width}x{height}超出分块编辑的像素数上限{Config.TILE_MAX_PIXELS}")
+        grid = TileUtils.plan(width, height, GenerationPipeline.tile_sizes(model))
+        if grid.count > Config.TILE_MAX_TILES:
+            raise ValueError(f"图片尺寸{width}x{height}需要{grid.count}个分块，超出上限{Config.TILE_MAX_TILES}")
+        return grid
+    
+    @staticmethod
+    def tile_sizes(model: str) -> List[Tuple[int, int]]:
+        """模型尺寸分组的可用尺寸（宽, 高），不支持image_size的编辑模型同样按分组尺寸分块"""
+        family = ImagePreprocessor.get_size_family(model)
+        return [tuple(int(v) for v in size.split("x")) for size in Config.AVAILABLE_IMAGE_SIZES.get(family, [])]
+    
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        """读取分块编辑的结果文件"""
+        with open(path, "rb") as f:
+            return f.read()
+    
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        """写入分块编辑的原图文件"""
+        with open(path, "wb") as f:
+            f.write(data)
+    
+    @staticmethod
+    def _payload(image: InputImage) -> Union[bytes, str]:
+        """传入进程池的图片数据：内存映射只传文件路径（由子进程读取），没有文件时转换为bytes"""
+        if isinstance(image.data, bytes):
+            return image.data
+        return image.path if image.path is not None else bytes(image.data)
+    
+    @staticmethod
+    def build_response(result: Dict[str, Any], outputs: List[OutputImage],
+                       response_mode: str = ResponseUtils.MODE_JSON) -> ImageGenerationResponse:
+        """构建JSON响应：json模式嵌入base64，url模式返回/images/{blob_id}链接"""
+        generated_images = []
+        for i, image in enumerate(outputs):
+            if response_mode == ResponseUtils.MODE_URL:
+                generated_images.append(GeneratedImage(url=f"/images/{image.blob_id}", mime_type=image.mime_type, index=i))
+            else:
+                generated_images.append(GeneratedImage(base64=image.base64, mime_type=image.mime_type, index=i))
+        
+        return ImageGenerationResponse(
+            success=True,
+            message="图片生成成功",
+            images=generated_images,
+            seed=result.get("seed"),
+            timing=result.get("timings")
+        )
+    
+    @staticmethod
+    def build_variants_response(outcomes: List[VariantOutcome],
+                                response_mode: str = ResponseUtils.MODE_JSON) -> ImageGenerationResponse:
+        """构建多候选的合并响应：images依次为各候选的图片，variants记录每个候选的种子、耗时和对应的图片序号"""
+        generated_images = []
+        variants = []
+        for outcome in outcomes:
+            indexes = []
+            for image in outcome.outputs:
+                index = len(generated_images)
+                indexes.append(index)
+                if response_mode == ResponseUtils.MODE_URL:
+                    generated_images.append(GeneratedImage(url=f"/images/{image.blob_id}", mime_type=image.mime_type, index=index))
+                else:
+                    generated_images.append(GeneratedImage(base64=image.base64, mime_type=image.mime_type, index=index))
+            variants.append(GeneratedVariant(**GenerationPipeline.build_variant_metadata(outcome, with_images=False),
+                                             image_indexes=indexes))
+        
+        failed = sum(1 for outcome in outcomes if outcome.error is not None)
+        return ImageGenerationResponse(
+            success=True,
+            message="图片生成成功" if not failed else f"图片生成部分成功，{failed}个候选失败",
+            images=generated_images,
+            seed=outcomes[0].seed,
+            variants=variants
+        )
+    
+    @staticmethod
+    def build_variant_metadata(outcome: VariantOutcome, with_images: bool = True) -> Dict[str, Any]:
+        """单个候选的元数据（multipart响应中每个候选图片之前的JSON段）"""
+        metadata = {
+            "variant_index": outcome.index,
+            "seed": outcome.seed,
+            "success": outcome.error is None,
+            "message": "图片生成成功" if outcome.error is None else f"图片生成失败: {str(outcome.error)}",
+            "timing": outcome.result.get("timings"),
+            "elapsed_seconds": round(outcome.elapsed_seconds, 4)
+        }
+        if with_images:
+            metadata["images"] = [
+                {"index": i, "mime_type": image.mime_type, "width": image.width,
+                 "height": image.height, "bytes": image.size}
+                for i, image in enumerate(outcome.outputs)
+            ]
+        return metadata
+    
+    @staticmethod
+    def build_metadata(result: Dict[str, Any], outputs: List[OutputImage]) -> Dict[str, Any]:
+        """multipart响应首段的JSON元数据"""
+        return {
+            "success": True,
+            "message": "图片生成成功",
+            "seed": result.get("seed"),
+            "timing": result.get("timings"),
+            "images": [
+                {"index": i, "mime_type": image.mime_type, "width": image.width,
+                 "height": image.height, "bytes": image.size}
+                for i, image in enumerate(outputs)
+            ]
+        }
+    
+    def _log(self, params: Dict[str, Any], input_images_log: List[Dict[str, Any]],
+             output_images_log: List[Dict[str, Any]], start_time: float, status: str,
+             result: Optional[Dict[str, Any]] = None, error_message: Optional[str] = None,
+             preprocess_bytes_saved: Optional[int] = None) -> None:
+        """记录API调用日志，并记录总耗时"""
+        result = result or {}
+        total_time_seconds = time.time() - start_time
+        MetricsUtils.observe_stage(MetricsUtils.STAGE_TOTAL, total_time_seconds)
+        with MetricsUtils.timer(MetricsUtils.STAGE_LOGGING):
+            LoggerUtils.log_api_call(
+                logger=self.logger,
+                api_key=Config.API_KEY,
+                model=params["model"],
+                prompt=params["prompt"],
+                negative_prompt=params.get("negative_prompt", ""),
+                input_images=input_images_log,
+                output_images=output_images_log,
+                status=status,
+                error_message=error_message,
+                seed=result.get("seed", params.get("seed")),
+                image_size=params.get("image_size"),
+                batch_size=params.get("batch_size"),
+                num_inference_steps=params.get("num_inference_steps"),
+                guidance_scale=params.get("guidance_scale"),
+                cfg=params.get("cfg"),
+                total_time_seconds=total_time_seconds,
+                timing=result.get("timings"),
+                preprocess_bytes_saved=preprocess_bytes_saved
+            )
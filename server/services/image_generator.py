@@ -1,23 +1,199 @@
-import requests
-from typing import List, Optional, Dict, Any
-from PIL import Image
+import asyncio
+import json
+import httpx
+from typing import List, Optional, Dict, Any, Union, TYPE_CHECKING
 from config import Config
-from utils.image_utils import ImageUtils
+from models.image_input import InputImage
+from models.model_registry import ModelRegistry
+from services.backend_pool import Backend, BackendPool
+from services.fair_scheduler import FairScheduler, TrafficClient
+from services.rate_governor import RateGovernor, UpstreamRateLimitError
+from services.resilience import Deadline, DeadlineExceededError, ResilientCaller
+from services.result_cache import ResultCache
+from services.single_flight import SingleFlight
+from utils.metrics_utils import MetricsUtils
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+try:
+    import h2  # noqa: F401  HTTP/2依赖为可选项
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 class ImageGenerator:
-    def __init__(self):
-        self.api_key = Config.API_KEY
-        self.api_base_url = Config.API_BASE_URL
-        self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
+    def __init__(self, client: Optional[httpx.AsyncClient] = None, cache: Optional[ResultCache] = None,
+                 rate_governor: Optional[RateGovernor] = None, backend_pool: Optional[BackendPool] = None,
+                 scheduler: Optional[FairScheduler] = None):
+        # 上游后端池（未显式传入时按配置创建）
+        self.backend_pool = backend_pool or BackendPool.from_config()
+        self._client = client
+        
+        # 结果缓存（未显式传入时按配置创建）
+        if cache is None and Config.RESULT_CACHE_ENABLED:
+            cache = ResultCache()
+        self.cache = cache
+        
+        # 上游速率控制（未显式传入时按配置创建）
+        if rate_governor is None and Config.RATE_LIMIT_ENABLED:
+            rate_governor = RateGovernor()
+        self.rate_governor = rate_governor
+        
+        # 按流量类别和客户端的公平调度（未显式传入时按配置创建）
+        if scheduler is None and Config.SCHEDULER_ENABLED:
+            scheduler = FairScheduler()
+        self.scheduler = scheduler
+        
+        # 截止时间、重试与对冲请求
+        self.resilience = ResilientCaller()
+        
+        # 并发相同请求合并
+        self.single_flight = SingleFlight() if Config.SINGLE_FLIGHT_ENABLED else None
+        
+        # 连接复用统计
+        self.connection_stats = {
+            "requests": 0,
+            "in_flight": 0,
+            "new_connections": 0,
+            "reused_connections": 0
         }
     
-    def generate_images(self, model: str, prompt: str, images: Optional[List[Image.Image]] = None, 
-                       negative_prompt: str = "", image_size: Optional[str] = None, 
-                       batch_size: int = 1, seed: Optional[int] = None, 
-                       num_inference_steps: int = 20, guidance_scale: float = 7.5, cfg: float = 4.0) -> Dict[str, Any]:
-        """调用SiliconFlow API生成图片"""
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """获取共享的连接池客户端（首次使用时创建）"""
+        if self._client is None:
+            self._client = ImageGenerator.create_client()
+        return self._client
+    
+    @staticmethod
+    def create_client() -> httpx.AsyncClient:
+        """根据配置创建支持保活（可选HTTP/2）的连接池客户端"""
+        limits = httpx.Limits(
+            max_connections=Config.HTTP_POOL_SIZE,
+            max_keepalive_connections=Config.HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=Config.HTTP_KEEPALIVE_EXPIRY
+        )
+        timeout = httpx.Timeout(
+            connect=Config.HTTP_CONNECT_TIMEOUT,
+            read=Config.HTTP_READ_TIMEOUT,
+            write=Config.HTTP_WRITE_TIMEOUT,
+            pool=Config.HTTP_POOL_TIMEOUT
+        )
+        return httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            http2=Config.HTTP2_ENABLED and HTTP2_AVAILABLE
+        )
+    
+    async def aclose(self) -> None:
+        """关闭连接池"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    def get_connection_stats(self) -> Dict[str, Any]:
+        """获取连接复用统计信息"""
+        stats = dict(self.connection_stats)
+        total = stats["new_connections"] + stats["reused_connections"]
+        stats["reuse_ratio"] = stats["reused_connections"] / total if total else 0.0
+        stats["http2"] = Config.HTTP2_ENABLED and HTTP2_AVAILABLE
+        return stats
+    
+    async def _post(self, payload: Dict[str, Any], deadline: Deadline,
+                    client: Optional[TrafficClient] = None) -> Dict[str, Any]:
+        """选择后端并经公平调度和速率控制发送请求；被限流时降低该密钥速率并优先换用其他后端重试，多次限流后抛出UpstreamRateLimitError"""
+        limited: List[Backend] = []
+        for attempt in range(Config.RATE_LIMIT_MAX_RETRIES + 1):
+            backend = self.backend_pool.choose(exclude=limited)
+            response = await self._dispatch(payload, backend, deadline, client)
+            
+            if response.status_code == 429 and self.rate_governor is not None:
+                retry_after = RateGovernor.parse_retry_after(response.headers.get("Retry-After"))
+                self.rate_governor.on_rate_limited(backend.api_key, payload["model"], retry_after)
+                limited.append(backend)
+                if attempt < Config.RATE_LIMIT_MAX_RETRIES:
+                    continue
+                raise UpstreamRateLimitError("上游API限流，请稍后重试", retry_after=retry_after)
+            if self.rate_governor is not None:
+                self.rate_governor.on_success(backend.api_key, payload["model"])
+            response.raise_for_status()
+            return response.json()
+    
+    async def _dispatch(self, payload: Dict[str, Any], backend: Backend, deadline: Deadline,
+                        client: Optional[TrafficClient]) -> httpx.Response:
+        """先经公平调度获得上游并发名额，再由速率控制按流量类别等待令牌后发送；
+        每次上游请求（含重试和对冲）单独排队，重试退避期间不占用名额"""
+        if self.scheduler is None:
+            return await self._paced_send(payload, backend, deadline, "default", 1.0)
+        client = self.scheduler.resolve(client)
+        weight = self.scheduler.classes[client.traffic_class]
+        async with self.scheduler.slot(client, payload.get("batch_size", 1), timeout=deadline.check()):
+            return await self._paced_send(payload, backend, deadline, client.traffic_class, weight)
+    
+    async def _paced_send(self, payload: Dict[str, Any], backend: Backend, deadline: Deadline,
+                          traffic_class: str, weight: float) -> httpx.Response:
+        """经速率控制获得该密钥和模型的令牌及并发名额后发送"""
+        if self.rate_governor is None:
+            return await self._send(payload, backend, deadline)
+        async with self.rate_governor.slot(backend.api_key, payload["model"], payload.get("batch_size", 1),
+                                           max_wait=deadline.check(), flow=traffic_class, weight=weight):
+            return await self._send(payload, backend, deadline)
+    
+    async def _send(self, payload: Dict[str, Any], backend: Backend, deadline: Deadline) -> httpx.Response:
+        """向指定后端发送请求（超时不超过截止时间），记录后端延迟/错误并统计连接是否复用"""
+        new_connection = False
+        
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            # httpcore追踪回调：本次请求建立了新的TCP连接
+            nonlocal new_connection
+            if event_name == "connection.connect_tcp.complete":
+                new_connection = True
+        
+        timeout = deadline.timeout()
+        # 请求体在此编码一次，同时用于统计载荷大小
+        content = json.dumps(payload).encode("utf-8")
+        MetricsUtils.observe_bytes("upstream_request", len(content))
+        self.connection_stats["requests"] += 1
+        self.connection_stats["in_flight"] += 1
+        start = self.backend_pool.begin(backend)
+        # 传输错误和5xx计为后端失败，429仅计为限流，请求被取消时不计入
+        success = None
+        rate_limited = False
+        status = "error"
+        try:
+            with MetricsUtils.timer(MetricsUtils.STAGE_UPSTREAM), MetricsUtils.in_flight.track(kind="upstream"):
+                response = await self.client.post(
+                    backend.base_url,
+                    headers=backend.headers,
+                    content=content,
+                    timeout=timeout,
+                    extensions={"trace": trace}
+                )
+            status = str(response.status_code)
+            MetricsUtils.observe_bytes("upstream_response", len(response.content))
+            success = response.status_code < 500
+            rate_limited = response.status_code == 429
+            if new_connection:
+                self.connection_stats["new_connections"] += 1
+            else:
+                self.connection_stats["reused_connections"] += 1
+        except httpx.HTTPError:
+            success = False
+            raise
+        finally:
+            self.connection_stats["in_flight"] -= 1
+            self.backend_pool.end(backend, start, success=success, rate_limited=rate_limited)
+            if success is not None:
+                MetricsUtils.count_upstream(payload.get("model", ""), status)
+        return response
+    
+    def build_payload(self, model: str, prompt: str, images: Optional[List[Union[InputImage, "Image.Image"]]] = None,
+                      negative_prompt: str = "", image_size: Optional[str] = None,
+                      batch_size: int = 1, seed: Optional[int] = None,
+                      num_inference_steps: int = 20, guidance_scale: float = 7.5, cfg: float = 4.0) -> Dict[str, Any]:
+        """构建SiliconFlow API请求体，模型参数和参考图片字段由模型注册表决定"""
+        spec = ModelRegistry.get_default().get(model)
         payload = {
             "model": model,
             "prompt": prompt,
@@ -25,33 +201,83 @@ class ImageGenerator:
         }
         
         # 根据模型添加特定参数
-        if model.startswith("Kwai-Kolors/"):
-            payload["image_size"] = image_size or Config.DEFAULT_IMAGE_SIZE
-            payload["batch_size"] = batch_size
-            payload["num_inference_steps"] = num_inference_steps
-            payload["guidance_scale"] = guidance_scale
-        elif model.startswith("Qwen/"):
-            if model not in ["Qwen/Qwen-Image-Edit-2509", "Qwen/Qwen-Image-Edit"]:
-                payload["image_size"] = image_size or Config.DEFAULT_IMAGE_SIZE
-            payload["cfg"] = cfg
+        if spec.custom_size:
+            payload["image_size"] = image_size or spec.default_size
+        params = {
+            "batch_size": batch_size,
+            "num_inference_steps": num_inference_steps,
+            "guidance_scale": guidance_scale,
+            "cfg": cfg
+        }
+        for name in spec.params:
+            payload[name] = params[name]
         
         if seed is not None:
             payload["seed"] = seed
         
-        # 处理图片
+        # 处理图片：原始字节直接编码为data URL，PIL图片编码为PNG；超出模型字段数的图片忽略
         if images:
-            for i, image in enumerate(images[:Config.MAX_IMAGES]):
-                base64_str = ImageUtils.pil_image_to_base64(image)
-                if i == 0:
-                    payload["image"] = f"data:image/png;base64,{base64_str}"
-                elif i == 1 and model == "Qwen/Qwen-Image-Edit-2509":
-                    payload["image2"] = f"data:image/png;base64,{base64_str}"
-                elif i == 2 and model == "Qwen/Qwen-Image-Edit-2509":
-                    payload["image3"] = f"data:image/png;base64,{base64_str}"
+            for slot, image in zip(spec.image_slots, images):
+                if not isinstance(image, InputImage):
+                    image = InputImage.from_pil(image)
+                payload[slot] = image.to_data_url()
         
-        try:
-            response = requests.post(self.api_base_url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"API调用失败: {str(e)}")
+        return payload
+    
+    async def generate_images(self, model: str, prompt: str, images: Optional[List[Union[InputImage, "Image.Image"]]] = None,
+                       negative_prompt: str = "", image_size: Optional[str] = None,
+                       batch_size: int = 1, seed: Optional[int] = None,
+                       num_inference_steps: int = 20, guidance_scale: float = 7.5, cfg: float = 4.0,
+                       deadline: Optional[Deadline] = None, client: Optional[TrafficClient] = None) -> Dict[str, Any]:
+        """调用SiliconFlow API生成图片，client为公平调度使用的客户端身份"""
+        payload = self.build_payload(
+            model=model,
+            prompt=prompt,
+            images=images,
+            negative_prompt=negative_prompt,
+            image_size=image_size,
+            batch_size=batch_size,
+            seed=seed,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            cfg=cfg
+        )
+        return await self.generate_from_payload(payload, deadline, client)
+    
+    async def generate_from_payload(self, payload: Dict[str, Any], deadline: Optional[Deadline] = None,
+                                    client: Optional[TrafficClient] = None) -> Dict[str, Any]:
+        """发送已构建的请求体，固定种子的请求优先查询结果缓存，并发的相同请求合并为一次上游调用；
+        实际调用上游前经公平调度排队（缓存命中和合并的请求不占用名额）"""
+        deadline = deadline or Deadline(Config.REQUEST_DEADLINE_SECONDS)
+        digest = ResultCache.make_key(payload)
+        idempotent = ResultCache.is_cacheable(payload)
+        cacheable = self.cache is not None and idempotent
+        if cacheable:
+            cached = await self.cache.get(digest)
+            if cached is not None:
+                return cached
+        
+        async def fetch(call_deadline: Deadline, call_client: Optional[TrafficClient]) -> Dict[str, Any]:
+            try:
+                # 固定种子的请求是幂等的，可以重试和发送对冲请求
+                result = await self.resilience.call(lambda d: self._post(payload, d, call_client), call_deadline, idempotent)
+            except httpx.HTTPError as e:
+                raise Exception(f"API调用失败: {str(e)}")
+            if cacheable:
+                await self.cache.set(digest, result)
+            return result
+        
+        if self.single_flight is not None and (idempotent or not Config.SINGLE_FLIGHT_SEEDED_ONLY):
+            # 共享的上游调用按默认截止时间执行（不受首个请求较短截止时间的限制），合并的请求各自按自己的截止时间等待结果；
+            # 只合并同一流量类别的请求，共享调用以首个请求的身份排队，不会改变其他请求的类别
+            key = digest
+            if self.scheduler is not None:
+                client = self.scheduler.resolve(client)
+                key = f"{digest}|{client.traffic_class}"
+            shared_deadline = Deadline(Config.REQUEST_DEADLINE_SECONDS)
+            try:
+                return await asyncio.wait_for(self.single_flight.do(key, lambda: fetch(shared_deadline, client)),
+                                              deadline.check())
+            except asyncio.TimeoutError:
+                raise DeadlineExceededError(f"请求超过截止时间（{deadline.timeout_seconds:g}秒）")
+        return await fetch(deadline, client)
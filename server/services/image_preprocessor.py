@@ -0,0 +1,105 @@
+import asyncio
+from io import BytesIO
+from typing import List, Dict, Any, Optional
+from config import Config
+from models.image_input import InputImage
+from models.model_registry import ModelRegistry
+from utils.image_utils import ImageUtils
+
+# EXIF方向标签
+EXIF_ORIENTATION_TAG = 0x0112
+
+class ImagePreprocessor:
+    """上传图片预处理：按模型限制最长边、应用EXIF方向、去除元数据并重新编码"""
+    
+    @staticmethod
+    def get_size_family(model: str) -> str:
+        """获取模型对应的尺寸配置分组"""
+        return ModelRegistry.get_default().get(model).size_family
+    
+    @staticmethod
+    def get_policy(model: str) -> Dict[str, Any]:
+        """获取模型的预处理策略，未配置最长边时取该模型可用尺寸中的最大边长"""
+        family = ImagePreprocessor.get_size_family(model)
+        policy = dict(Config.IMAGE_PREPROCESS_POLICIES.get(family, {}))
+        if not policy.get("max_edge"):
+            sizes = Config.AVAILABLE_IMAGE_SIZES.get(family, [])
+            policy["max_edge"] = max((max(int(v) for v in size.split("x")) for size in sizes), default=None)
+        return policy
+    
+    @staticmethod
+    def preprocess(image: InputImage, policy: Dict[str, Any]) -> InputImage:
+        """按策略处理单张图片，无需处理时原样返回"""
+        from PIL import Image, ImageOps
+        max_edge = policy.get("max_edge")
+        with Image.open(ImageUtils.open_buffer(image.data)) as pil_image:
+            orientation = pil_image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+            has_metadata = any(key in pil_image.info for key in ("exif", "xmp", "comment"))
+            needs_resize = bool(max_edge) and max(image.width, image.height) > max_edge
+            needs_strip = policy.get("strip_metadata", True) and has_metadata
+            
+            if not needs_resize and orientation == 1 and not needs_strip:
+                return image
+            
+            processed = ImageOps.exif_transpose(pil_image)
+            if needs_resize:
+                processed.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            
+            output_format = policy.get("format", "auto")
+            if output_format == "auto":
+                has_alpha = processed.mode in ("RGBA", "LA", "PA") or "transparency" in processed.info
+                output_format = "PNG" if has_alpha else "JPEG"
+            if output_format == "JPEG" and processed.mode not in ("RGB", "L"):
+                processed = processed.convert("RGB")
+            
+            save_kwargs = {}
+            if output_format in ("JPEG", "WEBP"):
+                save_kwargs["quality"] = policy.get("quality", 90)
+            # 保留ICC色彩配置，丢弃EXIF/XMP等元数据
+            icc_profile = pil_image.info.get("icc_profile")
+            if icc_profile and output_format in ("JPEG", "WEBP", "PNG"):
+                save_kwargs["icc_profile"] = icc_profile
+            
+            buffered = BytesIO()
+            processed.save(buffered, format=output_format, **save_kwargs)
+            data = buffered.getvalue()
+        
+        # 仅去除元数据而重新编码反而变大时保留原图
+        if not needs_resize and orientation == 1 and len(data) >= len(image.data):
+            return image
+        
+        result = InputImage.from_bytes(data, filename=image.filename)
+        result.preprocess = {
+            "original_bytes": len(image.data),
+            "original_width": image.width,
+            "original_height": image.height,
+            "original_format": image.format,
+            "bytes_saved": len(image.data) - len(data),
+            "resized": needs_resize,
+            "exif_orientation": orientation
+        }
+        return result
+    
+    async def process(self, images: List[InputImage], model: str) -> List[InputImage]:
+        """在ImageUtils执行器中并行预处理一组图片，已按同一尺寸分组预处理的图片（参考图片）跳过"""
+        if not Config.IMAGE_PREPROCESS_ENABLED or not images:
+            return images
+        policy = ImagePreprocessor.get_policy(model)
+        family = ImagePreprocessor.get_size_family(model)
+        
+        async def process_one(image: InputImage) -> InputImage:
+            if image.prepared_for == family:
+                return image
+            result = await ImageUtils.run_async(ImagePreprocessor.preprocess, image, policy,
+                                                heavy=Config.IMAGE_PREPROCESS_IN_PROCESS)
+            # 无需处理时进程池返回的是副本，改用原对象（保留内存映射和已完成的编码）
+            return image if result.preprocess == image.preprocess else result
+        
+        return list(await asyncio.gather(*[process_one(image) for image in images]))
+    
+    @staticmethod
+    def get_bytes_saved(images: List[InputImage]) -> Optional[int]:
+        """统计一组图片预处理节省的字节数"""
+        saved = [image.preprocess["bytes_saved"] for image in images if image.preprocess]
+        return sum(saved) if saved else None
+
@@ -0,0 +1,153 @@
+import asyncio
+import time
+import uuid
+from typing import List, Dict, Any, Optional
+from config import Config
+from models.image_input import InputImage
+from services.fair_scheduler import TrafficClient
+from services.generation_pipeline import GenerationPipeline
+from services.job_store import JobStore
+
+class JobQueueFullError(Exception):
+    """任务队列已满"""
+
+class JobManager:
+    """异步图片生成任务：有界队列 + 固定数量的工作协程，任务状态持久化到JobStore"""
+    
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    
+    # 未提供调度身份的任务（如重启后恢复的任务）
+    BULK_CLIENT = TrafficClient(client_id="jobs", traffic_class=Config.SCHEDULER_BULK_CLASS)
+    
+    def __init__(self, store: JobStore, pipeline: GenerationPipeline,
+                 workers: int = Config.JOB_WORKERS, max_queue: int = Config.JOB_QUEUE_MAX_SIZE):
+        self.store = store
+        self.pipeline = pipeline
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        # 队列名额：提交时在持久化之前预留，工作协程取出任务后归还，保证入队时队列不会已满
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"submitted": 0, "recovered": 0, "succeeded": 0, "failed": 0, "rejected": 0}
+    
+    async def start(self) -> None:
+        """启动工作协程，并恢复重启前未完成的任务"""
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._slots = asyncio.Semaphore(self.max_queue)
+        # 在接受新任务前取出未完成任务，避免与新提交的任务重复入队
+        unfinished = await asyncio.to_thread(self.store.list_unfinished)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._recover(unfinished)))
+        self._tasks.append(asyncio.ensure_future(self._purge_loop()))
+    
+    async def stop(self) -> None:
+        """停止工作协程（执行中的任务保持running状态，下次启动时重新执行）"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.to_thread(self.store.close)
+    
+    async def submit(self, images: List[InputImage], params: Dict[str, Any],
+                     client: Optional[TrafficClient] = None) -> str:
+        """提交任务，队列已满时抛出JobQueueFullError；client为执行时上游公平调度使用的客户端身份"""
+        if self._queue is None or self._slots.locked():
+            self.stats["rejected"] += 1
+            raise JobQueueFullError("任务队列已满，请稍后重试")
+        # 名额有空余时acquire不会挂起，之后并发的提交或恢复无法占用这个名额
+        await self._slots.acquire()
+        
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        job = {
+            "job_id": job_id,
+            "status": JobManager.QUEUED,
+            "stage": JobManager.QUEUED,
+            "progress": 0,
+            "params": params,
+            "created_at": now,
+            "updated_at": now
+        }
+        try:
+            await asyncio.to_thread(self.store.create, job, [(image.data, image.filename) for image in images])
+        except BaseException:
+            self._slots.release()
+            raise
+        # 调度身份只保存在队列中，重启后恢复的任务按内部客户端调度
+        self._queue.put_nowait((job_id, client))
+        self.stats["submitted"] += 1
+        return job_id
+    
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """查询任务"""
+        return await asyncio.to_thread(self.store.get, job_id)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取任务队列统计"""
+        stats = dict(self.stats)
+        stats["queue_depth"] = self._queue.qsize() if self._queue is not None else 0
+        stats["workers"] = self.workers
+        return stats
+    
+    async def _recover(self, job_ids: List[str]) -> None:
+        """将未完成的任务重新放回队列"""
+        for job_id in job_ids:
+            await asyncio.to_thread(self.store.update, job_id, status=JobManager.QUEUED, stage=JobManager.QUEUED, progress=0)
+            await self._slots.acquire()
+            self._queue.put_nowait((job_id, None))
+            self.stats["recovered"] += 1
+    
+    async def _worker(self) -> None:
+        """工作协程：逐个执行队列中的任务"""
+        while True:
+            job_id, client = await self._queue.get()
+            self._slots.release()
+            try:
+                await self._run(job_id, client)
+            finally:
+                self._queue.task_done()
+    
+    async def _run(self, job_id: str, client: Optional[TrafficClient] = None) -> None:
+        """执行单个任务并保存结果"""
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None or job["status"] != JobManager.QUEUED:
+            return
+        
+        async def progress(stage: str, percent: int) -> None:
+            await asyncio.to_thread(self.store.update, job_id, stage=stage, progress=percent)
+        
+        await asyncio.to_thread(self.store.update, job_id, status=JobManager.RUNNING, stage="loading", progress=5)
+        try:
+            stored_images = await asyncio.to_thread(self.store.load_images, job_id)
+            images = [InputImage.from_bytes(data, filename=filename) for data, filename in stored_images]
+            params = dict(job["params"])
+            if params.pop("tiled", False):
+                response = await self.pipeline.run_tiled(images, params, progress=progress,
+                                                         client=client or JobManager.BULK_CLIENT)
+            else:
+                response = await self.pipeline.run(images, params, progress=progress,
+                                                   client=client or JobManager.BULK_CLIENT)
+        except Exception as e:
+            await asyncio.to_thread(self.store.update, job_id, status=JobManager.FAILED, stage=JobManager.FAILED, error=str(e))
+            self.stats["failed"] += 1
+            return
+        
+        await asyncio.to_thread(
+            self.store.update, job_id, status=JobManager.SUCCEEDED, stage=JobManager.SUCCEEDED,
+            progress=100, result=response.dict()
+        )
+        self.stats["succeeded"] += 1
+    
+    async def purge_finished(self, ttl_seconds: float = Config.JOB_RESULT_TTL_SECONDS) -> int:
+        """删除结果已过期的任务"""
+        return await asyncio.to_thread(self.store.delete_finished_before, time.time() - ttl_seconds)
+    
+    async def _purge_loop(self) -> None:
+        """周期性清理过期任务"""
+        while True:
+            await self.purge_finished()
+            await asyncio.sleep(Config.JOB_PURGE_INTERVAL_SECONDS)
@@ -0,0 +1,184 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+from config import Config
+
+# 任务输入图片：(原始字节, 文件名)
+StoredImage = Tuple[bytes, Optional[str]]
+
+class JobStore:
+    """任务持久化后端接口（同步方法，调用方负责放到线程中执行）"""
+    
+    def create(self, job: Dict[str, Any], images: List[StoredImage]) -> None:
+        raise NotImplementedError
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+    
+    def update(self, job_id: str, **fields: Any) -> None:
+        raise NotImplementedError
+    
+    def load_images(self, job_id: str) -> List[StoredImage]:
+        raise NotImplementedError
+    
+    def list_unfinished(self) -> List[str]:
+        """列出排队中或执行中的任务（按创建时间），用于重启后恢复"""
+        raise NotImplementedError
+    
+    def delete_finished_before(self, timestamp: float) -> int:
+        """删除早于指定时间结束的任务，返回删除数量"""
+        raise NotImplementedError
+    
+    def close(self) -> None:
+        pass
+
+class MemoryJobStore(JobStore):
+    """内存任务存储（不支持重启恢复，主要用于测试）"""
+    
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._images: Dict[str, List[StoredImage]] = {}
+        self._lock = threading.Lock()
+    
+    def create(self, job: Dict[str, Any], images: List[StoredImage]) -> None:
+        with self._lock:
+            self._jobs[job["job_id"]] = dict(job)
+            self._images[job["job_id"]] = list(images)
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+    
+    def update(self, job_id: str, **fields: Any) -> None:
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields, updated_at=time.time())
+    
+    def load_images(self, job_id: str) -> List[StoredImage]:
+        with self._lock:
+            return list(self._images.get(job_id, []))
+    
+    def list_unfinished(self) -> List[str]:
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda job: job["created_at"])
+            return [job["job_id"] for job in jobs if job["status"] in ("queued", "running")]
+    
+    def delete_finished_before(self, timestamp: float) -> int:
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job["status"] in ("succeeded", "failed") and job["updated_at"] < timestamp]
+            for job_id in expired:
+                del self._jobs[job_id]
+                self._images.pop(job_id, None)
+            return len(expired)
+
+class SQLiteJobStore(JobStore):
+    """SQLite任务存储，排队中的任务在服务重启后可恢复"""
+    
+    # 以JSON保存的字段
+    JSON_FIELDS = ("params", "result")
+    
+    def __init__(self, db_path: str = Config.JOB_DB_PATH):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    progress INTEGER NOT NULL DEFAULT 0,
+                    params TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_images (
+                    job_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    filename TEXT,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (job_id, position)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+    
+    def _encode(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            key: json.dumps(value, ensure_ascii=False) if key in SQLiteJobStore.JSON_FIELDS and value is not None else value
+            for key, value in fields.items()
+        }
+    
+    def create(self, job: Dict[str, Any], images: List[StoredImage]) -> None:
+        row = self._encode(job)
+        columns = ", ".join(row)
+        placeholders = ", ".join(f":{key}" for key in row)
+        with self._lock, self._conn:
+            self._conn.execute(f"INSERT INTO jobs ({columns}) VALUES ({placeholders})", row)
+            self._conn.executemany(
+                "INSERT INTO job_images (job_id, position, filename, data) VALUES (?, ?, ?, ?)",
+                [(job["job_id"], i, filename, data) for i, (data, filename) in enumerate(images)]
+            )
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for key in SQLiteJobStore.JSON_FIELDS:
+            if job[key] is not None:
+                job[key] = json.loads(job[key])
+        return job
+    
+    def update(self, job_id: str, **fields: Any) -> None:
+        fields["updated_at"] = time.time()
+        row = self._encode(fields)
+        assignments = ", ".join(f"{key} = :{key}" for key in row)
+        row["job_id"] = job_id
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = :job_id", row)
+    
+    def load_images(self, job_id: str) -> List[StoredImage]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data, filename FROM job_images WHERE job_id = ? ORDER BY position", (job_id,)
+            ).fetchall()
+        return [(bytes(row["data"]), row["filename"]) for row in rows]
+    
+    def list_unfinished(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+        return [row["job_id"] for row in rows]
+    
+    def delete_finished_before(self, timestamp: float) -> int:
+        with self._lock, self._conn:
+            condition = "status IN ('succeeded', 'failed') AND updated_at < ?"
+            self._conn.execute(f"DELETE FROM job_images WHERE job_id IN (SELECT job_id FROM jobs WHERE {condition})", (timestamp,))
+            return self._conn.execute(f"DELETE FROM jobs WHERE {condition}", (timestamp,)).rowcount
+    
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+def create_job_store(backend: str = Config.JOB_STORE_BACKEND) -> JobStore:
+    """根据配置创建任务存储后端"""
+    if backend == "sqlite":
+        return SQLiteJobStore()
+    if backend == "memory":
+        return MemoryJobStore()
+    raise ValueError(f"不支持的任务存储后端: {backend}")
@@ -0,0 +1,221 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+from config import Config
+from services.fair_scheduler import DeficitRoundRobin
+from utils.logger_utils import LoggerUtils
+
+class UpstreamRateLimitError(Exception):
+    """上游持续限流或排队等待超时"""
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """令牌桶，速率按每分钟计，支持AIMD调整和Retry-After暂停"""
+    
+    def __init__(self, rate_per_minute: float, burst: float, min_rate_per_minute: float):
+        self.max_rate = rate_per_minute
+        self.min_rate = min_rate_per_minute
+        self.rate = rate_per_minute
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+    
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate / 60.0)
+        self.updated_at = now
+    
+    def wait_time(self, cost: float, now: float) -> float:
+        """获取cost个令牌还需等待的秒数"""
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) * 60.0 / self.rate
+    
+    def consume(self, cost: float) -> None:
+        self.tokens -= cost
+    
+    def increase(self, step: float) -> None:
+        """加性增：成功后逐步恢复速率"""
+        self.rate = min(self.max_rate, self.rate + step)
+    
+    def decrease(self, factor: float, pause_seconds: Optional[float], now: float) -> None:
+        """乘性减：被限流后降低速率，并按Retry-After暂停发放令牌"""
+        self.rate = max(self.min_rate, self.rate * factor)
+        self.tokens = min(self.tokens, 0.0)
+        if pause_seconds:
+            self.paused_until = max(self.paused_until, now + pause_seconds)
+
+class _Turnstile:
+    """密钥的令牌排队锁：同一时间只有一个请求等待令牌，释放时按流（流量类别）加权差额轮询选出下一个等待者，流内先到先得"""
+    
+    def __init__(self, quantum: float):
+        self._waiters = DeficitRoundRobin(quantum)
+        self._locked = False
+    
+    async def acquire(self, flow: str, weight: float, cost: float) -> None:
+        if not self._locked:
+            self._locked = True
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.push(flow, future, cost, weight)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._waiters.remove(flow, future)
+            else:
+                # 已获得锁但调用方同时被取消：交给下一个等待者
+                self.release()
+            raise
+    
+    def release(self) -> None:
+        """把锁直接交给轮询选出的下一个等待者，没有等待者时解锁"""
+        while len(self._waiters):
+            future, _ = self._waiters.pop_next()
+            if not future.done():
+                future.set_result(None)
+                return
+        self._locked = False
+
+class RateGovernor:
+    """上游速率控制：按API密钥和模型分别限速，限制并发数，并根据429自适应调整（AIMD）；
+    同一密钥的排队请求按流量类别加权轮询获得令牌"""
+    
+    def __init__(self, key_rpm: float = Config.RATE_LIMIT_KEY_RPM,
+                 model_rpm: Optional[Dict[str, float]] = None,
+                 max_in_flight: int = Config.RATE_LIMIT_MAX_IN_FLIGHT,
+                 burst: float = Config.RATE_LIMIT_BURST,
+                 max_wait_seconds: float = Config.RATE_LIMIT_MAX_WAIT_SECONDS,
+                 quantum: float = Config.SCHEDULER_QUANTUM):
+        self.key_rpm = key_rpm
+        self.model_rpm = model_rpm if model_rpm is not None else Config.RATE_LIMIT_MODEL_RPM
+        self.burst = burst
+        self.max_wait_seconds = max_wait_seconds
+        self.quantum = quantum
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self._key_buckets: Dict[str, TokenBucket] = {}
+        self._model_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        # 每个密钥一个排队锁，排队请求按流量类别加权轮询、类别内按到达顺序获得令牌
+        self._turnstiles: Dict[str, _Turnstile] = {}
+        self.stats = {"admitted": 0, "waited": 0, "wait_seconds": 0.0, "waiting": 0,
+                      "in_flight": 0, "rate_limited": 0, "timeouts": 0}
+        # 流量类别 -> 放行数与等待时间
+        self._flow_stats: Dict[str, Dict[str, Any]] = {}
+    
+    def _get_buckets(self, api_key: str, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        key_bucket = self._key_buckets.get(api_key)
+        if key_bucket is None:
+            key_bucket = TokenBucket(self.key_rpm, self.burst, Config.RATE_LIMIT_MIN_RPM)
+            self._key_buckets[api_key] = key_bucket
+        model_bucket = self._model_buckets.get((api_key, model))
+        if model_bucket is None:
+            rpm = self.model_rpm.get(model, self.model_rpm.get("default", self.key_rpm))
+            model_bucket = TokenBucket(rpm, self.burst, Config.RATE_LIMIT_MIN_RPM)
+            self._model_buckets[(api_key, model)] = model_bucket
+        return key_bucket, model_bucket
+    
+    @asynccontextmanager
+    async def slot(self, api_key: str, model: str, cost: float = 1.0, max_wait: Optional[float] = None,
+                   flow: str = "default", weight: float = 1.0) -> AsyncIterator[None]:
+        """排队获取令牌和并发名额，超过最大等待时间（默认max_wait_seconds）时抛出UpstreamRateLimitError；
+        flow和weight为请求的流量类别及其权重"""
+        key_bucket, model_bucket = self._get_buckets(api_key, model)
+        cost = min(cost, self.burst)
+        start = time.monotonic()
+        deadline = start + min(self.max_wait_seconds, max_wait if max_wait is not None else self.max_wait_seconds)
+        turnstile = self._turnstiles.get(api_key)
+        if turnstile is None:
+            turnstile = self._turnstiles[api_key] = _Turnstile(self.quantum)
+        
+        self.stats["waiting"] += 1
+        try:
+            await turnstile.acquire(flow, weight, cost)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = max(key_bucket.wait_time(cost, now), model_bucket.wait_time(cost, now))
+                    if wait <= 0:
+                        break
+                    if now + wait > deadline:
+                        self.stats["timeouts"] += 1
+                        raise UpstreamRateLimitError("上游请求排队超时，请稍后重试", retry_after=wait)
+                    await asyncio.sleep(wait)
+                key_bucket.consume(cost)
+                model_bucket.consume(cost)
+            finally:
+                turnstile.release()
+            remaining = deadline - time.monotonic()
+            try:
+                await asyncio.wait_for(self._in_flight.acquire(), timeout=max(remaining, 0.001))
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                raise UpstreamRateLimitError("上游并发已满，请稍后重试")
+        finally:
+            self.stats["waiting"] -= 1
+        
+        waited = time.monotonic() - start
+        flow_stats = self._flow_stats.setdefault(flow, {"admitted": 0, "waited": 0, "wait_seconds": 0.0})
+        for counters in (self.stats, flow_stats):
+            counters["admitted"] += 1
+            counters["wait_seconds"] += waited
+            if waited > 0.001:
+                counters["waited"] += 1
+        self.stats["in_flight"] += 1
+        try:
+            yield
+        finally:
+            self.stats["in_flight"] -= 1
+            self._in_flight.release()
+    
+    def on_success(self, api_key: str, model: str) -> None:
+        """请求成功：加性恢复速率"""
+        for bucket in self._get_buckets(api_key, model):
+            bucket.increase(Config.RATE_LIMIT_AIMD_INCREASE)
+    
+    def on_rate_limited(self, api_key: str, model: str, retry_after: Optional[float]) -> None:
+        """收到429：乘性降低速率并按Retry-After暂停"""
+        self.stats["rate_limited"] += 1
+        now = time.monotonic()
+        for bucket in self._get_buckets(api_key, model):
+            bucket.decrease(Config.RATE_LIMIT_AIMD_DECREASE, retry_after, now)
+    
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """解析Retry-After响应头（秒数或HTTP日期）"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取排队与限流统计，以及各令牌桶当前速率"""
+        stats = dict(self.stats)
+        stats["max_in_flight"] = self.max_in_flight
+        stats["flows"] = {
+            flow: dict(flow_stats, wait_seconds=round(flow_stats["wait_seconds"], 3))
+            for flow, flow_stats in self._flow_stats.items()
+        }
+        stats["key_rpm"] = {
+            LoggerUtils.mask_api_key(key, Config.API_KEY_VISIBLE_CHARS): round(bucket.rate, 2)
+            for key, bucket in self._key_buckets.items()
+        }
+        stats["model_rpm"] = {
+            f"{LoggerUtils.mask_api_key(key, Config.API_KEY_VISIBLE_CHARS)}:{model}": round(bucket.rate, 2)
+            for (key, model), bucket in self._model_buckets.items()
+        }
+        return stats
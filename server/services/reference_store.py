@@ -0,0 +1,127 @@
+import asyncio
+import dataclasses
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from config import Config
+from models.image_input import InputImage
+from services.blob_store import BlobStore
+from services.image_preprocessor import ImagePreprocessor
+from services.single_flight import SingleFlight
+from utils.image_utils import ImageUtils
+from utils.metrics_utils import MetricsUtils
+
+class ReferenceNotFoundError(LookupError):
+    """参考图片句柄不存在或已过期"""
+
+class ReferenceStore:
+    """参考图片存储（/uploads）：原图按内容寻址保存在本地磁盘（TTL与容量上限，按最近使用淘汰），
+    句柄即blob_id；按模型尺寸分组预处理后的图片及其data URL缓存在内存中（LRU），重复使用时无需再次上传和编码"""
+    
+    def __init__(self, preprocessor: ImagePreprocessor, blob_store: Optional[BlobStore] = None,
+                 memory_max_bytes: int = Config.UPLOAD_STORE_MEMORY_MAX_BYTES):
+        self.preprocessor = preprocessor
+        self.blob_store = blob_store or BlobStore(
+            Config.UPLOAD_STORE_DIR, Config.UPLOAD_STORE_TTL_SECONDS, Config.UPLOAD_STORE_MAX_BYTES
+        )
+        self.memory_max_bytes = memory_max_bytes
+        # (句柄, 尺寸分组) -> 已预处理并完成编码的图片
+        self._cache: "OrderedDict[Tuple[str, str], InputImage]" = OrderedDict()
+        self._cache_bytes = 0
+        self.single_flight = SingleFlight()
+        self.stats = {"uploads": 0, "memory_hits": 0, "disk_loads": 0, "misses": 0, "memory_evictions": 0}
+    
+    @staticmethod
+    def _size(image: InputImage) -> int:
+        """缓存占用：原始字节、base64和data URL"""
+        return len(image.data) + len(image._base64 or "") + len(image._data_url or "")
+    
+    async def put(self, image: InputImage, model: Optional[str] = None) -> str:
+        """保存参考图片并返回句柄，指定模型时预先完成该模型的预处理和编码"""
+        handle = await asyncio.to_thread(self.blob_store.put, image.data, image.format.lower())
+        self.stats["uploads"] += 1
+        if model is not None:
+            family = ImagePreprocessor.get_size_family(model)
+            await self.single_flight.do(f"{handle}|{family}", lambda: self._prepare(handle, model, image))
+        return handle
+    
+    async def resolve(self, handles: List[str], model: str) -> List[InputImage]:
+        """按句柄获取已按模型预处理的参考图片，句柄不存在或已过期时抛出ReferenceNotFoundError"""
+        return list(await asyncio.gather(*[self.get(handle, model) for handle in handles]))
+    
+    async def get(self, handle: str, model: str) -> InputImage:
+        """获取单个参考图片：内存命中时直接返回，否则从磁盘读取并预处理（并发请求只处理一次）"""
+        family = ImagePreprocessor.get_size_family(model)
+        key = (handle, family)
+        # 以磁盘上的原图为准判断是否过期，访问时刷新其最近使用时间
+        if self.blob_store.get_path(handle) is None or not self.blob_store.touch(handle):
+            self._discard(handle)
+            self.stats["misses"] += 1
+            raise ReferenceNotFoundError(f"参考图片 {handle} 不存在或已过期")
+        
+        image = self._cache.get(key)
+        if image is not None:
+            self._cache.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return image
+        return await self.single_flight.do(f"{handle}|{family}", lambda: self._load(handle, model))
+    
+    async def get_original(self, handle: str) -> InputImage:
+        """映射磁盘上未经预处理的原图（局部编辑和分块编辑需要完整分辨率，不读入内存），句柄不存在或已过期时抛出ReferenceNotFoundError"""
+        try:
+            path = self.blob_store.get_path(handle)
+            if path is None or not self.blob_store.touch(handle):
+                raise FileNotFoundError(handle)
+            data = await asyncio.to_thread(ImageUtils.map_file, path)
+        except FileNotFoundError:
+            self._discard(handle)
+            self.stats["misses"] += 1
+            raise ReferenceNotFoundError(f"参考图片 {handle} 不存在或已过期")
+        self.stats["disk_loads"] += 1
+        image = await ImageUtils.run_async(InputImage.from_bytes, data, handle, stage=MetricsUtils.STAGE_DECODE)
+        image.path = path
+        return image
+    
+    async def _load(self, handle: str, model: str) -> InputImage:
+        try:
+            data = await asyncio.to_thread(self.blob_store.read, handle)
+        except FileNotFoundError:
+            self.stats["misses"] += 1
+            raise ReferenceNotFoundError(f"参考图片 {handle} 不存在或已过期")
+        self.stats["disk_loads"] += 1
+        return await self._prepare(handle, model, InputImage.from_bytes(data, filename=handle))
+    
+    async def _prepare(self, handle: str, model: str, image: InputImage) -> InputImage:
+        """按模型策略预处理并预先编码data URL，结果放入内存缓存"""
+        family = ImagePreprocessor.get_size_family(model)
+        image = (await self.preprocessor.process([image], model))[0]
+        if not isinstance(image.data, bytes):
+            # 未经处理的上传原图改为映射已保存的文件，不复制到内存，也不占用上传的临时文件
+            path = self.blob_store.get_path(handle)
+            data = ImageUtils.map_file(path) if path is not None else bytes(image.data)
+            image = dataclasses.replace(image, data=data, path=path)
+        image = dataclasses.replace(image, filename=handle, prepared_for=family)
+        await ImageUtils.run_async(image.to_data_url, stage=MetricsUtils.STAGE_ENCODE)
+        
+        key = (handle, family)
+        if key in self._cache:
+            self._cache_bytes -= ReferenceStore._size(self._cache.pop(key))
+        self._cache[key] = image
+        self._cache_bytes += ReferenceStore._size(image)
+        while self._cache_bytes > self.memory_max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= ReferenceStore._size(evicted)
+            self.stats["memory_evictions"] += 1
+        return image
+    
+    def _discard(self, handle: str) -> None:
+        """移除句柄在内存中的所有缓存（原图已过期或被淘汰）"""
+        for key in [key for key in self._cache if key[0] == handle]:
+            self._cache_bytes -= ReferenceStore._size(self._cache.pop(key))
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取存储统计"""
+        stats = dict(self.stats)
+        stats["memory_entries"] = len(self._cache)
+        stats["memory_bytes"] = self._cache_bytes
+        stats["disk"] = self.blob_store.get_stats()
+        return stats
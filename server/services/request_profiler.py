@@ -0,0 +1,294 @@
+import asyncio
+import fnmatch
+import hmac
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from config import Config
+
+# 空闲等待的栈顶帧（文件名, 函数名），这些采样不计入结果
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("connection.py", "wait")
+}
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class ProfilingDisabledError(Exception):
+    """未配置PROFILE_TOKEN，剖析功能关闭"""
+
+@dataclass
+class Profile:
+    """一次请求的剖析结果：CPU采样按折叠调用栈计数（可直接生成火焰图），可选的内存分配按调用位置汇总"""
+    profile_id: str
+    path: str
+    started_at: float
+    memory: bool
+    duration_seconds: float = 0.0
+    status_code: Optional[int] = None
+    samples: int = 0
+    stacks: Counter = field(default_factory=Counter)
+    memory_peak_bytes: Optional[int] = None
+    memory_sites: Optional[List[Dict[str, Any]]] = None
+    _perf_start: float = field(default=0.0, repr=False)
+    _baseline: Optional[Dict[str, List[int]]] = field(default=None, repr=False)
+    
+    def collapsed(self) -> str:
+        """折叠调用栈格式（每行“帧;帧;帧 次数”），可用flamegraph.pl或speedscope查看"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+    
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "profile_id": self.profile_id,
+            "path": self.path,
+            "started_at": self.started_at,
+            "duration_seconds": round(self.duration_seconds, 4),
+            "status_code": self.status_code,
+            "samples": self.samples,
+            "memory": self.memory
+        }
+    
+    def to_dict(self, top: int = Config.PROFILE_TOP) -> Dict[str, Any]:
+        """剖析详情：采样最多的调用栈、按栈顶函数汇总的自身采样数和内存分配位置"""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return dict(
+            self.summary(),
+            top_stacks=[{"stack": stack, "samples": count} for stack, count in self.stacks.most_common(top)],
+            top_functions=[{"function": name, "samples": count} for name, count in leaves.most_common(top)],
+            memory_peak_bytes=self.memory_peak_bytes,
+            memory_sites=self.memory_sites[:top] if self.memory_sites is not None else None
+        )
+
+class RequestProfiler:
+    """按需请求剖析：预约接下来N个请求或由携带管理令牌的请求头触发。剖析期间后台线程按固定间隔采样所有线程的调用栈，
+    需要时用tracemalloc记录内存分配。采样覆盖整个进程，同时进行的其他请求也会计入。
+    未配置令牌时关闭；没有剖析中的请求时不运行采样线程、不开启tracemalloc"""
+    
+    def __init__(self, token: Optional[str] = Config.PROFILE_TOKEN,
+                 paths: Sequence[str] = Config.PROFILE_PATHS,
+                 interval: float = Config.PROFILE_SAMPLE_INTERVAL_SECONDS,
+                 max_results: int = Config.PROFILE_MAX_RESULTS,
+                 memory_sites: Sequence[str] = Config.PROFILE_MEMORY_SITES):
+        self.token = token
+        self.enabled = bool(token)
+        self.paths = tuple(paths)
+        self.interval = interval
+        self.max_results = max_results
+        self.memory_sites = tuple(memory_sites)
+        # 预约的剖析次数及是否记录内存
+        self.armed = 0
+        self.armed_memory = False
+        self._active: List[Profile] = []
+        self._results: "OrderedDict[str, Profile]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 采样线程及其停止信号（每个线程各自一个，避免新线程启动时清除旧线程的停止信号）
+        self._sampler: Optional[threading.Thread] = None
+        self._stop: Optional[threading.Event] = None
+        self._started_tracing = False
+        self._labels: Dict[Any, str] = {}
+        self._request_header = Config.PROFILE_REQUEST_HEADER.lower().encode("latin-1")
+        self._token_header = Config.PROFILE_TOKEN_HEADER.lower().encode("latin-1")
+    
+    def check_token(self, value: Optional[str]) -> bool:
+        """校验管理令牌（剖析关闭时抛出ProfilingDisabledError）"""
+        if not self.enabled:
+            raise ProfilingDisabledError("剖析功能未启用")
+        return value is not None and hmac.compare_digest(value.encode("utf-8"), self.token.encode("utf-8"))
+    
+    def arm(self, count: int, memory: bool = False) -> int:
+        """预约剖析接下来count个请求，返回实际预约数"""
+        self.armed = max(0, min(count, Config.PROFILE_MAX_ARMED))
+        self.armed_memory = memory
+        return self.armed
+    
+    def claim(self, scope: Dict[str, Any]) -> Optional[bool]:
+        """判断请求是否需要剖析：需要时返回是否记录内存，否则返回None"""
+        if scope["path"] not in self.paths:
+            return None
+        if self.armed > 0:
+            self.armed -= 1
+            return self.armed_memory
+        mode = token = None
+        for key, value in scope["headers"]:
+            if key == self._request_header:
+                mode = value.decode("latin-1").strip().lower()
+            elif key == self._token_header:
+                token = value.decode("latin-1")
+        if mode in ("cpu", "memory") and self.check_token(token):
+            return mode == "memory"
+        return None
+    
+    def start(self, path: str, memory: bool = False) -> Profile:
+        """开始剖析，必要时启动采样线程和tracemalloc"""
+        profile = Profile(profile_id=uuid.uuid4().hex, path=path, started_at=time.time(), memory=memory)
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(Config.PROFILE_TRACEMALLOC_FRAMES)
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+            profile._baseline = self._allocation_sites()
+        profile._perf_start = time.perf_counter()
+        with self._lock:
+            self._active.append(profile)
+            if self._sampler is None:
+                self._stop = threading.Event()
+                self._sampler = threading.Thread(target=self._sample_loop, args=(self._stop,),
+                                                 name="request-profiler", daemon=True)
+                self._sampler.start()
+        return profile
+    
+    def finish(self, profile: Profile, status_code: Optional[int] = None) -> Profile:
+        """结束剖析并保存结果，没有其他剖析中的请求时停止采样线程和tracemalloc"""
+        profile.duration_seconds = time.perf_counter() - profile._perf_start
+        profile.status_code = status_code
+        with self._lock:
+            self._active.remove(profile)
+            sampler = self._sampler if not self._active else None
+            if sampler is not None:
+                self._sampler = None
+                self._stop.set()
+        if sampler is not None:
+            sampler.join()
+        
+        if profile.memory:
+            profile.memory_peak_bytes = tracemalloc.get_traced_memory()[1]
+            sites = self._allocation_sites()
+            baseline = profile._baseline or {}
+            profile.memory_sites = sorted(
+                ({"site": site, "bytes": size - baseline.get(site, [0, 0])[0], "count": count - baseline.get(site, [0, 0])[1]}
+                 for site, (size, count) in sites.items()),
+                key=lambda item: item["bytes"], reverse=True
+            )
+            profile._baseline = None
+            with self._lock:
+                memory_active = any(active.memory for active in self._active)
+            if self._started_tracing and not memory_active:
+                tracemalloc.stop()
+                self._started_tracing = False
+        
+        with self._lock:
+            self._results[profile.profile_id] = profile
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return profile
+    
+    def _allocation_sites(self) -> Dict[str, List[int]]:
+        """当前存活的内存分配按调用位置汇总：调用链中最近的一个PROFILE_MEMORY_SITES文件中的行 -> [字节数, 分配次数]"""
+        filters = [tracemalloc.Filter(True, pattern, all_frames=True) for pattern in self.memory_sites]
+        snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+        sites: Dict[str, List[int]] = {}
+        for trace in snapshot.traces:
+            # traceback从最早的帧到最近的帧排列
+            for frame in reversed(trace.traceback):
+                if any(fnmatch.fnmatch(frame.filename, pattern) for pattern in self.memory_sites):
+                    site = f"{os.path.relpath(frame.filename, SERVER_DIR)}:{frame.lineno}"
+                    totals = sites.setdefault(site, [0, 0])
+                    totals[0] += trace.size
+                    totals[1] += 1
+                    break
+        return sites
+    
+    def _label(self, code: Any) -> str:
+        """调用栈中一帧的名称：函数限定名和文件（项目内为相对路径，第三方库从包名开始）"""
+        label = self._labels.get(code)
+        if label is None:
+            path = code.co_filename
+            if path.startswith(SERVER_DIR + os.sep):
+                path = os.path.relpath(path, SERVER_DIR)
+            elif "site-packages" + os.sep in path:
+                path = path.split("site-packages" + os.sep, 1)[1]
+            else:
+                path = os.path.basename(path)
+            label = self._labels[code] = f"{getattr(code, 'co_qualname', code.co_name)} ({path})"
+        return label
+    
+    def _collapse(self, frame: Any, thread_name: str) -> Optional[str]:
+        """把线程的当前调用栈折叠为“线程;最外层帧;...;栈顶帧”，空闲等待时返回None"""
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+            return None
+        labels = []
+        while frame is not None and len(labels) < Config.PROFILE_MAX_DEPTH:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.append(thread_name)
+        return ";".join(reversed(labels))
+    
+    def _sample_loop(self, stop: threading.Event) -> None:
+        """采样线程：按间隔记录除自身外所有线程的调用栈，计入所有剖析中的请求"""
+        own = threading.get_ident()
+        while not stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = self._collapse(frame, names.get(ident, str(ident)))
+                if stack is not None:
+                    stacks.append(stack)
+            with self._lock:
+                for profile in self._active:
+                    profile.samples += 1
+                    profile.stacks.update(stacks)
+    
+    def get(self, profile_id: str) -> Optional[Profile]:
+        return self._results.get(profile_id)
+    
+    def list_profiles(self) -> List[Dict[str, Any]]:
+        """已完成的剖析（最近的在前）"""
+        with self._lock:
+            return [profile.summary() for profile in reversed(self._results.values())]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取剖析状态"""
+        return {
+            "enabled": self.enabled,
+            "armed": self.armed,
+            "armed_memory": self.armed_memory,
+            "active": len(self._active),
+            "results": len(self._results),
+            "tracemalloc": tracemalloc.is_tracing()
+        }
+
+class ProfilingMiddleware:
+    """ASGI中间件：需要剖析的请求在整个处理过程（含读取上传和发送响应）中采样，响应头X-Profile-Id为剖析结果ID；
+    剖析关闭时直接调用应用"""
+    
+    def __init__(self, app: Callable, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+    
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        memory = self.profiler.claim(scope) if self.profiler.enabled and scope["type"] == "http" else None
+        if memory is None:
+            await self.app(scope, receive, send)
+            return
+        
+        # 内存快照和等待采样线程退出在线程中执行，不阻塞事件循环
+        profile = await asyncio.to_thread(self.profiler.start, scope["path"], memory)
+        status_code = None
+        
+        async def profiled_send(message: Dict[str, Any]) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile.profile_id.encode("latin-1"))
+                ])
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, profiled_send)
+        finally:
+            await asyncio.to_thread(self.profiler.finish, profile, status_code)
@@ -0,0 +1,152 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+import httpx
+from config import Config
+
+class DeadlineExceededError(Exception):
+    """请求超过截止时间"""
+
+class Deadline:
+    """请求截止时间（单调时钟），传递到排队等待和上游超时"""
+    
+    def __init__(self, timeout_seconds: float):
+        self.timeout_seconds = timeout_seconds
+        self.expires_at = time.monotonic() + timeout_seconds
+    
+    @staticmethod
+    def from_header(value: Optional[str], default: float = Config.REQUEST_DEADLINE_SECONDS) -> "Deadline":
+        """根据客户端请求头（秒）创建截止时间，不能超过配置的默认值，无效值时使用默认值"""
+        try:
+            timeout = float(value) if value else default
+        except ValueError:
+            timeout = default
+        if timeout <= 0:
+            timeout = default
+        return Deadline(min(timeout, default))
+    
+    def remaining(self) -> float:
+        """剩余秒数（可能为负）"""
+        return self.expires_at - time.monotonic()
+    
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+    
+    def check(self) -> float:
+        """返回剩余秒数，已过期时抛出DeadlineExceededError"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceededError(f"请求超过截止时间（{self.timeout_seconds:g}秒）")
+        return remaining
+    
+    def timeout(self) -> httpx.Timeout:
+        """按剩余时间收紧上游请求的各项超时"""
+        remaining = self.check()
+        return httpx.Timeout(
+            connect=min(Config.HTTP_CONNECT_TIMEOUT, remaining),
+            read=min(Config.HTTP_READ_TIMEOUT, remaining),
+            write=min(Config.HTTP_WRITE_TIMEOUT, remaining),
+            pool=min(Config.HTTP_POOL_TIMEOUT, remaining)
+        )
+
+class LatencyTracker:
+    """最近上游调用延迟的滑动窗口，用于计算对冲请求的触发时间"""
+    
+    def __init__(self, window: int = Config.UPSTREAM_LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+    
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+    
+    def percentile(self, percent: float, min_samples: int = Config.UPSTREAM_HEDGING_MIN_SAMPLES) -> Optional[float]:
+        """样本不足时返回None"""
+        if not self._samples or len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
+
+def is_retryable(error: BaseException) -> bool:
+    """传输错误和5xx可以重试，4xx（含429，已由速率控制处理）不重试"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+class ResilientCaller:
+    """上游调用韧性层：截止时间、固定种子请求的指数退避重试、按p95延迟发送对冲请求"""
+    
+    def __init__(self, max_attempts: int = Config.UPSTREAM_RETRY_MAX_ATTEMPTS,
+                 base_delay: float = Config.UPSTREAM_RETRY_BASE_DELAY,
+                 max_delay: float = Config.UPSTREAM_RETRY_MAX_DELAY,
+                 hedging: bool = Config.UPSTREAM_HEDGING_ENABLED,
+                 hedging_percentile: float = Config.UPSTREAM_HEDGING_PERCENTILE):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedging = hedging
+        self.hedging_percentile = hedging_percentile
+        self.latency = LatencyTracker()
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "deadline_exceeded": 0}
+    
+    async def call(self, func: Callable[[Deadline], Awaitable[Any]], deadline: Deadline, idempotent: bool) -> Any:
+        """执行func；仅幂等（固定种子）请求会重试和对冲，超过截止时间时抛出DeadlineExceededError"""
+        self.stats["calls"] += 1
+        attempts = self.max_attempts if idempotent else 1
+        for attempt in range(attempts):
+            try:
+                return await self._attempt(func, deadline, hedge=idempotent and self.hedging)
+            except httpx.TimeoutException as e:
+                # 超时由截止时间引起时不再重试
+                if deadline.expired():
+                    self.stats["deadline_exceeded"] += 1
+                    raise DeadlineExceededError(f"请求超过截止时间（{deadline.timeout_seconds:g}秒）") from e
+                if attempt + 1 >= attempts:
+                    raise
+            except Exception as e:
+                if not is_retryable(e) or attempt + 1 >= attempts:
+                    raise
+            
+            # 全抖动指数退避，且不超过剩余时间
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+            if delay >= deadline.remaining():
+                self.stats["deadline_exceeded"] += 1
+                raise DeadlineExceededError(f"请求超过截止时间（{deadline.timeout_seconds:g}秒），已重试{attempt}次")
+            self.stats["retries"] += 1
+            await asyncio.sleep(delay)
+    
+    async def _attempt(self, func: Callable[[Deadline], Awaitable[Any]], deadline: Deadline, hedge: bool) -> Any:
+        """单次尝试：超过p95延迟仍未返回时发送对冲请求，采用先成功的结果并取消另一个"""
+        start = time.monotonic()
+        primary = asyncio.ensure_future(func(deadline))
+        tasks = {primary}
+        try:
+            delay = self.latency.percentile(self.hedging_percentile) if hedge else None
+            if delay is not None and delay < deadline.remaining():
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.stats["hedges"] += 1
+                    tasks.add(asyncio.ensure_future(func(deadline)))
+            
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        self.latency.record(time.monotonic() - start)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取重试与对冲统计"""
+        stats = dict(self.stats)
+        p95 = self.latency.percentile(self.hedging_percentile)
+        stats["hedge_after_seconds"] = round(p95, 3) if p95 is not None else None
+        return stats
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+from config import Config
+
+class ResultCache:
+    """按请求内容寻址的生成结果缓存（内存LRU + 可选磁盘两级，两级共用过期时间，避免复用已失效的上游图片URL）"""
+    
+    # 上游请求中携带图片数据的字段，计算缓存键时替换为图片摘要
+    IMAGE_FIELDS = ("image", "image2", "image3")
+    
+    def __init__(self, max_memory_bytes: int = Config.RESULT_CACHE_MEMORY_MAX_BYTES,
+                 disk_dir: Optional[str] = Config.RESULT_CACHE_DISK_DIR,
+                 disk_ttl_seconds: float = Config.RESULT_CACHE_DISK_TTL_SECONDS):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_ttl_seconds = disk_ttl_seconds
+        self._last_purge = time.time()
+        
+        # 内存层：缓存键 -> (过期时间, 序列化后的结果字节)
+        self._memory: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._memory_bytes = 0
+        
+        self.stats = {
+            "hits": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "memory_evictions": 0,
+            "memory_expired": 0,
+            "disk_evictions": 0
+        }
+        
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+    
+    @staticmethod
+    def make_key(payload: Dict[str, Any]) -> str:
+        """根据规范化后的上游请求体计算缓存键"""
+        normalized = {}
+        for field, value in payload.items():
+            if field in ResultCache.IMAGE_FIELDS:
+                value = hashlib.sha256(value.encode("utf-8")).hexdigest()
+            elif isinstance(value, float):
+                value = repr(value)
+            normalized[field] = value
+        encoded = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def is_cacheable(payload: Dict[str, Any]) -> bool:
+        """只有固定种子的请求结果才可复用"""
+        return payload.get("seed") is not None
+    
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查询缓存，内存未命中或已过期时回落到磁盘层"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, data = entry
+            if time.time() < expires_at:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                return json.loads(data)
+            del self._memory[key]
+            self._memory_bytes -= len(data)
+            self.stats["memory_expired"] += 1
+        
+        if self.disk_dir:
+            disk_entry = await asyncio.to_thread(self._read_disk, key)
+            if disk_entry is not None:
+                # 从磁盘载入的条目按写入时间过期，不会比磁盘层存活更久
+                stored_at, data = disk_entry
+                self._store_memory(key, data, stored_at + self.disk_ttl_seconds)
+                self.stats["hits"] += 1
+                self.stats["disk_hits"] += 1
+                return json.loads(data)
+        
+        self.stats["misses"] += 1
+        return None
+    
+    async def set(self, key: str, result: Dict[str, Any]) -> None:
+        """写入缓存"""
+        data = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        self._store_memory(key, data, time.time() + self.disk_ttl_seconds)
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, data)
+            # 周期性清理磁盘层过期条目
+            if time.time() - self._last_purge > self.disk_ttl_seconds:
+                self._last_purge = time.time()
+                await asyncio.to_thread(self.purge_expired)
+        self.stats["stores"] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取命中/未命中/淘汰计数"""
+        stats = dict(self.stats)
+        stats["memory_entries"] = len(self._memory)
+        stats["memory_bytes"] = self._memory_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+    
+    def _store_memory(self, key: str, data: bytes, expires_at: float) -> None:
+        """写入内存层并按字节上限淘汰最久未使用的条目"""
+        if len(data) > self.max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old[1])
+        self._memory[key] = (expires_at, data)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.stats["memory_evictions"] += 1
+    
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+    
+    def _read_disk(self, key: str) -> Optional[Tuple[float, bytes]]:
+        """读取磁盘层，返回写入时间和内容，过期条目直接删除"""
+        path = self._disk_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if time.time() - stored_at > self.disk_ttl_seconds:
+                os.remove(path)
+                self.stats["disk_evictions"] += 1
+                return None
+            with open(path, "rb") as f:
+                return stored_at, f.read()
+        except FileNotFoundError:
+            return None
+    
+    def _write_disk(self, key: str, data: bytes) -> None:
+        """原子写入磁盘层（先写临时文件再重命名）"""
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    
+    def purge_expired(self) -> int:
+        """清理磁盘层中所有过期条目，返回清理数量"""
+        if not self.disk_dir:
+            return 0
+        removed = 0
+        now = time.time()
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if now - os.path.getmtime(path) > self.disk_ttl_seconds:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        self.stats["disk_evictions"] += removed
+        return removed
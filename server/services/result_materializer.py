@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import os
+from typing import Any, Callable, Dict, List, Optional, Union
+import httpx
+from config import Config
+from models.image_output import OutputImage
+from services.blob_store import BlobStore
+from services.resilience import Deadline
+from utils.image_utils import ImageUtils
+from utils.metrics_utils import MetricsUtils
+
+# 上游返回的单张结果：base64字符串或{"url": ...}
+ResultEntry = Union[str, Dict[str, Any]]
+
+class ResultMaterializer:
+    """结果图片获取：base64结果直接解码，URL结果经共享连接池并发流式下载到本地存储，尺寸只从文件头解析"""
+    
+    def __init__(self, blob_store: Optional[BlobStore], get_client: Callable[[], httpx.AsyncClient],
+                 chunk_size: int = Config.MATERIALIZE_CHUNK_SIZE,
+                 probe_bytes: int = Config.MATERIALIZE_PROBE_BYTES,
+                 max_bytes: int = Config.MATERIALIZE_MAX_BYTES):
+        self.blob_store = blob_store
+        self.get_client = get_client
+        self.chunk_size = chunk_size
+        self.probe_bytes = probe_bytes
+        self.max_bytes = max_bytes
+        self.stats = {"decoded": 0, "downloaded": 0, "download_bytes": 0, "download_failures": 0}
+    
+    @staticmethod
+    def get_url(entry: ResultEntry) -> Optional[str]:
+        """URL形式的结果返回其地址，base64形式返回None"""
+        if isinstance(entry, dict):
+            return entry.get("url")
+        if entry.startswith(("http://", "https://")):
+            return entry
+        return None
+    
+    async def materialize(self, entries: List[ResultEntry], store: bool = False,
+                          load: bool = True, deadline: Optional[Deadline] = None) -> List[OutputImage]:
+        """并发获取所有结果图片；store为True时base64结果也保存到本地存储，
+        load为False时URL结果只保存到本地存储而不读入内存"""
+        return list(await asyncio.gather(*[
+            self._materialize_one(entry, store, load, deadline) for entry in entries
+        ]))
+    
+    async def _materialize_one(self, entry: ResultEntry, store: bool, load: bool,
+                               deadline: Optional[Deadline]) -> OutputImage:
+        url = ResultMaterializer.get_url(entry)
+        if url is None:
+            image = await ImageUtils.run_async(OutputImage.from_base64, entry if isinstance(entry, str) else entry["b64_json"],
+                                               stage=MetricsUtils.STAGE_DECODE)
+            self.stats["decoded"] += 1
+            if store:
+                image.blob_id = await asyncio.to_thread(self.blob_store.put, image.data, image.extension)
+            return image
+        
+        image = await self.download(url, deadline)
+        if load and image.data is None:
+            image.data = await asyncio.to_thread(self.blob_store.read, image.blob_id)
+        return image
+    
+    async def download(self, url: str, deadline: Optional[Deadline] = None) -> OutputImage:
+        """流式下载URL结果：边下载边计算摘要并写入本地存储（未配置存储时保存在内存），从开头的字节解析尺寸"""
+        digest = hashlib.sha256()
+        head = bytearray()
+        size = 0
+        tmp_path = self.blob_store.create_temp_path() if self.blob_store is not None else None
+        file = open(tmp_path, "wb") if tmp_path else None
+        completed = False
+        try:
+            timeout = deadline.timeout() if deadline is not None else httpx.USE_CLIENT_DEFAULT
+            async with self.get_client().stream("GET", url, timeout=timeout) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(f"结果图片超过{self.max_bytes}字节")
+                    digest.update(chunk)
+                    if file is None or len(head) < self.probe_bytes:
+                        head.extend(chunk)
+                    if file is not None:
+                        await asyncio.to_thread(file.write, chunk)
+            completed = True
+        except (httpx.HTTPError, ValueError) as e:
+            self.stats["download_failures"] += 1
+            raise Exception(f"结果图片下载失败: {str(e)}")
+        finally:
+            if file is not None:
+                file.close()
+                if not completed:
+                    os.remove(tmp_path)
+        self.stats["downloaded"] += 1
+        self.stats["download_bytes"] += size
+        
+        # 仅解析文件头；开头的字节不足以解析时（如超长EXIF）再从完整文件解析
+        try:
+            try:
+                width, height, format, mime_type = ImageUtils.probe_image(bytes(head))
+            except (OSError, SyntaxError):
+                if tmp_path is None:
+                    raise
+                width, height, format, mime_type = await asyncio.to_thread(ImageUtils.probe_image_file, tmp_path)
+        except (OSError, SyntaxError) as e:
+            if tmp_path is not None:
+                os.remove(tmp_path)
+            raise Exception(f"结果图片格式无效: {str(e)}")
+        
+        image = OutputImage(data=bytes(head) if file is None else None, width=width, height=height, format=format,
+                            mime_type=mime_type, size=size, source_url=url)
+        if tmp_path is not None:
+            image.blob_id = await asyncio.to_thread(
+                self.blob_store.commit, tmp_path, digest.hexdigest(), image.extension, size
+            )
+        return image
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取解码与下载统计"""
+        return dict(self.stats)
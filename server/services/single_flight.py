@@ -0,0 +1,49 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+class SingleFlight:
+    """合并并发的相同请求：同一键同时只有一个上游调用，其余请求共享其结果或异常"""
+    
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        # 上游调用 -> 等待其结果的调用方数
+        self._waiting: Dict[asyncio.Task, int] = {}
+        self.stats = {
+            "leaders": 0,
+            "coalesced": 0
+        }
+    
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """执行func，若同键调用正在进行则等待其结果"""
+        task = self._calls.get(key)
+        if task is None:
+            # 上游调用在独立任务中执行，仍有调用方等待时不受其他调用方取消的影响
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        self._waiting[task] = self._waiting.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            # 所有调用方都已取消时取消上游调用，不留下无人等待的请求（调用结束后由_finish清理计数）
+            if not task.done():
+                self._waiting[task] -= 1
+                if not self._waiting[task]:
+                    task.cancel()
+    
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        """调用结束后移除键，并标记异常已读取（调用方可能已全部取消）"""
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        self._waiting.pop(task, None)
+        if not task.cancelled():
+            task.exception()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取合并统计"""
+        stats = dict(self.stats)
+        stats["in_flight"] = len(self._calls)
+        return stats
@@ -0,0 +1,300 @@
+import asyncio
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import weakref
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+from fastapi import UploadFile
+from config import Config
+from models.image_input import InputImage
+from utils.image_utils import ImageUtils
+from utils.metrics_utils import MetricsUtils
+
+# 图片数据：小文件为bytes，大文件为只读内存映射（不复制到Python bytes对象）
+ImageData = Union[bytes, mmap.mmap]
+
+class UploadRejectedError(ValueError):
+    """上传文件被拒绝（大小超限、格式无效或疑似解压炸弹）"""
+    
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+class UploadReader:
+    """上传图片读取：先按大小上限和文件头（魔数、尺寸）校验，通过后才读取完整内容；
+    小文件读入内存，超过阈值时写入带路径的临时文件后内存映射（进程池中按路径重新映射，不复制内容）"""
+    
+    # 文件头魔数 -> 格式
+    SIGNATURES = (
+        (b"\x89PNG\r\n\x1a\n", "PNG"),
+        (b"\xff\xd8\xff", "JPEG"),
+        (b"GIF87a", "GIF"),
+        (b"GIF89a", "GIF"),
+        (b"BM", "BMP")
+    )
+    
+    def __init__(self, max_file_bytes: int = Config.UPLOAD_MAX_FILE_BYTES,
+                 max_request_bytes: int = Config.UPLOAD_MAX_REQUEST_BYTES,
+                 max_pixels: int = Config.UPLOAD_MAX_PIXELS,
+                 sniff_bytes: int = Config.UPLOAD_SNIFF_BYTES,
+                 chunk_size: int = Config.UPLOAD_CHUNK_SIZE,
+                 spool_threshold: int = Config.UPLOAD_SPOOL_THRESHOLD,
+                 spool_dir: Optional[str] = Config.UPLOAD_SPOOL_DIR,
+                 allowed_formats: Sequence[str] = Config.UPLOAD_ALLOWED_FORMATS):
+        self.max_file_bytes = max_file_bytes
+        self.max_request_bytes = max_request_bytes
+        self.max_pixels = max_pixels
+        self.sniff_bytes = sniff_bytes
+        self.chunk_size = chunk_size
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.allowed_formats = tuple(allowed_formats)
+        self.stats = {"accepted": 0, "rejected": 0, "mapped": 0, "spooled": 0, "in_memory": 0}
+    
+    @staticmethod
+    def sniff_format(head: bytes) -> Optional[str]:
+        """根据文件头魔数判断图片格式（不信任客户端提供的Content-Type）"""
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return "WEBP"
+        for signature, format in UploadReader.SIGNATURES:
+            if head.startswith(signature):
+                return format
+        return None
+    
+    async def read_all(self, files: List[UploadFile]) -> List[InputImage]:
+        """按顺序读取一个请求中的所有上传图片，累计大小超过请求上限时拒绝"""
+        images = []
+        remaining = self.max_request_bytes
+        for file in files:
+            image = await self.read(file, remaining)
+            remaining -= len(image.data)
+            images.append(image)
+        return images
+    
+    async def read(self, file: UploadFile, remaining: Optional[int] = None) -> InputImage:
+        """读取并校验单个上传图片；remaining为该请求剩余的字节额度"""
+        try:
+            with MetricsUtils.timer(MetricsUtils.STAGE_UPLOAD_READ):
+                image = await self._read(file, remaining)
+        except UploadRejectedError:
+            self.stats["rejected"] += 1
+            raise
+        self.stats["accepted"] += 1
+        MetricsUtils.observe_bytes("upload", len(image.data))
+        return image
+    
+    async def _read(self, file: UploadFile, remaining: Optional[int]) -> InputImage:
+        from PIL import Image
+        name = file.filename
+        limit = self.max_file_bytes if remaining is None else min(self.max_file_bytes, remaining)
+        # 表单解析已知文件大小时，先按大小拒绝，不读取内容
+        if file.size is not None:
+            self._check_size(name, file.size, limit)
+        
+        head = await file.read(self.sniff_bytes)
+        await file.seek(0)
+        format = UploadReader.sniff_format(head)
+        if format is None or format not in self.allowed_formats:
+            raise UploadRejectedError(f"文件 {name} 不是有效的图片格式")
+        
+        # 文件头足以解析尺寸时，在读取完整内容前检查像素数
+        probed = None
+        try:
+            with MetricsUtils.timer(MetricsUtils.STAGE_DECODE):
+                probed = ImageUtils.probe_image(head)
+        except (OSError, SyntaxError):
+            if len(head) < self.sniff_bytes:
+                raise UploadRejectedError(f"文件 {name} 不是有效的图片格式")
+        except Image.DecompressionBombError:
+            raise UploadRejectedError(f"文件 {name} 像素数超过上限")
+        if probed is not None:
+            self._check_pixels(name, probed[0], probed[1])
+        
+        data, path = await asyncio.to_thread(self._load, file.file, name, limit)
+        if probed is None:
+            # 超长元数据（如EXIF）使尺寸信息不在文件头中时，从完整内容解析
+            try:
+                probed = await asyncio.to_thread(ImageUtils.probe_image, data)
+            except (OSError, SyntaxError, Image.DecompressionBombError):
+                raise UploadRejectedError(f"文件 {name} 不是有效的图片格式")
+            self._check_pixels(name, probed[0], probed[1])
+        
+        width, height, image_format, mime_type = probed
+        return InputImage(data=data, width=width, height=height, format=image_format,
+                          mime_type=mime_type, filename=name, path=path)
+    
+    def check_data(self, name: Optional[str], data: bytes) -> InputImage:
+        """校验已读入内存的图片（如压缩包成员）：大小、文件头魔数和像素数，不通过时抛出UploadRejectedError"""
+        from PIL import Image
+        self._check_size(name, len(data), self.max_file_bytes)
+        format = UploadReader.sniff_format(data[:self.sniff_bytes])
+        if format is None or format not in self.allowed_formats:
+            raise UploadRejectedError(f"文件 {name} 不是有效的图片格式")
+        try:
+            width, height, image_format, mime_type = ImageUtils.probe_image(data)
+        except (OSError, SyntaxError):
+            raise UploadRejectedError(f"文件 {name} 不是有效的图片格式")
+        except Image.DecompressionBombError:
+            raise UploadRejectedError(f"文件 {name} 像素数超过上限")
+        self._check_pixels(name, width, height)
+        return InputImage(data=data, width=width, height=height, format=image_format,
+                          mime_type=mime_type, filename=name)
+    
+    def _check_size(self, name: Optional[str], size: int, limit: int) -> None:
+        if size > self.max_file_bytes:
+            raise UploadRejectedError(f"文件 {name} 超过单个文件上限{self.max_file_bytes}字节", status_code=413)
+        if size > limit:
+            raise UploadRejectedError(f"上传图片总大小超过单个请求上限{self.max_request_bytes}字节", status_code=413)
+    
+    def _check_pixels(self, name: Optional[str], width: int, height: int) -> None:
+        """解压炸弹检查：按文件头声明的尺寸拒绝像素数过大的图片，避免完整解码"""
+        if width * height > self.max_pixels:
+            raise UploadRejectedError(f"文件 {name} 像素数{width}x{height}超过上限{self.max_pixels}")
+    
+    def _load(self, file: Any, name: Optional[str], limit: int) -> Tuple[ImageData, Optional[str]]:
+        """读取完整内容，返回数据和内存映射对应的临时文件路径：小文件读入内存；
+        大文件按块写入带路径的临时文件后映射（传入进程池时只传路径），表单解析时已落盘的文件按文件大小先检查"""
+        # SpooledTemporaryFile在内存中时fileno()会先将内容写入磁盘，只对已落盘的文件取fileno
+        if getattr(file, "_rolled", True):
+            try:
+                fileno = file.fileno()
+            except (AttributeError, OSError, ValueError):
+                fileno = None
+            if fileno is not None:
+                size = os.fstat(fileno).st_size
+                self._check_size(name, size, limit)
+                if size >= self.spool_threshold:
+                    # 表单的临时文件没有路径，按块复制到上传临时文件（不经过完整的内存副本）
+                    self.stats["mapped"] += 1
+                    file.seek(0)
+                    spool = self._create_spool()
+                    try:
+                        shutil.copyfileobj(file, spool, self.chunk_size)
+                        return self._map_spool(spool)
+                    except BaseException:
+                        UploadReader._remove_spool(spool.name)
+                        raise
+                    finally:
+                        spool.close()
+        
+        buffer = bytearray()
+        spool = None
+        size = 0
+        try:
+            while True:
+                chunk = file.read(self.chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                self._check_size(name, size, limit)
+                if spool is None and size > self.spool_threshold:
+                    spool = self._create_spool()
+                    spool.write(buffer)
+                    buffer = None
+                if spool is not None:
+                    spool.write(chunk)
+                else:
+                    buffer.extend(chunk)
+            if spool is None:
+                self.stats["in_memory"] += 1
+                return bytes(buffer), None
+            self.stats["spooled"] += 1
+            return self._map_spool(spool)
+        except BaseException:
+            if spool is not None:
+                UploadReader._remove_spool(spool.name)
+            raise
+        finally:
+            if spool is not None:
+                spool.close()
+    
+    def _create_spool(self) -> Any:
+        """创建上传临时文件（保留路径，由映射释放时删除）"""
+        return tempfile.NamedTemporaryFile(dir=self.spool_dir, prefix="upload-", delete=False)
+    
+    @staticmethod
+    def _map_spool(spool: Any) -> Tuple[mmap.mmap, str]:
+        """映射上传临时文件，映射对象释放时删除文件"""
+        spool.flush()
+        data = ImageUtils.map_file(spool.name)
+        weakref.finalize(data, UploadReader._remove_spool, spool.name)
+        return data, spool.name
+    
+    @staticmethod
+    def _remove_spool(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取上传读取统计"""
+        return dict(self.stats)
+
+class RequestSizeLimiter:
+    """ASGI中间件：限制指定路径的请求体大小；Content-Length超限时直接返回413，
+    分块传输时在接收过程中累计，超限后停止读取并返回413；path_limits中的接口使用单独的上限"""
+    
+    def __init__(self, app: Callable, max_bytes: int = Config.UPLOAD_MAX_REQUEST_BYTES,
+                 paths: Sequence[str] = Config.UPLOAD_LIMITED_PATHS,
+                 overhead_bytes: int = Config.UPLOAD_FORM_OVERHEAD_BYTES,
+                 path_limits: Mapping[str, int] = Config.UPLOAD_PATH_MAX_BYTES):
+        self.app = app
+        # 表单字段和multipart分隔符需要额外的空间
+        self.limits = {path: max_bytes + overhead_bytes for path in paths}
+        self.limits.update({path: limit + overhead_bytes for path, limit in path_limits.items()})
+    
+    async def _reject(self, send: Callable, max_bytes: int) -> None:
+        body = json.dumps({"detail": f"请求体超过上限{max_bytes}字节"}, ensure_ascii=False).encode("utf-8")
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
+    
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        max_bytes = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if max_bytes is None or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        
+        for key, value in scope["headers"]:
+            if key == b"content-length":
+                try:
+                    if int(value) > max_bytes:
+                        await self._reject(send, max_bytes)
+                        return
+                except ValueError:
+                    pass
+                break
+        
+        received = 0
+        rejected = False
+        response_started = False
+        
+        async def limited_receive() -> Dict[str, Any]:
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    # 通知应用客户端已断开，停止解析请求体
+                    rejected = True
+                    return {"type": "http.disconnect"}
+            return message
+        
+        async def guarded_send(message: Dict[str, Any]) -> None:
+            nonlocal response_started
+            if rejected:
+                return
+            response_started = True
+            await send(message)
+        
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+        if rejected and not response_started:
+            await self._reject(send, max_bytes)
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple, Union
+from config import Config
+from services.blob_store import BlobStore
+from services.single_flight import SingleFlight
+from utils.image_utils import ImageUtils
+from utils.metrics_utils import MetricsUtils
+from utils.response_utils import ResponseUtils
+
+# 输出格式 -> (PIL格式名, MIME类型, 扩展名)
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "avif": ("AVIF", "image/avif", "avif")
+}
+
+# 原图扩展名 -> format=auto且客户端不接受协商格式时的输出格式
+SOURCE_FORMATS = {"jpg": "jpeg", "jpeg": "jpeg", "mpo": "jpeg", "png": "png", "webp": "webp"}
+
+@dataclass(frozen=True)
+class Variant:
+    """一个衍生版本：原图、最长边、输出格式和质量，variant_id由这些参数确定"""
+    source_id: str
+    size: Optional[int]
+    format: str
+    quality: Optional[int]
+    
+    @property
+    def variant_id(self) -> str:
+        key = f"{self.source_id}|{self.size or 0}|{self.format}|{self.quality or 0}"
+        return f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.{FORMATS[self.format][2]}"
+    
+    @property
+    def mime_type(self) -> str:
+        return FORMATS[self.format][1]
+    
+    @property
+    def etag(self) -> str:
+        """原图按内容寻址且生成过程确定，参数摘要即为强ETag（无需生成即可响应条件请求）"""
+        return BlobStore.get_etag(self.variant_id)
+
+class VariantRenderer:
+    """图片衍生版本（缩略图、WebP/AVIF/JPEG转换）：首次请求时在执行器中生成，结果保存在有容量上限的磁盘缓存中"""
+    
+    _supported_formats = None
+    
+    def __init__(self, store: Optional[BlobStore] = None):
+        self.store = store or BlobStore(
+            Config.VARIANT_CACHE_DIR, Config.VARIANT_CACHE_TTL_SECONDS, Config.VARIANT_CACHE_MAX_BYTES
+        )
+        self.single_flight = SingleFlight()
+        self.stats = {"hits": 0, "renders": 0, "bytes_rendered": 0}
+    
+    @staticmethod
+    def supported_formats() -> Tuple[str, ...]:
+        """配置中允许且当前Pillow支持编码的格式（首次调用时检测）"""
+        if VariantRenderer._supported_formats is None:
+            from PIL import features
+            VariantRenderer._supported_formats = tuple(
+                format for format in Config.VARIANT_FORMATS
+                if format in FORMATS and (format not in ("webp", "avif") or features.check(format))
+            )
+        return VariantRenderer._supported_formats
+    
+    @staticmethod
+    def resolve(source_id: str, size: Optional[int] = None, format: str = "auto",
+                quality: Optional[str] = None, accept: Optional[str] = None) -> Variant:
+        """校验请求参数并确定衍生版本，format为auto时按Accept请求头协商；参数无效时抛出ValueError"""
+        if size is not None and size not in Config.VARIANT_SIZES:
+            raise ValueError(f"size必须是以下之一: {', '.join(str(size) for size in Config.VARIANT_SIZES)}")
+        quality = quality or Config.VARIANT_DEFAULT_QUALITY
+        if quality not in Config.VARIANT_QUALITY_LEVELS:
+            raise ValueError(f"quality必须是以下之一: {', '.join(Config.VARIANT_QUALITY_LEVELS)}")
+        
+        supported = VariantRenderer.supported_formats()
+        if format == "auto":
+            negotiated = [f for f in Config.VARIANT_AUTO_FORMATS if f in supported and ResponseUtils.accepts(accept, FORMATS[f][1])]
+            format = negotiated[0] if negotiated else SOURCE_FORMATS.get(source_id.rsplit(".", 1)[-1], "png")
+        elif format not in supported:
+            raise ValueError(f"format必须是auto或以下之一: {', '.join(supported)}")
+        
+        # 无损格式不使用质量参数，不同质量等级共享同一版本
+        level = Config.VARIANT_QUALITY_LEVELS[quality] if format != "png" else None
+        return Variant(source_id=source_id, size=size, format=format, quality=level)
+    
+    async def render(self, variant: Variant, source_path: str) -> Union[str, bytes]:
+        """获取衍生版本：缓存命中时返回文件路径，否则生成后保存并返回图片字节（并发请求只生成一次）"""
+        path = self.store.get_path(variant.variant_id)
+        if path is not None and self.store.touch(variant.variant_id):
+            self.stats["hits"] += 1
+            return path
+        return await self.single_flight.do(variant.variant_id, lambda: self._render(variant, source_path))
+    
+    async def _render(self, variant: Variant, source_path: str) -> bytes:
+        data = await ImageUtils.run_async(
+            ImageUtils.render_variant, source_path, variant.size, FORMATS[variant.format][0], variant.quality,
+            heavy=Config.VARIANT_IN_PROCESS, stage=MetricsUtils.STAGE_VARIANT
+        )
+        await asyncio.to_thread(self._save, variant, data)
+        self.stats["renders"] += 1
+        self.stats["bytes_rendered"] += len(data)
+        return data
+    
+    def _save(self, variant: Variant, data: bytes) -> None:
+        tmp_path = self.store.create_temp_path()
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        digest, extension = variant.variant_id.split(".")
+        self.store.commit(tmp_path, digest, extension, len(data))
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取生成与缓存统计"""
+        stats = dict(self.stats)
+        stats["cache"] = self.store.get_stats()
+        return stats
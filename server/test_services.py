@@ -0,0 +1,1630 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import base64
+import logging
+import tempfile
+import zipfile
+import gc
+import pickle
+import mmap
+import struct
+import zlib
+import tracemalloc
+import httpx
+from fastapi import UploadFile
+from pydantic import ValidationError
+from io import BytesIO
+from PIL import Image
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from config import Config
+from models.image_input import InputImage
+from models.image_output import OutputImage
+from models.image_request import ImageGenerationRequest
+from models.model_registry import ModelRegistry
+from services.batch_manager import BatchManager, BatchRunningError
+from services.batch_store import BatchStore
+from services.backend_pool import Backend, BackendPool, BackendUnavailableError
+from services.image_generator import ImageGenerator
+from services.image_preprocessor import ImagePreprocessor
+from services.blob_store import BlobStore
+from services.fair_scheduler import FairScheduler, SchedulerQueueFullError, TrafficClient
+from services.generation_pipeline import GenerationPipeline
+from services.job_manager import JobManager, JobQueueFullError
+from services.job_store import MemoryJobStore, SQLiteJobStore
+from services.rate_governor import RateGovernor, UpstreamRateLimitError
+from services.reference_store import ReferenceNotFoundError, ReferenceStore
+from services.request_profiler import ProfilingDisabledError, ProfilingMiddleware, RequestProfiler
+from services.resilience import Deadline, DeadlineExceededError, ResilientCaller
+from services.result_cache import ResultCache
+from services.upload_reader import RequestSizeLimiter, UploadReader, UploadRejectedError
+from services.variant_renderer import VariantRenderer
+from utils.image_utils import ImageUtils
+from utils.metrics_utils import MetricsUtils
+from utils.response_utils import ResponseUtils
+
+TEST_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_image.png")
+with open(TEST_IMAGE_PATH, "rb") as f:
+    TEST_IMAGE_BYTES = f.read()
+TEST_IMAGE_BASE64 = InputImage.from_bytes(TEST_IMAGE_BYTES).base64
+
+class FakeUpstream:
+    """本地模拟的SiliconFlow图片生成接口，记录调用次数"""
+    
+    def __init__(self, latency: float = 0.0, output: str = "url"):
+        self.latency = latency
+        self.output = output
+        self.calls = 0
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.output == "base64":
+            images = [TEST_IMAGE_BASE64]
+        else:
+            images = [{"url": f"https://example.com/{self.calls}.png"}]
+        return httpx.Response(200, json={
+            "images": images,
+            "timings": {"inference": self.latency},
+            "seed": 42
+        })
+    
+    def create_generator(self, cache: ResultCache = None) -> ImageGenerator:
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+        return ImageGenerator(client=client, cache=cache)
+
+async def generate(generator: ImageGenerator, **kwargs):
+    params = {"model": "Qwen/Qwen-Image-Edit", "prompt": "test prompt"}
+    params.update(kwargs)
+    return await generator.generate_images(**params)
+
+# 测试result_cache.py
+print("=== 测试result_cache.py ===")
+
+print("1. 测试固定种子的请求命中缓存")
+upstream = FakeUpstream()
+generator = upstream.create_generator(cache=ResultCache(max_memory_bytes=1024 * 1024))
+first = asyncio.run(generate(generator, seed=1))
+second = asyncio.run(generate(generator, seed=1))
+assert first == second
+assert upstream.calls == 1
+assert generator.cache.get_stats()["memory_hits"] == 1
+print("✅ 缓存命中测试成功")
+
+print("2. 测试未固定种子的请求不使用缓存")
+asyncio.run(generate(generator))
+asyncio.run(generate(generator))
+assert upstream.calls == 3
+print("✅ 未固定种子测试成功")
+
+print("3. 测试参数不同的请求不共享缓存")
+asyncio.run(generate(generator, seed=1, cfg=5.0))
+assert upstream.calls == 4
+print("✅ 缓存键区分参数测试成功")
+
+print("4. 测试内存层按字节上限淘汰")
+upstream = FakeUpstream()
+generator = upstream.create_generator(cache=ResultCache(max_memory_bytes=150))
+asyncio.run(generate(generator, seed=1))
+asyncio.run(generate(generator, seed=2))
+stats = generator.cache.get_stats()
+assert stats["memory_evictions"] == 1
+assert stats["memory_bytes"] <= 150
+print("✅ 内存淘汰测试成功")
+
+print("5. 测试磁盘层命中与过期")
+with tempfile.TemporaryDirectory() as cache_dir:
+    upstream = FakeUpstream()
+    generator = upstream.create_generator(cache=ResultCache(max_memory_bytes=1024, disk_dir=cache_dir))
+    asyncio.run(generate(generator, seed=7))
+    # 新的缓存实例（模拟重启）只能从磁盘层命中
+    generator.cache = ResultCache(max_memory_bytes=1024, disk_dir=cache_dir)
+    asyncio.run(generate(generator, seed=7))
+    assert upstream.calls == 1
+    assert generator.cache.get_stats()["disk_hits"] == 1
+    
+    generator.cache = ResultCache(max_memory_bytes=1024, disk_dir=cache_dir, disk_ttl_seconds=-1)
+    asyncio.run(generate(generator, seed=7))
+    assert upstream.calls == 2
+    assert generator.cache.get_stats()["disk_evictions"] >= 1
+print("✅ 磁盘层测试成功")
+
+print("6. 测试内存层条目过期后重新调用上游（避免复用已失效的图片URL）")
+upstream = FakeUpstream()
+generator = upstream.create_generator(cache=ResultCache(max_memory_bytes=1024, disk_ttl_seconds=0.05))
+asyncio.run(generate(generator, seed=8))
+asyncio.run(generate(generator, seed=8))
+assert upstream.calls == 1
+time.sleep(0.06)
+asyncio.run(generate(generator, seed=8))
+assert upstream.calls == 2 and generator.cache.get_stats()["memory_expired"] == 1
+print("✅ 内存层过期测试成功")
+
+# 测试single_flight.py
+print("\n=== 测试single_flight.py ===")
+
+print("1. 测试并发相同请求合并为一次上游调用")
+upstream = FakeUpstream(latency=0.1)
+generator = upstream.create_generator(cache=ResultCache(max_memory_bytes=1024 * 1024))
+
+async def run_concurrent(count: int, **kwargs):
+    return await asyncio.gather(*[generate(generator, **kwargs) for _ in range(count)])
+
+results = asyncio.run(run_concurrent(5, seed=3))
+assert upstream.calls == 1
+assert all(result == results[0] for result in results)
+assert generator.single_flight.get_stats()["coalesced"] == 4
+assert generator.single_flight.get_stats()["in_flight"] == 0
+print("✅ 请求合并测试成功")
+
+print("2. 测试首个请求取消不影响等待中的请求")
+async def cancel_leader():
+    leader = asyncio.ensure_future(generate(generator, seed=4))
+    await asyncio.sleep(0)
+    followers = [asyncio.ensure_future(generate(generator, seed=4)) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    return leader, await asyncio.gather(*followers)
+
+leader, results = asyncio.run(cancel_leader())
+assert leader.cancelled()
+assert len(results) == 3 and all(result["images"] for result in results)
+assert upstream.calls == 2
+print("✅ 取消隔离测试成功")
+
+print("3. 测试上游错误传播给所有合并的请求")
+async def failing_handler(request: httpx.Request) -> httpx.Response:
+    await asyncio.sleep(0.05)
+    return httpx.Response(500, json={"message": "upstream error"})
+
+generator = ImageGenerator(client=httpx.AsyncClient(transport=httpx.MockTransport(failing_handler)), cache=ResultCache())
+
+async def run_failing():
+    return await asyncio.gather(*[generate(generator, seed=5) for _ in range(3)], return_exceptions=True)
+
+errors = asyncio.run(run_failing())
+assert all(isinstance(error, Exception) and "API调用失败" in str(error) for error in errors)
+assert generator.single_flight.get_stats()["leaders"] == 1
+print("✅ 错误传播测试成功")
+
+print("4. 测试合并的请求各自按自己的截止时间等待，不受首个请求截止时间限制")
+class FlakyUpstream(FakeUpstream):
+    """首次调用返回500，之后正常返回"""
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if self.calls == 0:
+            self.calls += 1
+            await asyncio.sleep(self.latency)
+            return httpx.Response(500, json={"message": "upstream error"})
+        return await super().handler(request)
+
+upstream = FlakyUpstream(latency=0.1)
+generator = upstream.create_generator(cache=None)
+
+async def short_leader():
+    leader = asyncio.ensure_future(generate(generator, seed=6, deadline=Deadline(0.05)))
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(generate(generator, seed=6, deadline=Deadline(5)))
+    return await asyncio.gather(leader, follower, return_exceptions=True)
+
+leader_result, follower_result = asyncio.run(short_leader())
+assert isinstance(leader_result, DeadlineExceededError)
+# 共享调用失败后按默认截止时间重试，首个请求超时不影响等待中的请求
+assert follower_result["images"] and upstream.calls == 2
+print("✅ 截止时间隔离测试成功")
+
+# 测试rate_governor.py
+print("\n=== 测试rate_governor.py ===")
+
+print("1. 测试收到429后按Retry-After等待并降低速率")
+class RateLimitedUpstream(FakeUpstream):
+    """前limited次调用返回429"""
+    
+    def __init__(self, limited: int, retry_after: str = "0.2"):
+        super().__init__(output="base64")
+        self.limited = limited
+        self.retry_after = retry_after
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if self.calls < self.limited:
+            self.calls += 1
+            return httpx.Response(429, headers={"Retry-After": self.retry_after}, json={"message": "rate limited"})
+        return await super().handler(request)
+    
+    def create_generator(self, governor: RateGovernor) -> ImageGenerator:
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+        return ImageGenerator(client=client, cache=None, rate_governor=governor)
+
+governor = RateGovernor(key_rpm=600, model_rpm={"default": 600}, burst=4)
+upstream = RateLimitedUpstream(limited=1)
+generator = upstream.create_generator(governor)
+start = time.perf_counter()
+result = asyncio.run(generate(generator))
+elapsed = time.perf_counter() - start
+stats = governor.get_stats()
+assert result["images"] == [TEST_IMAGE_BASE64]
+assert upstream.calls == 2
+assert elapsed >= 0.2
+assert stats["rate_limited"] == 1
+assert all(rate < 600 for rate in stats["key_rpm"].values())
+print("✅ 429自适应测试成功")
+
+print("2. 测试令牌不足时请求排队而不是失败")
+governor = RateGovernor(key_rpm=600, model_rpm={"default": 600}, burst=1)
+generator = FakeUpstream(output="base64").create_generator(cache=None)
+generator.rate_governor = governor
+
+async def run_queued(count: int):
+    return await asyncio.gather(*[generate(generator, prompt=f"queued {i}") for i in range(count)])
+
+start = time.perf_counter()
+results = asyncio.run(run_queued(3))
+elapsed = time.perf_counter() - start
+assert len(results) == 3
+assert elapsed >= 0.2  # 600次/分钟即每0.1秒一个令牌，后两个请求需要排队
+assert governor.get_stats()["waited"] == 2
+print("✅ 排队测试成功")
+
+print("3. 测试持续限流时抛出UpstreamRateLimitError")
+governor = RateGovernor(key_rpm=6000, model_rpm={"default": 6000}, burst=4)
+generator = RateLimitedUpstream(limited=100, retry_after="0").create_generator(governor)
+try:
+    asyncio.run(generate(generator))
+    assert False, "应抛出UpstreamRateLimitError"
+except UpstreamRateLimitError as e:
+    assert e.retry_after == 0
+print("✅ 限流错误测试成功")
+
+print("4. 测试Retry-After解析")
+assert RateGovernor.parse_retry_after("5") == 5.0
+assert RateGovernor.parse_retry_after("invalid") is None
+assert RateGovernor.parse_retry_after(None) is None
+assert RateGovernor.parse_retry_after("Thu, 01 Jan 1970 00:00:00 GMT") == 0.0
+print("✅ Retry-After解析测试成功")
+
+# 测试fair_scheduler.py
+print("\n=== 测试fair_scheduler.py ===")
+
+print("1. 测试名额不足时按类别权重和客户端轮询调度")
+async def run_scheduled():
+    scheduler = FairScheduler(max_concurrent=1, classes={"interactive": 4, "bulk": 1}, clients={})
+    order = []
+    
+    async def call(client: TrafficClient, name: str):
+        async with scheduler.slot(client):
+            order.append(name)
+            await asyncio.sleep(0)
+    
+    async with scheduler.slot():
+        bulk_a = TrafficClient("id:bulk-a", "bulk")
+        bulk_b = TrafficClient("id:bulk-b", "bulk")
+        web = TrafficClient("id:web", "interactive")
+        tasks = [asyncio.ensure_future(call(bulk_a, f"a{i}")) for i in range(6)]
+        tasks += [asyncio.ensure_future(call(bulk_b, f"b{i}")) for i in range(2)]
+        tasks += [asyncio.ensure_future(call(web, f"w{i}")) for i in range(4)]
+        await asyncio.sleep(0)
+        assert scheduler.get_stats()["queued"] == 12
+    await asyncio.gather(*tasks)
+    return order, scheduler.get_stats()
+
+order, stats = asyncio.run(run_scheduled())
+# 先到的批量类别用完一轮额度后，交互请求按4:1的权重获得名额；批量类别内两个客户端交替
+assert order == ["a0", "w0", "w1", "w2", "w3", "b0", "a1", "b1", "a2", "a3", "a4", "a5"], order
+assert stats["in_flight"] == 0 and stats["queued"] == 0 and stats["queued_clients"] == 0
+assert stats["classes"]["interactive"]["dispatched"] == 5 and stats["classes"]["bulk"]["dispatched"] == 8
+assert stats["classes"]["interactive"]["wait_p95"] <= stats["classes"]["bulk"]["wait_p95"]
+print("✅ 加权轮询调度测试成功")
+
+print("2. 测试排队超时和客户端排队上限")
+async def run_limits():
+    scheduler = FairScheduler(max_concurrent=1, classes={"interactive": 1}, clients={}, max_queued_per_client=1)
+    client = TrafficClient("id:script", "interactive")
+    async with scheduler.slot():
+        try:
+            async with scheduler.slot(client, timeout=0.05):
+                pass
+            assert False, "应抛出DeadlineExceededError"
+        except DeadlineExceededError:
+            pass
+        waiting = asyncio.ensure_future(scheduler.slot(client).__aenter__())
+        await asyncio.sleep(0)
+        try:
+            async with scheduler.slot(client):
+                pass
+            assert False, "应抛出SchedulerQueueFullError"
+        except SchedulerQueueFullError:
+            pass
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+    return scheduler.get_stats()
+
+stats = asyncio.run(run_limits())
+assert stats["timeouts"] == 1 and stats["rejected"] == 1
+assert stats["in_flight"] == 0 and stats["queued"] == 0
+print("✅ 超时与排队上限测试成功")
+
+print("3. 测试按请求头确定客户端身份和类别")
+scheduler = FairScheduler(classes={"interactive": 8, "bulk": 1}, clients={"id:nightly": {"class": "bulk"}})
+client = scheduler.identify({"Authorization": "Bearer secret-token"}, "10.0.0.1", "interactive")
+assert client.client_id.startswith("token:") and "secret" not in client.client_id
+assert client.traffic_class == "interactive"
+assert scheduler.identify({}, "10.0.0.1", "interactive").client_id == "ip:10.0.0.1"
+assert scheduler.identify({"X-Client-Id": "nightly"}, None, "interactive").traffic_class == "bulk"
+assert scheduler.identify({"X-Traffic-Class": "bulk"}, None, "interactive").traffic_class == "bulk"
+assert scheduler.identify({"X-Traffic-Class": "interactive"}, None, "bulk").traffic_class == "bulk"
+print("✅ 客户端身份测试成功")
+
+print("4. 测试速率控制排队时交互请求优先于先到的批量请求")
+async def run_paced():
+    order = []
+    
+    async def handler(request: httpx.Request) -> httpx.Response:
+        order.append(json.loads(request.content)["prompt"])
+        return httpx.Response(200, json={"images": [{"url": "https://example.com/1.png"}], "seed": 42})
+    
+    governor = RateGovernor(key_rpm=600, model_rpm={"default": 600}, burst=1)
+    scheduler = FairScheduler(classes={"interactive": 8, "bulk": 1}, clients={})
+    generator = ImageGenerator(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)), cache=None,
+                               rate_governor=governor, scheduler=scheduler)
+    generator.single_flight = None
+    bulk = TrafficClient("id:nightly", "bulk")
+    web = TrafficClient("id:web", "interactive")
+    calls = [generate(generator, prompt=f"bulk{i}", client=bulk) for i in range(8)]
+    calls += [generate(generator, prompt=f"web{i}", client=web) for i in range(2)]
+    await asyncio.gather(*calls)
+    return order, governor.get_stats(), scheduler.get_stats()
+
+order, governor_stats, scheduler_stats = asyncio.run(run_paced())
+# 每0.1秒一个令牌：已在等待令牌的批量请求之后，交互请求先于其余批量请求发出
+assert order.index("web1") < order.index("bulk4"), order
+flows = governor_stats["flows"]
+assert flows["interactive"]["admitted"] == 2 and flows["bulk"]["admitted"] == 8
+assert flows["interactive"]["wait_seconds"] / 2 < flows["bulk"]["wait_seconds"] / 8
+assert scheduler_stats["in_flight"] == 0 and governor_stats["in_flight"] == 0
+print("✅ 速率控制与公平调度联合测试成功")
+
+# 测试backend_pool.py
+print("\n=== 测试backend_pool.py ===")
+
+class MultiBackendUpstream:
+    """按后端地址分别模拟延迟和故障"""
+    
+    def __init__(self, latencies: dict, failing: set = None):
+        self.latencies = latencies
+        self.failing = failing or set()
+        self.calls = {host: 0 for host in latencies}
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        self.calls[host] += 1
+        await asyncio.sleep(self.latencies[host])
+        if host in self.failing:
+            return httpx.Response(503, json={"message": "unavailable"})
+        return httpx.Response(200, json={"images": [TEST_IMAGE_BASE64], "seed": 42})
+    
+    def create_generator(self, strategy: str, weights: dict = None, **pool_kwargs) -> ImageGenerator:
+        backends = [
+            Backend(host, f"https://{host}/v1/images/generations", f"key-{host}", (weights or {}).get(host, 1.0))
+            for host in self.latencies
+        ]
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+        generator = ImageGenerator(client=client, cache=None,
+                                   backend_pool=BackendPool(backends, strategy=strategy, **pool_kwargs))
+        # 只测试路由和熔断，不经过速率控制
+        generator.rate_governor = None
+        return generator
+
+async def run_many(generator: ImageGenerator, count: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def one(i: int):
+        async with semaphore:
+            try:
+                return await generate(generator, prompt=f"prompt {i}")
+            except Exception as e:
+                return e
+    
+    return await asyncio.gather(*[one(i) for i in range(count)])
+
+print("1. 测试最少在途请求策略将并发请求分散到多个后端")
+upstream = MultiBackendUpstream({"a.test": 0.02, "b.test": 0.02})
+generator = upstream.create_generator(BackendPool.LEAST_OUTSTANDING)
+asyncio.run(run_many(generator, 20, concurrency=4))
+assert upstream.calls["a.test"] >= 5 and upstream.calls["b.test"] >= 5
+print(f"✅ 负载均衡测试成功: {upstream.calls}")
+
+print("2. 测试EWMA策略偏向低延迟后端")
+upstream = MultiBackendUpstream({"fast.test": 0.005, "slow.test": 0.05})
+generator = upstream.create_generator(BackendPool.EWMA)
+asyncio.run(run_many(generator, 30, concurrency=1))
+assert upstream.calls["fast.test"] > upstream.calls["slow.test"] * 3
+stats = {backend["name"]: backend for backend in generator.backend_pool.get_stats()}
+assert stats["fast.test"]["ewma_ms"] < stats["slow.test"]["ewma_ms"]
+print(f"✅ EWMA路由测试成功: {upstream.calls}")
+
+print("3. 测试连续失败的后端被熔断并在冷却后恢复探测")
+upstream = MultiBackendUpstream({"good.test": 0.0, "bad.test": 0.0}, failing={"bad.test"})
+generator = upstream.create_generator(BackendPool.LEAST_OUTSTANDING, failure_threshold=2, cooldown_seconds=0.2)
+asyncio.run(run_many(generator, 20, concurrency=1))
+stats = {backend["name"]: backend for backend in generator.backend_pool.get_stats()}
+assert stats["bad.test"]["state"] == Backend.OPEN
+assert stats["bad.test"]["ejections"] == 1
+assert upstream.calls["bad.test"] == 2
+time.sleep(0.25)
+asyncio.run(run_many(generator, 5, concurrency=1))
+assert upstream.calls["bad.test"] == 3  # 冷却后只放行一个探测请求，失败后再次熔断
+assert generator.backend_pool.get_stats()[1]["ejections"] == 2
+print("✅ 熔断测试成功")
+
+print("4. 测试所有后端熔断时快速失败")
+upstream = MultiBackendUpstream({"bad.test": 0.0}, failing={"bad.test"})
+generator = upstream.create_generator(BackendPool.LEAST_OUTSTANDING, failure_threshold=1, cooldown_seconds=60)
+errors = asyncio.run(run_many(generator, 3, concurrency=1))
+assert isinstance(errors[-1], BackendUnavailableError)
+assert upstream.calls["bad.test"] == 1
+assert 59 < errors[-1].retry_after <= 60  # 按熔断冷却剩余时间提示重试
+print("✅ 快速失败测试成功")
+
+# 测试resilience.py
+print("\n=== 测试resilience.py ===")
+
+class FlakyUpstream(FakeUpstream):
+    """按调用顺序注入延迟和错误：script中每项为(延迟秒数, 状态码)，用完后正常返回"""
+    
+    def __init__(self, script: list):
+        super().__init__(output="base64")
+        self.script = list(script)
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if self.calls < len(self.script):
+            latency, status = self.script[self.calls]
+            self.calls += 1
+            await asyncio.sleep(latency)
+            if status >= 400:
+                return httpx.Response(status, json={"message": "injected error"})
+            return httpx.Response(status, json={"images": [TEST_IMAGE_BASE64], "seed": self.calls})
+        return await super().handler(request)
+    
+    def create_generator(self, **caller_kwargs) -> ImageGenerator:
+        generator = super().create_generator(cache=None)
+        generator.rate_governor = None
+        generator.resilience = ResilientCaller(base_delay=0.01, **caller_kwargs)
+        return generator
+
+print("1. 测试固定种子的请求在5xx后退避重试")
+upstream = FlakyUpstream([(0, 503), (0, 502)])
+generator = upstream.create_generator()
+result = asyncio.run(generate(generator, seed=11))
+assert result["images"] == [TEST_IMAGE_BASE64]
+assert upstream.calls == 3
+assert generator.resilience.get_stats()["retries"] == 2
+print("✅ 重试测试成功")
+
+print("2. 测试未固定种子的请求不重试")
+upstream = FlakyUpstream([(0, 503)])
+generator = upstream.create_generator()
+try:
+    asyncio.run(generate(generator))
+    assert False, "应抛出异常"
+except Exception as e:
+    assert "API调用失败" in str(e)
+assert upstream.calls == 1
+print("✅ 非幂等请求不重试测试成功")
+
+print("3. 测试截止时间传递到上游超时")
+upstream = FlakyUpstream([(2.0, 200)])
+generator = upstream.create_generator()
+start = time.perf_counter()
+try:
+    asyncio.run(generator.generate_images(model="Qwen/Qwen-Image-Edit", prompt="slow", seed=12, deadline=Deadline(0.2)))
+    assert False, "应抛出DeadlineExceededError"
+except DeadlineExceededError:
+    pass
+assert time.perf_counter() - start < 1.0
+assert upstream.calls == 1
+print("✅ 截止时间测试成功")
+
+print("4. 测试超过p95延迟时发送对冲请求并采用先返回的结果")
+upstream = FlakyUpstream([(1.0, 200)])
+generator = upstream.create_generator(hedging=True)
+for _ in range(20):
+    generator.resilience.latency.record(0.05)
+start = time.perf_counter()
+result = asyncio.run(generate(generator, seed=13))
+stats = generator.resilience.get_stats()
+assert time.perf_counter() - start < 0.5
+assert upstream.calls == 2
+assert stats["hedges"] == 1 and stats["hedge_wins"] == 1
+assert generator.backend_pool.get_stats()[0]["outstanding"] == 0
+print("✅ 对冲请求测试成功")
+
+print("5. 测试重试退避期间不占用公平调度名额")
+upstream = FlakyUpstream([(0, 503)])
+generator = upstream.create_generator()
+generator.scheduler = FairScheduler(max_concurrent=1, classes={"interactive": 1}, clients={})
+generator.resilience.base_delay = generator.resilience.max_delay = 0.3
+
+async def run_during_backoff():
+    retried = asyncio.ensure_future(generate(generator, seed=14))
+    # 首次调用失败后处于退避中，另一个请求可以使用唯一的名额
+    await asyncio.sleep(0.1)
+    result = await generate(generator, prompt="other", seed=15)
+    assert not retried.done()
+    return result, await retried
+
+uniform = random.uniform
+random.uniform = lambda low, high: high
+try:
+    other, retried = asyncio.run(run_during_backoff())
+finally:
+    random.uniform = uniform
+assert other["images"] and retried["images"] and upstream.calls == 3
+assert generator.scheduler.get_stats()["dispatched"] == 3 and generator.scheduler.get_stats()["in_flight"] == 0
+print("✅ 退避期间释放名额测试成功")
+
+print("6. 测试请求头截止时间解析")
+assert Deadline.from_header("5", default=60).timeout_seconds == 5
+assert Deadline.from_header("600", default=60).timeout_seconds == 60
+assert Deadline.from_header("abc", default=60).timeout_seconds == 60
+assert Deadline.from_header(None, default=60).timeout_seconds == 60
+print("✅ 请求头解析测试成功")
+
+# 测试model_registry.py
+print("\n=== 测试model_registry.py ===")
+
+print("1. 测试请求体按模型能力构建")
+registry = ModelRegistry.get_default()
+payload_generator = ImageGenerator(client=httpx.AsyncClient(transport=httpx.MockTransport(FakeUpstream().handler)))
+images = [InputImage.from_bytes(TEST_IMAGE_BYTES)] * 3
+payload = payload_generator.build_payload("Qwen/Qwen-Image-Edit-2509", "p", images=images, seed=1)
+assert [key for key in payload if key.startswith("image")] == ["image", "image2", "image3"]
+assert payload["cfg"] == 4.0 and "image_size" not in payload and payload["seed"] == 1
+payload = payload_generator.build_payload("Qwen/Qwen-Image-Edit", "p", images=images)
+assert [key for key in payload if key.startswith("image")] == ["image"]
+payload = payload_generator.build_payload("Kwai-Kolors/Kolors", "p", batch_size=2)
+assert list(payload)[3:] == ["image_size", "batch_size", "num_inference_steps", "guidance_scale"]
+assert payload["image_size"] == "1024x1024" and "cfg" not in payload
+# 未注册的模型按名称前缀推断
+payload = payload_generator.build_payload("Qwen/Qwen-Image", "p", image_size="1328x1328")
+assert payload["image_size"] == "1328x1328" and payload["cfg"] == 4.0
+assert "Qwen/Qwen-Image" not in registry
+print("✅ 请求体构建测试成功")
+
+print("2. 测试注册表不可变且/models响应体预先计算")
+spec = registry.validate("Qwen/Qwen-Image-Edit-2509")
+assert spec.max_images == 3 and spec.is_default and spec.size_family == "Qwen-Image"
+try:
+    spec.image_slots = ()
+    raise AssertionError("模型能力可被修改")
+except AttributeError:
+    pass
+body = json.loads(registry.models_body)
+assert body["total"] == len(registry.names)
+kolors = next(model for model in body["models"] if model["model_name"] == "Kwai-Kolors/Kolors")
+assert kolors["available_sizes"][0] == "1024x1024" and kolors["parameters"]["batch_size"]["max"] == 4
+assert registry.models_etag == ModelRegistry().models_etag
+assert ModelRegistry(models=["Kwai-Kolors/Kolors"]).models_etag != registry.models_etag
+print("✅ 注册表测试成功")
+
+print("3. 测试参数校验使用注册表")
+for params in ({"model": "unknown/model"}, {"model": "Kwai-Kolors/Kolors", "image_size": "1328x1328"},
+               {"model": "Qwen/Qwen-Image-Edit", "batch_size": 5}):
+    try:
+        ImageGenerationRequest(prompt="p", **params)
+        raise AssertionError(f"参数未被拒绝: {params}")
+    except ValidationError:
+        pass
+ImageGenerationRequest(prompt="p", model="Kwai-Kolors/Kolors", image_size="960x1280")
+# 编辑模型不限制尺寸参数（上游忽略）
+ImageGenerationRequest(prompt="p", model="Qwen/Qwen-Image-Edit", image_size="1x1")
+print("✅ 参数校验测试成功")
+
+# 测试image_preprocessor.py
+print("\n=== 测试image_preprocessor.py ===")
+
+print("1. 测试超出最长边的图片被缩放并应用EXIF方向")
+exif = Image.Exif()
+exif[0x0112] = 6  # 顺时针旋转90度
+buffered = BytesIO()
+Image.new("RGB", (3000, 2000), color="blue").save(buffered, format="JPEG", exif=exif.tobytes())
+large_image = InputImage.from_bytes(buffered.getvalue())
+preprocessor = ImagePreprocessor()
+processed = asyncio.run(preprocessor.process([large_image], "Qwen/Qwen-Image-Edit"))[0]
+max_edge = ImagePreprocessor.get_policy("Qwen/Qwen-Image-Edit")["max_edge"]
+assert max(processed.width, processed.height) == max_edge
+assert processed.height > processed.width
+assert processed.preprocess["bytes_saved"] == len(large_image.data) - len(processed.data)
+assert Image.open(BytesIO(processed.data)).getexif().get(0x0112) is None
+print("✅ 缩放与方向校正测试成功")
+
+print("2. 测试无需处理的图片原样返回")
+small_image = InputImage.from_bytes(TEST_IMAGE_BYTES)
+processed = asyncio.run(preprocessor.process([small_image], "Kwai-Kolors/Kolors"))[0]
+assert processed is small_image
+assert ImagePreprocessor.get_bytes_saved([processed]) is None
+print("✅ 直通测试成功")
+
+# 测试响应模式与blob_store.py
+print("\n=== 测试响应模式与blob_store.py ===")
+
+TEST_LOGGER = logging.getLogger("test_services")
+TEST_LOGGER.addHandler(logging.NullHandler())
+TEST_LOGGER.propagate = False
+
+print("1. 测试url模式将结果保存到本地存储并按内容去重")
+with tempfile.TemporaryDirectory() as blob_dir:
+    store = BlobStore(blob_dir, ttl_seconds=60)
+    pipeline = GenerationPipeline(FakeUpstream(output="base64").create_generator(cache=None), ImagePreprocessor(),
+                                  TEST_LOGGER, store)
+    params = {"model": "Qwen/Qwen-Image-Edit", "prompt": "test prompt"}
+    response = asyncio.run(pipeline.run([], params, response_mode=ResponseUtils.MODE_URL))
+    image = response.images[0]
+    assert image.base64 is None and image.mime_type == "image/png"
+    blob_id = image.url.rsplit("/", 1)[1]
+    with open(store.get_path(blob_id), "rb") as f:
+        assert f.read() == TEST_IMAGE_BYTES
+    asyncio.run(pipeline.run([], params, response_mode=ResponseUtils.MODE_URL))
+    assert store.get_stats()["stores"] == 1 and store.get_stats()["dedup_hits"] == 1
+    assert BlobStore.get_etag(blob_id) == f'"{blob_id.split(".")[0]}"'
+    
+    # 过期和无效ID
+    assert store.get_path("../" + blob_id) is None
+    assert BlobStore(blob_dir, ttl_seconds=-1).get_path(blob_id) is None
+    assert BlobStore(blob_dir, ttl_seconds=-1).purge_expired() == 1
+print("✅ url模式测试成功")
+
+print("2. 测试json模式保持base64响应")
+response = asyncio.run(pipeline.run([], params))
+assert response.images[0].base64 == TEST_IMAGE_BASE64 and response.images[0].url is None
+print("✅ json模式测试成功")
+
+print("3. 测试multipart/mixed响应逐段输出原始图片字节")
+outputs = [OutputImage.from_base64(TEST_IMAGE_BASE64), OutputImage.from_base64("data:image/png;base64," + TEST_IMAGE_BASE64)]
+metadata = GenerationPipeline.build_metadata({"seed": 42}, outputs)
+body = b"".join(ResponseUtils.iter_multipart(metadata, outputs, "test-boundary"))
+parts = body.split(b"--test-boundary")
+assert len(parts) == 5 and parts[-1] == b"--\r\n"
+assert b'"seed": 42' in parts[1]
+for part in parts[2:4]:
+    headers, data = part.split(b"\r\n\r\n", 1)
+    assert b"Content-Type: image/png" in headers
+    assert data[:-2] == TEST_IMAGE_BYTES
+assert metadata["images"][1]["bytes"] == len(TEST_IMAGE_BYTES)
+print("✅ multipart响应测试成功")
+
+print("4. 测试If-None-Match匹配")
+assert ResponseUtils.etag_matches('"abc"', '"abc"')
+assert ResponseUtils.etag_matches('W/"abc", "def"', '"abc"')
+assert ResponseUtils.etag_matches("*", '"abc"')
+assert not ResponseUtils.etag_matches('"def"', '"abc"')
+assert not ResponseUtils.etag_matches(None, '"abc"')
+print("✅ ETag匹配测试成功")
+
+# 测试局部编辑（generation_pipeline.py）
+print("\n=== 测试局部编辑（generation_pipeline.py） ===")
+
+class RoiUpstream(FakeUpstream):
+    """记录收到的参考图片尺寸，返回纯红色结果"""
+    
+    def __init__(self):
+        super().__init__(output="base64")
+        self.input_sizes = []
+        self.image_sizes = []
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        payload = json.loads(request.content)
+        self.input_sizes.append(ImageUtils.probe_image(base64.b64decode(payload["image"].split(",", 1)[1]))[:2])
+        self.image_sizes.append(payload.get("image_size"))
+        return await super().handler(request)
+
+print("1. 测试只把编辑区域及其周边送上游，结果合成回完整分辨率的原图")
+roi_upstream = RoiUpstream()
+roi_source = Image.new("RGB", (2000, 1200), color=(0, 0, 255))
+buffered = BytesIO()
+roi_source.save(buffered, format="JPEG", quality=95)
+roi_input = InputImage.from_bytes(buffered.getvalue(), filename="photo.jpg")
+with tempfile.TemporaryDirectory() as blob_dir:
+    store = BlobStore(blob_dir, ttl_seconds=60)
+    pipeline = GenerationPipeline(roi_upstream.create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER, store)
+    
+    async def run_roi(response_mode: str):
+        images, roi = await pipeline.prepare_roi([roi_input], (900, 500, 1100, 700))
+        assert images[0].width == 512 and images[0].height == 512 and roi.crop_box == (744, 344, 1256, 856)
+        return await pipeline.run(images, params, response_mode=response_mode, roi=roi)
+    
+    response = asyncio.run(run_roi(ResponseUtils.MODE_JSON))
+    assert roi_upstream.input_sizes == [(512, 512)]
+    assert response.images[0].mime_type == "image/jpeg"
+    composite = Image.open(BytesIO(base64.b64decode(response.images[0].base64)))
+    assert composite.size == (2000, 1200)
+    assert all(abs(a - b) <= 3 for a, b in zip(composite.getpixel((1000, 600)), (255, 0, 0)))
+    assert all(abs(a - b) <= 3 for a, b in zip(composite.getpixel((200, 200)), (0, 0, 255)))
+    
+    # url模式保存合成后的完整图片
+    response = asyncio.run(run_roi(ResponseUtils.MODE_URL))
+    blob_id = response.images[0].url.rsplit("/", 1)[1]
+    assert blob_id.endswith(".jpg") and ImageUtils.probe_image(store.read(blob_id))[:2] == (2000, 1200)
+print("✅ 局部编辑测试成功")
+
+print("2. 测试支持image_size的模型按裁剪区域的宽高比选择可用尺寸")
+roi_upstream = RoiUpstream()
+with tempfile.TemporaryDirectory() as blob_dir:
+    pipeline = GenerationPipeline(roi_upstream.create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER,
+                                  BlobStore(blob_dir, ttl_seconds=60))
+    
+    async def run_tall_roi():
+        images, roi = await pipeline.prepare_roi([roi_input], (950, 100, 1050, 1100))
+        assert GenerationPipeline.roi_params(params, roi) is params
+        kolors_params = {"model": "Kwai-Kolors/Kolors", "prompt": "test", "image_size": "1024x1024"}
+        return roi, await pipeline.run(images, kolors_params, roi=roi)
+    
+    roi, response = asyncio.run(run_tall_roi())
+    # 裁剪区域为600x1200，宽高比最接近的可用尺寸为720x1440；结果缩放回裁剪尺寸后合成
+    assert roi.crop_box == (700, 0, 1300, 1200)
+    assert roi_upstream.image_sizes == ["720x1440"]
+    assert Image.open(BytesIO(base64.b64decode(response.images[0].base64))).size == (2000, 1200)
+print("✅ 局部编辑尺寸测试成功")
+
+# 测试多候选生成（generation_pipeline.py）
+print("\n=== 测试多候选生成（generation_pipeline.py） ===")
+
+class SeededUpstream(FakeUpstream):
+    """按种子决定延迟（种子越大越快），指定的种子返回400；记录收到的种子和参考图片"""
+    
+    def __init__(self, failing_seed: int = None):
+        super().__init__(output="base64")
+        self.seeds = []
+        self.images = set()
+        self.failing_seed = failing_seed
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        payload = json.loads(request.content)
+        self.seeds.append(payload["seed"])
+        self.images.add(payload["image"])
+        await asyncio.sleep(0.2 - (payload["seed"] % 4) * 0.05)
+        if payload["seed"] == self.failing_seed:
+            return httpx.Response(400, json={"message": "invalid request"})
+        return await super().handler(request)
+
+assert GenerationPipeline.derive_seeds(7, 3) == [7, 8, 9]
+assert GenerationPipeline.derive_seeds(9999999999, 2) == [9999999999, 0]
+assert len(set(GenerationPipeline.derive_seeds(None, 4))) == 4
+
+print("1. 测试输入只编码一次，按派生种子并发生成并合并响应")
+seeded_upstream = SeededUpstream()
+pipeline = GenerationPipeline(seeded_upstream.create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER)
+start = time.perf_counter()
+response = asyncio.run(pipeline.run_variants([InputImage.from_bytes(TEST_IMAGE_BYTES)], dict(params, seed=100), 4))
+elapsed = time.perf_counter() - start
+assert sorted(seeded_upstream.seeds) == [100, 101, 102, 103] and len(seeded_upstream.images) == 1
+assert elapsed < 0.35, f"候选应并发生成: {elapsed:.2f}秒"
+assert response.success and response.seed == 100 and len(response.images) == 4
+assert [variant.seed for variant in response.variants] == [100, 101, 102, 103]
+assert [variant.image_indexes for variant in response.variants] == [[0], [1], [2], [3]]
+assert all(variant.success and variant.elapsed_seconds > 0 for variant in response.variants)
+print(f"✅ 多候选生成测试成功: 4个候选耗时{elapsed:.2f}秒")
+
+print("2. 测试按完成顺序流式返回，单个候选失败不影响其他候选")
+seeded_upstream = SeededUpstream(failing_seed=201)
+pipeline = GenerationPipeline(seeded_upstream.create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER)
+
+async def stream_variants():
+    outcomes = await pipeline.generate_variants([InputImage.from_bytes(TEST_IMAGE_BYTES)], dict(params, seed=200), 3)
+    groups = GenerationPipeline.iter_variant_groups(outcomes)
+    return b"".join([chunk async for chunk in ResponseUtils.iter_multipart_groups({"num_variants": 3}, groups, "test-boundary")])
+
+body = asyncio.run(stream_variants())
+parts = body.split(b"--test-boundary")
+variant_parts = [json.loads(part.split(b"\r\n\r\n", 1)[1]) for part in parts if b"application/json" in part][1:]
+# 种子202最快、200最慢；种子201失败时没有图片段
+assert [part["seed"] for part in variant_parts] == [202, 201, 200]
+assert [part["success"] for part in variant_parts] == [True, False, True]
+assert body.count(b"X-Variant-Index") == 2 and b"X-Variant-Index: 2" in body
+assert parts[-1] == b"--\r\n"
+print("✅ 流式返回测试成功")
+
+print("3. 测试所有候选失败时抛出异常")
+seeded_upstream = SeededUpstream(failing_seed=300)
+pipeline = GenerationPipeline(seeded_upstream.create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER)
+try:
+    asyncio.run(pipeline.run_variants([InputImage.from_bytes(TEST_IMAGE_BYTES)], dict(params, seed=300), 1))
+    assert False
+except Exception as e:
+    assert "400" in str(e)
+print("✅ 全部失败测试成功")
+
+print("4. 测试迭代器未使用就丢弃或中途关闭时不遗留上游任务")
+seeded_upstream = SeededUpstream()
+pipeline = GenerationPipeline(seeded_upstream.create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER)
+
+async def abandon_variants():
+    # 客户端在开始输出前断开：迭代器从未被迭代
+    outcomes = await pipeline.generate_variants([InputImage.from_bytes(TEST_IMAGE_BYTES)], dict(params, seed=400), 3)
+    del outcomes
+    await asyncio.sleep(0.3)
+    assert seeded_upstream.seeds == []
+    # 收到第一个候选后关闭：其余候选被取消并等待结束
+    outcomes = await pipeline.generate_variants([InputImage.from_bytes(TEST_IMAGE_BYTES)], dict(params, seed=400), 3)
+    first = await outcomes.__anext__()
+    await outcomes.aclose()
+    await asyncio.sleep(0)
+    return first, [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+first, pending = asyncio.run(abandon_variants())
+assert first.seed == 402 and first.error is None
+assert pending == [], pending
+assert sorted(seeded_upstream.seeds) == [400, 401, 402]
+print("✅ 候选任务清理测试成功")
+
+# 测试分块编辑（generation_pipeline.py）
+print("\n=== 测试分块编辑（generation_pipeline.py） ===")
+import numpy as np
+
+class EchoUpstream(FakeUpstream):
+    """原样返回收到的第一张图片，记录种子、图片尺寸和同时进行的请求数"""
+    
+    def __init__(self, latency: float = 0.05):
+        super().__init__(latency=latency, output="base64")
+        self.seeds = []
+        self.input_sizes = []
+        self.active = 0
+        self.max_active = 0
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        payload = json.loads(request.content)
+        self.seeds.append(payload["seed"])
+        self.input_sizes.append(ImageUtils.probe_image(base64.b64decode(payload["image"].split(",", 1)[1]))[:2])
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(self.latency)
+        self.active -= 1
+        return httpx.Response(200, json={"images": [payload["image"]], "timings": {"inference": self.latency}, "seed": payload["seed"]})
+
+print("1. 测试按完整分辨率分块并发编辑，以相同种子生成后融合拼接")
+echo_upstream = EchoUpstream()
+tile_source = np.zeros((2000, 3000, 3), dtype=np.uint8)
+tile_source[..., 0] = np.arange(3000)[None, :] * 255 // 2999
+tile_source[..., 1] = np.arange(2000)[:, None] * 255 // 1999
+buffered = BytesIO()
+Image.fromarray(tile_source).save(buffered, format="JPEG", quality=95)
+tile_input = InputImage.from_bytes(buffered.getvalue(), filename="large.jpg")
+pipeline = GenerationPipeline(echo_upstream.create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER)
+progress_updates = []
+
+async def record_progress(stage: str, percent: int) -> None:
+    progress_updates.append((stage, percent))
+
+grid = GenerationPipeline.plan_tiles(3000, 2000, params["model"])
+assert (grid.tile_width, grid.tile_height, grid.count) == (1328, 1328, 6)
+response = asyncio.run(pipeline.run_tiled([tile_input], dict(params, seed=500), progress=record_progress))
+assert echo_upstream.seeds == [500] * 6 and echo_upstream.input_sizes == [(1328, 1328)] * 6
+assert 1 < echo_upstream.max_active <= Config.TILE_CONCURRENCY
+assert response.seed == 500 and response.timing["tiles"] == 6 and len(response.images) == 1
+tiled_output = Image.open(BytesIO(base64.b64decode(response.images[0].base64)))
+assert tiled_output.size == (3000, 2000) and tiled_output.format == "JPEG"
+assert np.abs(np.asarray(tiled_output, dtype=np.int16) - tile_source).mean() < 2
+percents = [percent for stage, percent in progress_updates if stage == "generating"]
+assert percents == sorted(percents) and percents[-1] == 90 and len(percents) == 7
+print(f"✅ 分块编辑测试成功: 6个分块，最多{echo_upstream.max_active}个同时进行")
+
+print("2. 测试分块数超出上限时拒绝，分块失败时抛出异常")
+try:
+    GenerationPipeline.plan_tiles(20000, 20000, params["model"])
+    assert False
+except ValueError:
+    pass
+# 分块数未超出上限，但解码后的整张图片超出像素数上限
+try:
+    GenerationPipeline.plan_tiles(9000, 5000, params["model"])
+    assert False
+except ValueError as e:
+    assert "像素数" in str(e)
+failing_pipeline = GenerationPipeline(SeededUpstream(failing_seed=600).create_generator(cache=None), ImagePreprocessor(),
+                                      TEST_LOGGER)
+with tempfile.TemporaryDirectory() as work_dir:
+    Config.TILE_WORK_DIR = work_dir
+    try:
+        asyncio.run(failing_pipeline.run_tiled([tile_input], dict(params, seed=600)))
+        assert False
+    except Exception as e:
+        assert "400" in str(e)
+    finally:
+        Config.TILE_WORK_DIR = None
+    # 被取消的分块结束后才删除中间文件
+    assert os.listdir(work_dir) == []
+print("✅ 分块失败测试成功")
+
+print("3. 测试url模式从文件保存拼接结果，内存映射的原图直接使用其文件")
+with tempfile.TemporaryDirectory() as blob_dir:
+    store = BlobStore(blob_dir, ttl_seconds=60)
+    pipeline = GenerationPipeline(EchoUpstream().create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER, store)
+    mapped_input = asyncio.run(UploadReader(spool_threshold=1024).read(
+        UploadFile(BytesIO(tile_input.data), filename="large.jpg", size=len(tile_input.data))
+    ))
+    assert mapped_input.path is not None
+    result, outputs = asyncio.run(pipeline.generate_tiled([mapped_input], dict(params, seed=700), store=True))
+    assert outputs[0].data is None and outputs[0].size == os.path.getsize(store.get_path(outputs[0].blob_id))
+    assert ImageUtils.probe_image(store.read(outputs[0].blob_id))[:3] == (3000, 2000, "JPEG")
+print("✅ 分块结果保存测试成功")
+
+# 测试result_materializer.py
+print("\n=== 测试result_materializer.py ===")
+
+class UrlResultUpstream(FakeUpstream):
+    """返回URL形式结果，图片下载接口注入延迟，记录下载并发峰值"""
+    
+    def __init__(self, batch: int, download_latency: float, missing: bool = False):
+        super().__init__()
+        self.batch = batch
+        self.download_latency = download_latency
+        self.missing = missing
+        self.downloads = 0
+        self.active = 0
+        self.max_active = 0
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "POST":
+            self.calls += 1
+            images = [{"url": f"https://cdn.example.com/{self.calls}/{i}.png"} for i in range(self.batch)]
+            return httpx.Response(200, json={"images": images, "seed": 42})
+        
+        self.downloads += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.download_latency)
+        finally:
+            self.active -= 1
+        if self.missing:
+            return httpx.Response(404)
+        return httpx.Response(200, content=TEST_IMAGE_BYTES, headers={"Content-Type": "image/png"})
+    
+    def create_pipeline(self, blob_store: BlobStore = None) -> GenerationPipeline:
+        generator = self.create_generator(cache=None)
+        generator.rate_governor = None
+        return GenerationPipeline(generator, ImagePreprocessor(), TEST_LOGGER, blob_store)
+
+KOLORS_PARAMS = {"model": "Kwai-Kolors/Kolors", "prompt": "test prompt", "batch_size": 4}
+
+print("1. 测试URL结果并发下载，总耗时接近单张下载时间")
+with tempfile.TemporaryDirectory() as blob_dir:
+    upstream = UrlResultUpstream(batch=4, download_latency=0.2)
+    pipeline = upstream.create_pipeline(BlobStore(blob_dir, ttl_seconds=60))
+    start = time.perf_counter()
+    response = asyncio.run(pipeline.run([], KOLORS_PARAMS))
+    elapsed = time.perf_counter() - start
+    assert upstream.downloads == 4 and upstream.max_active == 4
+    assert elapsed < 0.6, elapsed
+    assert all(image.base64 == TEST_IMAGE_BASE64 for image in response.images)
+    assert pipeline.blob_store.get_stats()["stores"] == 1 and pipeline.blob_store.get_stats()["dedup_hits"] == 3
+    print(f"✅ 并发下载测试成功: {elapsed:.2f}秒")
+    
+    print("2. 测试url模式只保存到本地存储，不读入内存")
+    result, outputs = asyncio.run(pipeline.generate([], KOLORS_PARAMS, store=True))
+    assert all(image.data is None and image.blob_id for image in outputs)
+    assert outputs[0].width == 100 and outputs[0].size == len(TEST_IMAGE_BYTES)
+    assert outputs[0].get_image_info(0)["source_url"].startswith("https://cdn.example.com/")
+    assert GenerationPipeline.build_response(result, outputs, ResponseUtils.MODE_URL).images[0].url == f"/images/{outputs[0].blob_id}"
+    print("✅ url模式测试成功")
+    
+    print("3. 测试下载失败时报错且不残留临时文件")
+    pipeline = UrlResultUpstream(batch=2, download_latency=0, missing=True).create_pipeline(BlobStore(blob_dir, ttl_seconds=60))
+    try:
+        asyncio.run(pipeline.run([], KOLORS_PARAMS))
+        assert False, "应抛出异常"
+    except Exception as e:
+        assert "结果图片下载失败" in str(e)
+    assert os.listdir(os.path.join(blob_dir, "tmp")) == []
+    print("✅ 下载失败测试成功")
+
+print("4. 测试未配置本地存储时在内存中获取URL结果")
+pipeline = UrlResultUpstream(batch=2, download_latency=0).create_pipeline()
+response = asyncio.run(pipeline.run([], KOLORS_PARAMS))
+assert [image.base64 for image in response.images] == [TEST_IMAGE_BASE64] * 2
+print("✅ 内存获取测试成功")
+
+# 测试batch_manager.py
+print("\n=== 测试batch_manager.py ===")
+
+class BatchUpstream(FakeUpstream):
+    """提示词包含fail的请求返回500，记录并发峰值"""
+    
+    def __init__(self, latency: float = 0.02):
+        super().__init__(latency=latency, output="base64")
+        self.active = 0
+        self.max_active = 0
+        self.fail = True
+    
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            if self.fail and b"fail" in request.content:
+                self.calls += 1
+                return httpx.Response(400, json={"message": "invalid request"})
+            return await super().handler(request)
+        finally:
+            self.active -= 1
+    
+    def create_manager(self, concurrency: int = 2) -> BatchManager:
+        generator = self.create_generator(cache=None)
+        generator.rate_governor = None
+        pipeline = GenerationPipeline(generator, ImagePreprocessor(), TEST_LOGGER)
+        return BatchManager(BatchStore(":memory:"), pipeline, concurrency=concurrency)
+
+async def collect(lines, limit: int = None):
+    result = []
+    async for line in lines:
+        result.append(line)
+        if limit is not None and len(result) >= limit:
+            break
+    await lines.aclose()
+    return result
+
+print("1. 测试压缩包中的每张图片使用同一提示词，按有限并发执行")
+buffered = BytesIO()
+with zipfile.ZipFile(buffered, "w") as archive:
+    for i in range(5):
+        # 图片各不相同，避免相同请求被single-flight合并
+        archive.writestr(f"photos/{i}.png", InputImage.from_pil(Image.new("RGB", (64, 64), color=(i, 0, 0))).data)
+    archive.writestr("photos/readme.txt", "ignored")
+images, manifest = BatchManager.read_archive(buffered, "photos.zip", UploadReader())
+assert sorted(images) == [f"photos/{i}.png" for i in range(5)] and manifest is None
+upstream = BatchUpstream()
+manager = upstream.create_manager(concurrency=2)
+items = BatchManager.parse_manifest(None, list(images), {"model": "Qwen/Qwen-Image-Edit", "prompt": "white background"})
+
+async def create_and_run():
+    batch_id = await manager.create(items, images, ResponseUtils.MODE_JSON)
+    return batch_id, await collect(manager.run(batch_id))
+
+batch_id, lines = asyncio.run(create_and_run())
+assert lines[0] == {"type": "batch", "batch_id": batch_id, "total": 5, "pending": 5}
+assert sorted(line["index"] for line in lines[1:-1]) == list(range(5))
+assert all(line["result"]["images"][0]["base64"] == TEST_IMAGE_BASE64 for line in lines[1:-1])
+assert lines[-1]["type"] == "summary" and lines[-1]["succeeded"] == 5
+assert upstream.max_active == 2
+print("✅ 压缩包批量测试成功")
+
+print("2. 测试清单中多个提示词作用于同一张图片，失败条目可继续执行")
+manifest = json.dumps({
+    "defaults": {"model": "Qwen/Qwen-Image-Edit"},
+    "items": [{"images": "a.png", "prompts": ["remove watermark", "fail once", "add shadow"]}]
+})
+upstream = BatchUpstream()
+manager = upstream.create_manager()
+items = BatchManager.parse_manifest(manifest, ["a.png"], {"model": "Kwai-Kolors/Kolors", "prompt": None})
+assert [item["params"]["prompt"] for item in items] == ["remove watermark", "fail once", "add shadow"]
+assert items[0]["params"]["model"] == "Qwen/Qwen-Image-Edit"
+
+async def run_with_failure():
+    batch_id = await manager.create(items, {"a.png": TEST_IMAGE_BYTES}, ResponseUtils.MODE_JSON)
+    first = await collect(manager.run(batch_id))
+    upstream.fail = False
+    second = await collect(manager.run(batch_id, replay=True))
+    return first, second, await manager.get(batch_id)
+
+first, second, batch = asyncio.run(run_with_failure())
+assert first[-1]["succeeded"] == 2 and first[-1]["failed"] == 1
+assert [line["status"] for line in first[1:-1] if line["index"] == 1] == ["failed"]
+assert second[0]["pending"] == 1
+assert len([line for line in second if line["type"] == "item"]) == 3  # 2条回放 + 1条重新执行
+assert batch["counts"]["succeeded"] == 3 and not batch["running"]
+print("✅ 多提示词与继续执行测试成功")
+
+print("3. 测试连接中断后未完成的条目保留为待执行")
+upstream = BatchUpstream(latency=0.05)
+manager = upstream.create_manager(concurrency=1)
+items = BatchManager.parse_manifest(None, ["a.png", "b.png", "c.png"], {"model": "Qwen/Qwen-Image-Edit", "prompt": "p"})
+
+async def interrupt_and_resume():
+    batch_id = await manager.create(items, {"a.png": TEST_IMAGE_BYTES, "b.png": TEST_IMAGE_BYTES, "c.png": TEST_IMAGE_BYTES},
+                                    ResponseUtils.MODE_JSON)
+    await collect(manager.run(batch_id), limit=2)  # 批量信息 + 第一个条目
+    interrupted = await manager.get(batch_id)
+    lines = await collect(manager.run(batch_id))
+    return interrupted, lines
+
+interrupted, lines = asyncio.run(interrupt_and_resume())
+assert interrupted["counts"]["succeeded"] == 1 and interrupted["counts"]["pending"] == 2
+assert not interrupted["running"]
+assert lines[0]["pending"] == 2 and lines[-1]["succeeded"] == 3
+print("✅ 中断恢复测试成功")
+
+print("4. 测试正在执行的批量任务不能重复执行")
+upstream = BatchUpstream(latency=0.05)
+manager = upstream.create_manager(concurrency=1)
+
+async def run_twice():
+    batch_id = await manager.create(items, {"a.png": TEST_IMAGE_BYTES, "b.png": TEST_IMAGE_BYTES, "c.png": TEST_IMAGE_BYTES},
+                                    ResponseUtils.MODE_JSON)
+    first = manager.run(batch_id)
+    await first.__anext__()
+    try:
+        await collect(manager.run(batch_id))
+        assert False
+    except BatchRunningError:
+        pass
+    lines = await collect(first)
+    return lines
+
+lines = asyncio.run(run_twice())
+assert lines[-1]["succeeded"] == 3
+print("✅ 重复执行测试成功")
+
+print("5. 测试无效清单")
+for bad_manifest, names in [("not json", ["a.png"]), ('[{"images": ["missing.png"], "prompt": "p"}]', ["a.png"]),
+                            ('[{"images": ["a.png"]}]', ["a.png"]), ("[]", ["a.png"])]:
+    try:
+        BatchManager.parse_manifest(bad_manifest, names, {"model": "Qwen/Qwen-Image-Edit", "prompt": None})
+        assert False, bad_manifest
+    except ValueError:
+        pass
+print("✅ 无效清单测试成功")
+
+print("6. 测试压缩包按声明的大小、成员数和解压总量拒绝（不读取成员内容），成员需为有效图片")
+import tarfile
+
+def build_tar(members: dict, mode: str = "w:gz") -> BytesIO:
+    buffered = BytesIO()
+    with tarfile.open(fileobj=buffered, mode=mode) as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, BytesIO(data))
+    return buffered
+
+def archive_rejected(buffered: BytesIO, **limits) -> Exception:
+    try:
+        BatchManager.read_archive(buffered, "bomb.tar.gz", limits.pop("reader", UploadReader()), **limits)
+    except ValueError as e:
+        return e
+    assert False, "应拒绝压缩包"
+
+# 高压缩比的成员：压缩后很小，声明大小超过单个文件上限
+bomb = build_tar({"bomb.png": b"\x00" * (2 * 1024 * 1024)})
+assert len(bomb.getvalue()) < 64 * 1024
+error = archive_rejected(bomb, reader=UploadReader(max_file_bytes=1024 * 1024))
+assert isinstance(error, UploadRejectedError) and error.status_code == 413
+# 除清单外最多max_members个成员
+error = archive_rejected(build_tar({f"{i}.png": TEST_IMAGE_BYTES for i in range(4)}), max_members=2)
+assert isinstance(error, UploadRejectedError) and "成员数" in str(error)
+error = archive_rejected(build_tar({f"{i}.png": TEST_IMAGE_BYTES for i in range(3)}), max_bytes=len(TEST_IMAGE_BYTES) * 2)
+assert isinstance(error, UploadRejectedError) and "解压" in str(error)
+error = archive_rejected(build_tar({"fake.png": b"not an image"}))
+assert isinstance(error, UploadRejectedError) and "格式" in str(error)
+assert isinstance(archive_rejected(BytesIO(b"neither zip nor tar")), ValueError)
+images, manifest = BatchManager.read_archive(build_tar({"a.png": TEST_IMAGE_BYTES, "manifest.json": b"[]"}, "w:xz"),
+                                             "photos.tar.xz", UploadReader())
+assert images == {"a.png": TEST_IMAGE_BYTES} and manifest == "[]"
+print("✅ 压缩包上限测试成功")
+
+print("7. 测试图片名称重复时拒绝而不是覆盖")
+images = {}
+BatchManager.add_images(images, [("a.png", TEST_IMAGE_BYTES)])
+try:
+    BatchManager.add_images(images, [("b.png", TEST_IMAGE_BYTES), ("a.png", b"other")])
+    assert False, "应拒绝重名图片"
+except ValueError as e:
+    assert "a.png" in str(e)
+assert images["a.png"] == TEST_IMAGE_BYTES
+# tar允许同名成员，后一个会覆盖前一个
+buffered = BytesIO()
+with tarfile.open(fileobj=buffered, mode="w") as archive:
+    for name in ("a.png", "a.png"):
+        info = tarfile.TarInfo(name)
+        info.size = len(TEST_IMAGE_BYTES)
+        archive.addfile(info, BytesIO(TEST_IMAGE_BYTES))
+error = archive_rejected(buffered)
+assert not isinstance(error, UploadRejectedError) and "a.png" in str(error)
+error = archive_rejected(build_tar({"a/manifest.json": b"[]", "b/manifest.json": b"[]"}))
+assert "清单" in str(error)
+print("✅ 重名图片测试成功")
+
+# 测试upload_reader.py与reference_store.py
+print("\n=== 测试upload_reader.py与reference_store.py ===")
+
+def make_upload(data: bytes, filename: str = "input.png", size: bool = True) -> UploadFile:
+    return UploadFile(BytesIO(data), filename=filename, size=len(data) if size else None)
+
+def read_rejected(reader: UploadReader, files: list) -> UploadRejectedError:
+    try:
+        asyncio.run(reader.read_all(files))
+    except UploadRejectedError as e:
+        return e
+    raise AssertionError("上传未被拒绝")
+
+print("1. 测试按文件头魔数识别格式（不信任Content-Type）")
+reader = UploadReader()
+image = asyncio.run(reader.read(make_upload(TEST_IMAGE_BYTES, "renamed.jpg")))
+assert image.format == "PNG" and image.data == TEST_IMAGE_BYTES
+assert UploadReader.sniff_format(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "WEBP"
+assert read_rejected(reader, [make_upload(b"not an image" * 100, "fake.png")]).status_code == 400
+print("✅ 格式识别测试成功")
+
+print("2. 测试单文件和单请求大小上限")
+reader = UploadReader(max_file_bytes=len(TEST_IMAGE_BYTES) - 1)
+assert read_rejected(reader, [make_upload(TEST_IMAGE_BYTES)]).status_code == 413
+# 表单未提供大小时在读取过程中检查
+assert read_rejected(reader, [make_upload(TEST_IMAGE_BYTES, size=False)]).status_code == 413
+reader = UploadReader(max_request_bytes=len(TEST_IMAGE_BYTES) * 2 - 1)
+assert read_rejected(reader, [make_upload(TEST_IMAGE_BYTES), make_upload(TEST_IMAGE_BYTES)]).status_code == 413
+assert reader.get_stats()["accepted"] == 1 and reader.get_stats()["rejected"] == 1
+print("✅ 大小上限测试成功")
+
+print("3. 测试解压炸弹在完整读取前被拒绝")
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+bomb = (b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", struct.pack(">IIBBBBB", 100000, 100000, 8, 0, 0, 0, 0))
+        + png_chunk(b"IDAT", zlib.compress(b"\x00" * 1024)) + png_chunk(b"IEND", b""))
+assert read_rejected(UploadReader(), [make_upload(bomb)]).status_code == 400
+assert read_rejected(UploadReader(max_pixels=100), [make_upload(TEST_IMAGE_BYTES)]).status_code == 400
+print("✅ 解压炸弹测试成功")
+
+print("4. 测试大文件写入临时文件并内存映射")
+large_bytes = BytesIO()
+Image.effect_noise((512, 512), 64).convert("RGB").save(large_bytes, format="PNG")
+large_bytes = large_bytes.getvalue()
+reader = UploadReader(spool_threshold=64 * 1024, chunk_size=16 * 1024)
+image = asyncio.run(reader.read(make_upload(large_bytes)))
+assert isinstance(image.data, mmap.mmap) and image.data[:] == large_bytes
+assert (image.width, image.height) == (512, 512)
+# 表单解析时已落盘的文件直接映射
+spooled = tempfile.SpooledTemporaryFile(max_size=1024)
+spooled.write(large_bytes)
+spooled.seek(0)
+image = asyncio.run(reader.read(UploadFile(spooled, filename="spooled.png", size=len(large_bytes))))
+assert isinstance(image.data, mmap.mmap) and image.data[:] == large_bytes
+assert image.digest == InputImage.from_bytes(large_bytes).digest
+assert reader.get_stats()["spooled"] == 1 and reader.get_stats()["mapped"] == 1
+
+# 传入进程池时只传临时文件路径，由子进程重新映射
+assert image.path is not None and os.path.exists(image.path)
+assert len(pickle.dumps(image)) < 4096
+copied = pickle.loads(pickle.dumps(image))
+assert isinstance(copied.data, mmap.mmap) and copied.data[:] == large_bytes
+
+class PicklingExecutor:
+    """模拟进程池：参数和返回值都经过序列化"""
+    async def run(self, func, *args, kind="thread", **kwargs):
+        result = func(*pickle.loads(pickle.dumps(args)), **kwargs)
+        return pickle.loads(pickle.dumps(result))
+
+# 预处理未改变图片时返回原对象，而不是进程池返回的副本
+ImageUtils.executor = PicklingExecutor()
+try:
+    assert asyncio.run(ImagePreprocessor().process([image], "Qwen/Qwen-Image-Edit"))[0] is image
+finally:
+    ImageUtils.executor = None
+
+# 映射释放后删除临时文件
+spool_path = image.path
+del image, copied
+gc.collect()
+assert not os.path.exists(spool_path)
+print("✅ 内存映射测试成功")
+
+print("5. 测试存储容量上限按最近使用淘汰")
+with tempfile.TemporaryDirectory() as blob_dir:
+    store = BlobStore(blob_dir, ttl_seconds=60, max_bytes=len(TEST_IMAGE_BYTES) * 2 + 10)
+    first = store.put(TEST_IMAGE_BYTES, "png")
+    second = store.put(TEST_IMAGE_BYTES + b"\x00", "png")
+    os.utime(store.get_path(second), (time.time() - 10, time.time() - 10))
+    assert store.touch(first)
+    store.put(TEST_IMAGE_BYTES + b"\x00\x00", "png")
+    assert store.get_path(first) is not None and store.get_path(second) is None
+    assert store.get_stats()["evictions"] == 1
+    assert store.get_stats()["total_bytes"] <= store.max_bytes
+print("✅ 容量淘汰测试成功")
+
+print("6. 测试参考图片句柄重复使用时跳过预处理和编码")
+with tempfile.TemporaryDirectory() as blob_dir:
+    preprocessor = ImagePreprocessor()
+    references = ReferenceStore(preprocessor, BlobStore(blob_dir, ttl_seconds=60))
+    model = "Qwen/Qwen-Image-Edit-2509"
+    handle = asyncio.run(references.put(InputImage.from_bytes(large_image.data), model))
+    resolved = asyncio.run(references.resolve([handle, handle], model))
+    assert resolved[0] is resolved[1] and resolved[0].prepared_for == "Qwen-Image"
+    assert resolved[0]._data_url is not None
+    assert max(resolved[0].width, resolved[0].height) == ImagePreprocessor.get_policy(model)["max_edge"]
+    assert asyncio.run(preprocessor.process(resolved, model))[0] is resolved[0]
+    assert references.get_stats()["memory_hits"] == 2 and references.get_stats()["disk_loads"] == 0
+    
+    # 其他尺寸分组从磁盘读取原图重新预处理
+    kolors = asyncio.run(references.resolve([handle], "Kwai-Kolors/Kolors"))[0]
+    assert kolors.prepared_for == "Kolor" and references.get_stats()["disk_loads"] == 1
+    
+    # 原图过期后句柄失效
+    references.blob_store.ttl_seconds = -1
+    try:
+        asyncio.run(references.resolve([handle], model))
+        raise AssertionError("过期句柄未被拒绝")
+    except ReferenceNotFoundError:
+        pass
+    assert references.get_stats()["memory_entries"] == 0
+print("✅ 参考图片存储测试成功")
+
+print("7. 测试请求体大小按接口使用各自的上限")
+async def limited_status(limiter: RequestSizeLimiter, path: str, size: int) -> int:
+    messages = []
+    
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    
+    async def send(message):
+        messages.append(message)
+    
+    scope = {"type": "http", "method": "POST", "path": path, "headers": [(b"content-length", str(size).encode())]}
+    await limiter(scope, receive, send)
+    return messages[0]["status"]
+
+async def accept(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+limiter = RequestSizeLimiter(accept, max_bytes=1000, paths=("/uploads",), overhead_bytes=0, path_limits={"/batch": 5000})
+assert asyncio.run(limited_status(limiter, "/uploads", 2000)) == 413
+assert asyncio.run(limited_status(limiter, "/batch", 2000)) == 200
+assert asyncio.run(limited_status(limiter, "/batch", 6000)) == 413
+assert asyncio.run(limited_status(limiter, "/images", 6000)) == 200
+assert "/batch" in RequestSizeLimiter(accept).limits
+print("✅ 请求体大小限制测试成功")
+
+# 测试variant_renderer.py
+print("\n=== 测试variant_renderer.py ===")
+
+print("1. 测试按Accept协商格式与参数校验")
+assert ResponseUtils.accepts("image/avif,image/webp;q=0.9,*/*;q=0.8", "image/webp")
+assert not ResponseUtils.accepts("image/webp;q=0, */*", "image/webp")
+assert not ResponseUtils.accepts("*/*", "image/webp")
+with tempfile.TemporaryDirectory() as variant_dir:
+    renderer = VariantRenderer(BlobStore(variant_dir, ttl_seconds=60, max_bytes=10 * 1024 * 1024))
+    source_id = "0" * 64 + ".png"
+    webp = VariantRenderer.resolve(source_id, 128, "auto", None, "image/webp,*/*")
+    assert webp.format == "webp" and webp.quality == Config.VARIANT_QUALITY_LEVELS[Config.VARIANT_DEFAULT_QUALITY]
+    assert VariantRenderer.resolve(source_id, 128, "auto", None, "*/*").format == "png"
+    assert VariantRenderer.resolve(source_id, 128, "png", "low").quality is None
+    assert webp.etag != VariantRenderer.resolve(source_id, 128, "auto", "high", "image/webp").etag
+    for params in ({"size": 100}, {"format": "gif"}, {"quality": "best"}):
+        try:
+            VariantRenderer.resolve(source_id, **params)
+            raise AssertionError(f"参数未被拒绝: {params}")
+        except ValueError:
+            pass
+print("✅ 格式协商测试成功")
+
+print("2. 测试并发请求只生成一次，之后从缓存返回")
+with tempfile.TemporaryDirectory() as variant_dir:
+    renderer = VariantRenderer(BlobStore(variant_dir, ttl_seconds=60, max_bytes=10 * 1024 * 1024))
+    
+    async def render_concurrently():
+        return await asyncio.gather(*[renderer.render(webp, TEST_IMAGE_PATH) for _ in range(3)])
+    
+    results = asyncio.run(render_concurrently())
+    assert all(result == results[0] for result in results) and isinstance(results[0], bytes)
+    assert ImageUtils.probe_image(results[0])[2] == "WEBP"
+    cached = asyncio.run(renderer.render(webp, TEST_IMAGE_PATH))
+    with open(cached, "rb") as f:
+        assert f.read() == results[0]
+    assert renderer.get_stats()["renders"] == 1 and renderer.get_stats()["hits"] == 1
+print("✅ 衍生版本缓存测试成功")
+
+# 测试metrics_utils.py
+print("\n=== 测试metrics_utils.py ===")
+
+print("1. 测试一次生成记录各阶段耗时、上游状态码和载荷大小")
+stages = [MetricsUtils.STAGE_PREPROCESS, MetricsUtils.STAGE_ENCODE, MetricsUtils.STAGE_UPSTREAM,
+          MetricsUtils.STAGE_MATERIALIZE, MetricsUtils.STAGE_DECODE, MetricsUtils.STAGE_LOGGING, MetricsUtils.STAGE_TOTAL]
+before = {stage: MetricsUtils.stage_seconds.get_count(stage=stage) for stage in stages}
+ok_before = MetricsUtils.upstream_responses.get(model="Qwen/Qwen-Image-Edit", status="200")
+request_bytes_before = MetricsUtils.payload_bytes.get_count(kind="upstream_request")
+generator = FakeUpstream(latency=0.05, output="base64").create_generator(cache=None)
+generator.rate_governor = None
+pipeline = GenerationPipeline(generator, ImagePreprocessor(), TEST_LOGGER)
+asyncio.run(pipeline.run([InputImage.from_bytes(TEST_IMAGE_BYTES)], {"model": "Qwen/Qwen-Image-Edit", "prompt": "metrics prompt"}))
+for stage in stages:
+    assert MetricsUtils.stage_seconds.get_count(stage=stage) == before[stage] + 1, stage
+assert MetricsUtils.upstream_responses.get(model="Qwen/Qwen-Image-Edit", status="200") == ok_before + 1
+assert MetricsUtils.payload_bytes.get_count(kind="upstream_request") == request_bytes_before + 1
+assert MetricsUtils.stage_seconds.get_sum(stage=MetricsUtils.STAGE_UPSTREAM) >= 0.05
+assert MetricsUtils.in_flight.get(kind="upstream") == 0 and MetricsUtils.in_flight.get(kind="pipeline") == 0
+print("✅ 阶段耗时测试成功")
+
+print("2. 测试上游5xx和传输错误按状态计数")
+def failing_handler(request: httpx.Request) -> httpx.Response:
+    if json.loads(request.content)["prompt"] == "broken":
+        raise httpx.ConnectError("connection refused")
+    return httpx.Response(503, json={"message": "unavailable"})
+generator = ImageGenerator(client=httpx.AsyncClient(transport=httpx.MockTransport(failing_handler)), cache=None)
+generator.rate_governor = None
+errors_before = MetricsUtils.upstream_responses.get(model="Kwai-Kolors/Kolors", status="error")
+unavailable_before = MetricsUtils.upstream_responses.get(model="Kwai-Kolors/Kolors", status="503")
+for prompt in ("broken", "unavailable"):
+    try:
+        asyncio.run(generate(generator, model="Kwai-Kolors/Kolors", prompt=prompt))
+    except Exception:
+        pass
+assert MetricsUtils.upstream_responses.get(model="Kwai-Kolors/Kolors", status="error") == errors_before + 1
+assert MetricsUtils.upstream_responses.get(model="Kwai-Kolors/Kolors", status="503") == unavailable_before + 1
+print("✅ 状态码计数测试成功")
+
+print("3. 测试Prometheus文本格式输出")
+text = MetricsUtils.render()
+assert "# TYPE image_api_stage_seconds histogram" in text
+assert 'image_api_stage_seconds_bucket{stage="upstream",le="+Inf"}' in text
+assert 'image_api_upstream_responses_total{model="Kwai-Kolors/Kolors",status="503"}' in text
+assert 'image_api_in_flight{kind="pipeline"} 0' in text
+print("✅ 文本格式测试成功")
+
+# 测试request_profiler.py
+print("\n=== 测试request_profiler.py ===")
+
+rendered = []
+
+async def profiled_app(scope, receive, send):
+    """在事件循环线程中执行约0.1秒的ImageUtils图片处理，并保留结果"""
+    deadline = time.perf_counter() + 0.1
+    while time.perf_counter() < deadline:
+        rendered.append(ImageUtils.render_variant(TEST_IMAGE_BYTES, 128, "PNG"))
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+async def call_app(app, path: str = "/generate-images", headers: list = ()):
+    messages = []
+    
+    async def receive():
+        return {"type": "http.request", "body": b""}
+    
+    async def send(message):
+        messages.append(message)
+    
+    await app({"type": "http", "method": "POST", "path": path, "headers": list(headers)}, receive, send)
+    return dict(messages[0]["headers"])
+
+print("1. 测试未配置令牌时不剖析")
+profiler = RequestProfiler(token=None)
+headers = asyncio.run(call_app(ProfilingMiddleware(profiled_app, profiler), headers=[(b"x-debug-profile", b"cpu")]))
+assert b"x-profile-id" not in headers and profiler.list_profiles() == []
+try:
+    profiler.check_token("anything")
+    assert False, "应抛出ProfilingDisabledError"
+except ProfilingDisabledError:
+    pass
+print("✅ 关闭状态测试成功")
+
+print("2. 测试预约剖析记录调用栈和ImageUtils的内存分配位置")
+profiler = RequestProfiler(token="secret", interval=0.002)
+app = ProfilingMiddleware(profiled_app, profiler)
+profiler.arm(1, memory=True)
+headers = asyncio.run(call_app(app))
+profile = profiler.get(headers[b"x-profile-id"].decode())
+assert profile.status_code == 200 and profile.samples > 0 and profile.memory_peak_bytes > 0
+assert "ImageUtils.render_variant (utils/image_utils.py)" in profile.collapsed()
+assert profile.memory_sites[0]["site"].startswith("utils/image_utils.py:") and profile.memory_sites[0]["bytes"] > 0
+assert profiler.armed == 0 and not tracemalloc.is_tracing() and profiler.get_stats()["active"] == 0
+# 预约用完后不再剖析，其他路径不剖析
+assert b"x-profile-id" not in asyncio.run(call_app(app))
+profiler.arm(1)
+assert b"x-profile-id" not in asyncio.run(call_app(app, path="/health"))
+print("✅ 预约剖析测试成功")
+
+print("3. 测试请求头触发剖析需要正确的管理令牌")
+profiler = RequestProfiler(token="secret", interval=0.002)
+app = ProfilingMiddleware(profiled_app, profiler)
+assert b"x-profile-id" not in asyncio.run(call_app(app, headers=[(b"x-debug-profile", b"cpu"), (b"x-debug-token", b"wrong")]))
+headers = asyncio.run(call_app(app, headers=[(b"x-debug-profile", b"cpu"), (b"x-debug-token", b"secret")]))
+profile = profiler.get(headers[b"x-profile-id"].decode())
+assert profile.memory_sites is None and profile.to_dict(top=3)["top_stacks"]
+assert len(profiler.list_profiles()) == 1
+rendered.clear()
+print("✅ 请求头剖析测试成功")
+
+# 测试job_manager.py
+print("\n=== 测试job_manager.py ===")
+
+JOB_PARAMS = {"model": "Qwen/Qwen-Image-Edit", "prompt": "test prompt", "seed": None}
+
+def create_job_manager(upstream: FakeUpstream, store, workers: int = 2) -> JobManager:
+    pipeline = GenerationPipeline(upstream.create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER)
+    return JobManager(store, pipeline, workers=workers, max_queue=10)
+
+async def wait_for_job(manager: JobManager, job_id: str, timeout: float = 5.0) -> dict:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = await manager.get(job_id)
+        if job["status"] in (JobManager.SUCCEEDED, JobManager.FAILED):
+            return job
+        await asyncio.sleep(0.02)
+    raise TimeoutError(job_id)
+
+print("1. 测试任务提交、执行与结果获取")
+async def run_job():
+    upstream = FakeUpstream(latency=0.05, output="base64")
+    manager = create_job_manager(upstream, MemoryJobStore())
+    await manager.start()
+    job_id = await manager.submit([InputImage.from_bytes(TEST_IMAGE_BYTES)], JOB_PARAMS)
+    assert (await manager.get(job_id))["status"] in (JobManager.QUEUED, JobManager.RUNNING)
+    job = await wait_for_job(manager, job_id)
+    await manager.stop()
+    return job
+
+job = asyncio.run(run_job())
+assert job["status"] == JobManager.SUCCEEDED
+assert job["progress"] == 100
+assert job["result"]["images"][0]["base64"] == TEST_IMAGE_BASE64
+print("✅ 任务执行测试成功")
+
+print("2. 测试SQLite存储的排队任务在重启后恢复执行")
+with tempfile.TemporaryDirectory() as data_dir:
+    db_path = os.path.join(data_dir, "jobs.db")
+    
+    async def submit_without_workers():
+        manager = create_job_manager(FakeUpstream(output="base64"), SQLiteJobStore(db_path), workers=0)
+        await manager.start()
+        # 提示词各不相同，避免并发执行时被single-flight合并
+        job_ids = [
+            await manager.submit([InputImage.from_bytes(TEST_IMAGE_BYTES)], dict(JOB_PARAMS, prompt=f"test prompt {i}"))
+            for i in range(3)
+        ]
+        await manager.stop()
+        return job_ids
+    
+    async def restart_and_wait(job_ids):
+        upstream = FakeUpstream(output="base64")
+        manager = create_job_manager(upstream, SQLiteJobStore(db_path))
+        await manager.start()
+        jobs = [await wait_for_job(manager, job_id) for job_id in job_ids]
+        stats = manager.get_stats()
+        await manager.stop()
+        return upstream, jobs, stats
+    
+    job_ids = asyncio.run(submit_without_workers())
+    upstream, jobs, stats = asyncio.run(restart_and_wait(job_ids))
+    assert all(job["status"] == JobManager.SUCCEEDED for job in jobs)
+    assert upstream.calls == 3
+    assert stats["recovered"] == 3
+print("✅ 重启恢复测试成功")
+
+print("3. 测试上游失败时任务标记为失败")
+async def run_failing_job():
+    async def failing_handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(500, json={"message": "upstream error"})
+    generator = ImageGenerator(client=httpx.AsyncClient(transport=httpx.MockTransport(failing_handler)), cache=ResultCache())
+    manager = JobManager(MemoryJobStore(), GenerationPipeline(generator, ImagePreprocessor(), TEST_LOGGER), workers=1)
+    await manager.start()
+    job_id = await manager.submit([InputImage.from_bytes(TEST_IMAGE_BYTES)], JOB_PARAMS)
+    job = await wait_for_job(manager, job_id)
+    await manager.stop()
+    return job
+
+job = asyncio.run(run_failing_job())
+assert job["status"] == JobManager.FAILED
+assert "API调用失败" in job["error"]
+print("✅ 任务失败测试成功")
+
+print("4. 测试并发提交不超过队列上限，被拒绝的提交不留下任务")
+async def submit_concurrently():
+    store = MemoryJobStore()
+    manager = JobManager(store, GenerationPipeline(FakeUpstream().create_generator(cache=None), ImagePreprocessor(), TEST_LOGGER),
+                         workers=0, max_queue=2)
+    await manager.start()
+    results = await asyncio.gather(*[
+        manager.submit([InputImage.from_bytes(TEST_IMAGE_BYTES)], JOB_PARAMS) for _ in range(5)
+    ], return_exceptions=True)
+    await manager.stop()
+    return store, results
+
+store, results = asyncio.run(submit_concurrently())
+assert sum(isinstance(result, str) for result in results) == 2
+assert sum(isinstance(result, JobQueueFullError) for result in results) == 3
+assert len(store._jobs) == 2
+print("✅ 并发提交测试成功")
+
+print("\n=== 所有测试完成 ===")
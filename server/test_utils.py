@@ -4,12 +4,13 @@ import tempfile
 from PIL import Image
 from io import BytesIO
 import base64
+import io
 
 # 添加项目根目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from utils.image_utils import ImageUtils
-from utils.logger_utils import LoggerUtils
+from utils.logger_utils import LoggerUtils, AsyncLogHandler, JsonLineFormatter
 from config import Config
 
 # 测试image_utils.py
@@ -67,11 +68,50 @@ pil_image_from_base64 = ImageUtils.base64_to_pil_image(base64_str)
 assert isinstance(pil_image_from_base64, Image.Image)
 print("✅ base64_to_pil_image函数测试成功")
 
+# 测试pil_image_to_bytes函数
+print("8. 测试pil_image_to_bytes函数")
+jpeg_bytes = ImageUtils.pil_image_to_bytes(test_image, "JPEG")
+assert jpeg_bytes[:2] == b"\xff\xd8"
+print("✅ pil_image_to_bytes函数测试成功")
+
+# 测试probe_image函数
+print("9. 测试probe_image函数")
+width, height, image_format, mime_type = ImageUtils.probe_image(jpeg_bytes)
+assert (width, height) == (100, 100)
+assert image_format == "JPEG"
+assert mime_type == "image/jpeg"
+print("✅ probe_image函数测试成功")
+
+# 测试build_image_info函数
+print("10. 测试build_image_info函数")
+image_info_from_meta = ImageUtils.build_image_info(width, height, image_format, base64_str, 0, 20, bytes=len(jpeg_bytes))
+assert image_info_from_meta["format"] == "JPEG"
+assert image_info_from_meta["bytes"] == len(jpeg_bytes)
+assert image_info_from_meta["base64_preview"] == image_info["base64_preview"]
+print("✅ build_image_info函数测试成功")
+
+# 测试render_variant函数
+print("11. 测试render_variant函数")
+rgba_image = Image.new('RGBA', (400, 200), color=(0, 0, 255, 128))
+buffered = BytesIO()
+rgba_image.save(buffered, format="PNG")
+variant_bytes = ImageUtils.render_variant(buffered.getvalue(), 128, "WEBP", 70)
+assert ImageUtils.probe_image(variant_bytes)[:3] == (128, 64, "WEBP")
+# JPEG合成透明通道，不放大小于最长边的图片
+variant_bytes = ImageUtils.render_variant(buffered.getvalue(), 1024, "JPEG", 70)
+assert ImageUtils.probe_image(variant_bytes)[:3] == (400, 200, "JPEG")
+with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
+    f.write(test_image_bytes)
+assert ImageUtils.probe_image(ImageUtils.render_variant(f.name, None, "PNG"))[:3] == (100, 100, "PNG")
+os.remove(f.name)
+print("✅ render_variant函数测试成功")
+
 # 测试logger_utils.py
 print("\n=== 测试logger_utils.py ===")
 
-# 测试setup_logger函数
+# 测试setup_logger函数（日志写入临时目录，不写入源码目录下的logs/）
 print("1. 测试setup_logger函数")
+Config.LOG_PATH = os.path.join(tempfile.mkdtemp(), "image_generation.log")
 logger = LoggerUtils.setup_logger("test_logger")
 assert logger is not None
 print("✅ setup_logger函数测试成功")
@@ -113,8 +153,9 @@ try:
 except Exception as e:
     print(f"❌ log_api_call函数测试失败: {e}")
 
-# 验证日志文件生成
+# 验证日志文件生成（异步写入，先等待队列写完）
 print("4. 验证日志文件生成")
+LoggerUtils.flush_logger(logger)
 log_file_path = Config.LOG_PATH
 if os.path.exists(log_file_path):
     print(f"✅ 日志文件生成成功: {log_file_path}")
@@ -128,4 +169,299 @@ if os.path.exists(log_file_path):
 else:
     print(f"❌ 日志文件未生成: {log_file_path}")
 
+# 测试异步日志处理器：单次编码、批量写入、轮转压缩和队列满时丢弃
+print("5. 测试AsyncLogHandler")
+import gzip
+import json
+import logging
+log_dir = tempfile.mkdtemp()
+sink_path = os.path.join(log_dir, "sink.log")
+sink = AsyncLogHandler(sink_path, rotate_bytes=2000, rotate_interval=0, backup_count=2, compress=True)
+sink.setFormatter(JsonLineFormatter())
+sink_logger = logging.getLogger("test_async_sink")
+sink_logger.propagate = False
+sink_logger.addHandler(sink)
+sink_logger.setLevel(logging.INFO)
+# 轮转在每次批量写入后检查，分几轮写入以触发多次轮转
+for round in range(4):
+    for i in range(15):
+        sink_logger.info({"call_id": f"{round}-{i}", "prompt": "p" * 100})
+    sink.flush()
+sink_logger.info("plain %s", "message")
+sink.flush()
+stats = sink.get_stats()
+assert stats["written"] == 61 and stats["dropped"] == 0
+assert stats["rotations"] >= 2
+sink.close()
+backups = sorted(name for name in os.listdir(log_dir) if name != "sink.log")
+# 旧备份已清理，只保留backup_count个，均已压缩
+assert len(backups) == 2 and all(name.endswith(".gz") for name in backups)
+with gzip.open(os.path.join(log_dir, backups[-1]), "rt", encoding="utf-8") as f:
+    first = json.loads(f.readline())
+# 字典消息直接展开为顶层字段，不再嵌套二次编码的字符串
+assert first["levelname"] == "INFO" and first["prompt"] == "p" * 100 and "message" not in first
+with open(sink_path, encoding="utf-8") as f:
+    last = json.loads(f.read().splitlines()[-1])
+assert last["message"] == "plain message"
+print(f"✅ 批量写入与轮转压缩测试成功: {stats['batches']}次写入, {stats['rotations']}次轮转")
+
+# 写入线程阻塞时（磁盘慢），队列满后丢弃新记录而不阻塞调用方
+slow_sink = AsyncLogHandler(os.path.join(log_dir, "slow.log"), queue_size=5, rotate_bytes=0, rotate_interval=0)
+slow_sink.setFormatter(JsonLineFormatter())
+write_gate = __import__("threading").Event()
+original_write = slow_sink._write
+slow_sink._write = lambda records: (write_gate.wait(), original_write(records))
+import time as _time
+begin = _time.perf_counter()
+for i in range(50):
+    slow_sink.handle(logging.LogRecord("slow", logging.INFO, __file__, 0, {"i": i}, None, None))
+elapsed = _time.perf_counter() - begin
+assert elapsed < 0.5
+assert slow_sink.get_stats()["dropped"] > 0
+write_gate.set()
+slow_sink.close()
+assert slow_sink.get_stats()["written"] + slow_sink.get_stats()["dropped"] == 50
+print(f"✅ 丢弃策略测试成功: 丢弃{slow_sink.get_stats()['dropped']}条, 耗时{elapsed * 1000:.1f}ms")
+
+# 测试metrics_utils.py
+print("\n=== 测试metrics_utils.py ===")
+from utils.metrics_utils import MetricsRegistry
+
+print("1. 测试直方图累计分桶与标签转义")
+registry = MetricsRegistry()
+histogram = registry.histogram("test_seconds", "测试耗时", (0.1, 1.0), labels=("stage",))
+for value in (0.05, 0.1, 0.5, 2.0):
+    histogram.observe(value, stage='a"b')
+text = registry.render()
+assert 'test_seconds_bucket{stage="a\\"b",le="0.1"} 2' in text
+assert 'test_seconds_bucket{stage="a\\"b",le="1.0"} 3' in text
+assert 'test_seconds_bucket{stage="a\\"b",le="+Inf"} 4' in text
+assert 'test_seconds_count{stage="a\\"b"} 4' in text
+assert histogram.get_count(stage='a"b') == 4 and abs(histogram.get_sum(stage='a"b') - 2.65) < 1e-9
+print("✅ 直方图测试成功")
+
+print("2. 测试计数器、仪表盘与重复注册")
+counter = registry.counter("test_total", "测试计数", labels=("status",))
+counter.inc(status="200")
+counter.inc(2, status="200")
+gauge = registry.gauge("test_in_flight", "测试并发")
+with gauge.track():
+    assert gauge.get() == 1
+assert counter.get(status="200") == 3 and gauge.get() == 0
+try:
+    registry.counter("test_total", "重复")
+    assert False
+except ValueError:
+    pass
+print("✅ 计数器与仪表盘测试成功")
+
+# 测试log_analytics.py
+print("\n=== 测试log_analytics.py ===")
+from datetime import datetime, timedelta
+from utils.log_analytics import LogIndex, main as log_analytics_main
+
+def call_line(i: int, model: str, status: str, total_ms: float, prompt: str, hour: int) -> str:
+    timestamp = (datetime(2026, 10, 1, hour) + timedelta(seconds=i)).isoformat() + "Z"
+    record = {"call_id": f"call-{i}", "timestamp": timestamp, "model": model, "status": status,
+              "prompt": prompt, "total_time_ms": total_ms}
+    return json.dumps({"asctime": timestamp, "name": "image_generation", "levelname": "INFO", **record})
+
+analytics_dir = tempfile.mkdtemp()
+analytics_log = os.path.join(analytics_dir, "calls.log")
+analytics_index = os.path.join(analytics_dir, "calls.index.db")
+
+print("1. 测试读取轮转备份、旧格式日志并建立索引")
+with gzip.open(analytics_log + ".20261001-000000-000000.gz", "wt", encoding="utf-8") as f:
+    for i in range(100):
+        f.write(call_line(i, "model-a", "success", float(i + 1), "cat", 1) + "\n")
+# 旧格式：调用记录作为JSON字符串嵌在message中
+legacy = json.dumps({"asctime": "2026-10-01T02:00:00", "name": "image_generation", "levelname": "ERROR",
+                     "message": call_line(100, "model-b", "failed", 5.0, "dog", 2)})
+with open(analytics_log, "w", encoding="utf-8") as f:
+    f.write(legacy + "\n")
+    f.write(json.dumps({"asctime": "2026-10-01T02:00:00", "message": "plain message"}) + "\n")
+    f.write(call_line(101, "model-b", "success", 10.0, "dog", 2) + "\n")
+    # 未写完的行不计入
+    f.write('{"call_id": "partial"')
+index = LogIndex(analytics_log, analytics_index)
+assert index.update() == {"files": 2, "records": 102}
+print("✅ 建立索引测试成功")
+
+print("2. 测试增量更新只扫描新追加的行")
+assert index.update() == {"files": 1, "records": 0}
+with open(analytics_log, "a", encoding="utf-8") as f:
+    f.write(', "timestamp": "2026-10-01T02:30:00Z", "model": "model-b", "status": "success", "total_time_ms": 20.0}\n')
+assert index.update() == {"files": 1, "records": 1}
+print("✅ 增量更新测试成功")
+
+print("3. 测试轮转后的文件不重复计入")
+os.replace(analytics_log, analytics_log + ".20261001-030000-000000")
+with open(analytics_log, "w", encoding="utf-8") as f:
+    f.write(call_line(102, "model-b", "failed", 30.0, "dog", 3) + "\n")
+assert index.update() == {"files": 2, "records": 1}
+print("✅ 轮转测试成功")
+
+print("4. 测试分位数、失败率和热门提示词")
+latency = {row["model"]: row for row in index.latency(by="model")}
+assert latency["model-a"]["count"] == 100
+assert latency["model-a"]["p50"] == 50.0 and latency["model-a"]["p95"] == 95.0 and latency["model-a"]["p99"] == 99.0
+assert latency["model-b"]["count"] == 2 and latency["model-b"]["p50"] == 10.0
+failures = {row["hour"]: row for row in index.failure_rate(by="hour")}
+assert failures["2026-10-01 01:00"]["failed"] == 0
+assert failures["2026-10-01 02:00"]["count"] == 3 and failures["2026-10-01 02:00"]["failed"] == 1
+assert index.top_prompts(limit=1)[0] == {"prompt": "cat", "count": 100, "mean_ms": 50.5}
+since = datetime(2026, 10, 1, 2).timestamp()
+assert [row["model"] for row in index.latency(since=since)] == ["model-b"]
+index.close()
+print("✅ 查询测试成功")
+
+print("5. 测试命令行")
+from contextlib import redirect_stdout
+output = io.StringIO()
+with redirect_stdout(output):
+    log_analytics_main(["--log", analytics_log, "--index", analytics_index, "--json", "latency", "--percentiles", "50,99.9"])
+rows = json.loads(output.getvalue())
+assert rows[0]["model"] == "model-a" and rows[0]["p99.9"] == 100.0
+print("✅ 命令行测试成功")
+
+# 测试roi_utils.py
+print("\n=== 测试roi_utils.py ===")
+import numpy as np
+from utils.roi_utils import RoiUtils
+
+print("1. 测试区域解析与裁剪范围")
+assert RoiUtils.parse_box("10,20,30,40") == (10, 20, 40, 60)
+for value in ("10,20,30", "a,b,c,d", "0,0,0,10", "-1,0,5,5"):
+    try:
+        RoiUtils.parse_box(value)
+        assert False
+    except ValueError:
+        pass
+# 边距为最长边的比例（不低于下限），过小的区域对称扩展到最短边下限，超出图片时向内平移
+assert RoiUtils.expand_box((400, 400, 600, 500), 2000, 1000, 0.25, 32, 0) == ((350, 350, 650, 550), 50)
+assert RoiUtils.expand_box((400, 400, 600, 500), 2000, 1000, 0.25, 32, 512) == ((244, 194, 756, 706), 50)
+assert RoiUtils.expand_box((0, 900, 100, 1000), 2000, 1000, 0.25, 32, 512) == ((0, 488, 512, 1000), 32)
+assert RoiUtils.expand_box((0, 0, 100, 100), 300, 200, 0.25, 32, 512) == ((0, 0, 300, 200), 32)
+print("✅ 区域解析与裁剪范围测试成功")
+
+print("2. 测试羽化权重")
+alpha = RoiUtils.feather_alpha((10, 10, 20, 20), (0, 0, 30, 30), 10)
+assert alpha.shape == (30, 30) and alpha.dtype == np.float32
+assert alpha[10:20, 10:20].min() == 1.0
+assert alpha[0, :].max() == 0.0 and alpha[:, 29].max() == 0.0
+assert abs(alpha[15, 5] - 0.5) < 1e-6 and abs(alpha[5, 5] - 0.5) < 1e-6
+print("✅ 羽化权重测试成功")
+
+print("3. 测试裁剪与合成回原图")
+roi_source = Image.new("RGB", (1200, 800), color=(200, 0, 0))
+buffered = BytesIO()
+roi_source.save(buffered, format="PNG")
+roi_source_bytes = buffered.getvalue()
+crop_bytes, edit_box, crop_box, padding, size = RoiUtils.crop(roi_source_bytes, (500, 300, 600, 400))
+assert edit_box == (500, 300, 600, 400) and size == (1200, 800) and padding == 32
+assert crop_box == (294, 94, 806, 606)
+assert ImageUtils.probe_image(crop_bytes)[:3] == (512, 512, "JPEG")
+# 上游返回的结果尺寸与裁剪区域不同，缩放后合成；编辑区域内为结果颜色，裁剪区域外保持原图
+edited = Image.new("RGB", (256, 256), color=(0, 0, 200))
+buffered = BytesIO()
+edited.save(buffered, format="PNG")
+composite = Image.open(BytesIO(RoiUtils.composite(roi_source_bytes, buffered.getvalue(), edit_box, crop_box, padding)))
+assert composite.size == (1200, 800) and composite.format == "PNG"
+assert composite.getpixel((550, 350)) == (0, 0, 200)
+assert composite.getpixel((100, 100)) == (200, 0, 0) and composite.getpixel((294, 350)) == (200, 0, 0)
+assert composite.getpixel((484, 350)) == (100, 0, 100)
+# 遮罩：编辑区域为遮罩覆盖范围，遮罩外（编辑区域内）保持原图
+roi_mask = Image.new("L", (600, 400), 0)
+roi_mask.paste(255, (250, 150, 300, 200))
+buffered = BytesIO()
+roi_mask.save(buffered, format="PNG")
+roi_mask_bytes = buffered.getvalue()
+_, edit_box, crop_box, padding, _ = RoiUtils.crop(roi_source_bytes, None, roi_mask_bytes)
+assert edit_box == (500, 300, 600, 400)
+try:
+    RoiUtils.crop(roi_source_bytes, (0, 0, 100, 100), roi_mask_bytes)
+    assert False
+except ValueError:
+    pass
+print("✅ 裁剪与合成测试成功")
+
+# 测试tile_utils.py
+print("\n=== 测试tile_utils.py ===")
+from utils.tile_utils import TileUtils
+
+print("1. 测试分块规划")
+assert TileUtils.count_tiles(1000, 512, 64) == 3 and TileUtils.count_tiles(500, 512, 64) == 1
+assert TileUtils.starts(1000, 512, 3) == (0, 244, 488)
+grid = TileUtils.plan(1000, 700, [(512, 512)], 64)
+assert (grid.tile_width, grid.tile_height, grid.xs, grid.ys) == (512, 512, (0, 244, 488), (0, 188))
+assert grid.count == 6 and grid.boxes[1] == (244, 0, 756, 512)
+# 选择分块数最少的尺寸，超出图片的一边截断为图片尺寸
+grid = TileUtils.plan(1000, 700, [(512, 512), (1024, 1024)], 64)
+assert (grid.tile_width, grid.tile_height, grid.count) == (1000, 700, 1)
+grid = TileUtils.plan(3000, 800, [(1024, 1024)], 128)
+assert (grid.tile_width, grid.tile_height, grid.count) == (1024, 800, 4)
+assert TileUtils.nearest_size(1024, 800, [(1024, 1024), (960, 1280), (1472, 1140)]) == (1472, 1140)
+print("✅ 分块规划测试成功")
+
+print("2. 测试融合权重")
+weights = TileUtils.axis_weights(1000, (0, 244, 488), 512)
+assert weights.shape == (3, 1000)
+assert np.allclose(weights.sum(axis=0), 1)
+# 只在重叠区域内渐变，图片边缘一侧不衰减
+assert weights[0, 0] == 1 and weights[0, 200] == 1 and weights[2, 999] == 1
+assert weights[0, 600] == 0 and 0 < weights[0, 400] < 1
+print("✅ 融合权重测试成功")
+
+print("3. 测试分块读取与拼接")
+tile_dir = tempfile.mkdtemp()
+gradient = np.zeros((700, 1000, 3), dtype=np.uint8)
+gradient[..., 0] = np.arange(1000)[None, :] * 255 // 999
+gradient[..., 1] = np.arange(700)[:, None] * 255 // 699
+gradient[..., 2] = 128
+tile_source_path = os.path.join(tile_dir, "source.png")
+Image.fromarray(gradient).save(tile_source_path)
+raw_path = os.path.join(tile_dir, "raw.npy")
+assert TileUtils.unpack(tile_source_path, raw_path, band_rows=100) == (1000, 700, "PNG", None)
+grid = TileUtils.plan(1000, 700, [(512, 512)], 64)
+tile_paths = []
+for i, box in enumerate(grid.boxes):
+    tile_bytes = TileUtils.read_tile(raw_path, box, "PNG")
+    assert ImageUtils.probe_image(tile_bytes)[:2] == (512, 512)
+    tile_paths.append(os.path.join(tile_dir, f"tile_{i}.npy"))
+    TileUtils.store_tile(tile_bytes, tile_paths[-1], (512, 512))
+# 分块结果与原图相同时拼接结果还原原图（PNG按行带编码，保留ICC配置）
+output_path = os.path.join(tile_dir, "output")
+assert TileUtils.assemble(grid, tile_paths, output_path, "PNG", b"fake icc", band_rows=100) == "PNG"
+assembled = Image.open(output_path)
+assert assembled.size == (1000, 700) and assembled.format == "PNG" and assembled.mode == "RGB"
+assert assembled.info.get("icc_profile") == b"fake icc"
+assert np.abs(np.asarray(assembled, dtype=np.int16) - gradient).max() <= 1
+# 上游结果尺寸不同时缩放到分块尺寸
+small = BytesIO()
+Image.new("RGB", (256, 256), color=(10, 20, 30)).save(small, format="PNG")
+TileUtils.store_tile(small.getvalue(), tile_paths[0], (512, 512))
+assert np.load(tile_paths[0]).shape == (512, 512, 3)
+assert TileUtils.assemble(grid, tile_paths, output_path, "JPEG") == "JPEG"
+assembled = Image.open(output_path)
+assert assembled.format == "JPEG" and assembled.size == (1000, 700) and assembled.getpixel((10, 10))[2] < 60
+assert sorted(os.listdir(tile_dir)) == sorted(["source.png", "raw.npy", "output"] + [os.path.basename(path) for path in tile_paths])
+print("✅ 分块读取与拼接测试成功")
+
+print("4. 测试解码时按行带应用EXIF方向并合成透明部分")
+from PIL import ImageOps
+oriented = Image.fromarray(gradient[:300, :500]).convert("RGBA")
+oriented.putpixel((0, 0), (0, 0, 0, 0))
+for orientation in range(1, 9):
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    oriented.save(tile_source_path, exif=exif)
+    width, height, _, _ = TileUtils.unpack(tile_source_path, raw_path, band_rows=64)
+    with Image.open(tile_source_path) as source:
+        expected = ImageOps.exif_transpose(source).convert("RGBA")
+    flattened = Image.new("RGB", expected.size, (255, 255, 255))
+    flattened.paste(expected, mask=expected.getchannel("A"))
+    assert (width, height) == flattened.size, orientation
+    assert np.array_equal(np.load(raw_path), np.asarray(flattened)), orientation
+print("✅ EXIF方向与透明通道测试成功")
+
 print("\n=== 所有测试完成 ===")
@@ -0,0 +1,128 @@
+import asyncio
+import functools
+import multiprocessing
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional
+from config import Config
+
+class ImageExecutor:
+    """图片处理执行器：线程池用于释放GIL的编解码，进程池用于重型变换，均有排队上限"""
+    
+    THREAD = "thread"
+    PROCESS = "process"
+    
+    def __init__(self, thread_workers: int = Config.EXECUTOR_THREAD_WORKERS,
+                 process_workers: int = Config.EXECUTOR_PROCESS_WORKERS,
+                 max_queue: int = Config.EXECUTOR_MAX_QUEUE):
+        self.workers = {
+            ImageExecutor.THREAD: thread_workers,
+            ImageExecutor.PROCESS: process_workers
+        }
+        self.max_queue = max_queue
+        self._pools: Dict[str, Executor] = {}
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+        self.stats = {
+            kind: {"submitted": 0, "completed": 0, "failed": 0, "in_flight": 0, "waiting": 0, "busy_seconds": 0.0}
+            for kind in self.workers
+        }
+    
+    def _get_pool(self, kind: str) -> Executor:
+        """首次使用时创建线程池或进程池"""
+        pool = self._pools.get(kind)
+        if pool is None:
+            if kind == ImageExecutor.PROCESS:
+                # 使用spawn避免在含事件循环和线程的进程中fork
+                pool = ProcessPoolExecutor(
+                    max_workers=self.workers[kind],
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                pool = ThreadPoolExecutor(max_workers=self.workers[kind], thread_name_prefix="image-utils")
+            self._pools[kind] = pool
+            # 执行中+排队中的任务数上限，超出时调用方在事件循环上等待
+            self._slots[kind] = asyncio.Semaphore(self.workers[kind] + self.max_queue)
+        return pool
+    
+    async def run(self, func: Callable[..., Any], *args: Any, kind: str = THREAD, **kwargs: Any) -> Any:
+        """在指定池中执行函数，未配置进程池时回退到线程池"""
+        if kind == ImageExecutor.PROCESS and self.workers[ImageExecutor.PROCESS] <= 0:
+            kind = ImageExecutor.THREAD
+        pool = self._get_pool(kind)
+        stats = self.stats[kind]
+        
+        stats["waiting"] += 1
+        try:
+            await self._slots[kind].acquire()
+        finally:
+            stats["waiting"] -= 1
+        
+        stats["submitted"] += 1
+        stats["in_flight"] += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
+            stats["completed"] += 1
+            return result
+        except Exception:
+            stats["failed"] += 1
+            raise
+        finally:
+            stats["busy_seconds"] += time.perf_counter() - start
+            stats["in_flight"] -= 1
+            self._slots[kind].release()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取各池的队列深度等统计"""
+        result = {}
+        for kind, stats in self.stats.items():
+            result[kind] = dict(stats)
+            result[kind]["workers"] = self.workers[kind]
+            # 已提交但尚未被工作线程/进程执行的任务数
+            result[kind]["queue_depth"] = max(0, stats["in_flight"] - self.workers[kind])
+        return result
+    
+    def shutdown(self) -> None:
+        """关闭所有池"""
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._pools.clear()
+        self._slots.clear()
+
+class LoopLagMonitor:
+    """事件循环延迟监控：周期性休眠并测量实际唤醒的滞后时间"""
+    
+    def __init__(self, interval: float = Config.LOOP_LAG_INTERVAL_SECONDS):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"samples": 0, "last_ms": 0.0, "max_ms": 0.0, "ewma_ms": 0.0}
+    
+    def start(self) -> None:
+        """启动后台采样任务"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+    
+    async def stop(self) -> None:
+        """停止后台采样任务"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (time.perf_counter() - start - self.interval) * 1000)
+            self.stats["samples"] += 1
+            self.stats["last_ms"] = lag_ms
+            self.stats["max_ms"] = max(self.stats["max_ms"], lag_ms)
+            self.stats["ewma_ms"] = lag_ms if self.stats["samples"] == 1 else 0.8 * self.stats["ewma_ms"] + 0.2 * lag_ms
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取事件循环延迟统计（毫秒）"""
+        return dict(self.stats)
@@ -1,20 +1,46 @@
-from PIL import Image
 from io import BytesIO
 import base64
-from typing import Dict, Any, Tuple
+import mmap
+from typing import Dict, Any, Tuple, Optional, Callable, BinaryIO, Union, TYPE_CHECKING
+from utils.metrics_utils import MetricsUtils
+
+# PIL在首次使用时导入，缩短服务启动时间
+if TYPE_CHECKING:
+    from PIL import Image
 
 class ImageUtils:
+    # 可插拔执行器（utils.executor_utils.ImageExecutor），为None时在调用线程同步执行
+    executor = None
+    
+    @staticmethod
+    async def run_async(func: Callable[..., Any], *args: Any, heavy: bool = False,
+                        stage: Optional[str] = None, **kwargs: Any) -> Any:
+        """在执行器中运行图片操作，避免阻塞事件循环；heavy为True时使用进程池，指定stage时记录耗时（含排队）"""
+        if stage is not None:
+            with MetricsUtils.timer(stage):
+                return await ImageUtils.run_async(func, *args, heavy=heavy, **kwargs)
+        if ImageUtils.executor is None:
+            return func(*args, **kwargs)
+        kind = "process" if heavy else "thread"
+        return await ImageUtils.executor.run(func, *args, kind=kind, **kwargs)
+    
     @staticmethod
-    def bytes_to_pil_image(image_bytes: bytes) -> Image.Image:
+    def bytes_to_pil_image(image_bytes: bytes) -> "Image.Image":
         """将字节数据转换为PIL Image对象"""
+        from PIL import Image
         return Image.open(BytesIO(image_bytes))
     
     @staticmethod
-    def pil_image_to_base64(image: Image.Image, format: str = "PNG") -> str:
-        """将PIL Image对象转换为base64字符串"""
+    def pil_image_to_bytes(image: "Image.Image", format: str = "PNG") -> bytes:
+        """将PIL Image对象编码为指定格式的字节数据"""
         buffered = BytesIO()
         image.save(buffered, format=format)
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
+        return buffered.getvalue()
+    
+    @staticmethod
+    def pil_image_to_base64(image: "Image.Image", format: str = "PNG") -> str:
+        """将PIL Image对象转换为base64字符串"""
+        return base64.b64encode(ImageUtils.pil_image_to_bytes(image, format)).decode("utf-8")
     
     @staticmethod
     def bytes_to_base64(image_bytes: bytes, format: str = "PNG") -> str:
@@ -23,26 +49,105 @@ class ImageUtils:
         return ImageUtils.pil_image_to_base64(image, format)
     
     @staticmethod
-    def get_image_size(image: Image.Image) -> Tuple[int, int]:
+    def map_file(path: str) -> mmap.mmap:
+        """只读内存映射文件（不复制到内存，映射建立后即关闭文件）"""
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    @staticmethod
+    def open_buffer(data: Union[bytes, mmap.mmap]) -> BinaryIO:
+        """图片数据的文件对象：内存映射直接使用（不复制），bytes包装为BytesIO"""
+        if isinstance(data, mmap.mmap):
+            data.seek(0)
+            return data
+        return BytesIO(data)
+    
+    @staticmethod
+    def probe_image(image_bytes: Union[bytes, mmap.mmap]) -> Tuple[int, int, str, str]:
+        """仅解析文件头获取图片宽高、格式和MIME类型（不解码像素）"""
+        from PIL import Image
+        with Image.open(ImageUtils.open_buffer(image_bytes)) as image:
+            width, height = image.size
+            return width, height, image.format, image.get_format_mimetype()
+    
+    @staticmethod
+    def probe_image_file(path: str) -> Tuple[int, int, str, str]:
+        """仅解析图片文件的文件头获取宽高、格式和MIME类型"""
+        from PIL import Image
+        with Image.open(path) as image:
+            width, height = image.size
+            return width, height, image.format, image.get_format_mimetype()
+    
+    @staticmethod
+    def render_variant(source: Union[str, bytes, mmap.mmap], max_edge: Optional[int], format: str,
+                       quality: Optional[int] = None) -> bytes:
+        """生成图片的衍生版本：应用EXIF方向，按最长边等比缩小（不放大），转换为指定格式（JPEG/PNG/WEBP/AVIF）；
+        source为文件路径或图片数据"""
+        from PIL import Image, ImageOps
+        with Image.open(source if isinstance(source, str) else ImageUtils.open_buffer(source)) as image:
+            if max_edge:
+                # JPEG按目标尺寸的整数分之一解码，减少缩略图的解码开销
+                image.draft("RGB", (max_edge, max_edge))
+            variant = ImageOps.exif_transpose(image)
+            if max_edge and max(variant.size) > max_edge:
+                variant.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            
+            if format == "JPEG" and variant.mode not in ("RGB", "L"):
+                # JPEG不支持透明通道，合成到白色背景
+                rgba = variant.convert("RGBA")
+                variant = Image.new("RGB", rgba.size, (255, 255, 255))
+                variant.paste(rgba, mask=rgba.getchannel("A"))
+            elif format in ("WEBP", "AVIF") and variant.mode not in ("RGB", "RGBA", "L"):
+                variant = variant.convert("RGBA" if "transparency" in variant.info or variant.mode in ("LA", "PA") else "RGB")
+            
+            save_kwargs = {}
+            if quality is not None and format in ("JPEG", "WEBP", "AVIF"):
+                save_kwargs["quality"] = quality
+            icc_profile = image.info.get("icc_profile")
+            if icc_profile:
+                save_kwargs["icc_profile"] = icc_profile
+            buffered = BytesIO()
+            variant.save(buffered, format=format, **save_kwargs)
+            return buffered.getvalue()
+    
+    @staticmethod
+    def get_image_size(image: "Image.Image") -> Tuple[int, int]:
         """获取图片尺寸"""
         return image.size
     
     @staticmethod
-    def get_image_info(image: Image.Image, base64_str: str, index: int, max_base64_len: int = 100) -> Dict[str, Any]:
+    def get_image_info(image: "Image.Image", base64_str: str, index: int, max_base64_len: int = 100) -> Dict[str, Any]:
         """获取图片信息（用于日志记录）"""
         width, height = ImageUtils.get_image_size(image)
-        
-        return {
+        return ImageUtils.build_image_info(width, height, image.format, base64_str, index, max_base64_len)
+    
+    @staticmethod
+    def build_image_info(width: int, height: int, format: Optional[str], base64_str: str,
+                         index: int, max_base64_len: int = 100, **extra: Any) -> Dict[str, Any]:
+        """根据已知的图片元数据构建日志信息（无需PIL对象）"""
+        info = {
             "index": index,
             "width": width,
             "height": height,
-            "format": image.format or "PNG",
+            "format": format or "PNG",
             "base64_preview": base64_str[:max_base64_len] + "..." if len(base64_str) > max_base64_len else base64_str
         }
+        info.update(extra)
+        return info
+    
+    @staticmethod
+    def get_base64_image_info(base64_str: str, index: int, max_base64_len: int = 100) -> Dict[str, Any]:
+        """解码base64并仅解析文件头，构建日志用的图片信息"""
+        if base64_str.startswith("data:image/"):
+            base64_str = base64_str.split(",")[1]
+        image_bytes = base64.b64decode(base64_str)
+        width, height, format, _ = ImageUtils.probe_image(image_bytes)
+        return ImageUtils.build_image_info(width, height, format, base64_str, index, max_base64_len, bytes=len(image_bytes))
     
     @staticmethod
-    def base64_to_pil_image(base64_str: str) -> Image.Image:
+    def base64_to_pil_image(base64_str: str) -> "Image.Image":
         """将base64字符串转换为PIL Image对象"""
+        from PIL import Image
         if base64_str.startswith("data:image/"):
             base64_str = base64_str.split(",")[1]
         image_bytes = base64.b64decode(base64_str)
@@ -0,0 +1,295 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from config import Config
+
+class LogIndex:
+    """调用日志分析：增量读取JSON调用日志（含轮转后的.gz备份）到SQLite索引，
+    重复查询只扫描新追加的行；分位数与分组统计在SQLite中用窗口函数和GROUP BY完成"""
+    
+    # 分组维度 -> SQL表达式
+    GROUPS = {
+        "model": "model",
+        "status": "status",
+        "hour": "strftime('%Y-%m-%d %H:00', ts, 'unixepoch', 'localtime')",
+        "day": "strftime('%Y-%m-%d', ts, 'unixepoch', 'localtime')",
+        "image_size": "image_size"
+    }
+    # 轮转备份文件名后缀（见AsyncLogHandler._rotate）
+    BACKUP_PATTERN = re.compile(r"\.\d{8}-\d{6}-\d{6}(\.gz)?$")
+    # 每次读取的字节数
+    CHUNK_SIZE = 1024 * 1024
+    
+    def __init__(self, log_path: str = Config.LOG_PATH, index_path: str = Config.LOG_INDEX_PATH):
+        self.log_path = log_path
+        directory = os.path.dirname(index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(index_path)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS calls (
+                    call_id TEXT PRIMARY KEY,
+                    ts REAL NOT NULL,
+                    model TEXT,
+                    status TEXT,
+                    total_ms REAL,
+                    prompt TEXT,
+                    image_size TEXT,
+                    batch_size INTEGER,
+                    error_message TEXT
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS calls_ts ON calls (ts)")
+            # 以文件首行的摘要识别文件，轮转改名或压缩后仍能对应到已读取的位置
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    fingerprint TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    offset INTEGER NOT NULL,
+                    complete INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+            """)
+    
+    def list_log_files(self) -> List[str]:
+        """当前日志文件和轮转备份，按时间从旧到新"""
+        directory = os.path.dirname(self.log_path) or "."
+        basename = os.path.basename(self.log_path)
+        backups = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.startswith(basename) and LogIndex.BACKUP_PATTERN.search(name[len(basename):])
+        ) if os.path.isdir(directory) else []
+        return backups + ([self.log_path] if os.path.exists(self.log_path) else [])
+    
+    @staticmethod
+    def _open(path: str):
+        return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+    
+    @staticmethod
+    def _fingerprint(path: str) -> Optional[str]:
+        """文件首行的摘要，首行尚未写完时返回None"""
+        with LogIndex._open(path) as f:
+            first = f.readline()
+        if not first.endswith(b"\n"):
+            return None
+        return hashlib.sha1(first).hexdigest()
+    
+    @staticmethod
+    def parse_line(line: bytes) -> Optional[Tuple[Any, ...]]:
+        """解析一行调用日志为索引行，非调用日志或无法解析时返回None；
+        兼容旧格式（调用记录作为JSON字符串嵌在message字段中）"""
+        try:
+            entry = json.loads(line)
+            if "call_id" not in entry and isinstance(entry.get("message"), str):
+                entry = json.loads(entry["message"])
+        except (ValueError, TypeError):
+            return None
+        if not isinstance(entry, dict) or "call_id" not in entry:
+            return None
+        try:
+            ts = datetime.fromisoformat(entry.get("timestamp", "").rstrip("Z")).timestamp()
+        except ValueError:
+            return None
+        return (
+            entry["call_id"], ts, entry.get("model"), entry.get("status"), entry.get("total_time_ms"),
+            entry.get("prompt"), entry.get("image_size"), entry.get("batch_size"), entry.get("error_message")
+        )
+    
+    def _read_from(self, path: str, offset: int) -> Iterator[Tuple[List[Tuple[Any, ...]], int]]:
+        """从指定位置流式读取完整的行，逐块产出(解析后的行, 已处理到的位置)"""
+        with LogIndex._open(path) as f:
+            f.seek(offset)
+            pending = b""
+            while True:
+                chunk = f.read(LogIndex.CHUNK_SIZE)
+                if not chunk:
+                    break
+                data = pending + chunk
+                end = data.rfind(b"\n") + 1
+                # 末尾未写完的行留到下次读取
+                pending = data[end:]
+                rows = [row for row in map(LogIndex.parse_line, data[:end].splitlines()) if row is not None]
+                offset += end
+                yield rows, offset
+    
+    def update(self) -> Dict[str, int]:
+        """把新追加的日志行加入索引，返回本次扫描的文件数和新增记录数"""
+        stats = {"files": 0, "records": 0}
+        for path in self.list_log_files():
+            # 轮转备份不再变化，读完一次后标记为完成
+            is_backup = path != self.log_path
+            try:
+                fingerprint = LogIndex._fingerprint(path)
+                if fingerprint is None:
+                    continue
+                row = self._conn.execute(
+                    "SELECT offset, complete FROM files WHERE fingerprint = ?", (fingerprint,)
+                ).fetchone()
+                offset, complete = row if row else (0, 0)
+                # 已读完的备份、大小未变的当前文件无需读取
+                if complete or (not is_backup and os.path.getsize(path) == offset):
+                    continue
+                stats["files"] += 1
+                for rows, offset in self._read_from(path, offset):
+                    with self._conn:
+                        stats["records"] += self._conn.executemany(
+                            "INSERT OR IGNORE INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+                        ).rowcount
+                        self._save_offset(fingerprint, path, offset, False)
+                with self._conn:
+                    self._save_offset(fingerprint, path, offset, is_backup)
+            except (OSError, EOFError):
+                # 正在压缩的备份可能尚不完整，下次再读
+                continue
+        return stats
+    
+    def _save_offset(self, fingerprint: str, path: str, offset: int, complete: bool) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO files (fingerprint, path, offset, complete, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (fingerprint, path, offset, int(complete), time.time())
+        )
+    
+    @staticmethod
+    def _where(since: Optional[float], until: Optional[float], model: Optional[str]) -> Tuple[str, List[Any]]:
+        conditions, args = ["1 = 1"], []
+        if since is not None:
+            conditions.append("ts >= ?")
+            args.append(since)
+        if until is not None:
+            conditions.append("ts < ?")
+            args.append(until)
+        if model is not None:
+            conditions.append("model = ?")
+            args.append(model)
+        return " AND ".join(conditions), args
+    
+    def _query(self, sql: str, args: Sequence[Any]) -> List[Dict[str, Any]]:
+        cursor = self._conn.execute(sql, args)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def latency(self, by: str = "model", percentiles: Sequence[float] = (50, 95, 99),
+                since: Optional[float] = None, until: Optional[float] = None,
+                model: Optional[str] = None, status: Optional[str] = "success") -> List[Dict[str, Any]]:
+        """按维度分组计算调用总耗时（毫秒）的分位数（最近秩法）"""
+        group = LogIndex.GROUPS[by]
+        where, args = LogIndex._where(since, until, model)
+        if status is not None:
+            where += " AND status = ?"
+            args.append(status)
+        columns = ", ".join(
+            f"MIN(CASE WHEN rn * 100 >= {float(p)} * n THEN total_ms END) AS \"p{p:g}\"" for p in percentiles
+        )
+        return self._query(f"""
+            WITH ranked AS (
+                SELECT {group} AS grp, total_ms,
+                       ROW_NUMBER() OVER (PARTITION BY {group} ORDER BY total_ms) AS rn,
+                       COUNT(*) OVER (PARTITION BY {group}) AS n
+                FROM calls WHERE {where} AND total_ms IS NOT NULL
+            )
+            SELECT grp AS {by}, COUNT(*) AS count, AVG(total_ms) AS mean, {columns}
+            FROM ranked GROUP BY grp ORDER BY grp
+        """, args)
+    
+    def failure_rate(self, by: str = "hour", since: Optional[float] = None, until: Optional[float] = None,
+                     model: Optional[str] = None) -> List[Dict[str, Any]]:
+        """按维度分组统计调用数、失败数和失败率"""
+        group = LogIndex.GROUPS[by]
+        where, args = LogIndex._where(since, until, model)
+        return self._query(f"""
+            SELECT {group} AS {by}, COUNT(*) AS count,
+                   SUM(status != 'success') AS failed,
+                   ROUND(1.0 * SUM(status != 'success') / COUNT(*), 4) AS failure_rate
+            FROM calls WHERE {where} GROUP BY {group} ORDER BY {group}
+        """, args)
+    
+    def top_prompts(self, limit: int = 10, since: Optional[float] = None, until: Optional[float] = None,
+                    model: Optional[str] = None) -> List[Dict[str, Any]]:
+        """调用次数最多的提示词"""
+        where, args = LogIndex._where(since, until, model)
+        return self._query(f"""
+            SELECT prompt, COUNT(*) AS count, ROUND(AVG(total_ms), 1) AS mean_ms
+            FROM calls WHERE {where} GROUP BY prompt ORDER BY count DESC, prompt LIMIT ?
+        """, [*args, limit])
+    
+    def close(self) -> None:
+        self._conn.close()
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    """解析时间参数：相对时长（如30m、12h、7d）或ISO时间"""
+    if value is None:
+        return None
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", value)
+    if match:
+        unit = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}[match.group(2)]
+        return (datetime.now() - timedelta(**{unit: float(match.group(1))})).timestamp()
+    return datetime.fromisoformat(value).timestamp()
+
+def format_value(value: Any) -> str:
+    """表格单元格：耗时保留1位小数，比率等小于1的值保留4位"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.1f}" if abs(value) >= 1 else f"{value:.4f}"
+    return str(value)
+
+def format_table(rows: List[Dict[str, Any]]) -> str:
+    """以对齐的文本表格输出查询结果"""
+    if not rows:
+        return "(无数据)"
+    columns = list(rows[0])
+    cells = [[format_value(row[column]) for column in columns] for row in rows]
+    widths = [max(len(column), *(len(line[i]) for line in cells)) for i, column in enumerate(columns)]
+    lines = ["  ".join(column.ljust(width) for column, width in zip(columns, widths))]
+    lines += ["  ".join(cell.ljust(width) for cell, width in zip(line, widths)) for line in cells]
+    return "\n".join(lines)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="调用日志分析（python -m utils.log_analytics）")
+    parser.add_argument("--log", default=Config.LOG_PATH, help="调用日志路径（同目录下的轮转备份一并读取）")
+    parser.add_argument("--index", default=Config.LOG_INDEX_PATH, help="索引文件路径")
+    parser.add_argument("--since", help="起始时间：相对时长（如7d、12h）或ISO时间")
+    parser.add_argument("--until", help="结束时间：相对时长或ISO时间")
+    parser.add_argument("--model", help="只统计指定模型")
+    parser.add_argument("--json", action="store_true", help="以JSON输出")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("update", help="只更新索引")
+    latency = commands.add_parser("latency", help="总耗时分位数（毫秒）")
+    latency.add_argument("--by", choices=list(LogIndex.GROUPS), default="model")
+    latency.add_argument("--percentiles", default="50,95,99", help="逗号分隔的分位数")
+    failures = commands.add_parser("failures", help="失败率")
+    failures.add_argument("--by", choices=list(LogIndex.GROUPS), default="hour")
+    prompts = commands.add_parser("top-prompts", help="调用次数最多的提示词")
+    prompts.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args(argv)
+    
+    index = LogIndex(args.log, args.index)
+    try:
+        updated = index.update()
+        filters = {"since": parse_time(args.since), "until": parse_time(args.until), "model": args.model}
+        if args.command == "update":
+            rows = [updated]
+        elif args.command == "latency":
+            percentiles = [float(p) for p in args.percentiles.split(",")]
+            rows = index.latency(by=args.by, percentiles=percentiles, **filters)
+        elif args.command == "failures":
+            rows = index.failure_rate(by=args.by, **filters)
+        else:
+            rows = index.top_prompts(limit=args.limit, **filters)
+    finally:
+        index.close()
+    print(json.dumps(rows, ensure_ascii=False, indent=2) if args.json else format_table(rows))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
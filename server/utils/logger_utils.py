@@ -1,11 +1,225 @@
+import gzip
 import logging
+import os
+import queue
+import shutil
+import threading
+import time
 import json
 import uuid
 from datetime import datetime
-from pythonjsonlogger import jsonlogger
 from config import Config
 from typing import Dict, Any, List, Optional
 
+class JsonLineFormatter(logging.Formatter):
+    """单行JSON格式化器：消息为字典时直接展开到日志行中，每条记录只编码一次"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "asctime": datetime.fromtimestamp(record.created).isoformat(),
+            "name": record.name,
+            "levelname": record.levelname
+        }
+        if isinstance(record.msg, dict):
+            entry.update(record.msg)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class AsyncLogHandler(logging.Handler):
+    """异步日志处理器：调用方只把记录放入有界队列，后台线程批量编码写入，按大小/时间轮转并压缩旧文件；
+    队列满时按策略丢弃（drop）或短暂阻塞（block），ERROR及以上级别总是短暂阻塞等待"""
+    
+    DROP = "drop"
+    BLOCK = "block"
+    # 通知写入线程退出的哨兵
+    _STOP = object()
+    
+    def __init__(self, path: str,
+                 queue_size: int = Config.LOG_QUEUE_SIZE,
+                 full_policy: str = Config.LOG_QUEUE_FULL_POLICY,
+                 block_seconds: float = Config.LOG_QUEUE_BLOCK_SECONDS,
+                 batch_size: int = Config.LOG_BATCH_SIZE,
+                 flush_interval: float = Config.LOG_FLUSH_INTERVAL_SECONDS,
+                 rotate_bytes: int = Config.LOG_ROTATE_BYTES,
+                 rotate_interval: float = Config.LOG_ROTATE_INTERVAL_SECONDS,
+                 backup_count: int = Config.LOG_BACKUP_COUNT,
+                 compress: bool = Config.LOG_COMPRESS):
+        super().__init__()
+        self.path = path
+        self.full_policy = full_policy
+        self.block_seconds = block_seconds
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._opened_at = 0.0
+        self._compressing: List[threading.Thread] = []
+        self._closed = False
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "batches": 0, "bytes_written": 0,
+                      "rotations": 0, "write_errors": 0}
+    
+    def _start(self) -> None:
+        """首次写日志时启动写入线程"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+    
+    def emit(self, record: logging.LogRecord) -> None:
+        """放入队列；字符串消息的参数和异常堆栈在此处展开，编码留给写入线程"""
+        if self._closed:
+            self.stats["dropped"] += 1
+            return
+        if self._thread is None:
+            self._start()
+        if record.args and isinstance(record.msg, str):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            if self.full_policy == AsyncLogHandler.BLOCK or record.levelno >= logging.ERROR:
+                self._queue.put(record, timeout=self.block_seconds)
+            else:
+                self._queue.put_nowait(record)
+            self.stats["queued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+    
+    def _run(self) -> None:
+        """写入线程：取出队列中已有的记录（最多batch_size条）合并为一次写入"""
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not AsyncLogHandler._STOP]
+            if records:
+                self._write(records)
+            for _ in batch:
+                self._queue.task_done()
+            if len(records) < len(batch):
+                break
+    
+    def _write(self, records: List[logging.LogRecord]) -> None:
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.stats["write_errors"] += 1
+        if not lines:
+            return
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        try:
+            if self._file is None:
+                self._open()
+            self._file.write(data)
+            self._file.flush()
+        except OSError:
+            self.stats["write_errors"] += 1
+            return
+        self._size += len(data)
+        self.stats["written"] += len(lines)
+        self.stats["batches"] += 1
+        self.stats["bytes_written"] += len(data)
+        if (self.rotate_bytes > 0 and self._size >= self.rotate_bytes) or \
+                (self.rotate_interval > 0 and time.time() - self._opened_at >= self.rotate_interval):
+            self._rotate()
+    
+    def _open(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+        # 按时间轮转的周期从打开文件时开始计算
+        self._opened_at = time.time()
+    
+    def _rotate(self) -> None:
+        """将当前文件改名为带时间戳的备份，压缩与清理旧备份在后台线程中进行"""
+        self._file.close()
+        self._file = None
+        backup = f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+        try:
+            os.replace(self.path, backup)
+        except OSError:
+            self.stats["write_errors"] += 1
+            return
+        self.stats["rotations"] += 1
+        self._compressing = [thread for thread in self._compressing if thread.is_alive()]
+        thread = threading.Thread(target=self._finish_rotation, args=(backup,), name="log-compress", daemon=True)
+        self._compressing.append(thread)
+        thread.start()
+    
+    def _finish_rotation(self, backup: str) -> None:
+        if self.compress:
+            try:
+                with open(backup, "rb") as source, gzip.open(backup + ".gz", "wb") as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(backup)
+            except OSError:
+                self.stats["write_errors"] += 1
+        self._prune_backups()
+    
+    def _prune_backups(self) -> None:
+        """只保留最近的backup_count个备份"""
+        if self.backup_count <= 0:
+            return
+        directory = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + "."
+        backups = sorted(name for name in os.listdir(directory) if name.startswith(prefix))
+        # 同一备份压缩过程中可能同时存在原文件和.gz文件，按时间戳去重后计数
+        stamps = sorted({name[len(prefix):].removesuffix(".gz") for name in backups})
+        expired = set(stamps[:-self.backup_count])
+        for name in backups:
+            if name[len(prefix):].removesuffix(".gz") in expired:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+    
+    def flush(self) -> None:
+        """等待队列中已有的记录全部写入"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+    
+    def close(self) -> None:
+        """写完队列中的记录后停止写入线程并关闭文件"""
+        if not self._closed:
+            self._closed = True
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(AsyncLogHandler._STOP)
+                self._thread.join()
+            for thread in self._compressing:
+                thread.join()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        super().close()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取日志写入统计"""
+        return {**self.stats, "queue_size": self._queue.qsize()}
+
 class LoggerUtils:
     @staticmethod
     def setup_logger(name: str = "image_generation") -> logging.Logger:
@@ -15,15 +229,11 @@ class LoggerUtils:
         
         # 检查是否已存在处理器，避免重复添加
         if not logger.handlers:
-            # 创建文件处理器，使用追加模式
-            file_handler = logging.FileHandler(Config.LOG_PATH, mode='a', encoding='utf-8')
+            # 创建异步文件处理器，请求路径上只入队，由后台线程批量写入
+            file_handler = AsyncLogHandler(Config.LOG_PATH)
             
-            # 创建JSON格式的日志格式化器
-            formatter = jsonlogger.JsonFormatter(
-                fmt='%(asctime)s %(name)s %(levelname)s %(message)s',
-                datefmt='%Y-%m-%dT%H:%M:%S.%fZ'
-            )
-            file_handler.setFormatter(formatter)
+            # 单行JSON格式，每条记录只编码一次
+            file_handler.setFormatter(JsonLineFormatter())
             
             # 添加处理器到logger
             logger.addHandler(file_handler)
@@ -61,7 +271,8 @@ class LoggerUtils:
         guidance_scale: Optional[float] = None,
         cfg: Optional[float] = None,
         total_time_seconds: Optional[float] = None,
-        timing: Optional[Dict[str, float]] = None
+        timing: Optional[Dict[str, float]] = None,
+        preprocess_bytes_saved: Optional[int] = None
     ) -> None:
         """记录API调用日志"""
         # 生成唯一调用ID
@@ -89,15 +300,33 @@ class LoggerUtils:
             "timing": timing
         }
         
+        # 添加预处理节省的字节数（如果有）
+        if preprocess_bytes_saved is not None:
+            log_record["preprocess_bytes_saved"] = preprocess_bytes_saved
+        
         # 添加错误信息（如果有）
         if error_message:
             log_record["error_message"] = error_message
         
-        # 记录日志
+        # 记录日志：直接传入字典，由写入线程编码一次
         if status == "success":
-            logger.info(json.dumps(log_record, ensure_ascii=False))
+            logger.info(log_record)
         else:
-            logger.error(json.dumps(log_record, ensure_ascii=False))
+            logger.error(log_record)
+    
+    @staticmethod
+    def flush_logger(logger: logging.Logger) -> None:
+        """等待logger的异步处理器写完已入队的记录"""
+        for handler in logger.handlers:
+            handler.flush()
+    
+    @staticmethod
+    def get_logger_stats(logger: logging.Logger) -> Optional[Dict[str, Any]]:
+        """获取logger的异步写入统计"""
+        for handler in logger.handlers:
+            if isinstance(handler, AsyncLogHandler):
+                return handler.get_stats()
+        return None
     
     @staticmethod
     def get_default_logger() -> logging.Logger:
@@ -0,0 +1,241 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from config import Config
+
+class Metric:
+    """指标基类：按标签值分组保存数据，输出Prometheus文本格式"""
+    
+    TYPE = "untyped"
+    
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+    
+    def _format_labels(self, key: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labels, key))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f"{label}=\"{value}\"" for (label, _), value in zip(pairs, escaped)) + "}"
+    
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"] + self._render_samples()
+    
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    """只增计数器"""
+    
+    TYPE = "counter"
+    
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+    
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._format_labels(key)} {value}" for key, value in values]
+
+class Gauge(Metric):
+    """可增可减的瞬时值（如进行中的请求数）"""
+    
+    TYPE = "gauge"
+    
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+    
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+    
+    @contextmanager
+    def track(self, **labels: str) -> Iterator[None]:
+        """进入时加一，退出时减一"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+    
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._format_labels(key)} {value}" for key, value in values]
+
+class Histogram(Metric):
+    """累计分桶直方图"""
+    
+    TYPE = "histogram"
+    
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各桶计数(非累计)..., +Inf桶计数, 总和]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+    
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+    
+    def get_count(self, **labels: str) -> int:
+        counts = self._values.get(self._key(labels))
+        return int(sum(counts[:-1])) if counts else 0
+    
+    def get_sum(self, **labels: str) -> float:
+        counts = self._values.get(self._key(labels))
+        return counts[-1] if counts else 0.0
+    
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', repr(float(bound))))} {cumulative}")
+            cumulative += counts[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """指标注册表，按注册顺序输出"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+    
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"指标 {metric.name} 已注册")
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+    
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+    
+    def histogram(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()) -> Histogram:
+        return self.register(Histogram(name, help, buckets, labels))
+    
+    def render(self) -> str:
+        """输出Prometheus文本格式（0.0.4）"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class MetricsUtils:
+    # Prometheus文本格式的Content-Type
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    
+    # 阶段名称
+    STAGE_UPLOAD_READ = "upload_read"  # 读取上传文件
+    STAGE_DECODE = "decode"  # 解析上传图片文件头、解码上游base64结果
+    STAGE_PREPROCESS = "preprocess"  # 按模型策略预处理上传图片
+    STAGE_ENCODE = "encode"  # 输入图片base64编码
+    STAGE_UPSTREAM = "upstream"  # 等待上游响应（单次HTTP请求）
+    STAGE_MATERIALIZE = "materialize"  # 获取结果图片（解码或下载）
+    STAGE_LOGGING = "logging"  # 记录调用日志（入队）
+    STAGE_VARIANT = "variant"  # 生成图片衍生版本（缩略图、格式转换）
+    STAGE_ROI = "roi"  # 局部编辑的裁剪与合成
+    STAGE_TILE = "tile"  # 分块编辑的解码、分块编码与拼接
+    STAGE_TOTAL = "total"  # 一次生成的总耗时
+    
+    registry = MetricsRegistry()
+    stage_seconds = registry.histogram(
+        "image_api_stage_seconds", "各处理阶段耗时（秒）", Config.METRICS_LATENCY_BUCKETS, labels=("stage",)
+    )
+    in_flight = registry.gauge("image_api_in_flight", "进行中的请求数", labels=("kind",))
+    upstream_responses = registry.counter(
+        "image_api_upstream_responses_total", "上游响应数（按模型和状态码，传输错误记为error）", labels=("model", "status")
+    )
+    payload_bytes = registry.histogram(
+        "image_api_payload_bytes", "载荷大小（字节）", Config.METRICS_SIZE_BUCKETS, labels=("kind",)
+    )
+    queue_wait_seconds = registry.histogram(
+        "image_api_queue_wait_seconds", "上游调用在公平调度队列中的等待时间（秒）", Config.METRICS_LATENCY_BUCKETS,
+        labels=("class",)
+    )
+    
+    @staticmethod
+    @contextmanager
+    def timer(stage: str) -> Iterator[None]:
+        """记录代码块耗时到指定阶段（异常退出时同样记录）"""
+        if not Config.METRICS_ENABLED:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            MetricsUtils.stage_seconds.observe(time.perf_counter() - start, stage=stage)
+    
+    @staticmethod
+    def observe_stage(stage: str, seconds: float) -> None:
+        """直接记录阶段耗时"""
+        if Config.METRICS_ENABLED:
+            MetricsUtils.stage_seconds.observe(seconds, stage=stage)
+    
+    @staticmethod
+    def observe_bytes(kind: str, size: int) -> None:
+        """记录载荷大小（upload、upstream_request、upstream_response、result）"""
+        if Config.METRICS_ENABLED:
+            MetricsUtils.payload_bytes.observe(size, kind=kind)
+    
+    @staticmethod
+    def observe_queue_wait(traffic_class: str, seconds: float) -> None:
+        """记录调度队列等待时间（按流量类别）"""
+        if Config.METRICS_ENABLED:
+            MetricsUtils.queue_wait_seconds.observe(seconds, **{"class": traffic_class})
+    
+    @staticmethod
+    def count_upstream(model: str, status: str) -> None:
+        """记录上游响应状态"""
+        if Config.METRICS_ENABLED:
+            MetricsUtils.upstream_responses.inc(model=model, status=status)
+    
+    @staticmethod
+    def render() -> str:
+        """输出所有指标"""
+        return MetricsUtils.registry.render()
@@ -0,0 +1,98 @@
+import json
+import uuid
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from models.image_output import OutputImage
+
+class ResponseUtils:
+    # 响应模式
+    MODE_JSON = "json"  # 图片以base64嵌入JSON（兼容旧客户端）
+    MODE_MULTIPART = "multipart"  # multipart/mixed流式返回原始图片字节
+    MODE_URL = "url"  # 返回/images/{blob_id}短期链接
+    RESPONSE_MODES = (MODE_JSON, MODE_MULTIPART, MODE_URL)
+    
+    @staticmethod
+    def new_boundary() -> str:
+        """生成multipart分隔符"""
+        return f"image-{uuid.uuid4().hex}"
+    
+    @staticmethod
+    def iter_multipart(metadata: Dict[str, Any], images: List[OutputImage], boundary: str) -> Iterator[bytes]:
+        """逐段生成multipart/mixed响应：首段为JSON元数据，之后每段为一张图片的原始字节"""
+        yield ResponseUtils.multipart_json_part(metadata, boundary, first=True)
+        for i, image in enumerate(images):
+            yield ResponseUtils.multipart_image_header(image, boundary, f"{i}.{image.extension}", {"X-Image-Index": i})
+            yield image.data
+        yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+    
+    @staticmethod
+    async def iter_multipart_groups(metadata: Dict[str, Any],
+                                    groups: AsyncIterator[Tuple[Dict[str, Any], List[OutputImage]]],
+                                    boundary: str) -> AsyncIterator[bytes]:
+        """逐组生成multipart/mixed响应：首段为JSON元数据，之后每组在产出时依次输出该组的JSON元数据和图片
+        （图片段带X-Variant-Index段头，组的顺序为完成顺序）"""
+        yield ResponseUtils.multipart_json_part(metadata, boundary, first=True)
+        index = 0
+        async for group_metadata, images in groups:
+            yield ResponseUtils.multipart_json_part(group_metadata, boundary)
+            variant_index = group_metadata.get("variant_index")
+            for i, image in enumerate(images):
+                yield ResponseUtils.multipart_image_header(
+                    image, boundary, f"{variant_index}-{i}.{image.extension}",
+                    {"X-Image-Index": index, "X-Variant-Index": variant_index}
+                )
+                yield image.data
+                index += 1
+        yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+    
+    @staticmethod
+    def multipart_json_part(data: Dict[str, Any], boundary: str, first: bool = False) -> bytes:
+        """multipart中的一个JSON段（含分隔符）"""
+        separator = f"--{boundary}\r\n" if first else f"\r\n--{boundary}\r\n"
+        return (
+            f"{separator}Content-Type: application/json; charset=utf-8\r\n\r\n"
+        ).encode("utf-8") + json.dumps(data, ensure_ascii=False).encode("utf-8")
+    
+    @staticmethod
+    def multipart_image_header(image: OutputImage, boundary: str, filename: str, headers: Dict[str, Any]) -> bytes:
+        """multipart中图片段的分隔符和段头，之后紧跟图片的原始字节"""
+        extra = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        return (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {image.mime_type}\r\n"
+            f"Content-Length: {len(image.data)}\r\n"
+            f"Content-Disposition: inline; name=\"image\"; filename=\"{filename}\"\r\n"
+            f"{extra}\r\n"
+        ).encode("utf-8")
+    
+    @staticmethod
+    async def iter_ndjson(lines: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+        """将逐条产出的字典编码为NDJSON（每行一个JSON对象）"""
+        async for line in lines:
+            yield json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n"
+    
+    @staticmethod
+    def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+        """判断If-None-Match请求头是否匹配ETag（支持多个值、弱比较和*）"""
+        if not if_none_match:
+            return False
+        candidates = [value.strip() for value in if_none_match.split(",")]
+        return "*" in candidates or any(value.removeprefix("W/") == etag for value in candidates)
+    
+    @staticmethod
+    def accepts(accept: Optional[str], mime_type: str) -> bool:
+        """判断Accept请求头是否明确接受指定的MIME类型（q=0视为不接受，不匹配通配符）"""
+        if not accept:
+            return False
+        for item in accept.split(","):
+            media_range, _, params = item.strip().partition(";")
+            if media_range.strip().lower() != mime_type:
+                continue
+            for param in params.split(";"):
+                key, _, value = param.strip().partition("=")
+                if key.strip() == "q":
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
@@ -0,0 +1,147 @@
+from io import BytesIO
+import mmap
+from typing import Optional, Tuple, Union, TYPE_CHECKING
+from config import Config
+from utils.image_utils import ImageUtils
+
+# PIL和NumPy在首次使用时导入，缩短服务启动时间
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL import Image
+
+# 矩形区域(左, 上, 右, 下)，右、下为开区间（与PIL的crop一致）
+Box = Tuple[int, int, int, int]
+
+class RoiUtils:
+    @staticmethod
+    def parse_box(value: str) -> Box:
+        """解析roi参数“x,y,宽,高”（像素）为(左, 上, 右, 下)，格式无效时抛出ValueError"""
+        try:
+            x, y, width, height = (int(part) for part in value.split(","))
+        except ValueError:
+            raise ValueError("roi格式必须为“x,y,宽,高”（整数像素）")
+        if x < 0 or y < 0 or width <= 0 or height <= 0:
+            raise ValueError("roi的x、y不能为负数，宽、高必须大于0")
+        return x, y, x + width, y + height
+    
+    @staticmethod
+    def expand_box(box: Box, width: int, height: int,
+                   padding_ratio: float = Config.ROI_PADDING_RATIO,
+                   min_padding: int = Config.ROI_MIN_PADDING,
+                   min_edge: int = Config.ROI_MIN_CROP_EDGE) -> Tuple[Box, int]:
+        """编辑区域四周加上边距得到裁剪区域，边长不足min_edge时对称扩展，超出图片时向内平移后截断；
+        返回裁剪区域和边距（像素）"""
+        left, top, right, bottom = box
+        padding = max(min_padding, round(max(right - left, bottom - top) * padding_ratio))
+        crop = [left - padding, top - padding, right + padding, bottom + padding]
+        for low, high, limit in ((0, 2, width), (1, 3, height)):
+            extra = min(min_edge, limit) - (crop[high] - crop[low])
+            if extra > 0:
+                crop[low] -= extra // 2
+                crop[high] += extra - extra // 2
+            if crop[low] < 0:
+                crop[high] -= crop[low]
+                crop[low] = 0
+            if crop[high] > limit:
+                crop[low] = max(0, crop[low] - (crop[high] - limit))
+                crop[high] = limit
+        return (crop[0], crop[1], crop[2], crop[3]), padding
+    
+    @staticmethod
+    def load_mask(mask_data: Union[bytes, mmap.mmap], size: Tuple[int, int]) -> "Image.Image":
+        """读取遮罩为灰度图（白色为编辑区域），尺寸与原图不同时拉伸到原图尺寸"""
+        from PIL import Image, ImageOps
+        with Image.open(ImageUtils.open_buffer(mask_data)) as mask:
+            mask = ImageOps.exif_transpose(mask).convert("L")
+        if mask.size != size:
+            mask = mask.resize(size, Image.Resampling.BILINEAR)
+        return mask
+    
+    @staticmethod
+    def crop(data: Union[bytes, mmap.mmap, str], box: Optional[Box] = None,
+             mask_data: Optional[bytes] = None) -> Tuple[bytes, Box, Box, int, Tuple[int, int]]:
+        """裁剪局部编辑的输入：编辑区域为box，提供遮罩时为遮罩覆盖范围（与box取交集），坐标按应用EXIF方向后的原图计算；
+        返回裁剪后的图片（有透明通道为PNG，否则为JPEG）、编辑区域、裁剪区域、边距和原图尺寸，区域无效时抛出ValueError"""
+        from PIL import Image, ImageOps
+        with Image.open(data if isinstance(data, str) else ImageUtils.open_buffer(data)) as source:
+            image = ImageOps.exif_transpose(source)
+            width, height = image.size
+            edit_box = (0, 0, width, height) if box is None else box
+            if mask_data is not None:
+                # 忽略边缘抗锯齿和缩放产生的浅灰像素
+                bbox = RoiUtils.load_mask(mask_data, image.size).point(lambda value: 255 if value >= 128 else 0).getbbox()
+                if bbox is None:
+                    raise ValueError("遮罩中没有编辑区域（白色部分）")
+                edit_box = (max(edit_box[0], bbox[0]), max(edit_box[1], bbox[1]),
+                            min(edit_box[2], bbox[2]), min(edit_box[3], bbox[3]))
+            edit_box = (max(edit_box[0], 0), max(edit_box[1], 0), min(edit_box[2], width), min(edit_box[3], height))
+            if edit_box[0] >= edit_box[2] or edit_box[1] >= edit_box[3]:
+                raise ValueError(f"编辑区域超出图片范围（{width}x{height}）或与遮罩不相交")
+            
+            crop_box, padding = RoiUtils.expand_box(edit_box, width, height)
+            region = image.crop(crop_box)
+            buffered = BytesIO()
+            if region.mode in ("RGBA", "LA", "PA") or "transparency" in region.info:
+                region.save(buffered, format="PNG")
+            else:
+                region.convert("RGB").save(buffered, format="JPEG", quality=Config.ROI_OUTPUT_QUALITY)
+            return buffered.getvalue(), edit_box, crop_box, padding, (width, height)
+    
+    @staticmethod
+    def feather_alpha(edit_box: Box, crop_box: Box, padding: int) -> "np.ndarray":
+        """裁剪区域内的合成权重：编辑区域内为1，向外在padding像素内线性降到0（裁剪区域边缘为0，不产生接缝）"""
+        import numpy as np
+        padding = max(padding, 1)
+        
+        def ramp(start: int, stop: int, low: int, high: int) -> "np.ndarray":
+            coords = np.arange(start, stop, dtype=np.float32)
+            distance = np.maximum(np.maximum(low - coords, coords - (high - 1)), 0)
+            return np.clip(1 - distance / padding, 0, 1)
+        
+        # 行、列权重取外积最小值，整块区域一次计算
+        return np.minimum.outer(ramp(crop_box[1], crop_box[3], edit_box[1], edit_box[3]),
+                                ramp(crop_box[0], crop_box[2], edit_box[0], edit_box[2]))
+    
+    @staticmethod
+    def composite(original: Union[bytes, mmap.mmap, str], edited: bytes, edit_box: Box, crop_box: Box, padding: int,
+                  mask_data: Optional[bytes] = None, quality: int = Config.ROI_OUTPUT_QUALITY) -> bytes:
+        """把上游返回的裁剪区域编辑结果缩放到裁剪尺寸，按羽化权重（有遮罩时乘以模糊后的遮罩）与原图逐像素混合，
+        返回完整分辨率的合成结果（保持原图格式和ICC配置，JPEG/WEBP使用quality）"""
+        import numpy as np
+        from PIL import Image, ImageFilter, ImageOps
+        with Image.open(original if isinstance(original, str) else ImageUtils.open_buffer(original)) as source:
+            format = source.format
+            icc_profile = source.info.get("icc_profile")
+            has_alpha = source.mode in ("RGBA", "LA", "PA") or "transparency" in source.info
+            mode = "RGBA" if has_alpha else "RGB"
+            base = ImageOps.exif_transpose(source).convert(mode)
+        
+        crop_size = (crop_box[2] - crop_box[0], crop_box[3] - crop_box[1])
+        with Image.open(BytesIO(edited)) as result:
+            result = result.convert(mode)
+        if result.size != crop_size:
+            result = result.resize(crop_size, Image.Resampling.LANCZOS)
+        
+        alpha = RoiUtils.feather_alpha(edit_box, crop_box, padding)
+        if mask_data is not None:
+            mask = RoiUtils.load_mask(mask_data, base.size).crop(crop_box)
+            mask = mask.filter(ImageFilter.GaussianBlur(max(padding / 4, 1)))
+            alpha *= np.asarray(mask, dtype=np.float32) / 255
+        
+        region = np.asarray(base.crop(crop_box), dtype=np.float32)
+        blended = region + (np.asarray(result, dtype=np.float32) - region) * alpha[..., None]
+        base.paste(Image.fromarray(np.clip(np.rint(blended), 0, 255).astype(np.uint8)), crop_box[:2])
+        
+        save_kwargs = {}
+        if format in ("JPEG", "MPO") and not has_alpha:
+            format = "JPEG"
+            save_kwargs["quality"] = quality
+        elif format == "WEBP":
+            save_kwargs["quality"] = quality
+        else:
+            format = "PNG"
+        if icc_profile:
+            save_kwargs["icc_profile"] = icc_profile
+        buffered = BytesIO()
+        base.save(buffered, format=format, **save_kwargs)
+        return buffered.getvalue()
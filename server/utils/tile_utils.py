@@ -0,0 +1,244 @@
+import math
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+from io import BytesIO
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Sequence, Tuple, TYPE_CHECKING
+from config import Config
+from utils.roi_utils import Box
+
+# PIL和NumPy在首次使用时导入，缩短服务启动时间
+if TYPE_CHECKING:
+    import numpy as np
+
+EXIF_ORIENTATION_TAG = 0x0112
+# EXIF方向 -> (PIL变换, 行带在输出中是否变为列, 行带在输出中的位置是否反向)
+EXIF_TRANSPOSES = {
+    2: ("FLIP_LEFT_RIGHT", False, False),
+    3: ("ROTATE_180", False, True),
+    4: ("FLIP_TOP_BOTTOM", False, True),
+    5: ("TRANSPOSE", True, False),
+    6: ("ROTATE_270", True, True),
+    7: ("TRANSVERSE", True, True),
+    8: ("ROTATE_90", True, False)
+}
+
+@dataclass(frozen=True)
+class TileGrid:
+    """分块网格：原图尺寸、分块尺寸和各行/列分块的起点（相邻分块重叠，均匀分布）"""
+    width: int
+    height: int
+    tile_width: int
+    tile_height: int
+    xs: Tuple[int, ...]
+    ys: Tuple[int, ...]
+    
+    @property
+    def count(self) -> int:
+        return len(self.xs) * len(self.ys)
+    
+    @property
+    def boxes(self) -> List[Box]:
+        """按行优先排列的分块区域"""
+        return [(x, y, x + self.tile_width, y + self.tile_height) for y in self.ys for x in self.xs]
+
+class TileUtils:
+    @staticmethod
+    def count_tiles(length: int, tile: int, overlap: int) -> int:
+        """一个方向上覆盖length所需的分块数（相邻分块至少重叠overlap像素）"""
+        if length <= tile:
+            return 1
+        return math.ceil((length - overlap) / (tile - overlap))
+    
+    @staticmethod
+    def starts(length: int, tile: int, count: int) -> Tuple[int, ...]:
+        """一个方向上均匀分布的分块起点，首尾分块贴齐图片边缘"""
+        if count == 1:
+            return (0,)
+        return tuple(round(i * (length - tile) / (count - 1)) for i in range(count))
+    
+    @staticmethod
+    def plan(width: int, height: int, sizes: Sequence[Tuple[int, int]],
+             overlap: int = Config.TILE_OVERLAP) -> TileGrid:
+        """在模型的可用尺寸中选择分块数最少的尺寸（相同时选面积较大的），得到分块网格；
+        图片某一边小于分块尺寸时该方向只有一块，分块尺寸截断为图片尺寸"""
+        def grid_count(size: Tuple[int, int]) -> Tuple[int, int]:
+            tile_width, tile_height = size
+            count = TileUtils.count_tiles(width, tile_width, overlap) * TileUtils.count_tiles(height, tile_height, overlap)
+            return count, -tile_width * tile_height
+        
+        tile_width, tile_height = min(sizes, key=grid_count)
+        tile_width, tile_height = min(tile_width, width), min(tile_height, height)
+        return TileGrid(
+            width=width, height=height, tile_width=tile_width, tile_height=tile_height,
+            xs=TileUtils.starts(width, tile_width, TileUtils.count_tiles(width, tile_width, overlap)),
+            ys=TileUtils.starts(height, tile_height, TileUtils.count_tiles(height, tile_height, overlap))
+        )
+    
+    @staticmethod
+    def nearest_size(width: int, height: int, sizes: Sequence[Tuple[int, int]]) -> Tuple[int, int]:
+        """宽高比与分块最接近的可用尺寸（分块被截断为图片尺寸时，支持image_size的模型按此尺寸生成后再缩放回分块尺寸）"""
+        return min(sizes, key=lambda size: abs(math.log(size[0] / size[1]) - math.log(width / height)))
+    
+    @staticmethod
+    def axis_weights(length: int, starts: Sequence[int], tile: int) -> "np.ndarray":
+        """一个方向上各分块的融合权重（分块数×length）：从分块中部向有相邻分块的边缘线性减小，贴齐图片边缘的一侧不减小；
+        按坐标归一化后任意位置各分块权重之和为1（只在重叠区域内渐变），行列权重的外积即为二维权重"""
+        import numpy as np
+        coords = np.arange(length, dtype=np.float32) + 0.5
+        weights = np.zeros((len(starts), length), dtype=np.float32)
+        for i, start in enumerate(starts):
+            end = start + tile
+            # 到需要过渡的分块边缘的距离（贴齐图片边缘的一侧视为无穷远）
+            left = coords - start if start > 0 else np.inf
+            right = end - coords if end < length else np.inf
+            ramp = np.minimum(left, right) / max(tile / 2, 1)
+            weights[i, start:end] = np.clip(ramp, 1e-3, 1)[start:end]
+        return weights / weights.sum(axis=0)
+    
+    @staticmethod
+    def unpack(source_path: str, raw_path: str, band_rows: int = Config.TILE_BAND_ROWS) -> Tuple[int, int, str, Optional[bytes]]:
+        """解码原图并按行带写入磁盘上的RGB数组（.npy，之后按分块内存映射读取）；EXIF方向和透明部分合成到白色背景都按行带处理，
+        除解码后的原图外不产生整张图片的副本。返回宽、高（应用EXIF方向后）、原图格式和ICC配置"""
+        import numpy as np
+        from PIL import Image
+        with Image.open(source_path) as source:
+            format = source.format
+            icc_profile = source.info.get("icc_profile")
+            orientation = source.getexif().get(EXIF_ORIENTATION_TAG, 1)
+            transpose, columns, reverse = EXIF_TRANSPOSES.get(orientation, (None, False, False))
+            has_alpha = source.mode in ("RGBA", "LA", "PA") or "transparency" in source.info
+            source_width, source_height = source.size
+            width, height = (source_height, source_width) if columns else (source_width, source_height)
+            raw = np.lib.format.open_memmap(raw_path, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+            for top in range(0, source_height, band_rows):
+                bottom = min(top + band_rows, source_height)
+                band = source.crop((0, top, source_width, bottom))
+                if has_alpha:
+                    rgba = band.convert("RGBA")
+                    band = Image.new("RGB", rgba.size, (255, 255, 255))
+                    band.paste(rgba, mask=rgba.getchannel("A"))
+                elif band.mode != "RGB":
+                    band = band.convert("RGB")
+                if transpose is not None:
+                    band = band.transpose(getattr(Image.Transpose, transpose))
+                # 行带在输出中的位置：旋转90度时为若干列，翻转时从另一端开始
+                low, high = (source_height - bottom, source_height - top) if reverse else (top, bottom)
+                if columns:
+                    raw[:, low:high] = np.asarray(band)
+                else:
+                    raw[low:high] = np.asarray(band)
+            raw.flush()
+            del raw
+        return width, height, format, icc_profile
+    
+    @staticmethod
+    def read_tile(raw_path: str, box: Box, format: str = "JPEG", quality: int = 92) -> bytes:
+        """从磁盘上的RGB数组读取一个分块并编码（只有该分块读入内存）"""
+        import numpy as np
+        from PIL import Image
+        raw = np.load(raw_path, mmap_mode="r")
+        tile = Image.fromarray(np.ascontiguousarray(raw[box[1]:box[3], box[0]:box[2]]))
+        buffered = BytesIO()
+        save_kwargs = {"quality": quality} if format in ("JPEG", "WEBP") else {}
+        tile.save(buffered, format=format, **save_kwargs)
+        return buffered.getvalue()
+    
+    @staticmethod
+    def store_tile(result: bytes, tile_path: str, size: Tuple[int, int]) -> None:
+        """解码上游返回的分块结果，缩放到分块尺寸后写入磁盘（.npy）"""
+        import numpy as np
+        from PIL import Image
+        with Image.open(BytesIO(result)) as image:
+            tile = image.convert("RGB")
+        if tile.size != size:
+            tile = tile.resize(size, Image.Resampling.LANCZOS)
+        np.save(tile_path, np.asarray(tile))
+    
+    @staticmethod
+    def blend(grid: TileGrid, tile_paths: Sequence[str],
+              band_rows: int = Config.TILE_BAND_ROWS) -> Iterator[Tuple[int, "np.ndarray"]]:
+        """按行带融合分块结果，依次产出(起始行, RGB行带)：每个行带只读取与其相交的分块部分（内存映射），
+        按行列权重的外积加权求和；tile_paths与grid.boxes顺序一致"""
+        import numpy as np
+        weights_x = TileUtils.axis_weights(grid.width, grid.xs, grid.tile_width)
+        weights_y = TileUtils.axis_weights(grid.height, grid.ys, grid.tile_height)
+        tiles = [np.load(path, mmap_mode="r") for path in tile_paths]
+        for top in range(0, grid.height, band_rows):
+            bottom = min(top + band_rows, grid.height)
+            band = np.zeros((bottom - top, grid.width, 3), dtype=np.float32)
+            for row, y in enumerate(grid.ys):
+                low, high = max(top, y), min(bottom, y + grid.tile_height)
+                if low >= high:
+                    continue
+                for column, x in enumerate(grid.xs):
+                    right = x + grid.tile_width
+                    weight = np.multiply.outer(weights_y[row, low:high], weights_x[column, x:right])
+                    tile = tiles[row * len(grid.xs) + column]
+                    band[low - top:high - top, x:right] += tile[low - y:high - y] * weight[..., None]
+            # 原地取整和截断，避免与行带同样大小的临时数组
+            np.rint(band, out=band)
+            np.clip(band, 0, 255, out=band)
+            yield top, band.astype(np.uint8)
+    
+    @staticmethod
+    def write_png(file: BinaryIO, width: int, height: int, bands: Iterable[Tuple[int, "np.ndarray"]],
+                  icc_profile: Optional[bytes] = None, compress_level: int = 6) -> None:
+        """按行带编码RGB PNG（每行使用Sub过滤），只有当前行带及其压缩结果在内存中"""
+        import numpy as np
+        
+        def write_chunk(kind: bytes, data: bytes) -> None:
+            # 分段写入并增量计算CRC，不拼接压缩数据
+            file.write(struct.pack(">I", len(data)) + kind)
+            file.write(data)
+            file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+        
+        file.write(b"\x89PNG\r\n\x1a\n")
+        write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        if icc_profile:
+            write_chunk(b"iCCP", b"ICC Profile\x00\x00" + zlib.compress(icc_profile))
+        compressor = zlib.compressobj(compress_level)
+        for _, band in bands:
+            pixels = band.reshape(len(band), width * 3)
+            rows = np.empty((len(band), width * 3 + 1), dtype=np.uint8)
+            # 每行首字节为过滤类型，Sub过滤的每个字节减去左侧像素的同一通道（按256取模）
+            rows[:, 0] = 1
+            rows[:, 1:4] = pixels[:, :3]
+            np.subtract(pixels[:, 3:], pixels[:, :-3], out=rows[:, 4:])
+            data = compressor.compress(rows)
+            if data:
+                write_chunk(b"IDAT", data)
+        write_chunk(b"IDAT", compressor.flush())
+        write_chunk(b"IEND", b"")
+    
+    @staticmethod
+    def assemble(grid: TileGrid, tile_paths: Sequence[str], output_path: str, format: Optional[str] = None,
+                 icc_profile: Optional[bytes] = None, quality: int = Config.TILE_OUTPUT_QUALITY,
+                 band_rows: int = Config.TILE_BAND_ROWS) -> str:
+        """按行带拼接分块结果并编码写入output_path，返回输出格式（原图为JPEG/WEBP时保持格式，否则为PNG）：
+        PNG逐行带压缩写入；JPEG/WEBP的行带先写入磁盘上的RGBX数组，编码器直接读取其内存映射，不在内存中组装整张图片"""
+        import numpy as np
+        from PIL import Image
+        bands = TileUtils.blend(grid, tile_paths, band_rows)
+        if format not in ("JPEG", "MPO", "WEBP"):
+            with open(output_path, "wb") as f:
+                TileUtils.write_png(f, grid.width, grid.height, bands, icc_profile)
+            return "PNG"
+        
+        format = "WEBP" if format == "WEBP" else "JPEG"
+        canvas_path = f"{output_path}.rgbx"
+        canvas = np.memmap(canvas_path, dtype=np.uint8, mode="w+", shape=(grid.height, grid.width, 4))
+        try:
+            for top, band in bands:
+                canvas[top:top + len(band), :, :3] = band
+            # RGBX与PIL内部的RGB布局相同，frombuffer直接使用内存映射而不复制
+            output = Image.frombuffer("RGBX", (grid.width, grid.height), canvas, "raw", "RGBX", 0, 1)
+            save_kwargs = {"quality": quality}
+            if icc_profile:
+                save_kwargs["icc_profile"] = icc_profile
+            output.save(output_path, format=format, **save_kwargs)
+            del output, canvas
+        finally:
+            os.remove(canvas_path)
+        return format